@@ -14,16 +14,19 @@ from datetime import timedelta
 from accounts.models import User, UserProfile
 from subscriptions.models import ProviderSubscriptionPlan, ProviderSubscription, SubscriptionUsage
 from payments.models import Payment, PaymentItem
+from config_generator.template_cache import render_config_template
+from config_generator.blobs import store_blob
 from config_generator.models import MikroTikModel, VoucherType, BandwidthProfile, ConfigTemplate, GeneratedConfig
 from billing_templates.models import BillingTemplate
+from hotspot_config.admission import admission_controller
 
 # Import serializers
 from accounts.serializers import UserSerializer, UserProfileSerializer
 from subscriptions.serializers import ProviderSubscriptionPlanSerializer, ProviderSubscriptionSerializer
-from payments.serializers import PaymentSerializer, PaymentItemSerializer
+from payments.serializers import PaymentListSerializer, PaymentItemSerializer
 from config_generator.serializers import (
     MikroTikModelSerializer, VoucherTypeSerializer, BandwidthProfileSerializer,
-    ConfigTemplateSerializer, GeneratedConfigSerializer, ConfigGenerationSerializer
+    ConfigTemplateListSerializer, GeneratedConfigListSerializer, ConfigGenerationSerializer
 )
 from billing_templates.serializers import BillingTemplateListSerializer, BillingTemplateConfigDataSerializer
 
@@ -96,12 +99,12 @@ class UserStatsView(APIView):
             subscription_data = None
         
         # User payment history
-        payments = Payment.objects.filter(user=user).order_by('-created_at')[:10]
-        payment_data = PaymentSerializer(payments, many=True).data
+        payments = PaymentListSerializer.setup_queryset(Payment.objects.filter(user=user)).order_by('-created_at')[:10]
+        payment_data = PaymentListSerializer(payments, many=True).data
         
-        # User generated configs
-        configs = GeneratedConfig.objects.filter(user=user).order_by('-created_at')[:10]
-        config_data = GeneratedConfigSerializer(configs, many=True).data
+        # User generated configs (summaries; bodies load only in preview/download)
+        configs = GeneratedConfigListSerializer.setup_queryset(GeneratedConfig.objects.filter(user=user)).order_by('-created_at')[:10]
+        config_data = GeneratedConfigListSerializer(configs, many=True).data
         
         # Usage statistics
         try:
@@ -155,21 +158,25 @@ class PublicBandwidthProfilesView(generics.ListAPIView):
 
 class PublicTemplatesView(generics.ListAPIView):
     """Public config templates (no authentication required)"""
-    queryset = ConfigTemplate.objects.filter(is_active=True)
-    serializer_class = ConfigTemplateSerializer
+    queryset = ConfigTemplateListSerializer.setup_queryset(ConfigTemplate.objects.filter(is_active=True))
+    serializer_class = ConfigTemplateListSerializer
     permission_classes = [permissions.AllowAny]
 
 
 class PublicBillingTemplatesView(generics.ListAPIView):
     """Public billing templates (no authentication required)"""
-    queryset = BillingTemplate.objects.filter(is_active=True).order_by('sort_order', 'price')
+    queryset = BillingTemplateListSerializer.setup_queryset(
+        BillingTemplate.objects.filter(is_active=True).order_by('sort_order', 'price')
+    )
     serializer_class = BillingTemplateListSerializer
     permission_classes = [permissions.AllowAny]
 
 
 class PopularBillingTemplatesView(generics.ListAPIView):
     """Popular billing templates (no authentication required)"""
-    queryset = BillingTemplate.objects.filter(is_active=True, is_popular=True).order_by('sort_order', 'price')
+    queryset = BillingTemplateListSerializer.setup_queryset(
+        BillingTemplate.objects.filter(is_active=True, is_popular=True).order_by('sort_order', 'price')
+    )
     serializer_class = BillingTemplateListSerializer
     permission_classes = [permissions.AllowAny]
 
@@ -187,7 +194,8 @@ def api_health_check(request):
             'authentication': 'active',
             'payments': 'ready',
             'config_generation': 'ready',
-        }
+        },
+        'load': admission_controller.snapshot(),
     })
 
 
@@ -239,7 +247,9 @@ def user_dashboard_data(request):
         }
     
     # Get recent payments
-    recent_payments = Payment.objects.filter(user=user).order_by('-created_at')[:5]
+    recent_payments = Payment.objects.filter(user=user).only(
+        'id', 'amount', 'currency', 'status', 'created_at', 'description'
+    ).order_by('-created_at')[:5]
     payments_data = []
     for payment in recent_payments:
         payments_data.append({
@@ -252,7 +262,9 @@ def user_dashboard_data(request):
         })
     
     # Get recent generated configs
-    recent_configs = GeneratedConfig.objects.filter(user=user).order_by('-created_at')[:5]
+    recent_configs = GeneratedConfig.objects.filter(user=user).only(
+        'id', 'config_name', 'hotspot_name', 'created_at'
+    ).order_by('-created_at')[:5]
     configs_data = []
     for config in recent_configs:
         configs_data.append({
@@ -343,9 +355,7 @@ def generate_config_api(request):
     
     # Generate config using Jinja2
     try:
-        from jinja2 import Template
-        jinja_template = Template(template.template_content)
-        config_content = jinja_template.render(**context)
+        config_content = render_config_template(template, context)
     except Exception as e:
         return Response(
             {'error': f'Template rendering failed: {str(e)}'}, 
@@ -358,7 +368,7 @@ def generate_config_api(request):
         template=template,
         billing_template=billing_template,
         config_name=data['config_name'],
-        config_content=config_content,
+        blob=store_blob(config_content),
         hotspot_name=data['hotspot_name'],
         hotspot_ip=data['hotspot_ip'],
         dns_servers=data['dns_servers'],
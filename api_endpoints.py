@@ -15,6 +15,8 @@ from accounts.models import Provider
 from payments.pesapal_provider import ProviderSubscriptionService
 from payments.mpesa_daraja import CustomerPaymentService
 from subscriptions.models import ProviderSubscriptionPlan
+from payments.webhooks import record_webhook, record_pesapal_webhook, mpesa_dedup_key
+from payments.idempotency import idempotent_payment, get_request_data, normalize_phone
 
 logger = logging.getLogger(__name__)
 
@@ -78,27 +80,20 @@ def pesapal_callback(request):
         if not order_tracking_id:
             return JsonResponse({'error': 'Order tracking ID required'}, status=400)
         
-        # Handle payment callback
-        subscription_service = ProviderSubscriptionService()
-        success, message = subscription_service.handle_pesapal_webhook({
+        # Activation happens in the webhook workers once Pesapal confirms the payment
+        payload = {
             'order_tracking_id': order_tracking_id,
             'payment_method': payment_method,
             'payment_account': payment_account,
-            'payment_status': 'COMPLETED'  # Assume success for redirect
-        })
+            'OrderNotificationType': 'CALLBACK'
+        }
+        record_pesapal_webhook(payload)
         
-        if success:
-            return JsonResponse({
-                'success': True,
-                'message': 'Payment successful! Your subscription is now active.',
-                'redirect_url': '/provider/dashboard/'
-            })
-        else:
-            return JsonResponse({
-                'success': False,
-                'error': message,
-                'redirect_url': '/subscriptions/plans/'
-            })
+        return JsonResponse({
+            'success': True,
+            'message': 'Payment received! Your subscription will be activated once Pesapal confirms it.',
+            'redirect_url': '/provider/dashboard/'
+        })
             
     except Exception as e:
         logger.error(f"Pesapal callback error: {e}")
@@ -117,16 +112,9 @@ def pesapal_webhook(request):
     try:
         webhook_data = json.loads(request.body)
         
-        # Handle webhook
-        subscription_service = ProviderSubscriptionService()
-        success, message = subscription_service.handle_pesapal_webhook(webhook_data)
-        
-        if success:
-            logger.info(f"Pesapal webhook processed successfully: {message}")
-            return JsonResponse({'status': 'success'})
-        else:
-            logger.warning(f"Pesapal webhook failed: {message}")
-            return JsonResponse({'status': 'failed', 'error': message})
+        # Store and acknowledge; the webhook workers process it
+        record_pesapal_webhook(webhook_data)
+        return JsonResponse({'status': 'success'})
             
     except Exception as e:
         logger.error(f"Pesapal webhook error: {e}")
@@ -181,8 +169,14 @@ def subscription_status(request, provider_id):
 # M-PESA CUSTOMER PAYMENT ENDPOINTS
 # =============================================================================
 
+def _customer_payment_identity(request, provider_id):
+    """Identify a customer payment for deduplicating repeated Pay taps"""
+    data = get_request_data(request)
+    return (provider_id, normalize_phone(data.get('phone_number')), data.get('amount'), data.get('plan_name', 'WiFi Access'))
+
 @csrf_exempt
 @require_http_methods(["POST"])
+@idempotent_payment('captive_initiate_mpesa', _customer_payment_identity)
 def initiate_mpesa_payment(request, provider_id):
     """
     POST /api/captive/{provider_id}/initiate-mpesa
@@ -250,30 +244,9 @@ def mpesa_callback(request, provider_id):
     try:
         callback_data = json.loads(request.body)
         
-        # Handle Daraja callback
-        payment_service = CustomerPaymentService()
-        success, result = payment_service.handle_daraja_callback(provider_id, callback_data)
-        
-        if success:
-            # Return ticket information
-            ticket = result
-            return JsonResponse({
-                'success': True,
-                'ticket': {
-                    'code': ticket.code,
-                    'username': ticket.username,
-                    'password': ticket.password,
-                    'expires_at': ticket.expires_at.isoformat(),
-                    'plan_type': ticket.plan_type,
-                    'duration_hours': ticket.duration_hours,
-                    'data_limit_mb': ticket.data_limit_mb
-                }
-            })
-        else:
-            return JsonResponse({
-                'success': False,
-                'error': result
-            })
+        # Store and acknowledge; the webhook workers issue the ticket
+        record_webhook('mpesa_stk', callback_data, mpesa_dedup_key(provider_id, callback_data), provider_id=provider_id)
+        return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
             
     except Exception as e:
         logger.error(f"M-PESA callback error: {e}")
@@ -44,6 +44,11 @@ class BillingTemplateListSerializer(serializers.ModelSerializer):
             'is_active', 'is_popular', 'sort_order',
             'bandwidth_display'
         ]
+    
+    @classmethod
+    def setup_queryset(cls, queryset):
+        """Load only the columns the listed fields and display properties read"""
+        return queryset.only(*(field for field in cls.Meta.fields if not field.endswith('_display')))
 
 
 class BillingTemplateUsageSerializer(serializers.ModelSerializer):
@@ -59,6 +64,12 @@ class BillingTemplateUsageSerializer(serializers.ModelSerializer):
             'generated_config', 'used_at'
         ]
         read_only_fields = ['used_at']
+    
+    @staticmethod
+    def setup_queryset(queryset):
+        return queryset.select_related('template', 'user').only(
+            'id', 'template', 'template__name', 'user', 'user__email', 'generated_config', 'used_at'
+        )
 
 
 class BillingTemplateCategorySerializer(serializers.ModelSerializer):
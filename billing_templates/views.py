@@ -21,7 +21,9 @@ from .serializers import (
 
 class BillingTemplateListView(generics.ListAPIView):
     """List all active billing templates"""
-    queryset = BillingTemplate.objects.filter(is_active=True).order_by('sort_order', 'price')
+    queryset = BillingTemplateListSerializer.setup_queryset(
+        BillingTemplate.objects.filter(is_active=True).order_by('sort_order', 'price')
+    )
     serializer_class = BillingTemplateListSerializer
     permission_classes = [permissions.AllowAny]  # Public endpoint
 
@@ -42,7 +44,9 @@ class BillingTemplateWithCategoriesView(generics.RetrieveAPIView):
 
 class PopularBillingTemplatesView(generics.ListAPIView):
     """Get popular billing templates"""
-    queryset = BillingTemplate.objects.filter(is_active=True, is_popular=True).order_by('sort_order', 'price')
+    queryset = BillingTemplateListSerializer.setup_queryset(
+        BillingTemplate.objects.filter(is_active=True, is_popular=True).order_by('sort_order', 'price')
+    )
     serializer_class = BillingTemplateListSerializer
     permission_classes = [permissions.AllowAny]  # Public endpoint
 
@@ -61,10 +65,10 @@ class BillingTemplateByCategoryView(generics.ListAPIView):
     
     def get_queryset(self):
         category_id = self.kwargs.get('category_id')
-        return BillingTemplate.objects.filter(
+        return BillingTemplateListSerializer.setup_queryset(BillingTemplate.objects.filter(
             is_active=True,
             category_assignments__category_id=category_id
-        ).order_by('sort_order', 'price')
+        ).order_by('sort_order', 'price'))
 
 
 class BillingTemplateStatsView(APIView):
@@ -128,9 +132,10 @@ class BillingTemplateUsageView(generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return BillingTemplateUsage.objects.filter(
+        # The config is only referenced by id, so its body is never loaded
+        return BillingTemplateUsageSerializer.setup_queryset(BillingTemplateUsage.objects.filter(
             user=self.request.user
-        ).select_related('template', 'generated_config').order_by('-used_at')
+        )).order_by('-used_at')
 
 
 class BillingTemplateConfigDataView(APIView):
@@ -209,7 +214,7 @@ class BillingTemplateSearchView(generics.ListAPIView):
     permission_classes = [permissions.AllowAny]  # Public endpoint
     
     def get_queryset(self):
-        queryset = BillingTemplate.objects.filter(is_active=True)
+        queryset = BillingTemplateListSerializer.setup_queryset(BillingTemplate.objects.filter(is_active=True))
         
         # Search parameters
         search = self.request.query_params.get('search', None)
@@ -1,15 +1,21 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse
-from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
+from django.http import JsonResponse, HttpResponse, HttpResponseNotAllowed, Http404
 from django.utils import timezone
-from django.db import transaction
+from asgiref.sync import sync_to_async
+from functools import wraps
 import json
 import logging
+import uuid
 
 from accounts.models import Provider
 from tickets.models import Ticket, TicketType, TicketUsage
+from payments.models import Payment
 from payments.payment_bucket import payment_bucket_service
+from payments.gateway_health import CircuitOpenError
+from payments.idempotency import idempotent_payment, get_request_data, normalize_phone
+from payments.c2b import order_code
+from payments.fulfilment import complete_payment
+from payments.latency import record_stage
 
 logger = logging.getLogger(__name__)
 
@@ -56,10 +62,90 @@ def captive_portal(request):
     
     return render(request, 'captive_portal/index.html', context)
 
-@csrf_exempt
-@require_http_methods(["POST"])
-def initiate_payment(request):
-    """Initiate M-PESA payment for ticket purchase"""
+def _purchase_identity(request):
+    """Identify a ticket purchase for deduplicating repeated Pay taps"""
+    data = get_request_data(request)
+    return (data.get('provider_id'), data.get('ticket_type_id'), normalize_phone(data.get('phone_number')))
+
+def async_post_view(view_func):
+    """
+    csrf_exempt + require_http_methods(["POST"]) for async views.
+
+    Django 4.2's versions wrap the view in a sync function, which would make
+    Django run it in a thread and get a coroutine back instead of a response.
+    """
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        return await view_func(request, *args, **kwargs)
+    wrapper.csrf_exempt = True
+    return wrapper
+
+def _remember_pending_payment(request, payment_data):
+    request.session['pending_payment'] = payment_data
+
+def _get_pending_payment(request):
+    return request.session.get('pending_payment')
+
+def _forget_pending_payment(request):
+    request.session.pop('pending_payment', None)
+
+def _msisdn(phone_number):
+    """Put a customer's phone number in the 2547... form Daraja expects"""
+    if phone_number.startswith('254'):
+        return phone_number
+    if phone_number.startswith('0'):
+        return '254' + phone_number[1:]
+    if phone_number.startswith('+254'):
+        return phone_number[1:]
+    return '254' + phone_number
+
+def _circuit_open_response(error):
+    logger.warning(f"Payment initiation rejected: {error}")
+    response = JsonResponse({
+        'success': False,
+        'message': 'M-PESA payments are temporarily unavailable. Please try again shortly.'
+    }, status=503)
+    response['Retry-After'] = str(int(error.retry_after) + 1)
+    return response
+
+async def _record_pending_payment(request, payment_id, provider, ticket_type, phone_number, result, initiated_at):
+    """Persist an accepted STK push so callbacks and the reconciliation sweeper can find it"""
+    await Payment.objects.acreate(
+        id=payment_id,
+        provider=provider,
+        ticket_type=ticket_type,
+        phone_number=phone_number,
+        amount=ticket_type.price,
+        currency=ticket_type.currency,
+        payment_method='mpesa',
+        description=f"WiFi Access - {ticket_type.name}",
+        mpesa_checkout_request_id=result.get('CheckoutRequestID'),
+        mpesa_merchant_request_id=result.get('MerchantRequestID'),
+        initiated_at=initiated_at,
+        stk_accepted_at=timezone.now(),
+    )
+    
+    # Store payment reference in the session for callback handling
+    await sync_to_async(_remember_pending_payment)(request, {
+        'checkout_request_id': result.get('CheckoutRequestID'),
+        'merchant_request_id': result.get('MerchantRequestID'),
+        'provider_id': provider.id,
+        'ticket_type_id': ticket_type.id,
+        'phone_number': phone_number,
+        'amount': float(ticket_type.price),
+    })
+
+@async_post_view
+@idempotent_payment('captive_portal_initiate', _purchase_identity)
+async def initiate_payment(request):
+    """
+    Initiate M-PESA payment for ticket purchase
+
+    Async so that, under ASGI, waiting on Daraja does not hold a worker;
+    ORM and session access go through async queries or sync_to_async.
+    """
     try:
         data = json.loads(request.body)
         provider_id = data.get('provider_id')
@@ -74,46 +160,35 @@ def initiate_payment(request):
             }, status=400)
         
         # Get provider and ticket type
-        provider = get_object_or_404(Provider, id=provider_id, status='active')
-        ticket_type = get_object_or_404(TicketType, id=ticket_type_id, provider=provider, is_active=True)
+        provider = await Provider.objects.filter(id=provider_id, status='active').afirst()
+        ticket_type = None
+        if provider:
+            ticket_type = await TicketType.objects.filter(id=ticket_type_id, provider=provider, is_active=True).afirst()
+        if not ticket_type:
+            raise Http404('Provider or ticket type not found')
         
-        # Validate phone number format
-        if not phone_number.startswith('254'):
-            if phone_number.startswith('0'):
-                phone_number = '254' + phone_number[1:]
-            elif phone_number.startswith('+254'):
-                phone_number = phone_number[1:]
-            else:
-                phone_number = '254' + phone_number
+        phone_number = _msisdn(phone_number)
         
-        # Initiate STK Push
-        result = payment_bucket_service.initiate_stk_push(
+        # Initiate STK Push; the order code lets the customer pay the same order through the Paybill
+        initiated_at = timezone.now()
+        payment_id = uuid.uuid4()
+        result = await payment_bucket_service.ainitiate_stk_push(
             provider_id=provider.id,
             phone_number=phone_number,
             amount=int(ticket_type.price),
-            account_reference=f"WIFI_{ticket_type.id}",
+            account_reference=order_code(payment_id),
             transaction_desc=f"WiFi Access - {ticket_type.name}"
         )
         
         if result.get('ResponseCode') == '0':
-            # Store payment reference for callback
-            payment_data = {
-                'checkout_request_id': result.get('CheckoutRequestID'),
-                'merchant_request_id': result.get('MerchantRequestID'),
-                'provider_id': provider.id,
-                'ticket_type_id': ticket_type.id,
-                'phone_number': phone_number,
-                'amount': float(ticket_type.price),
-            }
-            
-            # Store in session for callback handling
-            request.session['pending_payment'] = payment_data
-            
+            await _record_pending_payment(request, payment_id, provider, ticket_type, phone_number, result, initiated_at)
             return JsonResponse({
                 'success': True,
                 'message': 'Payment initiated successfully',
                 'checkout_request_id': result.get('CheckoutRequestID'),
-                'customer_message': result.get('CustomerMessage')
+                'customer_message': result.get('CustomerMessage'),
+                'paybill': provider.mpesa_shortcode,
+                'account_number': order_code(payment_id)
             })
         else:
             return JsonResponse({
@@ -122,6 +197,8 @@ def initiate_payment(request):
                 'error_code': result.get('ResponseCode')
             }, status=400)
             
+    except CircuitOpenError as e:
+        return _circuit_open_response(e)
     except Exception as e:
         logger.error(f"Payment initiation failed: {e}")
         return JsonResponse({
@@ -129,9 +206,8 @@ def initiate_payment(request):
             'message': f'Payment failed: {str(e)}'
         }, status=500)
 
-@csrf_exempt
-@require_http_methods(["POST"])
-def check_payment_status(request):
+@async_post_view
+async def check_payment_status(request):
     """Check payment status"""
     try:
         data = json.loads(request.body)
@@ -144,7 +220,7 @@ def check_payment_status(request):
             }, status=400)
         
         # Get payment data from session
-        payment_data = request.session.get('pending_payment')
+        payment_data = await sync_to_async(_get_pending_payment)(request)
         if not payment_data or payment_data.get('checkout_request_id') != checkout_request_id:
             return JsonResponse({
                 'success': False,
@@ -152,30 +228,25 @@ def check_payment_status(request):
             }, status=400)
         
         # Query payment status
-        provider = get_object_or_404(Provider, id=payment_data['provider_id'])
-        result = payment_bucket_service.query_stk_push_status(
+        provider = await Provider.objects.filter(id=payment_data['provider_id']).afirst()
+        if not provider:
+            raise Http404('Provider not found')
+        result = await payment_bucket_service.aquery_stk_push_status(
             provider_id=provider.id,
             checkout_request_id=checkout_request_id
         )
         
-        if result.get('ResultCode') == '0':
+        if str(result.get('ResultCode')) == '0':
             # Payment successful - create ticket
-            ticket = create_ticket_from_payment(payment_data, provider)
+            ticket = await sync_to_async(_issue_ticket_details)(payment_data, provider)
             
             # Clear session
-            if 'pending_payment' in request.session:
-                del request.session['pending_payment']
+            await sync_to_async(_forget_pending_payment)(request)
             
             return JsonResponse({
                 'success': True,
                 'status': 'completed',
-                'ticket': {
-                    'code': ticket.code,
-                    'username': ticket.username,
-                    'password': ticket.password,
-                    'expires_at': ticket.expires_at.isoformat(),
-                    'type': ticket.ticket_type.get_display_name()
-                }
+                'ticket': ticket
             })
         else:
             return JsonResponse({
@@ -191,43 +262,29 @@ def check_payment_status(request):
             'message': f'Status check failed: {str(e)}'
         }, status=500)
 
+def _issue_ticket_details(payment_data, provider):
+    """Create the ticket for a paid checkout and get the details shown to the customer"""
+    ticket = create_ticket_from_payment(payment_data, provider)
+    return {
+        'code': ticket.code,
+        'username': ticket.username,
+        'password': ticket.password,
+        'expires_at': ticket.expires_at.isoformat(),
+        'type': ticket.ticket_type.get_display_name()
+    }
+
 def create_ticket_from_payment(payment_data, provider):
-    """Create ticket after successful payment"""
-    from tickets.models import TicketType, Ticket, TicketSale
+    """Create ticket after successful payment (returns the existing ticket on repeat calls)"""
+    payment = get_object_or_404(
+        Payment,
+        provider=provider,
+        mpesa_checkout_request_id=payment_data['checkout_request_id']
+    )
     
-    ticket_type = get_object_or_404(TicketType, id=payment_data['ticket_type_id'])
+    payment, ticket = complete_payment(payment.id)
     
-    with transaction.atomic():
-        # Create ticket
-        ticket = Ticket.objects.create(
-            provider=provider,
-            ticket_type=ticket_type,
-            payment=None,  # Will be linked later
-        )
-        
-        # Create sale record
-        TicketSale.objects.create(
-            provider=provider,
-            ticket_type=ticket_type,
-            ticket=ticket,
-            unit_price=ticket_type.price,
-            total_amount=payment_data['amount'],
-            payment_method='mpesa',
-            payment_reference=payment_data['checkout_request_id'],
-            status='completed'
-        )
-        
-        # Set expiry time
-        if ticket_type.type == 'time':
-            ticket.expires_at = timezone.now() + timezone.timedelta(hours=ticket_type.duration_hours)
-        else:
-            # For data-based tickets, set a reasonable expiry (e.g., 30 days)
-            ticket.expires_at = timezone.now() + timezone.timedelta(days=30)
-        
-        ticket.save()
-        
-        logger.info(f"Ticket created: {ticket.code} for provider {provider.business_name}")
-        return ticket
+    logger.info(f"Ticket created: {ticket.code} for provider {provider.business_name}")
+    return ticket
 
 def ticket_activation(request, ticket_code):
     """Activate ticket for internet access"""
@@ -253,6 +310,8 @@ def ticket_activation(request, ticket_code):
                 device_mac=device_mac,
                 device_ip=device_ip
             )
+            if ticket.payment_id:
+                record_stage(ticket.payment_id, 'first_login', ticket.session_start)
             
             return JsonResponse({
                 'success': True,
@@ -12,6 +12,7 @@ from datetime import datetime, timedelta
 from accounts.decorators import cashier_required, cashier_permission_required
 from accounts.models import Cashier
 from tickets.models import Ticket, TicketSale, TicketType
+from payments.ledger import post_ticket_sale
 from subscriptions.models import ProviderSubscription
 
 
@@ -149,6 +150,7 @@ def sell_tickets(request):
                 payment_method=payment_method,
                 status='completed'
             )
+            post_ticket_sale(sale)
             
             # Mark ticket as used
             ticket.status = 'used'
@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import MikroTikModel, VoucherType, BandwidthProfile, ConfigTemplate, GeneratedConfig
+from django.utils.html import format_html
+from .models import MikroTikModel, VoucherType, BandwidthProfile, ConfigTemplate, GeneratedConfig, ConfigBlob
 
 
 @admin.register(MikroTikModel)
@@ -54,7 +55,7 @@ class GeneratedConfigAdmin(admin.ModelAdmin):
     list_display = ('user', 'config_name', 'hotspot_name', 'voucher_type', 'bandwidth_profile', 'created_at')
     list_filter = ('voucher_type', 'bandwidth_profile', 'created_at')
     search_fields = ('user__email', 'config_name', 'hotspot_name')
-    readonly_fields = ('created_at',)
+    readonly_fields = ('created_at', 'blob', 'content')
     ordering = ('-created_at',)
     
     fieldsets = (
@@ -65,7 +66,7 @@ class GeneratedConfigAdmin(admin.ModelAdmin):
             'fields': ('dns_servers', 'voucher_type', 'bandwidth_profile', 'max_users', 'voucher_length', 'voucher_prefix')
         }),
         ('Generated Content', {
-            'fields': ('config_content',),
+            'fields': ('blob', 'content'),
             'classes': ('wide',)
         }),
         ('Timestamps', {
@@ -73,3 +74,22 @@ class GeneratedConfigAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
     )
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('config_content')
+    
+    @admin.display(description='Config content')
+    def content(self, obj):
+        return format_html('<pre>{}</pre>', obj.get_content())
+
+
+@admin.register(ConfigBlob)
+class ConfigBlobAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'size', 'compressed_size', 'created_at')
+    search_fields = ('sha256',)
+    readonly_fields = ('sha256', 'size', 'compressed_size', 'created_at')
+    exclude = ('data',)
+    ordering = ('-created_at',)
+    
+    def has_add_permission(self, request):
+        return False
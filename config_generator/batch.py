@@ -0,0 +1,184 @@
+"""
+Batch config generation for providers with many sites
+
+All sites of a batch share one template, voucher type and voucher settings;
+each site has its own hotspot name, IP, DNS servers and optionally its own
+bandwidth profile. Configs are rendered in a process pool (rendering and
+compressing are CPU-bound, so threads would serialise on the GIL). The pool
+is created once per web process and reused across requests. Its workers are
+spawned rather than forked, because forking a multi-threaded server process
+can copy a lock another thread holds and deadlock the child. Workers keep
+their own template cache, warmed from the on-disk bytecode cache. They return
+each body already hashed and gzip-compressed for blob storage.
+
+The blobs and GeneratedConfig rows of a batch are written with one bulk
+insert each, and the bodies are streamed back as a zip archive of .rsc files.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import re
+import threading
+import zipfile
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from .blobs import store_blobs
+from .models import GeneratedConfig
+from .render_worker import render_site, setup_worker
+
+logger = logging.getLogger(__name__)
+
+
+def site_context(site, voucher_type, bandwidth_profile, options, user):
+    """Get the template context for one site"""
+    return {
+        'hotspot_name': site['hotspot_name'],
+        'hotspot_ip': site['hotspot_ip'],
+        'dns_servers': site['dns_servers'].split(','),
+        'voucher_type': voucher_type,
+        'bandwidth_profile': bandwidth_profile,
+        'max_users': options['max_users'],
+        'voucher_length': options['voucher_length'],
+        'voucher_prefix': options.get('voucher_prefix', ''),
+        'user': user,
+    }
+
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def get_pool(workers):
+    """Get the process-wide render pool, recreating it if the worker count changed"""
+    global _pool, _pool_workers
+
+    with _pool_lock:
+        if _pool is not None and _pool_workers != workers:
+            _pool.shutdown(wait=False)
+            _pool = None
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=setup_worker
+            )
+            _pool_workers = workers
+        return _pool
+
+
+def _discard_pool(pool):
+    """Drop a crashed pool so the next batch starts a fresh one"""
+    global _pool
+
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def render_sites(template, contexts, workers=None):
+    """
+    Render a config for each context, in order.
+
+    Returns (content, sha256, size, gzip data) tuples. Single sites, or a
+    pool of one worker, are rendered in this process.
+    """
+    if workers is None:
+        workers = getattr(settings, 'CONFIG_BATCH_WORKERS', 2)
+    if workers <= 1 or len(contexts) <= 1:
+        return [render_site(template, context) for context in contexts]
+
+    pool = get_pool(workers)
+    chunksize = max(1, len(contexts) // (workers * 4))
+    try:
+        return list(pool.map(render_site, [template] * len(contexts), contexts, chunksize=chunksize))
+    except BrokenProcessPool:
+        logger.warning("Config render pool crashed; rendering the batch in-process")
+        _discard_pool(pool)
+        return [render_site(template, context) for context in contexts]
+
+
+def generate_batch(user, template, voucher_type, sites, options, bandwidth_profiles, workers=None):
+    """
+    Render and record a config for every site.
+
+    sites are dicts with config_name, hotspot_name, hotspot_ip, dns_servers
+    and bandwidth_profile_id; bandwidth_profiles maps those ids to profiles.
+    Returns [(GeneratedConfig, content)] in site order.
+    """
+    contexts = [
+        site_context(site, voucher_type, bandwidth_profiles[site['bandwidth_profile_id']], options, user)
+        for site in sites
+    ]
+    rendered = render_sites(template, contexts, workers=workers)
+
+    with transaction.atomic():
+        blob_ids = store_blobs([(digest, size, data) for _, digest, size, data in rendered])
+        configs = GeneratedConfig.objects.bulk_create([
+            GeneratedConfig(
+                user=user,
+                template=template,
+                config_name=site['config_name'],
+                blob_id=blob_ids[digest],
+                hotspot_name=site['hotspot_name'],
+                hotspot_ip=site['hotspot_ip'],
+                dns_servers=site['dns_servers'],
+                voucher_type=voucher_type,
+                bandwidth_profile=bandwidth_profiles[site['bandwidth_profile_id']],
+                max_users=options['max_users'],
+                voucher_length=options['voucher_length'],
+                voucher_prefix=options.get('voucher_prefix', ''),
+            )
+            for site, (_, digest, _, _) in zip(sites, rendered)
+        ])
+    logger.info(f"Generated {len(configs)} configs for {user.email} in one batch")
+    return [(config, content) for config, (content, _, _, _) in zip(configs, rendered)]
+
+
+def archive_names(names):
+    """Get a unique, path-safe .rsc file name for each config name"""
+    used = set()
+    result = []
+    for name in names:
+        base = re.sub(r'[^\w.-]+', '_', name).strip('._') or 'config'
+        filename = f"{base}.rsc"
+        counter = 2
+        while filename.lower() in used:
+            filename = f"{base}-{counter}.rsc"
+            counter += 1
+        used.add(filename.lower())
+        result.append(filename)
+    return result
+
+
+class _ZipBuffer:
+    """Write-only file object collecting what ZipFile writes until it is drained"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def zip_stream(files):
+    """Yield a zip archive of (file name, text) pairs piece by piece"""
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, content in files:
+            archive.writestr(name, content)
+            yield buffer.drain()
+    yield buffer.drain()
@@ -0,0 +1,223 @@
+"""
+Config generation benchmarks
+
+run_benchmarks() times every way this project renders RouterOS scripts:
+
+  - jinja: a ConfigTemplate rendered as generate_config does it
+    (site_context + the compiled template cache),
+  - generator / generator_cached: mikrotik_generator's advanced config
+    with an empty and with a warm section cache,
+  - hotspot_config: mikrotik_config's advanced hotspot config,
+  - ticket_profiles: generate_ticket_profiles alone,
+  - bulk_users: a voucher batch import script.
+
+Each case runs at increasing sizes (template rules, ticket types, or ten
+vouchers per unit). The providers, ticket types and templates it needs
+are created inside a transaction that is rolled back afterwards. The
+results give the median time, the peak traced memory and the output size
+per config. They can be saved as a JSON baseline, and a later run
+compared against it: a case slower or hungrier than its baseline by more
+than the tolerance is a regression. Timings are only comparable on the
+machine that recorded the baseline.
+"""
+from collections import namedtuple
+from statistics import median
+import json
+import time
+import tracemalloc
+import uuid
+import logging
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+
+from .batch import site_context
+from .mikrotik_config import MikroTikConfigGenerator as HotspotConfigGenerator
+from .mikrotik_generator import MikroTikConfigGenerator
+from .models import BandwidthProfile, ConfigTemplate, MikroTikModel, VoucherType
+from .sections import SectionCache
+from .template_cache import config_template_cache, render_config_template
+
+logger = logging.getLogger(__name__)
+
+SIZES = {'small': 10, 'medium': 100, 'large': 1000}
+
+SITE = {'hotspot_name': 'bench-site', 'hotspot_ip': '10.20.0.1', 'dns_servers': '8.8.8.8,1.1.1.1'}
+OPTIONS = {'max_users': 100, 'voucher_length': 8, 'voucher_prefix': 'BN'}
+
+VoucherRow = namedtuple('VoucherRow', 'code username password ticket_type_id')
+
+
+def template_source(rules):
+    """Get a Jinja config template with the given number of firewall rules"""
+    lines = [
+        '# Benchmark template for {{ hotspot_name }}',
+        '/system identity set name="{{ hotspot_name }}"',
+        '/ip address add address={{ hotspot_ip }}/24 interface=ether2',
+        '/ip dns set servers={{ dns_servers | join(",") }}',
+        '{% for dns in dns_servers %}/ip dns static add name=dns{{ loop.index }}.{{ hotspot_name }} address={{ dns }}',
+        '{% endfor %}/ip hotspot user profile add name=default '
+        'rate-limit={{ bandwidth_profile.download_speed }}/{{ bandwidth_profile.upload_speed }}',
+    ]
+    lines.extend(
+        f'/ip firewall filter add chain=forward action=accept src-address={{{{ hotspot_ip }}}}/32 '
+        f'dst-port={1000 + rule} comment="{{{{ hotspot_name }}}} rule {rule}"'
+        for rule in range(rules)
+    )
+    return '\n'.join(lines) + '\n'
+
+
+class BenchmarkSeed:
+    """Rows the cases generate from; create them inside a transaction that is rolled back"""
+
+    def __init__(self):
+        from accounts.models import Provider
+
+        suffix = uuid.uuid4().hex[:8]
+        self.user = get_user_model().objects.create_user(
+            email=f'benchmark-{suffix}@example.com', username=f'benchmark-{suffix}', password=None
+        )
+        self.provider = Provider.objects.create(
+            user=self.user, status='active', license_number=f'BENCH-{suffix}', business_name='Benchmark Hotspot',
+            business_type='cafe', contact_person='Benchmark', contact_phone='254700000000',
+            contact_email=self.user.email, address='Moi Avenue', city='Nairobi', county='Nairobi',
+            service_areas='CBD'
+        )
+        self.model = MikroTikModel.objects.create(name='Benchmark', model_code=f'bench-{suffix}')
+        self.voucher_type = VoucherType.objects.create(name='Benchmark', duration_hours=24)
+        self.bandwidth_profile = BandwidthProfile.objects.create(name='Benchmark', download_speed='5M', upload_speed='2M')
+
+    def template(self, rules):
+        return ConfigTemplate.objects.create(
+            name=f'Benchmark {rules}', description='Benchmark template', mikrotik_model=self.model,
+            template_content=template_source(rules)
+        )
+
+    def set_ticket_types(self, count):
+        """Give the provider count ticket types, alternating time and data"""
+        from tickets.models import TicketType
+
+        TicketType.objects.filter(provider=self.provider).delete()
+        TicketType.objects.bulk_create([
+            TicketType(
+                provider=self.provider, name=f'Plan {i}', type='time' if i % 2 else 'data', price=10 + i,
+                duration_hours=i + 1 if i % 2 else None, data_limit_mb=None if i % 2 else 100 * (i + 1),
+                download_speed_mbps=5 + i % 20, upload_speed_mbps=2
+            )
+            for i in range(count)
+        ])
+        return list(TicketType.objects.filter(provider=self.provider).order_by('id'))
+
+
+def _jinja_case(seed, size):
+    template = seed.template(size)
+    context = site_context(SITE, seed.voucher_type, seed.bandwidth_profile, OPTIONS, seed.user)
+    # Time rendering, not the one-off compile
+    config_template_cache.get_template(template)
+    return lambda: render_config_template(template, context)
+
+
+def _generator_case(seed, size):
+    ticket_types = seed.set_ticket_types(size)
+    # A cache that keeps nothing renders every section on every call
+    cache = SectionCache(max_entries=0)
+    return lambda: MikroTikConfigGenerator(seed.provider, cache=cache).generate_advanced_config(ticket_types)
+
+
+def _generator_cached_case(seed, size):
+    ticket_types = seed.set_ticket_types(size)
+    cache = SectionCache()
+    return lambda: MikroTikConfigGenerator(seed.provider, cache=cache).generate_advanced_config(ticket_types)
+
+
+def _hotspot_config_case(seed, size):
+    seed.set_ticket_types(size)
+    cache = SectionCache(max_entries=0)
+    return lambda: HotspotConfigGenerator(seed.provider, cache=cache).generate_advanced_hotspot_config()
+
+
+def _ticket_profiles_case(seed, size):
+    ticket_types = seed.set_ticket_types(size)
+    cache = SectionCache(max_entries=0)
+    return lambda: MikroTikConfigGenerator(seed.provider, cache=cache).generate_ticket_profiles(ticket_types)
+
+
+def _bulk_users_case(seed, size):
+    rows = [VoucherRow(f'BN{i:08d}', f'bn{i:08d}', f'pw{i:06d}', 1) for i in range(size * 10)]
+    generator = MikroTikConfigGenerator(seed.provider)
+    return lambda: ''.join(generator.generate_bulk_user_script(rows, total=len(rows)))
+
+
+CASES = {
+    'jinja': _jinja_case,
+    'generator': _generator_case,
+    'generator_cached': _generator_cached_case,
+    'hotspot_config': _hotspot_config_case,
+    'ticket_profiles': _ticket_profiles_case,
+    'bulk_users': _bulk_users_case,
+}
+
+
+def measure(generate, repeat=5):
+    """Time generate() and trace its memory; returns seconds (median), peak bytes and output bytes"""
+    output = generate()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        generate()
+        timings.append(time.perf_counter() - started)
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    generate()
+    _, peak = tracemalloc.get_traced_memory()
+    if not tracing:
+        tracemalloc.stop()
+    return {'seconds': median(timings), 'peak_bytes': peak - baseline, 'output_bytes': len(output.encode('utf-8'))}
+
+
+def run_benchmarks(cases=None, sizes=None, repeat=5):
+    """Run the benchmark cases at each size; returns {"case/size": measurement}"""
+    cases = cases or list(CASES)
+    sizes = sizes or list(SIZES)
+    results = {}
+    with transaction.atomic():
+        seed = BenchmarkSeed()
+        for case in cases:
+            for size in sizes:
+                generate = CASES[case](seed, SIZES[size])
+                results[f'{case}/{size}'] = measure(generate, repeat)
+                logger.debug(f"Benchmark {case}/{size}: {results[f'{case}/{size}']}")
+        transaction.set_rollback(True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Compare results with a baseline.
+
+    Returns (name, time ratio, memory ratio, regressed) for each case in
+    both; a ratio above 1 + tolerance is a regression.
+    """
+    rows = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        time_ratio = result['seconds'] / base['seconds'] if base['seconds'] else 1.0
+        memory_ratio = result['peak_bytes'] / base['peak_bytes'] if base['peak_bytes'] else 1.0
+        rows.append((name, time_ratio, memory_ratio, max(time_ratio, memory_ratio) > 1 + tolerance))
+    return rows
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['results']
+
+
+def save_baseline(path, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=2, sort_keys=True)
@@ -0,0 +1,153 @@
+"""
+Content-addressed storage for generated config bodies
+
+Each distinct body is stored once as a ConfigBlob, keyed by the SHA-256 of
+its text and gzip-compressed (with a fixed mtime, so equal bodies compress to
+equal bytes). Generated configs point at their blob; regenerating a config
+with the same settings reuses the existing row.
+
+Blobs are plain gzip members, so downloads send the stored bytes as-is with
+Content-Encoding: gzip to clients that accept it and decompress on the fly
+for the rest, chunk by chunk under both WSGI and ASGI.
+"""
+import gzip
+import hashlib
+import zlib
+import logging
+
+from django.db import IntegrityError, transaction
+from django.utils.cache import patch_vary_headers
+
+from hotspot_config.streaming import streaming_response
+from .models import ConfigBlob, GeneratedConfig
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def compress(content):
+    return gzip.compress(content.encode('utf-8'), compresslevel=9, mtime=0)
+
+
+def store_blob(content):
+    """Get the blob holding content, creating it if this body is new"""
+    digest = content_hash(content)
+    blob = ConfigBlob.objects.filter(sha256=digest).defer('data').first()
+    if blob:
+        return blob
+
+    data = compress(content)
+    try:
+        with transaction.atomic():
+            return ConfigBlob.objects.create(
+                sha256=digest,
+                size=len(content.encode('utf-8')),
+                compressed_size=len(data),
+                data=data
+            )
+    except IntegrityError:
+        # Stored concurrently by another request
+        return ConfigBlob.objects.defer('data').get(sha256=digest)
+
+
+def store_blobs(items):
+    """
+    Store many compressed bodies at once.
+
+    Takes (sha256, size, gzip data) tuples and returns {sha256: blob id},
+    inserting only the bodies not stored yet.
+    """
+    digests = {digest for digest, _, _ in items}
+    blob_ids = dict(ConfigBlob.objects.filter(sha256__in=digests).values_list('sha256', 'id'))
+    missing = {}
+    for digest, size, data in items:
+        if digest not in blob_ids and digest not in missing:
+            missing[digest] = ConfigBlob(sha256=digest, size=size, compressed_size=len(data), data=data)
+    if missing:
+        # Bodies stored concurrently by another request are skipped and looked up below
+        ConfigBlob.objects.bulk_create(missing.values(), ignore_conflicts=True)
+        blob_ids.update(ConfigBlob.objects.filter(sha256__in=missing).values_list('sha256', 'id'))
+    return blob_ids
+
+
+def compact_configs(batch_size=500):
+    """
+    Move bodies still stored in GeneratedConfig.config_content into blobs.
+
+    Returns (configs moved, blobs created).
+    """
+    moved = created = 0
+    while True:
+        batch = list(
+            GeneratedConfig.objects.filter(blob__isnull=True).exclude(config_content='')
+            .only('id', 'config_content').order_by('id')[:batch_size]
+        )
+        if not batch:
+            return moved, created
+        blobs_before = ConfigBlob.objects.count()
+        with transaction.atomic():
+            for config in batch:
+                GeneratedConfig.objects.filter(pk=config.pk).update(
+                    blob=store_blob(config.config_content),
+                    config_content=''
+                )
+        moved += len(batch)
+        created += ConfigBlob.objects.count() - blobs_before
+        logger.info(f"Moved {moved} config bodies to blobs")
+
+
+def prune_blobs():
+    """Delete blobs no config points to; returns how many were deleted"""
+    deleted, _ = ConfigBlob.objects.filter(configs__isnull=True).delete()
+    return deleted
+
+
+def read_blob(blob):
+    return gzip.decompress(bytes(blob.data)).decode('utf-8')
+
+
+def _chunks(data):
+    view = memoryview(data)
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield bytes(view[start:start + CHUNK_SIZE])
+
+
+def _decompressed_chunks(data):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in _chunks(data):
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def accepts_gzip(request):
+    return 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+
+
+def config_download_response(request, config, filename):
+    """
+    Stream a generated config as an .rsc attachment.
+
+    The stored gzip bytes are sent unchanged to clients that accept gzip.
+    Configs not yet moved to a blob are sent from their text column.
+    """
+    if config.blob_id:
+        data = bytes(config.blob.data)
+        if accepts_gzip(request):
+            response = streaming_response(request, _chunks(data), content_type='text/plain; charset=utf-8')
+            response['Content-Encoding'] = 'gzip'
+            response['Content-Length'] = str(len(data))
+        else:
+            response = streaming_response(request, _decompressed_chunks(data), content_type='text/plain; charset=utf-8')
+            response['Content-Length'] = str(config.blob.size)
+        patch_vary_headers(response, ('Accept-Encoding',))
+    else:
+        content = config.config_content.encode('utf-8')
+        response = streaming_response(request, _chunks(content), content_type='text/plain; charset=utf-8')
+        response['Content-Length'] = str(len(content))
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,63 @@
+"""
+Management command to benchmark config generation and compare it with a stored baseline
+"""
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from config_generator.benchmark import CASES, SIZES, compare, load_baseline, run_benchmarks, save_baseline
+
+
+class Command(BaseCommand):
+    help = (
+        'Time Jinja template rendering, both MikroTikConfigGenerator classes, ticket profiles and '
+        'bulk voucher scripts at increasing sizes, reporting time and memory per config. Seeded rows '
+        'are rolled back. Results are compared with the baseline file if it exists.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--case', action='append', choices=list(CASES), help='Case to run (repeatable; default all)')
+        parser.add_argument('--size', action='append', choices=list(SIZES), help='Size to run (repeatable; default all)')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case; the median is reported')
+        parser.add_argument(
+            '--baseline',
+            default=getattr(settings, 'CONFIG_BENCHMARK_BASELINE',
+                            os.path.join(settings.BASE_DIR, 'config_generator', 'benchmark_baseline.json')),
+            help='Baseline JSON file'
+        )
+        parser.add_argument('--save-baseline', action='store_true', help='Write these results as the new baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown or memory growth (0.25 = 25%%)')
+        parser.add_argument('--fail', action='store_true', help='Exit with an error if any case regressed')
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(options['case'], options['size'], options['repeat'])
+
+        self.stdout.write(f"{'case':<28}{'ms/config':>12}{'peak KiB':>12}{'output KiB':>12}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<28}{result['seconds'] * 1000:>12.3f}{result['peak_bytes'] / 1024:>12.1f}"
+                f"{result['output_bytes'] / 1024:>12.1f}"
+            )
+
+        baseline_path = options['baseline']
+        if options['save_baseline']:
+            save_baseline(baseline_path, results)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {baseline_path}"))
+            return
+        if not os.path.exists(baseline_path):
+            self.stdout.write(f"No baseline at {baseline_path}; run with --save-baseline to record one")
+            return
+
+        regressions = 0
+        self.stdout.write(f"\nAgainst {baseline_path}:")
+        for name, time_ratio, memory_ratio, regressed in compare(results, load_baseline(baseline_path), options['tolerance']):
+            line = f"{name:<28}{time_ratio:>11.2f}x time{memory_ratio:>9.2f}x memory"
+            if regressed:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(f"{line}  REGRESSION"))
+            else:
+                self.stdout.write(line)
+
+        if regressions and options['fail']:
+            raise CommandError(f"{regressions} benchmark cases regressed")
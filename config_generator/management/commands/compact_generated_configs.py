@@ -0,0 +1,34 @@
+"""
+Management command to move generated config bodies into compressed blobs
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+
+from config_generator.blobs import compact_configs, prune_blobs
+from config_generator.models import ConfigBlob
+
+
+class Command(BaseCommand):
+    help = (
+        'Store generated config bodies kept in the config_content column as deduplicated, '
+        'gzip-compressed blobs. On PostgreSQL run VACUUM FULL on the config table afterwards '
+        'to return the freed space.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Configs moved per transaction')
+        parser.add_argument('--prune', action='store_true', help='Also delete blobs no config points to')
+
+    def handle(self, *args, **options):
+        moved, created = compact_configs(batch_size=options['batch_size'])
+        self.stdout.write(f'Moved {moved} configs into {created} new blobs')
+
+        if options['prune']:
+            self.stdout.write(f'Pruned {prune_blobs()} unused blobs')
+
+        totals = ConfigBlob.objects.aggregate(size=Sum('size'), compressed=Sum('compressed_size'))
+        if totals['size']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Blobs hold {totals['size']} bytes of config in {totals['compressed']} bytes "
+                f"({totals['size'] / totals['compressed']:.1f}x)"
+            ))
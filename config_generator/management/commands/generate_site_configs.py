@@ -0,0 +1,78 @@
+"""
+Management command to generate configs for many sites from a CSV file
+"""
+import csv
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from config_generator.batch import archive_names, generate_batch, zip_stream
+from config_generator.models import BandwidthProfile, ConfigTemplate, VoucherType
+from config_generator.serializers import BatchConfigGenerationSerializer
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate a config for every site in a CSV file (columns hotspot_name, hotspot_ip, '
+        'dns_servers and optionally config_name, bandwidth_profile_id) and write them to a zip archive.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('sites', help='CSV file with one site per row')
+        parser.add_argument('output', help='Zip archive to write')
+        parser.add_argument('--user', required=True, help='Email of the user the configs belong to')
+        parser.add_argument('--template', type=int, required=True, help='Config template ID')
+        parser.add_argument('--voucher-type', type=int, required=True, help='Voucher type ID')
+        parser.add_argument('--bandwidth-profile', type=int, required=True, help='Default bandwidth profile ID')
+        parser.add_argument('--max-users', type=int, default=50)
+        parser.add_argument('--voucher-length', type=int, default=8)
+        parser.add_argument('--voucher-prefix', default='')
+        parser.add_argument('--workers', type=int, help='Render processes (default CONFIG_BATCH_WORKERS)')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(email=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user with email {options['user']}")
+
+        with open(options['sites'], newline='') as sites_file:
+            sites = [
+                {key: value for key, value in row.items() if value not in (None, '')}
+                for row in csv.DictReader(sites_file)
+            ]
+
+        serializer = BatchConfigGenerationSerializer(data={
+            'template_id': options['template'],
+            'voucher_type_id': options['voucher_type'],
+            'bandwidth_profile_id': options['bandwidth_profile'],
+            'max_users': options['max_users'],
+            'voucher_length': options['voucher_length'],
+            'voucher_prefix': options['voucher_prefix'],
+            'sites': sites,
+        })
+        if not serializer.is_valid():
+            raise CommandError(f'Invalid sites: {serializer.errors}')
+        data = serializer.validated_data
+        sites = data.pop('sites')
+
+        try:
+            template = ConfigTemplate.objects.get(id=data['template_id'], is_active=True)
+            voucher_type = VoucherType.objects.get(id=data['voucher_type_id'], is_active=True)
+        except (ConfigTemplate.DoesNotExist, VoucherType.DoesNotExist) as e:
+            raise CommandError(str(e))
+        profile_ids = {site['bandwidth_profile_id'] for site in sites}
+        bandwidth_profiles = BandwidthProfile.objects.filter(id__in=profile_ids, is_active=True).in_bulk()
+        if len(bandwidth_profiles) != len(profile_ids):
+            raise CommandError(f'Unknown bandwidth profiles: {sorted(profile_ids - set(bandwidth_profiles))}')
+
+        generated = generate_batch(
+            user, template, voucher_type, sites, data, bandwidth_profiles, workers=options['workers']
+        )
+        names = archive_names(config.config_name for config, _ in generated)
+        with open(options['output'], 'wb') as output:
+            for chunk in zip_stream(zip(names, (content for _, content in generated))):
+                output.write(chunk)
+
+        self.stdout.write(self.style.SUCCESS(f"Wrote {len(generated)} configs to {options['output']}"))
@@ -0,0 +1,71 @@
+"""
+Management command to check stored generated configs against the RouterOS command schema
+"""
+from collections import Counter
+import re
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from config_generator.models import GeneratedConfig
+from config_generator.validator import validate_script
+
+# Quoted names vary between configs; drop them to group errors by kind
+_QUOTED = re.compile(r"'[^']*'")
+
+
+class Command(BaseCommand):
+    help = (
+        'Check generated configs against the bundled RouterOS command schema and report '
+        'errors by line. Configs sharing a stored blob are checked once.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Only configs of this username')
+        parser.add_argument('--template', type=int, help='Only configs from this template ID')
+        parser.add_argument('--show', type=int, default=5, help='Errors listed per invalid config')
+        parser.add_argument('--batch-size', type=int, default=500, help='Configs read per query')
+        parser.add_argument('--fail', action='store_true', help='Exit with an error if any config is invalid')
+
+    def handle(self, *args, **options):
+        configs = GeneratedConfig.objects.select_related('blob')
+        if options['user']:
+            configs = configs.filter(user__username=options['user'])
+        if options['template']:
+            configs = configs.filter(template_id=options['template'])
+        # Configs sharing a blob come together, so each blob is checked once
+        configs = configs.order_by('blob_id', 'id')
+
+        started = time.perf_counter()
+        checked = invalid = scripts = size = 0
+        kinds = Counter()
+        blob_id = errors = None
+        for config in configs.iterator(chunk_size=options['batch_size']):
+            checked += 1
+            if config.blob_id is None or config.blob_id != blob_id:
+                content = config.get_content() or ''
+                errors = validate_script(content)
+                blob_id = config.blob_id
+                scripts += 1
+                size += len(content)
+                kinds.update(_QUOTED.sub("'…'", error.message) for error in errors)
+            if not errors:
+                continue
+
+            invalid += 1
+            self.stdout.write(self.style.WARNING(
+                f"Config {config.id} ({config.config_name}): {len(errors)} errors"
+            ))
+            for error in errors[:options['show']]:
+                self.stdout.write(f"  {error}")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Checked {checked} configs ({scripts} distinct scripts, {size / 1e6:.1f} MB) "
+            f"in {elapsed:.2f}s: {invalid} invalid"
+        )
+        for message, count in kinds.most_common(10):
+            self.stdout.write(f"  {count:>6}  {message}")
+
+        if invalid and options['fail']:
+            raise CommandError(f"{invalid} configs have script errors")
@@ -3,66 +3,16 @@ MikroTik RouterOS Configuration Generator
 """
 from django.template.loader import render_to_string
 from django.http import HttpResponse
+from django.utils import timezone
 from .models import MikroTikModel, VoucherType, BandwidthProfile, ConfigTemplate, GeneratedConfig
+from .sections import ConfigBuilder, section_cache
 from accounts.models import Provider
 import uuid
 import secrets
 import string
 
 
-class MikroTikConfigGenerator:
-    """Generate MikroTik RouterOS configuration files"""
-    
-    def __init__(self, provider):
-        self.provider = provider
-    
-    def generate_basic_hotspot_config(self, router_ip="192.168.1.1", hotspot_ip="192.168.1.0/24"):
-        """Generate basic hotspot configuration"""
-        config = f"""
-# MikroTik Hotspot Configuration for {self.provider.business_name}
-# Generated on {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
-
-# Set router identity
-/system identity set name="{self.provider.business_name} Hotspot"
-
-# Configure IP pool for hotspot users
-/ip pool add name=hotspot-pool ranges={hotspot_ip}
-
-# Configure hotspot server
-/ip hotspot setup set enabled=yes interface=ether2 ip-address={router_ip} ip-pool=hotspot-pool
-
-# Configure hotspot profile
-/ip hotspot profile set [find name="hsprof1"] name=default dns-name="{self.provider.business_name}" html-directory-override=hotspot1
-
-# Configure user manager
-/user manager set enabled=yes
-
-# Configure user manager database
-/user manager database set type=local
-
-# Configure hotspot user profile
-/ip hotspot user profile add name=default local-address={router_ip} remote-address=hotspot-pool
-
-# Configure bandwidth profiles for different ticket types
-"""
-        
-        # Add bandwidth profiles for each ticket type
-        for ticket_type in self.provider.ticket_types.all():
-            if ticket_type.ticket_type == 'time':
-                # Time-based tickets
-                config += f"""
-# Profile for {ticket_type.name} ({ticket_type.value} hours)
-/ip hotspot user profile add name="{ticket_type.name}" local-address={router_ip} remote-address=hotspot-pool
-"""
-            else:
-                # Data-based tickets
-                config += f"""
-# Profile for {ticket_type.name} ({ticket_type.value} GB)
-/ip hotspot user profile add name="{ticket_type.name}" local-address={router_ip} remote-address=hotspot-pool
-"""
-        
-        # Add firewall rules
-        config += """
+FIREWALL_RULES = """
 # Firewall rules for hotspot
 /ip firewall filter add chain=forward action=accept src-address=192.168.1.0/24 dst-address=192.168.1.0/24
 /ip firewall filter add chain=forward action=accept src-address=192.168.1.0/24 dst-address=!192.168.1.0/24
@@ -70,29 +20,30 @@ class MikroTikConfigGenerator:
 # NAT rules
 /ip firewall nat add chain=srcnat action=masquerade src-address=192.168.1.0/24
 """
-        
-        return config
-    
-    def generate_advanced_hotspot_config(self, router_ip="192.168.1.1", hotspot_ip="192.168.1.0/24"):
-        """Generate advanced hotspot configuration with custom branding"""
-        config = f"""
-# Advanced MikroTik Hotspot Configuration for {self.provider.business_name}
-# Generated on {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
 
-# Set router identity
-/system identity set name="{self.provider.business_name} Hotspot"
+RATE_LIMITS = """
+# Rate limiting for different user types
+/ip hotspot user profile set default rate-limit="1M/1M"
+"""
+
 
+def _hotspot_section(business_name, router_ip, hotspot_ip, advanced):
+    log_setup = """
 # Configure logging
 /system logging add topics=hotspot,info action=memory
-
+""" if advanced else ""
+    return f"""
+# Set router identity
+/system identity set name="{business_name} Hotspot"
+{log_setup}
 # Configure IP pool for hotspot users
 /ip pool add name=hotspot-pool ranges={hotspot_ip}
 
-# Configure hotspot server with custom settings
+# Configure hotspot server{" with custom settings" if advanced else ""}
 /ip hotspot setup set enabled=yes interface=ether2 ip-address={router_ip} ip-pool=hotspot-pool
 
-# Configure hotspot profile with custom branding
-/ip hotspot profile set [find name="hsprof1"] name=default dns-name="{self.provider.business_name}" html-directory-override=hotspot1
+# Configure hotspot profile{" with custom branding" if advanced else ""}
+/ip hotspot profile set [find name="hsprof1"] name=default dns-name="{business_name}" html-directory-override=hotspot1
 
 # Configure user manager
 /user manager set enabled=yes
@@ -105,36 +56,58 @@ class MikroTikConfigGenerator:
 
 # Configure bandwidth profiles for different ticket types
 """
-        
-        # Add bandwidth profiles for each ticket type
-        for ticket_type in self.provider.ticket_types.all():
-            if ticket_type.ticket_type == 'time':
-                # Time-based tickets with time limits
-                config += f"""
-# Profile for {ticket_type.name} ({ticket_type.value} hours)
-/ip hotspot user profile add name="{ticket_type.name}" local-address={router_ip} remote-address=hotspot-pool
-"""
-            else:
-                # Data-based tickets with data limits
-                config += f"""
-# Profile for {ticket_type.name} ({ticket_type.value} GB)
-/ip hotspot user profile add name="{ticket_type.name}" local-address={router_ip} remote-address=hotspot-pool
-"""
-        
-        # Add firewall rules
-        config += """
-# Firewall rules for hotspot
-/ip firewall filter add chain=forward action=accept src-address=192.168.1.0/24 dst-address=192.168.1.0/24
-/ip firewall filter add chain=forward action=accept src-address=192.168.1.0/24 dst-address=!192.168.1.0/24
 
-# NAT rules
-/ip firewall nat add chain=srcnat action=masquerade src-address=192.168.1.0/24
 
-# Rate limiting for different user types
-/ip hotspot user profile set default rate-limit="1M/1M"
-"""
-        
-        return config
+def _ticket_profiles_section(router_ip, ticket_types):
+    builder = ConfigBuilder()
+    for name, kind, duration_hours, data_limit_mb in ticket_types:
+        if kind == 'time':
+            # Time-based tickets
+            builder.write(f"""
+# Profile for {name} ({duration_hours} hours)
+/ip hotspot user profile add name="{name}" local-address={router_ip} remote-address=hotspot-pool
+""")
+        else:
+            # Data-based tickets
+            builder.write(f"""
+# Profile for {name} ({data_limit_mb} MB)
+/ip hotspot user profile add name="{name}" local-address={router_ip} remote-address=hotspot-pool
+""")
+    return builder.getvalue()
+
+
+class MikroTikConfigGenerator:
+    """Generate MikroTik RouterOS configuration files"""
+    
+    def __init__(self, provider, cache=None):
+        self.provider = provider
+        self.cache = cache if cache is not None else section_cache
+    
+    def _hotspot_config(self, title, router_ip, hotspot_ip, advanced):
+        provider_id = self.provider.pk
+        ticket_types = tuple(
+            (t.name, t.type, t.duration_hours, t.data_limit_mb) for t in self.provider.ticket_types.all()
+        )
+        builder = ConfigBuilder().write(
+            f"\n# {title} for {self.provider.business_name}\n"
+            f"# Generated on {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}\n",
+            self.cache.get(provider_id, 'hotspot', _hotspot_section,
+                           (self.provider.business_name, router_ip, hotspot_ip, advanced)),
+            # Add bandwidth profiles for each ticket type
+            self.cache.get(provider_id, 'ticket_profiles', _ticket_profiles_section, (router_ip, ticket_types)),
+            FIREWALL_RULES,
+        )
+        if advanced:
+            builder.write(RATE_LIMITS)
+        return builder.getvalue()
+    
+    def generate_basic_hotspot_config(self, router_ip="192.168.1.1", hotspot_ip="192.168.1.0/24"):
+        """Generate basic hotspot configuration"""
+        return self._hotspot_config("MikroTik Hotspot Configuration", router_ip, hotspot_ip, advanced=False)
+    
+    def generate_advanced_hotspot_config(self, router_ip="192.168.1.1", hotspot_ip="192.168.1.0/24"):
+        """Generate advanced hotspot configuration with custom branding"""
+        return self._hotspot_config("Advanced MikroTik Hotspot Configuration", router_ip, hotspot_ip, advanced=True)
     
     def generate_user_script(self, ticket_code, username, password, ticket_type, expiry_hours=None):
         """Generate user creation script for a specific ticket"""
@@ -145,51 +118,48 @@ class MikroTikConfigGenerator:
 # Ticket Type: {ticket_type.name}
 """
         
-        if ticket_type.ticket_type == 'time' and expiry_hours:
-            script += f"""
+        if ticket_type.type == 'time' and expiry_hours:
+            return script + f"""
 # Time-based ticket: {expiry_hours} hours
 /ip hotspot user add name="{username}" password="{password}" profile="{ticket_type.name}" limit-uptime="{expiry_hours}h"
 """
-        else:
-            script += f"""
-# Data-based ticket: {ticket_type.value} GB
+        return script + f"""
+# Data-based ticket: {ticket_type.data_limit_mb} MB
 /ip hotspot user add name="{username}" password="{password}" profile="{ticket_type.name}"
 """
-        
-        return script
     
     def generate_batch_users_script(self, tickets):
         """Generate script to add multiple users at once"""
-        script = f"""
+        builder = ConfigBuilder().write(f"""
 # Batch user creation for {len(tickets)} tickets
 # Generated on {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
-"""
+""")
         
         for ticket in tickets:
-            script += self.generate_user_script(
+            builder.write(self.generate_user_script(
                 ticket.code,
                 ticket.username,
                 ticket.password,
                 ticket.ticket_type,
-                ticket_type.value if ticket.ticket_type.ticket_type == 'time' else None
-            )
+                ticket.ticket_type.duration_hours if ticket.ticket_type.type == 'time' else None
+            ))
         
-        return script
+        return builder.getvalue()
     
     def generate_cleanup_script(self, expired_tickets):
         """Generate script to remove expired users"""
-        script = f"""
+        builder = ConfigBuilder().write(f"""
 # Cleanup expired users
 # Generated on {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
-"""
+""")
         
         for ticket in expired_tickets:
-            script += f"""
+            builder.write(f"""
 # Remove expired user: {ticket.username}
 /ip hotspot user remove [find name="{ticket.username}"]
-"""
+""")
         
-        return script
+        return builder.getvalue()
     
     def save_config_to_file(self, config_content, filename=None):
         """Save configuration to a file"""
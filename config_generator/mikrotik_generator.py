@@ -4,53 +4,30 @@ from datetime import datetime, timedelta
 import secrets
 import string
 
-class MikroTikConfigGenerator:
-    """Generate MikroTik RouterOS configuration files"""
-    
-    def __init__(self, provider):
-        self.provider = provider
-        self.config_sections = []
-    
-    def generate_basic_config(self):
-        """Generate basic MikroTik hotspot configuration"""
-        
-        # System identity
-        self.add_section("System Identity", f"""
-# Set router identity
-/system identity set name="{self.provider.business_name} Hotspot"
-""")
-        
-        # IP configuration
-        self.add_section("IP Configuration", f"""
+from .routeros import escape_string
+from .sections import ConfigBuilder, section_cache
+
+
+# Sections that are the same for every provider
+IP_CONFIGURATION = """
 # Configure IP addresses
 /ip address add address=192.168.1.1/24 interface=ether2 comment="Hotspot Network"
 /ip address add address=10.0.0.1/24 interface=ether3 comment="Management Network"
-""")
-        
-        # DHCP Server
-        self.add_section("DHCP Server", f"""
+"""
+
+DHCP_SERVER = """
 # Configure DHCP server for hotspot
 /ip dhcp-server add interface=ether2 address-pool=hotspot-pool disabled=no
 /ip pool add name=hotspot-pool ranges=192.168.1.10-192.168.1.254
 /ip dhcp-server network add address=192.168.1.0/24 gateway=192.168.1.1 dns-server=8.8.8.8,8.8.4.4
-""")
-        
-        # Hotspot Server
-        self.add_section("Hotspot Server", f"""
-# Configure hotspot server
-/ip hotspot setup
-/ip hotspot profile add name=hsprof1 dns-name="{self.provider.business_name.lower().replace(' ', '-')}.local" html-directory=hotspot login-by=http,https,ftp
-/ip hotspot add name=hs1 interface=ether2 profile=hsprof1 address-pool=hotspot-pool
-""")
-        
-        # User management
-        self.add_section("User Management", f"""
+"""
+
+USER_MANAGEMENT = """
 # Hotspot users will be managed via API
 # Users are created dynamically when tickets are purchased
-""")
-        
-        # Firewall rules
-        self.add_section("Firewall Rules", f"""
+"""
+
+FIREWALL_RULES = """
 # Basic firewall configuration
 /ip firewall filter add chain=input action=accept connection-state=established,related
 /ip firewall filter add chain=input action=accept src-address=192.168.1.0/24
@@ -60,102 +37,94 @@ class MikroTikConfigGenerator:
 # Allow hotspot traffic
 /ip firewall filter add chain=forward action=accept src-address=192.168.1.0/24 dst-address=192.168.1.0/24
 /ip firewall filter add chain=forward action=accept src-address=192.168.1.0/24 dst-address=!192.168.1.0/24
-""")
-        
-        # NAT rules
-        self.add_section("NAT Rules", f"""
+"""
+
+NAT_RULES = """
 # NAT configuration for internet access
 /ip firewall nat add chain=srcnat action=masquerade out-interface=ether1
-""")
-        
-        # Bandwidth limits
-        self.add_section("Bandwidth Limits", f"""
+"""
+
+BANDWIDTH_LIMITS = """
 # Bandwidth limiting for different ticket types
 # These will be applied based on user profiles
-""")
-        
-        return self.get_full_config()
-    
-    def generate_advanced_config(self, ticket_types):
-        """Generate advanced configuration with ticket type support"""
-        
-        # Start with basic config
-        self.generate_basic_config()
-        
-        # Add ticket type specific configurations
-        self.add_section("Ticket Type Profiles", self.generate_ticket_profiles(ticket_types))
-        
-        # Add API integration
-        self.add_section("API Integration", self.generate_api_config())
-        
-        # Add monitoring
-        self.add_section("Monitoring", self.generate_monitoring_config())
-        
-        return self.get_full_config()
-    
-    def generate_ticket_profiles(self, ticket_types):
-        """Generate user profiles for different ticket types"""
-        config = []
-        
-        for ticket_type in ticket_types:
-            profile_name = f"profile_{ticket_type.id}"
-            
-            # Create user profile
-            config.append(f"""
-# Profile for {ticket_type.name}
-/ip hotspot user profile add name={profile_name}""")
-            
-            # Set bandwidth limits
-            if ticket_type.download_speed_mbps:
-                config.append(f"/ip hotspot user profile set {profile_name} rate-limit={ticket_type.download_speed_mbps}M/{ticket_type.upload_speed_mbps}M")
-            
-            # Set session timeout for time-based tickets
-            if ticket_type.type == 'time':
-                config.append(f"/ip hotspot user profile set {profile_name} session-timeout={ticket_type.duration_hours * 3600}")
-            
-            # Set data limit for data-based tickets
-            if ticket_type.type == 'data':
-                config.append(f"/ip hotspot user profile set {profile_name} bytes-in-limit={ticket_type.data_limit_mb * 1024 * 1024}")
-        
-        return "\n".join(config)
-    
-    def generate_api_config(self):
-        """Generate API configuration for dynamic user management"""
-        return f"""
+"""
+
+API_CONFIG = """
 # API configuration for dynamic user management
 /ip service set api disabled=no
 /ip service set api port=8728
 /ip service set api address=10.0.0.0/24
 
 # Script for user management
-/system script add name=add-user source={{
+/system script add name=add-user source={
     /ip hotspot user add name=$username password=$password profile=$profile
-}}
+}
 
-/system script add name=remove-user source={{
+/system script add name=remove-user source={
     /ip hotspot user remove [find name=$username]
-}}
+}
 
-/system script add name=update-user source={{
+/system script add name=update-user source={
     /ip hotspot user set [find name=$username] password=$password profile=$profile
-}}
+}
+"""
+
+
+def _identity_section(business_name):
+    return f"""
+# Set router identity
+/system identity set name="{business_name} Hotspot"
 """
+
+
+def _hotspot_server_section(business_name):
+    return f"""
+# Configure hotspot server
+/ip hotspot setup
+/ip hotspot profile add name=hsprof1 dns-name="{business_name.lower().replace(' ', '-')}.local" html-directory=hotspot login-by=http,https,ftp
+/ip hotspot add name=hs1 interface=ether2 profile=hsprof1 address-pool=hotspot-pool
+"""
+
+
+def _ticket_profiles_section(ticket_types):
+    config = []
+    for ticket_type_id, name, kind, duration_hours, data_limit_mb, download_mbps, upload_mbps in ticket_types:
+        profile_name = f"profile_{ticket_type_id}"
+        
+        # Create user profile
+        config.append(f"""
+# Profile for {name}
+/ip hotspot user profile add name={profile_name}""")
+        
+        # Set bandwidth limits
+        if download_mbps:
+            config.append(f"/ip hotspot user profile set {profile_name} rate-limit={download_mbps}M/{upload_mbps}M")
+        
+        # Set session timeout for time-based tickets
+        if kind == 'time':
+            config.append(f"/ip hotspot user profile set {profile_name} session-timeout={duration_hours * 3600}")
+        
+        # Set data limit for data-based tickets
+        if kind == 'data':
+            config.append(f"/ip hotspot user profile set {profile_name} bytes-in-limit={data_limit_mb * 1024 * 1024}")
     
-    def generate_monitoring_config(self):
-        """Generate monitoring and logging configuration"""
-        return f"""
+    return "\n".join(config)
+
+
+def _monitoring_section(contact_email, address):
+    return f"""
 # Monitoring and logging
 /log print info message="Hotspot user connected: $user"
 /log print info message="Hotspot user disconnected: $user"
 
 # SNMP configuration for monitoring
-/snmp set enabled=yes contact="{self.provider.contact_email}" location="{self.provider.address}"
+/snmp set enabled=yes contact="{contact_email}" location="{address}"
 /snmp community set public addresses=10.0.0.0/24
 """
-    
-    def generate_captive_portal_config(self):
-        """Generate captive portal configuration"""
-        return f"""
+
+
+def _captive_portal_section(business_name):
+    return f"""
 # Captive portal customization
 /ip hotspot profile set hsprof1 html-directory=hotspot
 /ip hotspot profile set hsprof1 http-proxy=0.0.0.0:0
@@ -165,7 +134,7 @@ class MikroTikConfigGenerator:
 /file add name=login.html contents="<!DOCTYPE html>
 <html>
 <head>
-    <title>{self.provider.business_name} WiFi</title>
+    <title>{business_name} WiFi</title>
     <meta name='viewport' content='width=device-width, initial-scale=1'>
     <style>
         body {{ font-family: Arial, sans-serif; text-align: center; padding: 50px; }}
@@ -178,7 +147,7 @@ class MikroTikConfigGenerator:
 </head>
 <body>
     <div class='container'>
-        <div class='logo'>{self.provider.business_name}</div>
+        <div class='logo'>{business_name}</div>
         <div class='form'>
             <h3>WiFi Access</h3>
             <form method='post' action='$linklogin'>
@@ -193,28 +162,96 @@ class MikroTikConfigGenerator:
 </body>
 </html>"
 """
+
+
+def ticket_type_inputs(ticket_types):
+    """Get the fields the ticket profile section is rendered from, as a cache key"""
+    return tuple(
+        (t.id, t.name, t.type, t.duration_hours, t.data_limit_mb, t.download_speed_mbps, t.upload_speed_mbps)
+        for t in ticket_types
+    )
+
+
+class MikroTikConfigGenerator:
+    """Generate MikroTik RouterOS configuration files"""
+    
+    # Users per block of a bulk import script
+    IMPORT_BLOCK_SIZE = 500
+    
+    def __init__(self, provider, cache=None):
+        self.provider = provider
+        self.config_sections = []
+        self.cache = cache if cache is not None else section_cache
+    
+    def _cached(self, name, render, *inputs):
+        """Get a section rendered from this provider's inputs, from the section cache"""
+        return self.cache.get(self.provider.pk, name, render, inputs)
+    
+    def _add_basic_sections(self):
+        business_name = self.provider.business_name
+        self.add_section("System Identity", self._cached("identity", _identity_section, business_name))
+        self.add_section("IP Configuration", IP_CONFIGURATION)
+        self.add_section("DHCP Server", DHCP_SERVER)
+        self.add_section("Hotspot Server", self._cached("hotspot_server", _hotspot_server_section, business_name))
+        self.add_section("User Management", USER_MANAGEMENT)
+        self.add_section("Firewall Rules", FIREWALL_RULES)
+        self.add_section("NAT Rules", NAT_RULES)
+        self.add_section("Bandwidth Limits", BANDWIDTH_LIMITS)
+    
+    def generate_basic_config(self):
+        """Generate basic MikroTik hotspot configuration"""
+        self._add_basic_sections()
+        return self.get_full_config()
+    
+    def generate_advanced_config(self, ticket_types):
+        """Generate advanced configuration with ticket type support"""
+        
+        # Start with basic config
+        self._add_basic_sections()
+        
+        # Add ticket type specific configurations
+        self.add_section("Ticket Type Profiles", self.generate_ticket_profiles(ticket_types))
+        
+        # Add API integration
+        self.add_section("API Integration", self.generate_api_config())
+        
+        # Add monitoring
+        self.add_section("Monitoring", self.generate_monitoring_config())
+        
+        return self.get_full_config()
+    
+    def generate_ticket_profiles(self, ticket_types):
+        """Generate user profiles for different ticket types"""
+        return self._cached("ticket_profiles", _ticket_profiles_section, ticket_type_inputs(ticket_types))
+    
+    def generate_api_config(self):
+        """Generate API configuration for dynamic user management"""
+        return API_CONFIG
+    
+    def generate_monitoring_config(self):
+        """Generate monitoring and logging configuration"""
+        return self._cached("monitoring", _monitoring_section, self.provider.contact_email, self.provider.address)
+    
+    def generate_captive_portal_config(self):
+        """Generate captive portal configuration"""
+        return self._cached("captive_portal", _captive_portal_section, self.provider.business_name)
     
     def add_section(self, title, content):
         """Add a configuration section"""
-        section = f"""
-# {title}
-{content}
-"""
-        self.config_sections.append(section)
+        self.config_sections.append((title, content))
     
     def get_full_config(self):
         """Get the complete configuration"""
-        config = f"""# MikroTik RouterOS Configuration
-# Generated for {self.provider.business_name}
-# Generated on {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
-# Provider ID: {self.provider.id}
-
-"""
-        
-        for section in self.config_sections:
-            config += section + "\n"
-        
-        return config
+        builder = ConfigBuilder().write(
+            "# MikroTik RouterOS Configuration\n"
+            f"# Generated for {self.provider.business_name}\n"
+            f"# Generated on {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"# Provider ID: {self.provider.id}\n"
+            "\n"
+        )
+        for title, content in self.config_sections:
+            builder.section(title, content)
+        return builder.getvalue()
     
     def generate_user_script(self, ticket):
         """Generate script to add a specific user"""
@@ -230,6 +267,54 @@ class MikroTikConfigGenerator:
 /ip hotspot user remove [find name={ticket.username}]
 """
     
+    def generate_bulk_user_script(self, tickets, total=None, remove=False, block_size=None):
+        """
+        Yield one import script for many tickets, a block at a time.
+    
+        tickets may be any iterable of objects with code, username, password
+        and ticket_type_id (e.g. named values_list rows). Adding skips users
+        that already exist and removing skips users that do not, so the script
+        can be imported again after an interruption. Each block runs in its
+        own :do scope, so an error only loses that block, and logs progress.
+        """
+        block_size = block_size or self.IMPORT_BLOCK_SIZE
+        action = 'remove' if remove else 'add'
+        yield f"""# Bulk hotspot user {action} for {self.provider.business_name}
+# Generated on {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
+# Import with: /import file-name=<this file>
+"""
+        block = []
+        done = 0
+        for ticket in tickets:
+            name = escape_string(ticket.username)
+            if remove:
+                block.append(f"/ip hotspot user remove [find name={name}]")
+            else:
+                block.append(
+                    f":if ([:len [/ip hotspot user find name={name}]] = 0) do={{"
+                    f"/ip hotspot user add name={name} password={escape_string(ticket.password)} "
+                    f"profile=profile_{ticket.ticket_type_id} comment={escape_string(ticket.code)}}}"
+                )
+            if len(block) == block_size:
+                done += len(block)
+                yield self._import_block(block, action, done, total)
+                block = []
+        if block:
+            done += len(block)
+            yield self._import_block(block, action, done, total)
+        yield f':log info "Hotspot user {action} finished: {done} users"\n'
+    
+    @staticmethod
+    def _import_block(lines, action, done, total):
+        progress = f"{done}/{total}" if total else str(done)
+        first = done - len(lines) + 1
+        return (
+            f"\n# Users {first}-{done}\n"
+            ":do {\n" + "\n".join(lines) + "\n"
+            f"}} on-error={{:log warning \"Hotspot user {action} failed in users {first}-{done}\"}}\n"
+            f':log info "Hotspot user {action}: {progress}"\n'
+        )
+    
     @staticmethod
     def generate_radius_config(provider):
         """Generate RADIUS configuration for advanced setups"""
@@ -246,3 +331,22 @@ class MikroTikConfigGenerator:
 # Backup script
 /system backup save name=hotspot-backup-{datetime.now().strftime('%Y%m%d-%H%M%S')}
 """
+
+
+def generate_provider_configs(providers, cache=None):
+    """
+    Yield (provider, advanced config) for each provider.
+
+    Active ticket types are read for all providers in one query, and
+    sections shared by providers, or unchanged since a previous run, come
+    from the section cache.
+    """
+    from django.db.models import Prefetch
+    from tickets.models import TicketType
+
+    providers = providers.prefetch_related(
+        Prefetch('ticket_types', queryset=TicketType.objects.filter(is_active=True).order_by('id'))
+    )
+    for provider in providers:
+        generator = MikroTikConfigGenerator(provider, cache=cache)
+        yield provider, generator.generate_advanced_config(provider.ticket_types.all())
@@ -53,6 +53,18 @@ class ConfigTemplate(models.Model):
         return f"{self.name} - {self.mikrotik_model.name}"
 
 
+class ConfigBlob(models.Model):
+    """Gzip-compressed config body, stored once per distinct content (see config_generator.blobs)"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveIntegerField(help_text="Uncompressed size in bytes")
+    compressed_size = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
 class GeneratedConfig(models.Model):
     """Generated configuration files"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='generated_configs')
@@ -65,7 +77,10 @@ class GeneratedConfig(models.Model):
         help_text="Billing template used for this configuration"
     )
     config_name = models.CharField(max_length=200)
-    config_content = models.TextField()
+    # Bodies live in ConfigBlob; config_content only holds rows not yet moved
+    # over by the compact_generated_configs command
+    blob = models.ForeignKey(ConfigBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='configs')
+    config_content = models.TextField(blank=True, default='')
     
     # Configuration parameters
     hotspot_name = models.CharField(max_length=100)
@@ -89,5 +104,12 @@ class GeneratedConfig(models.Model):
     def __str__(self):
         return f"{self.user.email} - {self.config_name}"
     
+    def get_content(self):
+        """Get the config body, from its blob or the legacy text column"""
+        if self.blob_id:
+            from .blobs import read_blob
+            return read_blob(self.blob)
+        return self.config_content
+    
     class Meta:
         ordering = ['-created_at']
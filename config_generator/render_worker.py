@@ -0,0 +1,26 @@
+"""
+Functions run inside the batch render pool's worker processes
+
+Workers are spawned, so they start without Django and unpickle these
+functions by importing this module. It must therefore not import models (or
+anything that does) at module level; Django is set up by the initializer
+before the first task arrives.
+"""
+
+
+def setup_worker():
+    """Pool initializer: set up Django in a freshly spawned worker"""
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+def render_site(template, context):
+    """Render and compress one site's config"""
+    from .blobs import compress, content_hash
+    from .template_cache import config_template_cache
+
+    content = config_template_cache.render(template, context)
+    return content, content_hash(content), len(content.encode('utf-8')), compress(content)
@@ -0,0 +1,453 @@
+"""
+RouterOS script model and delta scripts between config versions
+
+RouterConfig.parse() reads a generated .rsc into keyed entries:
+
+  - "add" commands are keyed by (menu, identity). The identity is the
+    entry's name, or for unnamed entries the properties that identify
+    them in that menu (IDENTITY_KEYS). Anything else, e.g. a firewall rule,
+    is identified by all of its properties. Later "set" commands aimed at
+    an entry added in the same script are folded into it.
+  - "set" commands on other targets are keyed by (menu, target). A target
+    is a positional name, a [find name=...] selector, or nothing for
+    singleton menus such as /system identity.
+  - Anything else (setup, print, scripting) is kept verbatim, keyed by its
+    text.
+
+Comments are dropped, so regenerating an unchanged config (which only
+changes the "Generated on" header) gives an empty delta. Commands may span
+lines with a trailing backslash, inside quotes or inside {} blocks.
+
+diff_scripts() compares two scripts and returns the commands that turn a
+router running the first into one running the second: removals, then
+set/unset of changed properties, then new entries. Rule order matters in
+ORDERED_MENUS, so a new (or changed) entry there is added with
+place-before= the next unchanged entry and keeps its position; other new
+entries are appended. Unchanged rules that were reordered are not moved.
+
+An unnamed entry is selected by its properties, and [find where ...] also
+matches entries that have those properties plus others. When the selector
+of an entry the delta removes, changes or places before would match any
+other entry of the menu (a rule with extra properties, or a duplicate of
+the same rule), diff_configs() raises AmbiguousDelta and delta_script()
+falls back to the full config.
+"""
+from collections import OrderedDict
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Menu commands that change or describe configuration state
+ADD, SET = 'add', 'set'
+VERBS = {
+    'add', 'set', 'remove', 'unset', 'print', 'setup', 'enable', 'disable', 'export',
+    'save', 'edit', 'find', 'monitor', 'reset', 'run', 'comment', 'move', 'get', 'import',
+}
+
+# Properties identifying unnamed entries, by menu
+IDENTITY_KEYS = {
+    '/ip address': ('address', 'interface'),
+    '/ip dhcp-server network': ('address',),
+    '/ip dns static': ('name', 'address'),
+    '/ip hotspot walled-garden': ('dst-host',),
+    '/ip hotspot walled-garden ip': ('dst-address',),
+    '/radius': ('service', 'address'),
+    '/ip dhcp-server': ('interface',),
+    '/ip hotspot': ('interface',),
+}
+
+# Menus whose entries are evaluated in order
+ORDERED_MENUS = {'/ip firewall filter', '/ip firewall nat', '/ip firewall mangle', '/ip firewall raw'}
+
+CLOSERS = {'[': ']', '{': '}', '(': ')'}
+OPENERS = {closer: opener for opener, closer in CLOSERS.items()}
+
+# Characters the scanners stop at; everything else is copied in slices
+_SPECIAL = re.compile(r'[\\"\[\]{}()\n]')
+_WORD_SPECIAL = re.compile(r'[\\"\[\]{}()\s]')
+_NESTED_SPECIAL = re.compile(r'[\\"\[\]{}()]')
+_QUOTED_SPECIAL = re.compile(r'[\\"]')
+_BLANK = re.compile(r'(?:[ \t\r]*(?:#[^\n]*)?\n)*[ \t\r]*(?:#[^\n]*)?')
+
+_FIND_NAME = re.compile(r'^\[\s*find\s+(?:where\s+)?name\s*=\s*("(?:[^"\\]|\\.)*"|[^\s\]]+)\s*\]$')
+
+
+def iter_commands(text, errors=None):
+    """
+    Yield (line, command) for each logical line of a script, dropping comments.
+
+    A single left-to-right pass tracking quotes, brackets and braces, so the
+    cost is linear in the script length; plain text between the characters
+    that matter is skipped by regex search. line is the 1-based line the
+    command starts on. If errors is a list, (line, message) pairs are
+    appended to it for stray closing brackets and for quotes or brackets
+    left open.
+    """
+    openers = []
+    in_quote = False
+    line = 1
+    quote_line = 0
+    start_line = None
+    parts = []
+    segment = 0
+    i = 0
+    length = len(text)
+    while i < length:
+        if start_line is None:
+            # Skip blank and comment lines before the next command
+            blank = _BLANK.match(text, i)
+            line += blank.group().count('\n')
+            i = segment = blank.end()
+            if i >= length:
+                break
+            start_line = line
+            parts = []
+
+        match = _SPECIAL.search(text, i)
+        if match is None:
+            break
+        j = match.start()
+        char = text[j]
+        i = j + 1
+        if char == '\\':
+            if text.startswith('\n', i):
+                line += 1
+                if not in_quote:
+                    # Backslash-newline continues the command on the next line
+                    parts.append(text[segment:j])
+                    parts.append(' ')
+                    segment = i + 1
+            i += 1
+        elif char == '\n':
+            line += 1
+            if not in_quote and not openers:
+                parts.append(text[segment:j])
+                command = ''.join(parts).strip()
+                if command:
+                    yield start_line, command
+                start_line = None
+        elif char == '"':
+            in_quote = not in_quote
+            quote_line = line
+        elif in_quote:
+            continue
+        elif char in CLOSERS:
+            openers.append((CLOSERS[char], line))
+        elif openers and openers[-1][0] == char:
+            openers.pop()
+        elif errors is not None:
+            errors.append((line, f"unmatched '{char}'"))
+
+    if errors is not None:
+        if in_quote:
+            errors.append((quote_line, 'unterminated string'))
+        for closer, opened_on in openers:
+            errors.append((opened_on, f"'{OPENERS[closer]}' is never closed"))
+    if start_line is not None:
+        parts.append(text[segment:])
+        command = ''.join(parts).strip()
+        if command:
+            yield start_line, command
+
+
+def split_commands(text):
+    """Split a script into commands, one per logical line, dropping comments"""
+    return [command for _, command in iter_commands(text)]
+
+
+def split_words(command):
+    """Split a command into words at top-level whitespace, keeping quotes and brackets intact"""
+    words = []
+    depth = 0
+    in_quote = False
+    start = 0
+    i = 0
+    while True:
+        # Inside quotes or brackets whitespace does not matter, so skip past it
+        pattern = _QUOTED_SPECIAL if in_quote else _NESTED_SPECIAL if depth else _WORD_SPECIAL
+        match = pattern.search(command, i)
+        if match is None:
+            break
+        j = match.start()
+        char = command[j]
+        i = j + 1
+        if char == '\\':
+            i += 1
+        elif char == '"':
+            in_quote = not in_quote
+        elif char in '[{(':
+            depth += 1
+        elif char in ']})':
+            depth = max(depth - 1, 0)
+        else:
+            if j > start:
+                words.append(command[start:j])
+            start = i
+    if start < len(command):
+        words.append(command[start:])
+    return words
+
+
+def menu_path(words, verbs=VERBS):
+    """
+    Take the menu path off the front of a command's words and return it.
+
+    "/ip/hotspot user" and "/ip hotspot user" give the same menu; the path
+    ends at the first verb or name=value word.
+    """
+    path = [words.pop(0)]
+    while words and words[0] not in verbs and '=' not in words[0] and not words[0].startswith('['):
+        path.append(words.pop(0))
+    return '/' + ' '.join(part for word in path for part in word.split('/') if part)
+
+
+def escape_string(value):
+    """Quote text as a RouterOS string literal"""
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+    return f'"{escaped}"'
+
+
+def quote(value):
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        return value
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def unquote(value):
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        return value[1:-1]
+    return value
+
+
+def normalize_target(target):
+    """Reduce "name", "\"name\"" and [find name=name] to the same target"""
+    match = _FIND_NAME.match(target)
+    if match:
+        target = match.group(1)
+    return unquote(target)
+
+
+class AmbiguousDelta(Exception):
+    """A delta would select an entry the router cannot tell apart from others"""
+
+
+class Entry:
+    """One configuration item: an added entry, a set target, or a verbatim command"""
+
+    __slots__ = ('menu', 'verb', 'target', 'args', 'raw')
+
+    def __init__(self, menu, verb, target=None, args=None, raw=None):
+        self.menu = menu
+        self.verb = verb
+        self.target = target
+        self.args = args if args is not None else OrderedDict()
+        self.raw = raw
+
+    def identity(self):
+        if self.raw is not None:
+            return self.raw
+        if self.verb == SET:
+            return normalize_target(self.target or '')
+        if 'name' in self.args:
+            return unquote(self.args['name'])
+        keys = IDENTITY_KEYS.get(self.menu)
+        if keys and all(key in self.args for key in keys):
+            return ' '.join(f"{key}={unquote(self.args[key])}" for key in keys)
+        return ' '.join(f"{key}={unquote(value)}" for key, value in self.args.items())
+
+    def conditions(self):
+        """Get the properties an unnamed added entry is selected by, or None if it is selected otherwise"""
+        if self.raw is not None or self.verb == SET or 'name' in self.args:
+            return None
+        keys = IDENTITY_KEYS.get(self.menu)
+        if not (keys and all(key in self.args for key in keys)):
+            keys = list(self.args)
+        return OrderedDict((key, unquote(self.args[key] or '')) for key in keys)
+
+    def matches(self, conditions):
+        """Check whether [find where ...] with the given conditions selects this entry"""
+        return self.raw is None and self.verb == ADD and all(
+            key in self.args and unquote(self.args[key] or '') == value for key, value in conditions.items()
+        )
+
+    def selector(self):
+        """Get the expression selecting this entry on the router"""
+        if self.verb == SET:
+            return self.target or ''
+        if 'name' in self.args:
+            return f"[find name={quote(unquote(self.args['name']))}]"
+        conditions = ' and '.join(f"{key}={quote(value)}" for key, value in self.conditions().items())
+        return f"[find where {conditions}]"
+
+    def command(self, args=None):
+        """Render the entry (or just the given properties) as one command"""
+        if self.raw is not None:
+            return self.raw
+        target = self.target if self.verb == SET else None
+        return _command(self.menu, self.verb, target, _assignments(self.args if args is None else args))
+
+
+class RouterConfig:
+    """A parsed RouterOS script: entries keyed by (menu, identity), in script order"""
+
+    def __init__(self):
+        self.entries = OrderedDict()
+
+    @classmethod
+    def parse(cls, text):
+        config = cls()
+        menu = '/'
+        for command in split_commands(text):
+            words = split_words(command)
+            if words[0].startswith('/'):
+                menu = menu_path(words)
+                if not words:
+                    # A bare menu path switches the current menu, as in /export output
+                    continue
+            config.add_command(menu, words, command)
+        return config
+
+    def add_command(self, menu, words, command):
+        verb = words[0] if words else ''
+        if verb not in (ADD, SET) or not menu.startswith('/') or menu == '/':
+            self._put(Entry(menu, verb, raw=command))
+            return
+
+        args = OrderedDict()
+        target = None
+        for word in words[1:]:
+            key, sep, value = word.partition('=')
+            if sep and not word.startswith('['):
+                args[key] = value
+            elif verb == SET and target is None:
+                target = word
+            else:
+                args[word] = None
+
+        if verb == SET:
+            target_name = normalize_target(target or '')
+            added = self.entries.get((menu, target_name))
+            if added is not None and added.verb == ADD:
+                added.args.update(args)
+                return
+            existing = self.entries.get((menu, target_name))
+            if existing is not None and existing.verb == SET:
+                existing.args.update(args)
+                return
+        self._put(Entry(menu, verb, target, args))
+
+    def _put(self, entry):
+        key = (entry.menu, entry.identity())
+        if key in self.entries:
+            # Repeated identical commands (e.g. duplicate rules) are kept apart
+            counter = 2
+            while (entry.menu, f"{key[1]} #{counter}") in self.entries:
+                counter += 1
+            key = (entry.menu, f"{key[1]} #{counter}")
+        self.entries[key] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _command(*words):
+    return ' '.join(word for word in words if word)
+
+
+def _assignments(args):
+    return ' '.join(f"{key}={value}" if value is not None else key for key, value in args.items())
+
+
+def _exact_selector(key, entry, old, new):
+    """
+    Get the selector of an entry on the router, raising AmbiguousDelta if it
+    would also select another entry of the old or new config.
+    """
+    conditions = entry.conditions()
+    if conditions:
+        for config in (old, new):
+            for other_key, other in config.entries.items():
+                if other_key != key and other.menu == entry.menu and other.matches(conditions):
+                    reason = 'is repeated' if other.args == entry.args else f"also matches {other.command()}"
+                    raise AmbiguousDelta(f"{entry.command()} {reason}")
+    return entry.selector()
+
+
+def diff_configs(old, new):
+    """Get the commands turning RouterConfig old into new"""
+    removals = []
+    changes = []
+    additions = []
+
+    for key, entry in reversed(old.entries.items()):
+        if key in new.entries:
+            continue
+        if entry.raw is not None:
+            continue
+        if entry.verb == ADD:
+            removals.append(_command(entry.menu, 'remove', _exact_selector(key, entry, old, new)))
+        else:
+            removals.append(f"# {_command(entry.menu, entry.target)}: no longer set, left as is")
+
+    # For entries of ordered menus: the next entry of the same menu that is already on the router
+    anchors = {}
+    next_kept = {}
+    for key, entry in reversed(new.entries.items()):
+        if entry.menu not in ORDERED_MENUS or entry.raw is not None:
+            continue
+        anchors[key] = next_kept.get(entry.menu)
+        if key in old.entries:
+            next_kept[entry.menu] = key
+
+    for key, entry in new.entries.items():
+        previous = old.entries.get(key)
+        if previous is None:
+            anchor = anchors.get(key)
+            placement = None
+            if anchor is not None:
+                placement = f"place-before={_exact_selector(anchor, old.entries[anchor], old, new)}"
+            additions.append(_command(entry.command(), placement))
+            continue
+        if entry.raw is not None:
+            continue
+        changed = OrderedDict(
+            (arg, value) for arg, value in entry.args.items()
+            if arg not in previous.args or previous.args[arg] != value
+        )
+        dropped = [arg for arg in previous.args if arg not in entry.args]
+        if not (changed or dropped):
+            continue
+        selector = _exact_selector(key, previous, old, new)
+        if changed:
+            changes.append(_command(entry.menu, 'set', selector, _assignments(changed)))
+        for arg in dropped:
+            changes.append(_command(entry.menu, 'unset', selector, arg))
+
+    return removals + changes + additions
+
+
+def diff_scripts(old_text, new_text):
+    return diff_configs(RouterConfig.parse(old_text), RouterConfig.parse(new_text))
+
+
+def delta_script(old_config, new_config):
+    """
+    Get a script applying the changes from one GeneratedConfig to another,
+    or the full new config if the changes cannot be selected exactly.
+    """
+    new_content = new_config.get_content()
+    header = [
+        f"# Changes from config {old_config.id} ({old_config.config_name}, {old_config.created_at:%Y-%m-%d %H:%M})",
+        f"# to config {new_config.id} ({new_config.config_name}, {new_config.created_at:%Y-%m-%d %H:%M})",
+    ]
+    try:
+        commands = diff_scripts(old_config.get_content(), new_content)
+    except AmbiguousDelta as exc:
+        logger.info("Delta from config %s to %s is ambiguous: %s", old_config.id, new_config.id, exc)
+        header.append(f"# No exact delta ({exc}), full config follows")
+        return '\n'.join(header + ['', new_content.rstrip('\n')]) + '\n'
+    if not commands:
+        return '\n'.join(header + ['# No changes']) + '\n'
+    changes = sum(1 for command in commands if not command.startswith('#'))
+    return '\n'.join(header + [f"# {changes} commands", ''] + commands) + '\n'
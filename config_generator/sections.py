@@ -0,0 +1,87 @@
+"""
+Section cache and buffer for the Python RouterOS config generators
+
+A generated config is a header followed by sections, and most sections
+depend on a few inputs (the provider's name, its ticket types) or on none
+at all (firewall, NAT, DHCP, the API scripts). Sections with no inputs are
+module-level constants in the generators (FIREWALL_RULES, API_CONFIG, ...)
+and never touch the cache. The rest are rendered by a function of their
+inputs and kept in section_cache under (provider id, section name, inputs).
+Changed inputs give a section a new key, so stale text is never served; old
+versions age out of the LRU. Inputs must be hashable, e.g. tuples of field
+values.
+
+ConfigBuilder collects the header and cached sections as parts of one
+buffer and joins them once, instead of growing the config string section
+by section.
+"""
+from collections import OrderedDict
+import threading
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SectionCache:
+    """LRU of rendered config sections keyed by (provider id, section name, inputs)"""
+
+    def __init__(self, max_entries=None):
+        if max_entries is None:
+            max_entries = getattr(settings, 'CONFIG_SECTION_CACHE_SIZE', 8192)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._sections = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, provider_id, name, render, inputs=()):
+        """Get a section, rendering it with render(*inputs) if it is not cached"""
+        key = (provider_id, name, inputs)
+        with self._lock:
+            text = self._sections.get(key)
+            if text is not None:
+                self._sections.move_to_end(key)
+                self.hits += 1
+                return text
+
+        text = render(*inputs)
+        with self._lock:
+            self.misses += 1
+            if self.max_entries:
+                self._sections[key] = text
+                while len(self._sections) > self.max_entries:
+                    self._sections.popitem(last=False)
+        return text
+
+    def clear(self):
+        with self._lock:
+            self._sections.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._sections)
+
+
+class ConfigBuilder:
+    """Write a config's header and titled sections into one buffer"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, *parts):
+        self._parts.extend(parts)
+        return self
+
+    def section(self, title, content):
+        """Write a section the way the generators lay them out: a title comment, the body, a blank line"""
+        self._parts.extend(('\n# ', title, '\n', content, '\n\n'))
+        return self
+
+    def getvalue(self):
+        return ''.join(self._parts)
+
+
+# Global section cache
+section_cache = SectionCache()
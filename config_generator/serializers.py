@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import MikroTikModel, VoucherType, BandwidthProfile, ConfigTemplate, GeneratedConfig
 
@@ -28,14 +29,54 @@ class ConfigTemplateSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class ConfigTemplateListSerializer(serializers.ModelSerializer):
+    """Config template without its Jinja source, for list endpoints"""
+    mikrotik_model = MikroTikModelSerializer(read_only=True)
+    
+    class Meta:
+        model = ConfigTemplate
+        exclude = ('template_content',)
+    
+    @staticmethod
+    def setup_queryset(queryset):
+        return queryset.select_related('mikrotik_model').defer('template_content')
+
+
+class GeneratedConfigListSerializer(serializers.ModelSerializer):
+    """Generated config summary without its body, for list endpoints"""
+    template_name = serializers.CharField(source='template.name', read_only=True)
+    voucher_type_name = serializers.CharField(source='voucher_type.name', read_only=True)
+    bandwidth_profile_name = serializers.CharField(source='bandwidth_profile.name', read_only=True)
+    
+    class Meta:
+        model = GeneratedConfig
+        fields = (
+            'id', 'config_name', 'hotspot_name', 'hotspot_ip', 'dns_servers',
+            'template', 'template_name', 'voucher_type', 'voucher_type_name',
+            'bandwidth_profile', 'bandwidth_profile_name', 'billing_template',
+            'max_users', 'voucher_length', 'voucher_prefix', 'created_at',
+        )
+    
+    related_names = ('template_name', 'voucher_type_name', 'bandwidth_profile_name')
+    
+    @classmethod
+    def setup_queryset(cls, queryset):
+        """Load only the listed columns, with the related names in the same query"""
+        return queryset.select_related('template', 'voucher_type', 'bandwidth_profile').only(
+            *(field for field in cls.Meta.fields if field not in cls.related_names),
+            'template__name', 'voucher_type__name', 'bandwidth_profile__name'
+        )
+
+
 class GeneratedConfigSerializer(serializers.ModelSerializer):
     template = ConfigTemplateSerializer(read_only=True)
     voucher_type = VoucherTypeSerializer(read_only=True)
     bandwidth_profile = BandwidthProfileSerializer(read_only=True)
+    config_content = serializers.CharField(source='get_content', read_only=True)
     
     class Meta:
         model = GeneratedConfig
-        fields = '__all__'
+        exclude = ('blob',)
         read_only_fields = ('user', 'created_at')
 
 
@@ -52,3 +93,36 @@ class ConfigGenerationSerializer(serializers.Serializer):
     max_users = serializers.IntegerField(default=50)
     voucher_length = serializers.IntegerField(default=8)
     voucher_prefix = serializers.CharField(max_length=10, required=False, allow_blank=True)
+
+
+class BatchSiteSerializer(serializers.Serializer):
+    """One site of a batch config generation request"""
+    config_name = serializers.CharField(max_length=200, required=False)
+    hotspot_name = serializers.CharField(max_length=100)
+    hotspot_ip = serializers.IPAddressField()
+    dns_servers = serializers.CharField(max_length=200)
+    bandwidth_profile_id = serializers.IntegerField(required=False)
+
+
+class BatchConfigGenerationSerializer(serializers.Serializer):
+    """Serializer for generating configs for many sites at once"""
+    template_id = serializers.IntegerField()
+    voucher_type_id = serializers.IntegerField()
+    bandwidth_profile_id = serializers.IntegerField()
+    max_users = serializers.IntegerField(default=50)
+    voucher_length = serializers.IntegerField(default=8)
+    voucher_prefix = serializers.CharField(max_length=10, required=False, allow_blank=True)
+    sites = BatchSiteSerializer(many=True, allow_empty=False)
+    
+    def validate_sites(self, sites):
+        max_sites = getattr(settings, 'CONFIG_BATCH_MAX_SITES', 500)
+        if len(sites) > max_sites:
+            raise serializers.ValidationError(f'At most {max_sites} sites can be generated at once')
+        return sites
+    
+    def validate(self, data):
+        # Sites default to the batch's bandwidth profile and their hotspot name
+        for site in data['sites']:
+            site.setdefault('bandwidth_profile_id', data['bandwidth_profile_id'])
+            site.setdefault('config_name', site['hotspot_name'])
+        return data
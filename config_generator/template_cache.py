@@ -0,0 +1,145 @@
+"""
+Compiled Jinja template cache for RouterOS config generation
+
+ConfigTemplate sources are compiled once per process by a shared Jinja
+Environment and kept in its LRU cache under "config_template/<id>/<updated_at>",
+so editing a template gives it a new name and the old compiled version simply
+ages out. Compiled bytecode is also written to CONFIG_TEMPLATE_BYTECODE_DIR,
+keyed by name and source checksum, so restarted workers load templates
+without re-lexing and re-compiling them. warm_template_cache() compiles the
+active templates when a web process starts.
+
+Rendering output is identical to jinja2.Template(source).render(), which uses
+the same default Environment options.
+"""
+import os
+import tempfile
+import threading
+import logging
+
+from django.conf import settings
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, TemplateNotFound
+
+logger = logging.getLogger(__name__)
+
+
+def template_name(template):
+    """Get the cache name of a ConfigTemplate's current version"""
+    updated_at = template.updated_at.timestamp() if template.updated_at else 0
+    return f"config_template/{template.pk}/{updated_at:.6f}"
+
+
+class ConfigTemplateLoader(BaseLoader):
+    """
+    Load ConfigTemplate sources by cache name.
+
+    Callers that already hold the template hand its source over with
+    provide(), so compiling on a cache miss needs no extra query; otherwise the
+    source is read from the database.
+    """
+
+    def __init__(self):
+        self._provided = {}
+        self._lock = threading.Lock()
+
+    def provide(self, name, source):
+        with self._lock:
+            self._provided[name] = source
+
+    def discard(self, name):
+        with self._lock:
+            self._provided.pop(name, None)
+
+    def get_source(self, environment, name):
+        with self._lock:
+            source = self._provided.pop(name, None)
+        if source is None:
+            source = self._load_source(name)
+        # auto_reload is off: a template's name changes whenever it does
+        return source, None, lambda: True
+
+    def _load_source(self, name):
+        from .models import ConfigTemplate
+
+        try:
+            _, pk, _ = name.split('/')
+            return ConfigTemplate.objects.values_list('template_content', flat=True).get(pk=pk)
+        except (ValueError, ConfigTemplate.DoesNotExist):
+            raise TemplateNotFound(name)
+
+
+def _bytecode_cache():
+    directory = getattr(settings, 'CONFIG_TEMPLATE_BYTECODE_DIR', None)
+    if directory is None:
+        directory = os.path.join(tempfile.gettempdir(), 'hotspot-config-templates')
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"Jinja bytecode cache disabled, cannot create {directory}: {e}")
+        return None
+    return FileSystemBytecodeCache(directory, 'config-template-%s.cache')
+
+
+class ConfigTemplateCache:
+    """Shared Jinja environment compiling each ConfigTemplate version once"""
+
+    def __init__(self):
+        self.loader = ConfigTemplateLoader()
+        self.environment = Environment(
+            loader=self.loader,
+            cache_size=getattr(settings, 'CONFIG_TEMPLATE_CACHE_SIZE', 200),
+            auto_reload=False,
+            bytecode_cache=_bytecode_cache()
+        )
+
+    def get_template(self, template):
+        """Get the compiled Jinja template for a ConfigTemplate"""
+        name = template_name(template)
+        self.loader.provide(name, template.template_content)
+        try:
+            return self.environment.get_template(name)
+        finally:
+            # Drop the source if the compiled template was already cached
+            self.loader.discard(name)
+
+    def render(self, template, context):
+        """Render a ConfigTemplate with the given context"""
+        return self.get_template(template).render(**context)
+
+    def warm(self, templates=None):
+        """Compile templates (by default all active ones); returns how many were compiled"""
+        from .models import ConfigTemplate
+
+        if templates is None:
+            templates = ConfigTemplate.objects.filter(is_active=True).only('id', 'template_content', 'updated_at')
+        warmed = 0
+        for template in templates:
+            try:
+                self.get_template(template)
+                warmed += 1
+            except Exception as e:
+                logger.warning(f"Could not compile config template {template.pk}: {e}")
+        return warmed
+
+
+# Global cache instance
+config_template_cache = ConfigTemplateCache()
+
+
+def render_config_template(template, context):
+    return config_template_cache.render(template, context)
+
+
+def warm_template_cache():
+    """Compile active templates at process start; never fails startup"""
+    if not getattr(settings, 'CONFIG_TEMPLATE_WARMUP', True):
+        return 0
+    try:
+        warmed = config_template_cache.warm()
+    except Exception as e:
+        logger.warning(f"Config template warm-up skipped: {e}")
+        return 0
+    logger.info(f"Compiled {warmed} config templates")
+    return warmed
@@ -0,0 +1,549 @@
+"""
+Tests for config_generator app
+"""
+from datetime import timedelta
+import tempfile
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from jinja2 import Template
+import gzip
+import io
+import os
+import zipfile
+
+from config_generator.models import MikroTikModel, ConfigTemplate, GeneratedConfig, ConfigBlob, VoucherType, BandwidthProfile
+from config_generator.template_cache import ConfigTemplateCache
+from config_generator.blobs import store_blob
+from config_generator.batch import archive_names, generate_batch, zip_stream
+from config_generator.routeros import AmbiguousDelta, RouterConfig, delta_script, diff_scripts
+from config_generator.validator import ScriptError, validate_script
+from config_generator.mikrotik_config import MikroTikConfigGenerator as HotspotConfigGenerator
+from config_generator.mikrotik_generator import MikroTikConfigGenerator, generate_provider_configs
+from config_generator.sections import SectionCache
+
+User = get_user_model()
+
+TEMPLATE_SOURCE = """/ip hotspot profile
+add name={{ hotspot_name }} hotspot-address={{ hotspot_ip }}
+{% for dns in dns_servers %}/ip dns static add address={{ dns }}
+{% endfor %}"""
+
+
+def create_template(source=TEMPLATE_SOURCE):
+    model = MikroTikModel.objects.get_or_create(model_code='hAP-ac2', defaults={'name': 'hAP ac2'})[0]
+    return ConfigTemplate.objects.create(
+        name='Hotspot', description='Basic hotspot', mikrotik_model=model, template_content=source
+    )
+
+
+class ConfigTemplateCacheTest(TestCase):
+    """Test config templates are compiled once per version"""
+
+    def setUp(self):
+        self.bytecode_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.bytecode_dir.cleanup)
+        with override_settings(CONFIG_TEMPLATE_BYTECODE_DIR=self.bytecode_dir.name):
+            self.cache = ConfigTemplateCache()
+        self.context = {'hotspot_name': 'cafe', 'hotspot_ip': '10.5.50.1', 'dns_servers': ['8.8.8.8', '1.1.1.1']}
+
+    def test_render_matches_plain_jinja(self):
+        template = create_template()
+        self.assertEqual(self.cache.render(template, self.context), Template(TEMPLATE_SOURCE).render(**self.context))
+
+    def test_template_is_compiled_once_per_version(self):
+        template = create_template()
+        with mock.patch.object(self.cache.environment, 'compile', wraps=self.cache.environment.compile) as compile_:
+            first = self.cache.get_template(template)
+            self.assertIs(self.cache.get_template(template), first)
+            self.assertEqual(compile_.call_count, 1)
+
+            template.template_content = 'edited {{ hotspot_name }}'
+            template.save()
+            self.assertEqual(self.cache.render(template, self.context), 'edited cafe')
+            self.assertEqual(compile_.call_count, 2)
+
+    def test_restarted_process_loads_bytecode(self):
+        template = create_template()
+        self.cache.get_template(template)
+
+        with override_settings(CONFIG_TEMPLATE_BYTECODE_DIR=self.bytecode_dir.name):
+            restarted = ConfigTemplateCache()
+        with mock.patch.object(restarted.environment, 'compile') as compile_:
+            self.assertEqual(restarted.render(template, self.context), self.cache.render(template, self.context))
+        compile_.assert_not_called()
+
+    def test_warm_compiles_active_templates(self):
+        create_template()
+        inactive = create_template('{{ broken')
+        inactive.is_active = False
+        inactive.save()
+        self.assertEqual(self.cache.warm(), 1)
+        # A broken active template is skipped rather than failing warm-up
+        ConfigTemplate.objects.filter(pk=inactive.pk).update(is_active=True, updated_at=inactive.updated_at + timedelta(seconds=1))
+        self.assertEqual(self.cache.warm(), 1)
+
+
+def create_generated_config(user, content, **fields):
+    template = create_template()
+    return GeneratedConfig.objects.create(
+        user=user,
+        template=template,
+        config_name=fields.pop('config_name', 'cafe'),
+        hotspot_name='cafe',
+        hotspot_ip='10.5.50.1',
+        dns_servers='8.8.8.8',
+        voucher_type=VoucherType.objects.create(name='Daily', duration_hours=24),
+        bandwidth_profile=BandwidthProfile.objects.create(name='5M', download_speed='5M', upload_speed='2M'),
+        **({'blob': store_blob(content)} if fields.pop('as_blob', True) else {'config_content': content}),
+        **fields
+    )
+
+
+class ConfigBlobTest(TestCase):
+    """Test config bodies are stored once, compressed, and streamed as gzip"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='owner@example.com', username='owner', password='testpass123')
+        self.client.force_login(self.user)
+        self.async_client.force_login(self.user)
+        self.content = '\n'.join(f'/ip hotspot user add name=user{i} password=secret{i}' for i in range(500))
+
+    def test_identical_bodies_share_one_blob(self):
+        first = create_generated_config(self.user, self.content)
+        second = create_generated_config(self.user, self.content, config_name='copy')
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(ConfigBlob.objects.count(), 1)
+
+        blob = ConfigBlob.objects.get()
+        self.assertLess(blob.compressed_size * 5, blob.size)
+        self.assertEqual(GeneratedConfig.objects.get(pk=second.pk).get_content(), self.content)
+
+    def test_download_sends_stored_gzip_bytes(self):
+        config = create_generated_config(self.user, self.content)
+        url = reverse('download_config', args=[config.id])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = b''.join(response.streaming_content)
+        self.assertEqual(body, bytes(ConfigBlob.objects.get().data))
+        self.assertEqual(gzip.decompress(body).decode(), self.content)
+
+        plain = self.client.get(url)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(plain.streaming_content).decode(), self.content)
+
+    async def test_download_streams_under_asgi(self):
+        config = await sync_to_async(create_generated_config)(self.user, self.content)
+
+        response = await self.async_client.get(reverse('download_config', args=[config.id]))
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.__aiter__()])
+        self.assertEqual(body.decode(), self.content)
+
+    def test_compact_moves_legacy_bodies(self):
+        legacy = [create_generated_config(self.user, self.content, as_blob=False, config_name=f'old{i}') for i in range(3)]
+        call_command('compact_generated_configs', batch_size=2, stdout=io.StringIO())
+
+        self.assertEqual(ConfigBlob.objects.count(), 1)
+        for config in GeneratedConfig.objects.filter(pk__in=[config.pk for config in legacy]):
+            self.assertEqual(config.config_content, '')
+            self.assertEqual(config.get_content(), self.content)
+
+
+class ConfigListTest(TestCase):
+    """Test list endpoints return summaries without loading config bodies"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='lister@example.com', username='lister', password='testpass123')
+        self.client.force_login(self.user)
+
+    def test_generated_list_omits_bodies(self):
+        create_generated_config(self.user, '/ip hotspot user add name=a', as_blob=False)
+
+        with self.assertNumQueries(3):  # session, user, configs
+            response = self.client.get(reverse('generated_configs'))
+        self.assertEqual(response.status_code, 200)
+        config = response.json()['results'][0] if 'results' in response.json() else response.json()[0]
+        self.assertNotIn('config_content', config)
+        self.assertEqual(config['template_name'], 'Hotspot')
+        self.assertEqual(config['voucher_type_name'], 'Daily')
+
+        templates = self.client.get(reverse('config_templates')).json()
+        template = templates['results'][0] if 'results' in templates else templates[0]
+        self.assertNotIn('template_content', template)
+        self.assertEqual(template['mikrotik_model']['model_code'], 'hAP-ac2')
+
+
+class BatchGenerationTest(TestCase):
+    """Test configs for many sites are rendered in a pool and stored in bulk"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(email='chain@example.com', username='chain', password='testpass123')
+        self.template = create_template()
+        self.voucher_type = VoucherType.objects.create(name='Daily', duration_hours=24)
+        self.profile = BandwidthProfile.objects.create(name='5M', download_speed='5M', upload_speed='2M')
+        self.sites = [
+            {'config_name': f'site {i}', 'hotspot_name': f'site{i}', 'hotspot_ip': f'10.5.{i}.1',
+             'dns_servers': '8.8.8.8,1.1.1.1', 'bandwidth_profile_id': self.profile.id}
+            for i in range(6)
+        ]
+        self.options = {'max_users': 50, 'voucher_length': 8}
+
+    def test_pool_renders_every_site_in_one_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            generated = generate_batch(
+                self.user, self.template, self.voucher_type, self.sites, self.options,
+                {self.profile.id: self.profile}, workers=3
+            )
+        # One insert for the blobs, one for the configs
+        self.assertEqual(sum('INSERT' in query['sql'] for query in queries.captured_queries), 2)
+
+        self.assertEqual(GeneratedConfig.objects.filter(user=self.user).count(), 6)
+        for (config, content), site in zip(generated, self.sites):
+            expected = Template(TEMPLATE_SOURCE).render(hotspot_name=site['hotspot_name'], hotspot_ip=site['hotspot_ip'],
+                                                        dns_servers=site['dns_servers'].split(','))
+            self.assertEqual(content, expected)
+            self.assertEqual(GeneratedConfig.objects.get(pk=config.pk).get_content(), expected)
+
+        names = archive_names(config.config_name for config, _ in generated)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(zip_stream(zip(names, (c for _, c in generated))))))
+        self.assertEqual(archive.namelist(), [f'site_{i}.rsc' for i in range(6)])
+        self.assertEqual(archive.read('site_0.rsc').decode(), generated[0][1])
+
+    def batch_payload(self):
+        return {
+            'template_id': self.template.id, 'voucher_type_id': self.voucher_type.id,
+            'bandwidth_profile_id': self.profile.id,
+            'sites': [{key: site[key] for key in ('hotspot_name', 'hotspot_ip', 'dns_servers')} for site in self.sites[:2]],
+        }
+
+    def subscribe(self, provider):
+        from subscriptions.models import ProviderSubscription, ProviderSubscriptionPlan
+
+        plan = ProviderSubscriptionPlan.objects.create(name='Basic', plan_type='basic', description='Basic',
+                                                       price=1000, duration_days=30)
+        return ProviderSubscription.objects.create(provider=provider, plan=plan, status='active', amount_paid=1000)
+
+    @override_settings(CONFIG_BATCH_WORKERS=1)
+    def test_batch_endpoint_checks_subscription_and_records_usage(self):
+        from payments.tests import create_provider
+        from subscriptions.models import SubscriptionUsage
+
+        provider = create_provider('batch@example.com')
+        self.client.force_login(provider.user)
+        url = reverse('generate_config_batch')
+        payload = self.batch_payload()
+        self.assertEqual(self.client.post(url, payload, content_type='application/json').status_code, 403)
+
+        subscription = self.subscribe(provider)
+        response = self.client.post(url, payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(archive.namelist(), ['site0.rsc', 'site1.rsc'])
+        self.assertEqual(len(response['X-Config-Ids'].split(',')), 2)
+        self.assertEqual(SubscriptionUsage.objects.get(subscription=subscription).total_configs_generated, 2)
+
+    @override_settings(CONFIG_BATCH_WORKERS=1)
+    async def test_batch_endpoint_streams_under_asgi(self):
+        from payments.tests import create_provider
+
+        provider = await sync_to_async(create_provider)('batch@example.com')
+        await sync_to_async(self.subscribe)(provider)
+        await sync_to_async(self.async_client.force_login)(provider.user)
+
+        response = await self.async_client.post(reverse('generate_config_batch'), self.batch_payload(),
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        archive = zipfile.ZipFile(io.BytesIO(b''.join([chunk async for chunk in response.__aiter__()])))
+        self.assertEqual(archive.namelist(), ['site0.rsc', 'site1.rsc'])
+
+    def test_command_writes_archive(self):
+        with tempfile.TemporaryDirectory() as directory:
+            sites_path = os.path.join(directory, 'sites.csv')
+            with open(sites_path, 'w') as sites_file:
+                sites_file.write('hotspot_name,hotspot_ip,dns_servers\ncafe,10.5.50.1,8.8.8.8\ncafe,10.5.51.1,8.8.8.8\n')
+            output = os.path.join(directory, 'configs.zip')
+            call_command(
+                'generate_site_configs', sites_path, output, user=self.user.email, template=self.template.id,
+                voucher_type=self.voucher_type.id, bandwidth_profile=self.profile.id, workers=1,
+                stdout=io.StringIO()
+            )
+            self.assertEqual(zipfile.ZipFile(output).namelist(), ['cafe.rsc', 'cafe-2.rsc'])
+        self.assertEqual(GeneratedConfig.objects.filter(hotspot_name='cafe').count(), 2)
+
+
+ROUTER_SCRIPT = """# Generated on 2026-10-01 10:00:00
+/system identity set name="Cafe Hotspot"
+/ip pool add name=hotspot-pool ranges=192.168.1.10-192.168.1.254
+/ip hotspot user profile add name=profile_1
+/ip hotspot user profile set profile_1 rate-limit=5M/2M session-timeout=3600
+/ip hotspot user profile add name=profile_2 rate-limit=10M/5M
+/ip firewall filter add chain=input action=accept src-address=10.0.0.0/24
+/ip firewall filter add chain=input action=drop
+/system script add name=remove-user source={
+    /ip hotspot user remove [find name=$username]
+}
+/ip service set api disabled=no \\
+    port=8728
+"""
+
+
+class RouterConfigDeltaTest(TestCase):
+    """Test generated configs are diffed into minimal delta scripts"""
+
+    def test_parse_keys_entries(self):
+        config = RouterConfig.parse(ROUTER_SCRIPT)
+        profile = config.entries[('/ip hotspot user profile', 'profile_1')]
+        self.assertEqual(profile.args['rate-limit'], '5M/2M')
+        self.assertEqual(config.entries[('/ip service', 'api')].args['port'], '8728')
+        self.assertIn(('/system script', 'remove-user'), config.entries)
+        self.assertEqual(len(config), 8)
+
+    def test_delta_contains_only_changes(self):
+        new = ROUTER_SCRIPT.replace('2026-10-01', '2026-10-02').replace(
+            'rate-limit=5M/2M session-timeout=3600', 'rate-limit=8M/2M'
+        ).replace('/ip hotspot user profile add name=profile_2 rate-limit=10M/5M\n', '').replace(
+            'src-address=10.0.0.0/24', 'src-address=10.0.1.0/24'
+        ) + '/ip hotspot user profile add name=profile_3 rate-limit=1M/1M\n'
+
+        self.assertEqual(diff_scripts(ROUTER_SCRIPT, ROUTER_SCRIPT.replace('10:00', '11:00')), [])
+        self.assertEqual(diff_scripts(ROUTER_SCRIPT, new), [
+            '/ip firewall filter remove [find where chain="input" and action="accept" and src-address="10.0.0.0/24"]',
+            '/ip hotspot user profile remove [find name="profile_2"]',
+            '/ip hotspot user profile set [find name="profile_1"] rate-limit=8M/2M',
+            '/ip hotspot user profile unset [find name="profile_1"] session-timeout',
+            # The changed rule keeps its place ahead of the drop rule
+            '/ip firewall filter add chain=input action=accept src-address=10.0.1.0/24 '
+            'place-before=[find where chain="input" and action="drop"]',
+            '/ip hotspot user profile add name=profile_3 rate-limit=1M/1M',
+        ])
+        self.assertEqual(validate_script('\n'.join(diff_scripts(ROUTER_SCRIPT, new)) + '\n'), [])
+
+    def test_rule_matched_by_a_superset_is_ambiguous(self):
+        old = ROUTER_SCRIPT + (
+            '/ip firewall filter add chain=forward action=drop\n'
+            '/ip firewall filter add chain=forward action=drop protocol=tcp dst-port=25\n'
+        )
+        # Removing the plain drop rule would also remove the port 25 rule
+        with self.assertRaises(AmbiguousDelta):
+            diff_scripts(old, old.replace('/ip firewall filter add chain=forward action=drop\n', ''))
+        # The port 25 rule itself is selected exactly
+        self.assertEqual(
+            diff_scripts(old, old.replace('/ip firewall filter add chain=forward action=drop protocol=tcp dst-port=25\n', '')),
+            ['/ip firewall filter remove [find where chain="forward" and action="drop" and protocol="tcp" and dst-port="25"]'],
+        )
+        # A rule placed before the drop rule cannot tell it from the drop rule with extra properties
+        udp = ROUTER_SCRIPT + '/ip firewall filter add chain=input action=drop protocol=udp\n'
+        with self.assertRaises(AmbiguousDelta):
+            diff_scripts(udp, udp.replace('10.0.0.0/24', '10.0.1.0/24'))
+
+    def test_duplicate_rules_are_ambiguous(self):
+        duplicated = ROUTER_SCRIPT + '/ip firewall filter add chain=input action=drop\n'
+        with self.assertRaises(AmbiguousDelta):
+            diff_scripts(duplicated, ROUTER_SCRIPT)
+        # Adding a duplicate at the end needs no selector
+        self.assertEqual(diff_scripts(ROUTER_SCRIPT, duplicated), ['/ip firewall filter add chain=input action=drop'])
+
+    def test_ambiguous_delta_falls_back_to_full_config(self):
+        user = User.objects.create_user(email='full@example.com', username='full', password='testpass123')
+        duplicated = ROUTER_SCRIPT + '/ip firewall filter add chain=input action=drop\n'
+        old = create_generated_config(user, duplicated)
+        new = create_generated_config(user, ROUTER_SCRIPT, config_name='v2')
+
+        script = delta_script(old, new)
+        self.assertIn('full config follows', script)
+        self.assertTrue(script.endswith(ROUTER_SCRIPT))
+
+    def test_delta_endpoint(self):
+        user = User.objects.create_user(email='delta@example.com', username='delta', password='testpass123')
+        self.client.force_login(user)
+        old = create_generated_config(user, ROUTER_SCRIPT)
+        new = create_generated_config(user, ROUTER_SCRIPT.replace('5M/2M', '6M/2M'), config_name='v2')
+
+        response = self.client.get(reverse('config_delta', args=[old.id, new.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('/ip hotspot user profile set [find name="profile_1"] rate-limit=6M/2M', response.content.decode())
+
+
+class BulkUserScriptTest(TestCase):
+    """Test voucher batches export as one streamed, idempotent import script"""
+
+    def setUp(self):
+        from payments.tests import create_provider
+        from tickets.models import Ticket, TicketType
+
+        self.provider = create_provider()
+        self.provider.user.user_type = 'provider'
+        self.provider.user.save()
+        self.client.force_login(self.provider.user)
+        self.async_client.force_login(self.provider.user)
+        ticket_type = TicketType.objects.create(
+            provider=self.provider, name='1 Hour WiFi', type='time', duration_hours=1, price=20
+        )
+        expires_at = timezone.now() + timedelta(days=1)
+        self.tickets = [
+            Ticket.objects.create(provider=self.provider, ticket_type=ticket_type, expires_at=expires_at)
+            for _ in range(5)
+        ]
+        Ticket.objects.create(provider=self.provider, ticket_type=ticket_type, expires_at=expires_at, status='cancelled')
+
+    @mock.patch('config_generator.mikrotik_generator.MikroTikConfigGenerator.IMPORT_BLOCK_SIZE', 2)
+    def test_export_streams_blocks(self):
+        response = self.client.get(reverse('provider:export_tickets_script'), {'status': 'active'})
+        self.assertTrue(response.streaming)
+        script = b''.join(response.streaming_content).decode()
+
+        self.assertEqual(script.count(':do {'), 3)
+        self.assertEqual(validate_script(script), [])
+        self.assertIn(':log info "Hotspot user add: 4/5"', script)
+        for ticket in self.tickets:
+            self.assertIn(f':if ([:len [/ip hotspot user find name="{ticket.username}"]] = 0) do={{'
+                          f'/ip hotspot user add name="{ticket.username}" password="{ticket.password}"', script)
+
+        removal = b''.join(self.client.get(
+            reverse('provider:export_tickets_script'), {'status': 'cancelled', 'action': 'remove'}
+        ).streaming_content).decode()
+        self.assertEqual(removal.count('/ip hotspot user remove [find name='), 1)
+
+    @mock.patch('config_generator.mikrotik_generator.MikroTikConfigGenerator.IMPORT_BLOCK_SIZE', 2)
+    async def test_export_streams_blocks_under_asgi(self):
+        response = await self.async_client.get(reverse('provider:export_tickets_script'), {'status': 'active'})
+        self.assertTrue(response.is_async)
+        # Blocks arrive one by one rather than as one buffered body
+        chunks = [chunk async for chunk in response.__aiter__()]
+        self.assertGreater(len(chunks), 3)
+        script = b''.join(chunks).decode()
+        self.assertEqual(script.count(':do {'), 3)
+        self.assertEqual(validate_script(script), [])
+
+
+BROKEN_SCRIPT = """/ip hotspot user profile add name="day pass"
+    rate-limit=5M/2M
+/ip hotspot user manager add name=x
+/ip hotspot profile add name=hsprof1 use-https=yes
+/ip hotspot setup
+/ip hotspot user add name=ab"c" password=x
+:if ($x) do={
+    /queue simple add name=q max-limits=1M/1M
+}
+/ip dns static add name=my host.local address=10.0.0.1
+/system identity set name="Cafe ]
+"""
+
+
+class ScriptValidatorTest(TestCase):
+    """Test generated scripts are checked against the RouterOS command schema"""
+
+    def test_valid_script_has_no_errors(self):
+        self.assertEqual(validate_script(ROUTER_SCRIPT), [])
+
+    def test_errors_are_reported_by_line(self):
+        errors = validate_script(BROKEN_SCRIPT)
+        self.assertEqual([error.line for error in errors], [2, 3, 4, 5, 6, 8, 10, 11, 11])
+        self.assertIn('needs a backslash', errors[0].message)
+        self.assertEqual(errors[1], ScriptError(3, "unknown menu '/ip hotspot user manager'"))
+        self.assertEqual(errors[2].message, "'/ip hotspot profile' has no property 'use-https'")
+        self.assertIn('interactive', errors[3].message)
+        self.assertEqual(errors[4].message, "badly quoted value for 'name'")
+        self.assertEqual(errors[5].message, "'/queue simple' has no property 'max-limits'")
+        self.assertIn("unexpected 'host.local'", errors[6].message)
+        self.assertEqual(errors[8].message, 'unterminated string')
+
+    def test_command_reports_stored_configs(self):
+        user = User.objects.create_user(email='check@example.com', username='check', password='testpass123')
+        create_generated_config(user, ROUTER_SCRIPT)
+        create_generated_config(user, BROKEN_SCRIPT, config_name='broken')
+
+        out = io.StringIO()
+        with self.assertRaises(CommandError):
+            call_command('validate_generated_configs', fail=True, stdout=out)
+        self.assertIn('(broken): 9 errors', out.getvalue())
+        self.assertIn('line 3: unknown menu', out.getvalue())
+
+
+class SectionCacheTest(TestCase):
+    """Test the Python generators only re-render sections whose inputs changed"""
+
+    def setUp(self):
+        from payments.tests import create_provider
+        from tickets.models import TicketType
+
+        self.providers = [create_provider(f'site{i}@example.com') for i in range(3)]
+        for provider in self.providers:
+            TicketType.objects.create(provider=provider, name='1 Hour WiFi', type='time', duration_hours=1, price=20)
+        self.cache = SectionCache(max_entries=100)
+
+    def test_unchanged_sections_come_from_cache(self):
+        from accounts.models import Provider
+
+        providers = Provider.objects.filter(pk__in=[p.pk for p in self.providers]).order_by('pk')
+        with self.assertNumQueries(2):
+            first = dict(generate_provider_configs(providers, cache=self.cache))
+        self.assertEqual(self.cache.hits, 0)
+        misses = self.cache.misses
+
+        second = dict(generate_provider_configs(providers, cache=self.cache))
+        self.assertEqual((self.cache.hits, self.cache.misses), (misses, misses))
+        self.assertEqual(
+            [config.split('\n', 4)[4] for config in first.values()],
+            [config.split('\n', 4)[4] for config in second.values()]
+        )
+
+        provider = self.providers[0]
+        provider.ticket_types.update(download_speed_mbps=20)
+        config = MikroTikConfigGenerator(provider, cache=self.cache).generate_advanced_config(provider.ticket_types.all())
+        self.assertIn('rate-limit=20M/2M', config)
+        # Only the ticket profiles were rendered again
+        self.assertEqual(self.cache.misses, misses + 1)
+
+    def test_hotspot_config_sections(self):
+        generator = HotspotConfigGenerator(self.providers[0], cache=self.cache)
+        basic = generator.generate_basic_hotspot_config()
+        advanced = generator.generate_advanced_hotspot_config()
+        self.assertIn('/ip hotspot user profile add name="1 Hour WiFi" local-address=192.168.1.1', basic)
+        self.assertNotIn('/system logging add', basic)
+        self.assertIn('/system logging add', advanced)
+        self.assertTrue(advanced.endswith('/ip hotspot user profile set default rate-limit="1M/1M"\n'))
+        # The ticket profiles are the same for both and rendered once
+        self.assertEqual(self.cache.hits, 1)
+
+
+class BenchmarkCommandTest(TestCase):
+    """Test the generation benchmarks run, record a baseline and flag regressions"""
+
+    def test_baseline_round_trip(self):
+        import json
+
+        with tempfile.TemporaryDirectory() as directory:
+            baseline = os.path.join(directory, 'baseline.json')
+            out = io.StringIO()
+            call_command('benchmark_config_generation', size=['small'], repeat=1, baseline=baseline,
+                         save_baseline=True, stdout=out)
+            self.assertIn('hotspot_config/small', out.getvalue())
+            with open(baseline) as f:
+                recorded = json.load(f)
+            self.assertEqual(len(recorded['results']), 6)
+            self.assertGreater(recorded['results']['jinja/small']['output_bytes'], 0)
+
+            # A baseline far faster than this run makes every case a regression
+            for result in recorded['results'].values():
+                result['seconds'] /= 100
+            with open(baseline, 'w') as f:
+                json.dump(recorded, f)
+            out = io.StringIO()
+            with self.assertRaises(CommandError):
+                call_command('benchmark_config_generation', case=['bulk_users'], size=['small'], repeat=1,
+                             baseline=baseline, fail=True, stdout=out)
+            self.assertIn('REGRESSION', out.getvalue())
+        # Seeded rows are rolled back
+        self.assertFalse(ConfigTemplate.objects.filter(name__startswith='Benchmark').exists())
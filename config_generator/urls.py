@@ -8,6 +8,8 @@ urlpatterns = [
     path('templates/', views.ConfigTemplateListView.as_view(), name='config_templates'),
     path('generated/', views.GeneratedConfigListView.as_view(), name='generated_configs'),
     path('generate/', views.generate_config, name='generate_config'),
+    path('generate/batch/', views.generate_config_batch, name='generate_config_batch'),
     path('download/<int:config_id>/', views.download_config, name='download_config'),
     path('preview/<int:config_id>/', views.config_preview, name='config_preview'),
+    path('delta/<int:from_id>/<int:to_id>/', views.config_delta, name='config_delta'),
 ]
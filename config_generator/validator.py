@@ -0,0 +1,222 @@
+"""
+RouterOS script validation against a bundled command schema
+
+validate_script() checks a generated .rsc the way the router's /import
+would read it, without a router. It reports, with the line each problem
+starts on:
+
+  - quotes, brackets and braces left open, and stray closing ones,
+  - menus that do not exist (e.g. /ip hotspot user manager),
+  - commands a menu does not have, and interactive ones such as setup,
+  - property names a menu does not take,
+  - badly quoted values, and values split by unquoted spaces,
+  - lines that start with name=value, which is what the rest of a command
+    becomes when it is wrapped over several lines without a trailing
+    backslash.
+
+Known menus, their commands and properties, and the scripting commands
+(:local, :if, ...) are read from routeros_schema.json. Script bodies in {}
+(:do, :if, /system script source=...) are checked as scripts of their own.
+
+Each command is split once (routeros.iter_commands and split_words) and
+checked with set lookups, so the cost is linear in the script length and
+validation can run on every generation and over all stored configs.
+"""
+import json
+import logging
+import os
+
+from .routeros import VERBS, iter_commands, menu_path, split_words
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_PATH = os.path.join(os.path.dirname(__file__), 'routeros_schema.json')
+
+# Commands whose arguments are a where-expression or output flags, not properties
+QUERY_COMMANDS = {'print', 'export', 'find'}
+# Commands that take positional words (item numbers, names, a log message)
+POSITIONAL_COMMANDS = {
+    'set', 'unset', 'remove', 'enable', 'disable', 'comment', 'move', 'get', 'edit', 'run',
+    'reset-counters', 'info', 'warning', 'error', 'debug', 'reset-html', 'make-binding', 'load',
+}
+# Arguments taken by every command that selects items
+COMMON_ARGUMENTS = {'numbers', '.id', 'value-name', 'destination'}
+
+
+class ScriptError:
+    """A problem found in a script"""
+
+    __slots__ = ('line', 'message')
+
+    def __init__(self, line, message):
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        return f"line {self.line}: {self.message}"
+
+    def __repr__(self):
+        return f"ScriptError({self.line}, {self.message!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, ScriptError) and (self.line, self.message) == (other.line, other.message)
+
+
+class ScriptSchema:
+    """Menus with the commands and properties they accept"""
+
+    def __init__(self, data):
+        command_sets = data.get('command_sets', {})
+        self.menus = {}
+        for path, menu in data['menus'].items():
+            commands = menu.get('commands', 'list')
+            if isinstance(commands, str):
+                commands = command_sets[commands]
+            self.menus[path] = (frozenset(commands), frozenset(menu.get('properties', ())))
+        self.script_commands = frozenset(data.get('script_commands', ()))
+        self.interactive_commands = frozenset(data.get('interactive_commands', ()))
+        self.verbs = frozenset(VERBS).union(*(commands for commands, _ in self.menus.values()))
+
+    @classmethod
+    def load(cls, path=SCHEMA_PATH):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+
+def _badly_quoted(value):
+    """Check a value's quoting: one whole string literal, or no quotes at all"""
+    if '"' not in value:
+        return False
+    if len(value) < 2 or value[0] != '"' or value[-1] != '"':
+        return True
+    escaped = False
+    for char in value[1:-1]:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            return True
+    return escaped
+
+
+class ScriptValidator:
+    """Check RouterOS scripts against a schema"""
+
+    def __init__(self, schema=None):
+        self.schema = schema or ScriptSchema.load()
+
+    def validate(self, text):
+        """Get the ScriptErrors of a script, ordered by line"""
+        errors = []
+        self._check_script(text, 1, errors)
+        errors.sort(key=lambda error: error.line)
+        return errors
+
+    def _check_script(self, text, first_line, errors):
+        scan_errors = []
+        menu = '/'
+        for line, command in iter_commands(text, scan_errors):
+            line += first_line - 1
+            try:
+                menu = self._check_command(command, line, menu, errors)
+            except Exception as e:
+                # A validator bug must not stop generation; report the line instead
+                logger.exception(f"Validating line {line} failed")
+                errors.append(ScriptError(line, f"could not be checked: {e}"))
+        errors.extend(ScriptError(line + first_line - 1, message) for line, message in scan_errors)
+
+    def _check_command(self, command, line, menu, errors):
+        """Check one command; returns the menu following commands run in"""
+        words = split_words(command)
+        first = words[0]
+
+        if first.startswith(':'):
+            name = first[1:]
+            if name not in self.schema.script_commands:
+                errors.append(ScriptError(line, f"unknown script command ':{name}'"))
+            self._check_blocks(command, words[1:], line, errors)
+            return menu
+
+        if first.startswith('/'):
+            menu = menu_path(words, self.schema.verbs)
+            if menu not in self.schema.menus and menu != '/':
+                errors.append(ScriptError(line, f"unknown menu '{menu}'"))
+                return None
+            if not words:
+                return menu
+        elif menu is None:
+            # The current menu is unknown and was already reported
+            return menu
+        elif '=' in first and not first.startswith(('[', '{', '(')):
+            errors.append(ScriptError(
+                line, f"'{first.split('=', 1)[0]}=' does not start a command; "
+                      "a command continued on this line needs a backslash at the end of the line before"
+            ))
+            return menu
+
+        if menu == '/':
+            errors.append(ScriptError(line, f"'{words[0]}' is not a command outside a menu"))
+            return menu
+        self._check_arguments(command, menu, words, line, errors)
+        return menu
+
+    def _check_arguments(self, command, menu, words, line, errors):
+        commands, properties = self.schema.menus[menu]
+        verb = words[0]
+        if verb not in commands:
+            errors.append(ScriptError(line, f"'{menu}' has no command '{verb}'"))
+            return
+        if verb in self.schema.interactive_commands:
+            errors.append(ScriptError(line, f"'{menu} {verb}' is interactive and cannot run from an import"))
+            return
+        if verb in QUERY_COMMANDS:
+            return
+
+        positional = 0
+        for word in words[1:]:
+            if word.startswith(('[', '(', '$')):
+                positional += 1
+                continue
+            if word.startswith('{'):
+                self._check_block(command, word, line, errors)
+                continue
+            key, sep, value = word.partition('=')
+            if not sep:
+                positional += 1
+                if verb not in POSITIONAL_COMMANDS or positional > 2:
+                    errors.append(ScriptError(
+                        line, f"unexpected '{word}' in '{menu} {verb}' (a value with spaces must be quoted)"
+                    ))
+                continue
+            if key not in properties and key not in COMMON_ARGUMENTS:
+                errors.append(ScriptError(line, f"'{menu}' has no property '{key}'"))
+            elif value.startswith('{'):
+                self._check_block(command, value, line, errors)
+            elif value.startswith(('[', '(', '$')):
+                # An expression, e.g. place-before=[find where ...]
+                continue
+            elif _badly_quoted(value):
+                errors.append(ScriptError(line, f"badly quoted value for '{key}'"))
+
+    def _check_blocks(self, command, words, line, errors):
+        for word in words:
+            value = word.partition('=')[2] if not word.startswith('{') else word
+            if value.startswith('{'):
+                self._check_block(command, value, line, errors)
+
+    def _check_block(self, command, block, line, errors):
+        if not block.endswith('}'):
+            # Left open; already reported by the scan
+            return
+        offset = command[:command.find(block)].count('\n')
+        self._check_script(block[1:-1], line + offset, errors)
+
+
+def validate_script(text):
+    """Get the ScriptErrors of a RouterOS script"""
+    return script_validator.validate(text)
+
+
+# Global validator with the bundled schema
+script_validator = ScriptValidator()
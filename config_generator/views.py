@@ -1,17 +1,29 @@
 from rest_framework import generics, status, permissions
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
-from django.shortcuts import get_object_or_404
 from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django.template.loader import render_to_string
-from jinja2 import Template
+from .template_cache import render_config_template
+from hotspot_config.streaming import streaming_response
+from .blobs import store_blob, config_download_response
+from .batch import archive_names, generate_batch, site_context, zip_stream
+from .routeros import delta_script
+from .validator import validate_script
 from .models import MikroTikModel, VoucherType, BandwidthProfile, ConfigTemplate, GeneratedConfig
 from .serializers import (
     MikroTikModelSerializer, VoucherTypeSerializer, BandwidthProfileSerializer,
-    ConfigTemplateSerializer, GeneratedConfigSerializer, ConfigGenerationSerializer
+    ConfigTemplateListSerializer, GeneratedConfigListSerializer, ConfigGenerationSerializer,
+    BatchConfigGenerationSerializer
 )
-from subscriptions.models import ProviderSubscription
+from subscriptions.models import SubscriptionUsage
+from django.db.models import F
+from django.conf import settings
 import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class MikroTikModelListView(generics.ListAPIView):
@@ -37,42 +49,64 @@ class BandwidthProfileListView(generics.ListAPIView):
 
 class ConfigTemplateListView(generics.ListAPIView):
     """List all config templates"""
-    queryset = ConfigTemplate.objects.filter(is_active=True)
-    serializer_class = ConfigTemplateSerializer
+    queryset = ConfigTemplateListSerializer.setup_queryset(ConfigTemplate.objects.filter(is_active=True))
+    serializer_class = ConfigTemplateListSerializer
     permission_classes = [permissions.AllowAny]
 
 
 class GeneratedConfigListView(generics.ListAPIView):
     """List user's generated configs"""
-    serializer_class = GeneratedConfigSerializer
+    serializer_class = GeneratedConfigListSerializer
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return GeneratedConfig.objects.filter(user=self.request.user)
+        return GeneratedConfigListSerializer.setup_queryset(GeneratedConfig.objects.filter(user=self.request.user))
+
+
+def _active_subscription(user):
+    """Get the user's provider subscription, or an error response if there is no active one"""
+    provider = getattr(user, 'provider_profile', None)
+    if provider is None:
+        return None, Response(
+            {'error': 'Only providers can generate configurations'}, 
+            status=status.HTTP_403_FORBIDDEN
+        )
+    
+    subscription = provider.subscriptions.filter(status='active').order_by('-created_at').first()
+    if subscription is None:
+        return None, Response(
+            {'error': 'No active subscription'}, 
+            status=status.HTTP_403_FORBIDDEN
+        )
+    if subscription.is_expired():
+        return None, Response(
+            {'error': 'ProviderSubscription expired'}, 
+            status=status.HTTP_403_FORBIDDEN
+        )
+    return subscription, None
+
+
+def _record_usage(subscription, configs):
+    usage, created = SubscriptionUsage.objects.get_or_create(subscription=subscription)
+    SubscriptionUsage.objects.filter(pk=usage.pk).update(
+        total_configs_generated=F('total_configs_generated') + configs
+    )
+
+
+def _script_errors(content):
+    """Check a generated script against the RouterOS schema; returns error lines"""
+    if not getattr(settings, 'CONFIG_VALIDATE_SCRIPTS', True):
+        return []
+    return [str(error) for error in validate_script(content)]
 
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def generate_config(request):
     """Generate MikroTik configuration"""
-    # Check if user has active subscription
-    try:
-        subscription = ProviderSubscription.objects.filter(
-            user=request.user,
-            is_active=True,
-            status='active'
-        ).latest('created_at')
-        
-        if subscription.is_expired():
-            return Response(
-                {'error': 'ProviderSubscription expired'}, 
-                status=status.HTTP_403_FORBIDDEN
-            )
-    except ProviderSubscription.DoesNotExist:
-        return Response(
-            {'error': 'No active subscription'}, 
-            status=status.HTTP_403_FORBIDDEN
-        )
+    subscription, error = _active_subscription(request.user)
+    if error:
+        return error
     
     serializer = ConfigGenerationSerializer(data=request.data)
     if not serializer.is_valid():
@@ -86,22 +120,11 @@ def generate_config(request):
     bandwidth_profile = get_object_or_404(BandwidthProfile, id=data['bandwidth_profile_id'], is_active=True)
     
     # Prepare template context
-    context = {
-        'hotspot_name': data['hotspot_name'],
-        'hotspot_ip': data['hotspot_ip'],
-        'dns_servers': data['dns_servers'].split(','),
-        'voucher_type': voucher_type,
-        'bandwidth_profile': bandwidth_profile,
-        'max_users': data['max_users'],
-        'voucher_length': data['voucher_length'],
-        'voucher_prefix': data.get('voucher_prefix', ''),
-        'user': request.user,
-    }
+    context = site_context(data, voucher_type, bandwidth_profile, data, request.user)
     
     # Generate config using Jinja2
     try:
-        jinja_template = Template(template.template_content)
-        config_content = jinja_template.render(**context)
+        config_content = render_config_template(template, context)
     except Exception as e:
         return Response(
             {'error': f'Template rendering failed: {str(e)}'}, 
@@ -113,7 +136,7 @@ def generate_config(request):
         user=request.user,
         template=template,
         config_name=data['config_name'],
-        config_content=config_content,
+        blob=store_blob(config_content),
         hotspot_name=data['hotspot_name'],
         hotspot_ip=data['hotspot_ip'],
         dns_servers=data['dns_servers'],
@@ -125,26 +148,92 @@ def generate_config(request):
     )
     
     # Update subscription usage
-    from subscriptions.models import ProviderSubscriptionUsage
-    usage, created = ProviderSubscriptionUsage.objects.get_or_create(subscription=subscription)
-    usage.configs_generated += 1
-    usage.save()
+    _record_usage(subscription, 1)
+    
+    validation_errors = _script_errors(config_content)
+    if validation_errors:
+        logger.warning(
+            f"Config {generated_config.id} from template {template.id} has {len(validation_errors)} script errors"
+        )
     
     return Response({
         'config_id': generated_config.id,
         'config_content': config_content,
+        'validation_errors': validation_errors,
         'download_url': f'/api/config/download/{generated_config.id}/'
     }, status=status.HTTP_201_CREATED)
 
 
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def generate_config_batch(request):
+    """Generate configs for many sites and download them as one zip archive"""
+    subscription, error = _active_subscription(request.user)
+    if error:
+        return error
+    
+    serializer = BatchConfigGenerationSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    data = serializer.validated_data
+    sites = data.pop('sites')
+    
+    template = get_object_or_404(ConfigTemplate, id=data['template_id'], is_active=True)
+    voucher_type = get_object_or_404(VoucherType, id=data['voucher_type_id'], is_active=True)
+    profile_ids = {site['bandwidth_profile_id'] for site in sites}
+    bandwidth_profiles = BandwidthProfile.objects.filter(id__in=profile_ids, is_active=True).in_bulk()
+    if len(bandwidth_profiles) != len(profile_ids):
+        return Response(
+            {'error': f'Unknown bandwidth profiles: {sorted(profile_ids - set(bandwidth_profiles))}'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    try:
+        generated = generate_batch(request.user, template, voucher_type, sites, data, bandwidth_profiles)
+    except Exception as e:
+        return Response(
+            {'error': f'Template rendering failed: {str(e)}'}, 
+            status=status.HTTP_500_INTERNAL_SERVER_ERROR
+        )
+    
+    _record_usage(subscription, len(generated))
+    
+    names = archive_names(config.config_name for config, _ in generated)
+    files = list(zip(names, (content for _, content in generated)))
+    report = [
+        f"{name} {error}"
+        for name, content in files
+        for error in _script_errors(content)
+    ]
+    if report:
+        logger.warning(f"Batch from template {template.id} has {len(report)} script errors")
+        files.append(('validation.txt', '\n'.join(report) + '\n'))
+    
+    response = streaming_response(request, zip_stream(files), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="configs-{timezone.now():%Y%m%d-%H%M%S}.zip"'
+    response['X-Config-Ids'] = ','.join(str(config.id) for config, _ in generated)
+    response['X-Config-Validation-Errors'] = str(len(report))
+    return response
+
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def download_config(request, config_id):
     """Download generated configuration file"""
-    config = get_object_or_404(GeneratedConfig, id=config_id, user=request.user)
-    
-    response = HttpResponse(config.config_content, content_type='text/plain')
-    response['Content-Disposition'] = f'attachment; filename="{config.config_name}.rsc"'
+    config = get_object_or_404(GeneratedConfig.objects.select_related('blob'), id=config_id, user=request.user)
+    return config_download_response(request, config, f"{config.config_name}.rsc")
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def config_delta(request, from_id, to_id):
+    """Download a script applying the changes between two generated configs"""
+    configs = GeneratedConfig.objects.filter(user=request.user).select_related('blob')
+    old_config = get_object_or_404(configs, id=from_id)
+    new_config = get_object_or_404(configs, id=to_id)
+    response = HttpResponse(delta_script(old_config, new_config), content_type='text/plain; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{new_config.config_name}-delta-{from_id}-{to_id}.rsc"'
     return response
 
 
@@ -155,7 +244,7 @@ def config_preview(request, config_id):
     config = get_object_or_404(GeneratedConfig, id=config_id, user=request.user)
     return Response({
         'config_name': config.config_name,
-        'config_content': config.config_content,
+        'config_content': config.get_content(),
         'created_at': config.created_at,
         'hotspot_name': config.hotspot_name,
         'hotspot_ip': config.hotspot_ip,
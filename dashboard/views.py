@@ -50,7 +50,9 @@ def dashboard_stats(request):
         usage_data = None
     
     # Get recent payments
-    recent_payments = Payment.objects.filter(user=user).order_by('-created_at')[:5]
+    recent_payments = Payment.objects.filter(user=user).only(
+        'id', 'amount', 'currency', 'status', 'created_at', 'description'
+    ).order_by('-created_at')[:5]
     payments_data = []
     for payment in recent_payments:
         payments_data.append({
@@ -63,7 +65,9 @@ def dashboard_stats(request):
         })
     
     # Get recent generated configs
-    recent_configs = GeneratedConfig.objects.filter(user=user).order_by('-created_at')[:5]
+    recent_configs = GeneratedConfig.objects.filter(user=user).only(
+        'id', 'config_name', 'hotspot_name', 'created_at'
+    ).order_by('-created_at')[:5]
     configs_data = []
     for config in recent_configs:
         configs_data.append({
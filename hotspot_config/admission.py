@@ -0,0 +1,203 @@
+"""
+Admission control for web workers under overload
+
+Requests are classified by path, from most to least important:
+
+  callback  - M-PESA/Pesapal callbacks and IPNs, C2B notifications (never shed)
+  purchase  - starting a payment and activating the ticket it bought
+  status    - payment and ticket status polls
+  page      - captive portal and public pages, static files
+  dashboard - provider, cashier and admin dashboards
+
+The load level of the process is the worst of three ratios:
+
+  - page views and callbacks in flight / ADMISSION_MAX_IN_FLIGHT
+  - time requests spent queued before reaching Django (from the router's
+    X-Request-Start header) / ADMISSION_TARGET_QUEUE_MS
+  - response time of page views and callbacks / ADMISSION_TARGET_LATENCY_MS
+    (purchases and status polls mostly wait on M-PESA, dashboards on
+    reporting queries, so neither their number nor their response times say
+    much about this process)
+
+Queue and response times are moving averages that decay while no samples
+arrive, so a spike does not keep traffic shed after it has passed. Each class
+is shed with a 503 and Retry-After once the level reaches its threshold in
+ADMISSION_SHED_LEVELS, so dashboards go first and callbacks are always served.
+"""
+import re
+import random
+import threading
+import time
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CALLBACK = 'callback'
+PURCHASE = 'purchase'
+STATUS = 'status'
+PAGE = 'page'
+DASHBOARD = 'dashboard'
+
+REQUEST_CLASSES = (CALLBACK, PURCHASE, STATUS, PAGE, DASHBOARD)
+
+# Classes whose requests in flight and response times are used as load signals
+LATENCY_CLASSES = (CALLBACK, PAGE)
+
+# First match wins; anything unmatched is a page view
+ROUTES = (
+    (CALLBACK, re.compile(r'^/api/v1/(health/|payments/(callback/|c2b/|pesapal/(ipn|callback)/))')),
+    (CALLBACK, re.compile(r'^(/api/v1)?/subscriptions/callback/')),
+    (PURCHASE, re.compile(r'^/captive-portal/(payment/$|ticket/[^/]+/activate/)')),
+    (PURCHASE, re.compile(r'^/api/v1/payments/(create|bucket/initiate)/')),
+    (PURCHASE, re.compile(r'^/subscriptions/subscribe/')),
+    (STATUS, re.compile(r'^/captive-portal/(payment/status/|ticket/[^/]+/status/)')),
+    (STATUS, re.compile(r'^/api/v1/payments/(status/|bucket/status/)')),
+    (STATUS, re.compile(r'^/subscriptions/status/')),
+    (DASHBOARD, re.compile(r'^/(admin|super-admin|provider|cashier|dashboard)/')),
+    (DASHBOARD, re.compile(r'^/api/v1/(dashboard|stats|user-stats|payments/latency|config/generate/batch)/')),
+)
+
+
+def classify_request(path):
+    for request_class, pattern in ROUTES:
+        if pattern.match(path):
+            return request_class
+    return PAGE
+
+
+def get_queue_seconds(request, now=None):
+    """
+    Get how long a request waited before reaching Django, from X-Request-Start.
+
+    Accepts the Heroku router's milliseconds since the epoch and nginx's
+    "t=<seconds>.<milliseconds>"; returns None if the header is missing or
+    unusable.
+    """
+    header = request.META.get('HTTP_X_REQUEST_START', '')
+    if header.startswith('t='):
+        header = header[2:]
+    try:
+        started = float(header)
+    except ValueError:
+        return None
+    if started > 1e11:
+        # Milliseconds (or microseconds) since the epoch
+        started /= 1000 if started < 1e14 else 1000000
+    waited = (now or time.time()) - started
+    return waited if 0 <= waited < 3600 else None
+
+
+class DecayingAverage:
+    """Exponentially weighted moving average that halves every half_life seconds without samples"""
+
+    def __init__(self, weight=0.2, half_life=5.0):
+        self.weight = weight
+        self.half_life = half_life
+        self.value = 0.0
+        self.updated = time.monotonic()
+
+    def _decay(self, now):
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.value *= 0.5 ** (elapsed / self.half_life)
+            self.updated = now
+
+    def add(self, sample, now):
+        self._decay(now)
+        self.value += self.weight * (sample - self.value)
+
+    def get(self, now):
+        self._decay(now)
+        return self.value
+
+
+class AdmissionController:
+    """Per-process load tracker deciding which requests to admit"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        # Requests in flight of the LATENCY_CLASSES, the ones that load this process
+        self.busy = 0
+        half_life = getattr(settings, 'ADMISSION_DECAY_SECONDS', 5)
+        self._queue_wait = DecayingAverage(half_life=half_life)
+        self._latency = DecayingAverage(half_life=half_life)
+        self.admitted = dict.fromkeys(REQUEST_CLASSES, 0)
+        self.shed = dict.fromkeys(REQUEST_CLASSES, 0)
+        self._shedding = set()
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'ADMISSION_CONTROL_ENABLED', True)
+
+    def _level(self, now):
+        max_in_flight = getattr(settings, 'ADMISSION_MAX_IN_FLIGHT', 64)
+        target_queue = getattr(settings, 'ADMISSION_TARGET_QUEUE_MS', 500) / 1000
+        target_latency = getattr(settings, 'ADMISSION_TARGET_LATENCY_MS', 1500) / 1000
+        return max(
+            self.busy / max_in_flight,
+            self._queue_wait.get(now) / target_queue,
+            self._latency.get(now) / target_latency,
+        )
+
+    def admit(self, request_class, queue_seconds=None):
+        """Count a request in if its class is not being shed; returns (admitted, load level)"""
+        threshold = getattr(settings, 'ADMISSION_SHED_LEVELS', {}).get(request_class)
+        now = time.monotonic()
+        with self._lock:
+            if queue_seconds is not None:
+                self._queue_wait.add(queue_seconds, now)
+            level = self._level(now)
+            admitted = threshold is None or level < threshold
+            was_shedding = request_class in self._shedding
+            if admitted:
+                self.admitted[request_class] += 1
+                self.in_flight += 1
+                if request_class in LATENCY_CLASSES:
+                    self.busy += 1
+                self._shedding.discard(request_class)
+            else:
+                self.shed[request_class] += 1
+                self._shedding.add(request_class)
+
+        if not admitted and not was_shedding:
+            logger.warning(f"Overloaded (level {level:.2f}): shedding {request_class} requests")
+        elif admitted and was_shedding:
+            logger.info(f"Load back to {level:.2f}: admitting {request_class} requests again")
+        return admitted, level
+
+    def release(self, request_class, seconds):
+        """Count an admitted request out, recording how long it took"""
+        with self._lock:
+            self.in_flight -= 1
+            if request_class in LATENCY_CLASSES:
+                self.busy -= 1
+                self._latency.add(seconds, time.monotonic())
+
+    def retry_after(self, level):
+        """Seconds a shed client should wait, longer the more overloaded we are, with jitter"""
+        base = getattr(settings, 'ADMISSION_RETRY_AFTER_SECONDS', 5)
+        return int(base * min(max(level, 1), 4) + random.uniform(0, base))
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'level': round(self._level(now), 3),
+                'in_flight': self.in_flight,
+                'busy': self.busy,
+                'queue_ms': round(self._queue_wait.get(now) * 1000, 1),
+                'latency_ms': round(self._latency.get(now) * 1000, 1),
+                'shedding': sorted(self._shedding),
+                'admitted': dict(self.admitted),
+                'shed': dict(self.shed),
+            }
+
+    def reset(self):
+        self.__init__()
+
+
+# Global controller instance
+admission_controller = AdmissionController()
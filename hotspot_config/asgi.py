@@ -0,0 +1,29 @@
+"""
+ASGI config for hotspot_config project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+The captive portal payment views are async and wait on Daraja without holding
+a worker thread when served from here; the WSGI entry point keeps working and
+runs them on a per-request event loop. Static files are served in front of
+Django so that no middleware in the chain is sync-only.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hotspot_config.settings')
+
+application = get_asgi_application()
+
+from hotspot_config.static import StaticFilesApplication  # noqa: E402
+
+application = StaticFilesApplication(application)
+
+# Compile active config templates before the first request
+from config_generator.template_cache import warm_template_cache  # noqa: E402
+
+warm_template_cache()
@@ -1,22 +1,126 @@
 """
-Custom middleware for handling Content Security Policy
+Custom middleware for Content Security Policy, request correlation and admission control
 """
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+
+from .admission import admission_controller, classify_request, get_queue_seconds
+
+from payments.tracing import trace_context
+
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+
+class RequestCorrelationMiddleware:
+    """Tag outbound gateway calls with the inbound request's X-Request-ID (generated if absent)"""
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+    
+    def _request_id(self, request):
+        request_id = request.META.get('HTTP_X_REQUEST_ID', '')
+        return request_id if REQUEST_ID_PATTERN.match(request_id) else None
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with trace_context(self._request_id(request)) as correlation_id:
+            request.correlation_id = correlation_id
+            response = self.get_response(request)
+        response['X-Request-ID'] = correlation_id
+        return response
+    
+    async def __acall__(self, request):
+        with trace_context(self._request_id(request)) as correlation_id:
+            request.correlation_id = correlation_id
+            response = await self.get_response(request)
+        response['X-Request-ID'] = correlation_id
+        return response
+
+
+class AdmissionControlMiddleware:
+    """Shed low-priority requests with a 503 while this process is overloaded (see hotspot_config.admission)"""
+    sync_capable = True
+    async_capable = True
+    
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+    
+    def _admit(self, request):
+        request_class = classify_request(request.path)
+        admitted, level = admission_controller.admit(request_class, get_queue_seconds(request))
+        return request_class, None if admitted else self._shed_response(request, level)
+    
+    def _shed_response(self, request, level):
+        message = 'The service is busy. Please try again shortly.'
+        if request.path.startswith('/api/') or 'json' in request.META.get('HTTP_ACCEPT', '') or request.content_type == 'application/json':
+            response = JsonResponse({'success': False, 'message': message}, status=503)
+        else:
+            response = HttpResponse(message, status=503, content_type='text/plain')
+        response['Retry-After'] = str(admission_controller.retry_after(level))
+        return response
+    
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not admission_controller.enabled:
+            return self.get_response(request)
+        request_class, shed = self._admit(request)
+        if shed:
+            return shed
+        started = time.monotonic()
+        try:
+            return self.get_response(request)
+        finally:
+            admission_controller.release(request_class, time.monotonic() - started)
+    
+    async def __acall__(self, request):
+        if not admission_controller.enabled:
+            return await self.get_response(request)
+        request_class, shed = self._admit(request)
+        if shed:
+            return shed
+        started = time.monotonic()
+        try:
+            return await self.get_response(request)
+        finally:
+            admission_controller.release(request_class, time.monotonic() - started)
+
 
 class CSPMiddleware:
     """Middleware to add Content Security Policy headers"""
+    sync_capable = True
+    async_capable = True
     
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        response = self.get_response(request)
-        
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self._add_headers(self.get_response(request))
+    
+    async def __acall__(self, request):
+        return self._add_headers(await self.get_response(request))
+    
+    def _add_headers(self, response):
         # In development or if CSP is disabled, don't set CSP headers
         if getattr(settings, 'DEBUG', False) or getattr(settings, 'DISABLE_CSP', False):
             # Remove any existing CSP headers in development
-            response.pop('Content-Security-Policy', None)
-            response.pop('Content-Security-Policy-Report-Only', None)
+            response.headers.pop('Content-Security-Policy', None)
+            response.headers.pop('Content-Security-Policy-Report-Only', None)
             return response
         
         # Set very permissive CSP headers to avoid conflicts with browser extensions
@@ -4,6 +4,7 @@ Django settings for hotspot_config project.
 
 import os
 from pathlib import Path
+from celery.schedules import crontab
 from decouple import config
 import dj_database_url
 
@@ -54,12 +55,16 @@ INSTALLED_APPS = [
     'captive_portal',
     'provider',
     'cashier',
+    'routers',
 ]
 
+# Static files are served by WhiteNoise around the WSGI/ASGI applications
+# (hotspot_config.static), so every middleware here must be async-capable
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'hotspot_config.middleware.RequestCorrelationMiddleware',
+    'hotspot_config.middleware.AdmissionControlMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
     'hotspot_config.middleware.CSPMiddleware',  # Add CSP middleware
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -90,6 +95,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'hotspot_config.wsgi.application'
+ASGI_APPLICATION = 'hotspot_config.asgi.application'
 
 # Database
 DATABASES = {
@@ -178,6 +184,71 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# Celery queues, each served by its own worker (see Procfile) with (soft, hard)
+# time limits in seconds. A worker consuming several queues drains them in this
+# order. Payment callbacks are handled in the request and the webhook inbox is
+# drained by the "webhooks" process, so no payment work waits on a Celery queue.
+CELERY_QUEUE_TIME_LIMITS = {
+    'router_sync': (config('CELERY_ROUTER_SYNC_SOFT_TIME_LIMIT', default=300, cast=int),
+                    config('CELERY_ROUTER_SYNC_TIME_LIMIT', default=360, cast=int)),
+    'sweeps': (config('CELERY_SWEEPS_SOFT_TIME_LIMIT', default=600, cast=int),
+               config('CELERY_SWEEPS_TIME_LIMIT', default=720, cast=int)),
+    'reports': (config('CELERY_REPORTS_SOFT_TIME_LIMIT', default=1800, cast=int),
+                config('CELERY_REPORTS_TIME_LIMIT', default=2100, cast=int)),
+}
+CELERY_TASK_QUEUES_BY_TASK = {
+    'tickets.tasks.sync_tickets_to_router': 'router_sync',
+    'routers.tasks.sync_router': 'router_sync',
+    # Manual fallback for the "webhooks" process; the inbox is idempotent
+    'payments.tasks.process_webhook_inbox': 'sweeps',
+    # Up to PAYMENT_RECONCILE_LIMIT gateway queries with 30 second timeouts
+    'payments.tasks.reconcile_pending_payments': 'sweeps',
+    'tickets.tasks.expire_tickets': 'sweeps',
+    'tickets.tasks.cleanup_old_tickets': 'sweeps',
+    'tickets.tasks.update_ticket_usage_stats': 'sweeps',
+    'tickets.tasks.send_ticket_expiry_reminders': 'sweeps',
+    # Bulk inserts of up to a whole batch of tickets; no router I/O
+    'tickets.tasks.generate_ticket_batch': 'reports',
+    'tickets.tasks.generate_daily_reports': 'reports',
+    'payments.tasks.settle_previous_month_commissions': 'reports',
+}
+CELERY_TASK_DEFAULT_QUEUE = 'sweeps'
+CELERY_TASK_ROUTES = {task: {'queue': queue} for task, queue in CELERY_TASK_QUEUES_BY_TASK.items()}
+CELERY_TASK_ANNOTATIONS = {
+    task: {
+        'soft_time_limit': CELERY_QUEUE_TIME_LIMITS[queue][0],
+        'time_limit': CELERY_QUEUE_TIME_LIMITS[queue][1],
+    }
+    for task, queue in CELERY_TASK_QUEUES_BY_TASK.items()
+}
+# Polls a worker's queues in their -Q order (sweeps before reports) rather than
+# round robin; tasks set no message priorities
+CELERY_BROKER_TRANSPORT_OPTIONS = {'queue_order_strategy': 'priority'}
+# Periodic tasks, sent by the "beat" process (see Procfile)
+CELERY_BEAT_SCHEDULE = {
+    'reconcile-pending-payments': {
+        'task': 'payments.tasks.reconcile_pending_payments',
+        'schedule': config('PAYMENT_RECONCILE_INTERVAL_SECONDS', default=300, cast=int),
+    },
+    # Early on the 1st, once last month's late callbacks have been reconciled
+    'settle-previous-month-commissions': {
+        'task': 'payments.tasks.settle_previous_month_commissions',
+        'schedule': crontab(minute=0, hour=3, day_of_month=1),
+    },
+}
+# Workers take one task at a time so a long report never holds queued sweeps
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Cache (use a shared Redis cache when running several web workers)
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default='')
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        }
+    }
+
 # Supabase settings
 SUPABASE_URL = config('SUPABASE_URL', default='')
 SUPABASE_KEY = config('SUPABASE_KEY', default='')
@@ -189,6 +260,101 @@ PESAPAL_CONSUMER_SECRET = config('PESAPAL_CONSUMER_SECRET', default='')
 PESAPAL_BASE_URL = config('PESAPAL_BASE_URL', default='https://cybqa.pesapal.com/pesapalv3/api/')
 PESAPAL_CALLBACK_URL = config('PESAPAL_CALLBACK_URL', default='')
 PESAPAL_IPN_URL = config('PESAPAL_IPN_URL', default='')
+# Pesapal tokens live 5 minutes; refresh a little early
+PESAPAL_TOKEN_CACHE_SECONDS = config('PESAPAL_TOKEN_CACHE_SECONDS', default=240, cast=int)
+
+# Payment reconciliation sweeper
+PAYMENT_RECONCILE_MIN_AGE_MINUTES = config('PAYMENT_RECONCILE_MIN_AGE_MINUTES', default=5, cast=int)
+PAYMENT_RECONCILE_MAX_AGE_HOURS = config('PAYMENT_RECONCILE_MAX_AGE_HOURS', default=48, cast=int)
+PAYMENT_RECONCILE_MAX_WORKERS = config('PAYMENT_RECONCILE_MAX_WORKERS', default=16, cast=int)
+PAYMENT_RECONCILE_PER_PROVIDER = config('PAYMENT_RECONCILE_PER_PROVIDER', default=2, cast=int)
+PAYMENT_RECONCILE_PESAPAL_CONCURRENCY = config('PAYMENT_RECONCILE_PESAPAL_CONCURRENCY', default=4, cast=int)
+PAYMENT_RECONCILE_BATCH_SIZE = config('PAYMENT_RECONCILE_BATCH_SIZE', default=100, cast=int)
+PAYMENT_RECONCILE_MAX_ATTEMPTS = config('PAYMENT_RECONCILE_MAX_ATTEMPTS', default=10, cast=int)
+
+# M-PESA gateway health tracking and circuit breaker
+GATEWAY_HEALTH_WINDOW_SECONDS = config('GATEWAY_HEALTH_WINDOW_SECONDS', default=300, cast=int)
+GATEWAY_HEALTH_FLUSH_SECONDS = config('GATEWAY_HEALTH_FLUSH_SECONDS', default=30, cast=int)
+GATEWAY_BREAKER_MIN_CALLS = config('GATEWAY_BREAKER_MIN_CALLS', default=5, cast=int)
+GATEWAY_BREAKER_ERROR_RATE = config('GATEWAY_BREAKER_ERROR_RATE', default=0.5, cast=float)
+GATEWAY_BREAKER_CONSECUTIVE_FAILURES = config('GATEWAY_BREAKER_CONSECUTIVE_FAILURES', default=5, cast=int)
+GATEWAY_BREAKER_COOLDOWN_SECONDS = config('GATEWAY_BREAKER_COOLDOWN_SECONDS', default=60, cast=int)
+GATEWAY_BREAKER_TRIAL_TIMEOUT_SECONDS = config('GATEWAY_BREAKER_TRIAL_TIMEOUT_SECONDS', default=90, cast=int)
+
+# STK status query coalescing: pending results are cached briefly, final ones
+# for STK_STATUS_TERMINAL_CACHE_SECONDS (a day by default)
+STK_STATUS_CACHE_SECONDS = config('STK_STATUS_CACHE_SECONDS', default=5, cast=int)
+STK_STATUS_TERMINAL_CACHE_SECONDS = config('STK_STATUS_TERMINAL_CACHE_SECONDS', default=86400, cast=int)
+STK_STATUS_COALESCE_WAIT_SECONDS = config('STK_STATUS_COALESCE_WAIT_SECONDS', default=35, cast=int)
+
+# Gateway call tracing: recent calls kept in memory and the aggregation window
+GATEWAY_TRACE_BUFFER_SIZE = config('GATEWAY_TRACE_BUFFER_SIZE', default=500, cast=int)
+GATEWAY_TRACE_WINDOW_MINUTES = config('GATEWAY_TRACE_WINDOW_MINUTES', default=15, cast=int)
+
+# Connection pool of the async gateway client used by the ASGI payment views (per event loop)
+GATEWAY_ASYNC_MAX_CONNECTIONS = config('GATEWAY_ASYNC_MAX_CONNECTIONS', default=200, cast=int)
+GATEWAY_ASYNC_MAX_KEEPALIVE = config('GATEWAY_ASYNC_MAX_KEEPALIVE', default=50, cast=int)
+
+# Admission control: shed low-priority requests when a web process is overloaded
+ADMISSION_CONTROL_ENABLED = config('ADMISSION_CONTROL_ENABLED', default=True, cast=bool)
+ADMISSION_MAX_IN_FLIGHT = config('ADMISSION_MAX_IN_FLIGHT', default=64, cast=int)
+ADMISSION_TARGET_QUEUE_MS = config('ADMISSION_TARGET_QUEUE_MS', default=500, cast=int)
+ADMISSION_TARGET_LATENCY_MS = config('ADMISSION_TARGET_LATENCY_MS', default=1500, cast=int)
+ADMISSION_DECAY_SECONDS = config('ADMISSION_DECAY_SECONDS', default=5, cast=float)
+ADMISSION_RETRY_AFTER_SECONDS = config('ADMISSION_RETRY_AFTER_SECONDS', default=5, cast=int)
+# Load level at which each request class is shed; callbacks are never shed
+ADMISSION_SHED_LEVELS = {
+    'dashboard': 0.6,
+    'page': 0.8,
+    'status': 1.0,
+    'purchase': 1.5,
+}
+
+# Payment initiation idempotency keys
+PAYMENT_IDEMPOTENCY_TTL_SECONDS = config('PAYMENT_IDEMPOTENCY_TTL_SECONDS', default=600, cast=int)
+PAYMENT_IDEMPOTENCY_WINDOW_SECONDS = config('PAYMENT_IDEMPOTENCY_WINDOW_SECONDS', default=90, cast=int)
+
+# Paybill (C2B) matching
+C2B_INDEX_TTL_SECONDS = config('C2B_INDEX_TTL_SECONDS', default=60, cast=int)
+C2B_PENDING_INDEX_TTL_SECONDS = config('C2B_PENDING_INDEX_TTL_SECONDS', default=15, cast=int)
+C2B_PENDING_ORDER_MINUTES = config('C2B_PENDING_ORDER_MINUTES', default=60, cast=int)
+C2B_REJECT_UNMATCHED = config('C2B_REJECT_UNMATCHED', default=False, cast=bool)
+# Signs the path token in registered C2B callback URLs; changing it requires re-registering them
+C2B_CALLBACK_SECRET = config('C2B_CALLBACK_SECRET', default=SECRET_KEY)
+
+# M-PESA statement import
+STATEMENT_MATCH_WINDOW_MINUTES = config('STATEMENT_MATCH_WINDOW_MINUTES', default=10, cast=int)
+STATEMENT_IMPORT_SAMPLE_ROWS = config('STATEMENT_IMPORT_SAMPLE_ROWS', default=100, cast=int)
+
+# Payment ledger: platform fee charged on each M-PESA sale, as a percentage
+LEDGER_FEE_PERCENT = config('LEDGER_FEE_PERCENT', default=0, cast=float)
+
+# Webhook inbox workers
+WEBHOOK_BATCH_SIZE = config('WEBHOOK_BATCH_SIZE', default=50, cast=int)
+WEBHOOK_MAX_ATTEMPTS = config('WEBHOOK_MAX_ATTEMPTS', default=8, cast=int)
+WEBHOOK_RETRY_BASE_SECONDS = config('WEBHOOK_RETRY_BASE_SECONDS', default=15, cast=int)
+WEBHOOK_RETRY_MAX_SECONDS = config('WEBHOOK_RETRY_MAX_SECONDS', default=3600, cast=int)
+WEBHOOK_LOCK_TIMEOUT_SECONDS = config('WEBHOOK_LOCK_TIMEOUT_SECONDS', default=300, cast=int)
+
+# Config generation: compiled Jinja templates kept per process, bytecode on disk
+# (defaults to a directory under the system temp dir; set to '' to disable)
+CONFIG_TEMPLATE_CACHE_SIZE = config('CONFIG_TEMPLATE_CACHE_SIZE', default=200, cast=int)
+CONFIG_TEMPLATE_BYTECODE_DIR = config('CONFIG_TEMPLATE_BYTECODE_DIR', default=None)
+CONFIG_TEMPLATE_WARMUP = config('CONFIG_TEMPLATE_WARMUP', default=True, cast=bool)
+# Batch generation: render processes per web process (1 renders in-process) and sites per request
+CONFIG_BATCH_WORKERS = config('CONFIG_BATCH_WORKERS', default=2, cast=int)
+CONFIG_BATCH_MAX_SITES = config('CONFIG_BATCH_MAX_SITES', default=500, cast=int)
+# Rendered sections kept by the Python config generators
+CONFIG_SECTION_CACHE_SIZE = config('CONFIG_SECTION_CACHE_SIZE', default=8192, cast=int)
+# Check generated scripts against the bundled RouterOS command schema
+CONFIG_VALIDATE_SCRIPTS = config('CONFIG_VALIDATE_SCRIPTS', default=True, cast=bool)
+
+# RouterOS API sync: pooled connections per router and commands pipelined per batch
+ROUTEROS_API_TIMEOUT = config('ROUTEROS_API_TIMEOUT', default=10, cast=int)
+ROUTEROS_POOL_SIZE = config('ROUTEROS_POOL_SIZE', default=2, cast=int)
+ROUTEROS_POOL_IDLE_SECONDS = config('ROUTEROS_POOL_IDLE_SECONDS', default=300, cast=int)
+ROUTEROS_SYNC_BATCH_SIZE = config('ROUTEROS_SYNC_BATCH_SIZE', default=200, cast=int)
+ROUTEROS_SYNC_MAX_ATTEMPTS = config('ROUTEROS_SYNC_MAX_ATTEMPTS', default=5, cast=int)
 
 # Security settings
 SECURE_BROWSER_XSS_FILTER = True
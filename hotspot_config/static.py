@@ -0,0 +1,50 @@
+"""
+Static file serving in front of Django
+
+WhiteNoiseMiddleware is sync-only, so in the middleware chain it makes
+Django adapt every request under ASGI back onto a thread, async views
+included. WhiteNoise wraps the WSGI and ASGI applications instead, and the
+middleware chain stays async end to end.
+"""
+from asgiref.wsgi import WsgiToAsgi
+from django.conf import settings
+from whitenoise import WhiteNoise
+
+
+def _not_found(environ, start_response):
+    start_response('404 Not Found', [('Content-Type', 'text/plain')])
+    return [b'Not Found']
+
+
+def static_files(application):
+    """Wrap a WSGI application so STATIC_URL is served from STATIC_ROOT"""
+    return WhiteNoise(
+        application,
+        root=settings.STATIC_ROOT,
+        prefix=settings.STATIC_URL,
+        autorefresh=settings.DEBUG,
+    )
+
+
+class StaticFilesApplication:
+    """
+    ASGI application serving collected static files ahead of Django.
+
+    Only requests for a file WhiteNoise has are handed to it (on a thread,
+    as WhiteNoise is WSGI); everything else goes straight to Django.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.whitenoise = static_files(_not_found)
+        self.static = WsgiToAsgi(self.whitenoise)
+
+    def _serves(self, path):
+        if self.whitenoise.autorefresh:
+            return self.whitenoise.find_file(path) is not None
+        return path in self.whitenoise.files
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and self._serves(scope['path']):
+            return await self.static(scope, receive, send)
+        return await self.application(scope, receive, send)
@@ -0,0 +1,38 @@
+"""
+Streaming responses that stream under both WSGI and ASGI
+
+Under ASGI, Django reads a StreamingHttpResponse over a sync iterator with
+sync_to_async(list), so the whole body is built in memory before the first
+byte is sent. streaming_response() gives ASGI requests an async iterator
+that pulls one item at a time from the sync iterator in a worker thread
+instead; WSGI requests keep the sync iterator.
+"""
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+_DONE = object()
+
+
+async def aiter_sync(iterable):
+    """
+    Iterate a sync iterable from async code, one item per worker thread call.
+
+    Items are pulled on the thread-sensitive thread, so iterators holding a
+    database cursor (QuerySet.iterator()) keep using one connection.
+    """
+    iterator = iter(iterable)
+    pull = sync_to_async(next)
+    while True:
+        item = await pull(iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+def streaming_response(request, iterable, **kwargs):
+    """Get a StreamingHttpResponse over a sync iterable that streams whichever handler serves the request"""
+    # DRF views pass a Request wrapping the handler's HttpRequest
+    if isinstance(getattr(request, '_request', request), ASGIRequest):
+        iterable = aiter_sync(iterable)
+    return StreamingHttpResponse(iterable, **kwargs)
@@ -13,4 +13,13 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'hotspot_config.settings')
 
-application = get_wsgi_application()
\ No newline at end of file
+application = get_wsgi_application()
+
+from hotspot_config.static import static_files  # noqa: E402
+
+application = static_files(application)
+
+# Compile active config templates before the first request
+from config_generator.template_cache import warm_template_cache  # noqa: E402
+
+warm_template_cache()
@@ -1,5 +1,9 @@
 from django.contrib import admin
-from .models import Payment, PaymentItem
+from django.utils import timezone
+from .models import (Payment, PaymentItem, PesapalIPNRegistration, WebhookEvent, C2BTransaction,
+                     LedgerAccount, LedgerEntry, CommissionSettlement)
+from .webhooks import requeue_dead_events
+from .c2b import C2BMatcher
 
 
 class PaymentItemInline(admin.TabularInline):
@@ -9,16 +13,22 @@ class PaymentItemInline(admin.TabularInline):
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
-    list_display = ('user', 'amount', 'currency', 'status', 'payment_method', 'created_at')
+    list_display = ('user', 'provider', 'amount', 'currency', 'status', 'payment_method', 'created_at')
     list_filter = ('status', 'payment_method', 'currency', 'created_at')
-    search_fields = ('user__email', 'user__username', 'pesapal_order_tracking_id', 'pesapal_merchant_reference')
+    search_fields = ('user__email', 'user__username', 'pesapal_order_tracking_id', 'pesapal_merchant_reference',
+                     'mpesa_checkout_request_id', 'mpesa_receipt_number', 'phone_number')
     readonly_fields = ('id', 'created_at', 'updated_at', 'completed_at')
     inlines = [PaymentItemInline]
     ordering = ('-created_at',)
     
     fieldsets = (
         ('Payment Details', {
-            'fields': ('user', 'amount', 'currency', 'status', 'payment_method', 'description')
+            'fields': ('user', 'provider', 'ticket_type', 'phone_number', 'amount', 'currency', 'status', 'payment_method', 'description')
+        }),
+        ('M-PESA Details', {
+            'fields': ('mpesa_checkout_request_id', 'mpesa_merchant_request_id', 'mpesa_receipt_number',
+                       'last_checked_at', 'check_attempts'),
+            'classes': ('collapse',)
         }),
         ('Pesapal Details', {
             'fields': ('pesapal_order_tracking_id', 'pesapal_merchant_reference', 'pesapal_payment_reference'),
@@ -37,3 +47,105 @@ class PaymentItemAdmin(admin.ModelAdmin):
     list_filter = ('payment__status', 'payment__created_at')
     search_fields = ('payment__user__email', 'name', 'description')
     readonly_fields = ('total_price',)
+
+
+@admin.register(PesapalIPNRegistration)
+class PesapalIPNRegistrationAdmin(admin.ModelAdmin):
+    list_display = ('environment', 'ipn_url', 'ipn_id', 'notification_type', 'updated_at')
+    list_filter = ('environment',)
+    search_fields = ('ipn_url', 'ipn_id')
+    readonly_fields = ('created_at', 'updated_at')
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ('dedup_key', 'source', 'provider', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('source', 'status', 'received_at')
+    search_fields = ('dedup_key', 'last_error')
+    readonly_fields = ('source', 'dedup_key', 'provider', 'payload', 'status', 'attempts', 'next_attempt_at',
+                       'locked_at', 'last_error', 'result', 'received_at', 'processed_at')
+    ordering = ('-received_at',)
+    actions = ['requeue']
+    
+    def requeue(self, request, queryset):
+        count = requeue_dead_events(queryset)
+        self.message_user(request, f"{count} dead-lettered events requeued.")
+    requeue.short_description = "Requeue dead-lettered events"
+
+
+@admin.register(C2BTransaction)
+class C2BTransactionAdmin(admin.ModelAdmin):
+    list_display = ('trans_id', 'business_shortcode', 'amount', 'bill_ref_number', 'msisdn', 'provider',
+                    'ticket_type', 'status', 'match_reason', 'created_at')
+    list_filter = ('status', 'match_reason', 'created_at')
+    search_fields = ('trans_id', 'bill_ref_number', 'msisdn', 'business_shortcode')
+    readonly_fields = ('trans_id', 'transaction_type', 'business_shortcode', 'amount', 'bill_ref_number', 'msisdn',
+                       'first_name', 'trans_time', 'payload', 'match_reason', 'payment', 'reviewed_by',
+                       'reviewed_at', 'created_at', 'updated_at')
+    ordering = ('-created_at',)
+    actions = ['issue_tickets', 'mark_ignored']
+    
+    def issue_tickets(self, request, queryset):
+        """Issue tickets for reviewed payments using the ticket type set on each"""
+        matcher = C2BMatcher()
+        issued = 0
+        for c2b_txn in queryset.filter(status='unmatched', ticket_type__isnull=False).select_related('ticket_type'):
+            if matcher.resolve(c2b_txn, c2b_txn.ticket_type, reviewed_by=request.user):
+                issued += 1
+        self.message_user(request, f"{issued} tickets issued. Set a ticket type on unmatched payments before issuing.")
+    issue_tickets.short_description = "Issue tickets for selected payments"
+    
+    def mark_ignored(self, request, queryset):
+        count = queryset.filter(status='unmatched').update(
+            status='ignored',
+            reviewed_by=request.user,
+            reviewed_at=timezone.now()
+        )
+        self.message_user(request, f"{count} payments marked as ignored.")
+    mark_ignored.short_description = "Mark selected payments as ignored"
+
+
+@admin.register(LedgerAccount)
+class LedgerAccountAdmin(admin.ModelAdmin):
+    list_display = ('provider', 'kind', 'balance', 'total_debit', 'total_credit', 'entry_count', 'updated_at')
+    list_filter = ('kind',)
+    search_fields = ('provider__business_name',)
+    readonly_fields = ('provider', 'kind', 'balance', 'total_debit', 'total_credit', 'entry_count',
+                       'created_at', 'updated_at')
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('reference', 'entry_type', 'account', 'debit', 'credit', 'balance_after', 'occurred_at')
+    list_filter = ('entry_type', 'account__kind', 'occurred_at')
+    search_fields = ('reference', 'description')
+    list_select_related = ('account__provider',)
+    ordering = ('-id',)
+    
+    # Entries are append-only; corrections are posted through payments.ledger
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(CommissionSettlement)
+class CommissionSettlementAdmin(admin.ModelAdmin):
+    list_display = ('provider', 'period_start', 'period_end', 'sale_count', 'gross_sales', 'commission_rate',
+                    'commission', 'net_amount', 'status')
+    list_filter = ('status', 'period_start')
+    search_fields = ('provider__business_name', 'ledger_reference')
+    readonly_fields = ('provider', 'period_start', 'period_end', 'sale_count', 'gross_sales', 'commission_rate',
+                       'min_commission', 'max_commission', 'calculated_commission', 'commission', 'net_amount',
+                       'status', 'ledger_reference', 'created_at', 'posted_at')
+    ordering = ('-period_start', 'provider')
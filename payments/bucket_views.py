@@ -6,6 +6,8 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.decorators import user_passes_test
 from django.utils.decorators import method_decorator
 from django.views import View
+from django.urls import reverse
+from django.conf import settings
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -16,6 +18,12 @@ import logging
 from accounts.models import Provider
 from accounts.encryption import encrypt_mpesa_credential, decrypt_mpesa_credential
 from .payment_bucket import payment_bucket_service
+from .gateway_health import gateway_health, CircuitOpenError
+from .webhooks import record_webhook, mpesa_dedup_key
+from .idempotency import idempotent_payment, normalize_phone
+from .c2b import C2BMatcher, INVALID_SHORTCODE, callback_token, is_valid_callback_token
+from .mpesa_daraja import MpesaDarajaAPI
+from .statements import StatementReconciler, MISSING, ORPHANED
 
 logger = logging.getLogger(__name__)
 
@@ -23,8 +31,18 @@ def is_provider(user):
     """Check if user is a provider"""
     return user.is_authenticated and (user.user_type == 'provider' or user.is_super_admin)
 
+def _stk_push_identity(request):
+    """Identify an STK push request for deduplicating repeats"""
+    return (
+        request.user.pk,
+        normalize_phone(request.data.get('phone_number')),
+        request.data.get('amount'),
+        request.data.get('account_reference'),
+    )
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@idempotent_payment('bucket_initiate', _stk_push_identity)
 def initiate_payment(request):
     """Initiate STK Push payment for a provider"""
     try:
@@ -78,6 +96,12 @@ def initiate_payment(request):
                 'error_code': result.get('ResponseCode')
             }, status=status.HTTP_400_BAD_REQUEST)
             
+    except CircuitOpenError as e:
+        logger.warning(f"Payment initiation rejected: {e}")
+        return Response({
+            'success': False,
+            'message': 'M-PESA is failing for this account; payments are paused briefly. Please check your payment settings.'
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': str(int(e.retry_after) + 1)})
     except Exception as e:
         logger.error(f"Payment initiation failed: {e}")
         return Response({
@@ -175,36 +199,163 @@ def get_provider_callback_url(request, provider_id):
 @csrf_exempt
 @require_http_methods(["POST"])
 def mpesa_callback(request, provider_id):
-    """Handle M-PESA callback for a specific provider"""
+    """Accept an M-PESA callback for a specific provider into the webhook inbox"""
     try:
-        # Get provider
-        provider = get_object_or_404(Provider, id=provider_id)
+        callback_data = json.loads(request.body.decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JsonResponse({
+            'ResultCode': 1,
+            'ResultDesc': 'Invalid JSON data'
+        }, status=400)
+    
+    try:
+        # Processing happens in the webhook workers; just store and acknowledge
+        record_webhook('mpesa_stk', callback_data, mpesa_dedup_key(provider_id, callback_data), provider_id=provider_id)
+    except Exception as e:
+        logger.error(f"Failed to store M-PESA callback for provider {provider_id}: {e}")
+        return JsonResponse({
+            'ResultCode': 1,
+            'ResultDesc': 'Callback could not be stored'
+        }, status=500)
+    
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def c2b_validation(request, token):
+    """Validate a Paybill (C2B) payment before M-PESA completes it"""
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        payload = None
+    
+    if not is_valid_callback_token(token, payload):
+        logger.warning("Rejected C2B validation with an invalid callback token")
+        return JsonResponse({'ResultCode': INVALID_SHORTCODE, 'ResultDesc': 'Rejected'}, status=403)
+    
+    try:
+        result_code, result_desc = C2BMatcher().validate(payload)
+    except Exception as e:
+        # Never block a customer's payment because of our own error
+        logger.error(f"C2B validation failed: {e}")
+        result_code, result_desc = '0', 'Accepted'
+    
+    return JsonResponse({'ResultCode': result_code, 'ResultDesc': result_desc})
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def c2b_confirmation(request, token):
+    """Record a confirmed Paybill (C2B) payment and issue its ticket"""
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Invalid JSON data'}, status=400)
+    
+    if not is_valid_callback_token(token, payload):
+        logger.warning("Rejected C2B confirmation with an invalid callback token")
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Rejected'}, status=403)
+    
+    try:
+        c2b_txn = C2BMatcher().confirm(payload)
+        logger.info(f"C2B confirmation {c2b_txn.trans_id} recorded as {c2b_txn.status}")
+    except Exception as e:
+        logger.error(f"C2B confirmation failed: {e}")
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Confirmation could not be recorded'}, status=500)
+    
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def register_c2b_urls(request):
+    """Register the Paybill confirmation and validation URLs for the provider's shortcode"""
+    try:
+        provider = request.user.provider_profile
         
-        # Parse callback data
-        try:
-            callback_data = json.loads(request.body.decode('utf-8'))
-        except json.JSONDecodeError:
-            return JsonResponse({
+        if not provider.mpesa_shortcode or not provider.mpesa_consumer_key or not provider.mpesa_consumer_secret:
+            return Response({
                 'success': False,
-                'message': 'Invalid JSON data'
-            }, status=400)
+                'message': 'M-PESA credentials not configured'
+            }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Process callback
-        result = payment_bucket_service.handle_mpesa_callback(provider_id, callback_data)
+        daraja = MpesaDarajaAPI(
+            consumer_key=decrypt_mpesa_credential(provider.mpesa_consumer_key),
+            consumer_secret=decrypt_mpesa_credential(provider.mpesa_consumer_secret),
+            environment=provider.mpesa_environment
+        )
+        token = callback_token(provider.mpesa_shortcode)
+        result, error = daraja.register_c2b_urls(
+            shortcode=provider.mpesa_shortcode,
+            confirmation_url=request.build_absolute_uri(reverse('c2b_confirmation', args=[token])),
+            validation_url=request.build_absolute_uri(reverse('c2b_validation', args=[token]))
+        )
         
-        if result['success']:
-            logger.info(f"Callback processed successfully for provider {provider_id}")
-        else:
-            logger.warning(f"Callback processing failed for provider {provider_id}: {result['message']}")
+        if error:
+            return Response({
+                'success': False,
+                'message': f'C2B URL registration failed: {error}'
+            }, status=status.HTTP_400_BAD_REQUEST)
         
-        return JsonResponse(result)
+        return Response({
+            'success': True,
+            'message': 'Paybill URLs registered successfully',
+            'response': result
+        })
         
     except Exception as e:
-        logger.error(f"Callback handling failed for provider {provider_id}: {e}")
-        return JsonResponse({
+        logger.error(f"C2B URL registration failed: {e}")
+        return Response({
             'success': False,
-            'message': f'Callback processing failed: {str(e)}'
-        }, status=500)
+            'message': f'C2B URL registration failed: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def import_mpesa_statement(request):
+    """Reconcile an uploaded M-PESA statement CSV against the provider's payments"""
+    try:
+        provider = request.user.provider_profile
+        statement = request.FILES.get('statement')
+        if not statement:
+            return Response({
+                'success': False,
+                'message': 'Upload the statement CSV as "statement"'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        apply = str(request.data.get('apply', '')).lower() in ('1', 'true', 'yes')
+        queue_missing = str(request.data.get('queue_missing', '')).lower() in ('1', 'true', 'yes')
+        sample_size = getattr(settings, 'STATEMENT_IMPORT_SAMPLE_ROWS', 100)
+        samples = {MISSING: [], ORPHANED: []}
+        
+        def collect(set_name, record):
+            if set_name in samples and len(samples[set_name]) < sample_size:
+                samples[set_name].append(record)
+        
+        reconciler = StatementReconciler(provider)
+        try:
+            summary = reconciler.reconcile_file(statement, on_row=collect, keep_missing=queue_missing)
+        except ValueError as e:
+            return Response({'success': False, 'message': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        result = {'corrected': 0, 'queued_for_review': 0}
+        if apply or queue_missing:
+            if not apply:
+                reconciler.corrections = {}
+            result = reconciler.apply_corrections(queue_missing=queue_missing)
+        
+        return Response({
+            'success': True,
+            'summary': summary,
+            'applied': result,
+            'missing': samples[MISSING],
+            'orphaned': samples[ORPHANED]
+        })
+        
+    except Exception as e:
+        logger.error(f"Statement import failed: {e}")
+        return Response({
+            'success': False,
+            'message': f'Statement import failed: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -238,6 +389,9 @@ def save_mpesa_credentials(request):
         
         provider.save()
         
+        # New credentials get a fresh circuit
+        gateway_health.reset(provider.id)
+        
         return Response({
             'success': True,
             'message': 'M-PESA credentials saved successfully',
@@ -0,0 +1,319 @@
+"""
+M-PESA Paybill (C2B) validation and confirmation matching
+
+Customers who pay by typing the Paybill number get no STK callback, so the C2B
+confirmation is the only signal we get. Confirmations are matched against an
+in-memory index, so the request does no catalogue queries:
+
+  1. shortcode -> provider
+  2. (provider, order code) -> pending STK order that the customer paid manually,
+     with the order code (see order_code()) as the account number
+  3. (provider, amount, phone) -> pending STK order, only when the MSISDN is a
+     plain number; current Daraja confirmations mask or hash it
+  4. (provider, account reference) -> ticket type, e.g. "WIFI_3", "3" or "1 Hour WiFi"
+  5. (provider, amount) -> the provider's only ticket type at that price
+
+A match issues the ticket inside the confirmation request. Anything else is
+recorded as an unmatched C2BTransaction for review.
+
+The callbacks are unauthenticated, so each shortcode's URLs are registered with
+a secret path token (see callback_token()) and a callback whose token does not
+match its BusinessShortCode is rejected before any matching.
+"""
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+import hashlib
+import hmac
+import re
+import threading
+import time
+import uuid
+import logging
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+
+from .models import Payment, C2BTransaction
+from .fulfilment import complete_payment
+from .latency import record_stage
+from .idempotency import normalize_phone
+
+logger = logging.getLogger(__name__)
+
+# Daraja C2B validation result codes
+ACCEPTED = '0'
+INVALID_ACCOUNT = 'C2B00012'
+INVALID_AMOUNT = 'C2B00013'
+INVALID_SHORTCODE = 'C2B00015'
+
+
+def parse_amount(value):
+    try:
+        return Decimal(str(value)).quantize(Decimal('0.01'))
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+
+def normalize_reference(reference):
+    """Normalise an account reference for lookup: upper case, no spaces"""
+    return ''.join(str(reference or '').split()).upper()
+
+
+def order_code(payment_id):
+    """Get the short code a customer can enter as the Paybill account number to pay a pending order"""
+    return uuid.UUID(str(payment_id)).hex[:8].upper()
+
+
+def callback_token(shortcode):
+    """Get the secret path token for the C2B URLs registered for a shortcode"""
+    message = f"c2b:{str(shortcode or '').strip()}".encode()
+    return hmac.new(settings.C2B_CALLBACK_SECRET.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def is_valid_callback_token(token, payload):
+    """Check a callback's path token belongs to the shortcode it reports a payment for"""
+    shortcode = payload.get('BusinessShortCode') if isinstance(payload, dict) else None
+    if not shortcode or not token:
+        return False
+    return hmac.compare_digest(str(token), callback_token(shortcode))
+
+
+def unmasked_phone(msisdn):
+    """Get the normalised phone number of a C2B MSISDN, or '' if Daraja masked or hashed it"""
+    value = str(msisdn or '').strip()
+    if not re.fullmatch(r'\+?\d{9,12}', value):
+        return ''
+    return normalize_phone(value)
+
+
+class C2BIndex:
+    """
+    Process-local snapshot of shortcodes, ticket types and pending orders.
+
+    The catalogue (shortcodes and ticket types) is rebuilt every
+    C2B_INDEX_TTL_SECONDS and pending orders every C2B_PENDING_INDEX_TTL_SECONDS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._catalog_built_at = 0
+        self._pending = None
+        self._pending_built_at = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._catalog = None
+            self._pending = None
+
+    def _build_catalog(self):
+        from accounts.models import Provider
+        from tickets.models import TicketType
+
+        shortcodes = dict(
+            Provider.objects.filter(status='active')
+            .exclude(mpesa_shortcode__isnull=True)
+            .exclude(mpesa_shortcode='')
+            .values_list('mpesa_shortcode', 'id')
+        )
+        by_amount = defaultdict(list)
+        by_reference = {}
+        ticket_types = TicketType.objects.filter(
+            is_active=True,
+            provider_id__in=list(shortcodes.values())
+        ).values_list('id', 'provider_id', 'name', 'price')
+
+        for ticket_type_id, provider_id, name, price in ticket_types:
+            entry = (ticket_type_id, parse_amount(price))
+            by_amount[(provider_id, entry[1])].append(ticket_type_id)
+            for reference in (str(ticket_type_id), f"WIFI_{ticket_type_id}", name):
+                by_reference[(provider_id, normalize_reference(reference))] = entry
+
+        return {
+            'shortcodes': {str(code).strip(): provider_id for code, provider_id in shortcodes.items()},
+            'by_amount': dict(by_amount),
+            'by_reference': by_reference,
+        }
+
+    def _build_pending(self):
+        since = timezone.now() - timezone.timedelta(minutes=getattr(settings, 'C2B_PENDING_ORDER_MINUTES', 60))
+        by_reference = {}
+        by_phone = {}
+        orders = Payment.objects.filter(
+            status='pending',
+            payment_method='mpesa',
+            provider_id__isnull=False,
+            created_at__gte=since
+        ).order_by('created_at').values_list('id', 'provider_id', 'amount', 'phone_number')
+
+        for payment_id, provider_id, amount, phone_number in orders:
+            amount = parse_amount(amount)
+            by_reference[(provider_id, order_code(payment_id))] = (payment_id, amount)
+            # Later orders win; the customer is most likely paying the latest one
+            by_phone[(provider_id, amount, normalize_phone(phone_number))] = payment_id
+        return {'by_reference': by_reference, 'by_phone': by_phone}
+
+    def get(self):
+        """Get (catalog, pending) snapshots, rebuilding whichever has expired"""
+        now = time.monotonic()
+        with self._lock:
+            if self._catalog is None or now - self._catalog_built_at > getattr(settings, 'C2B_INDEX_TTL_SECONDS', 60):
+                self._catalog = self._build_catalog()
+                self._catalog_built_at = now
+            if self._pending is None or now - self._pending_built_at > getattr(settings, 'C2B_PENDING_INDEX_TTL_SECONDS', 15):
+                self._pending = self._build_pending()
+                self._pending_built_at = now
+            return self._catalog, self._pending
+
+
+c2b_index = C2BIndex()
+
+
+class C2BMatcher:
+    """Validate and confirm Paybill payments"""
+
+    def __init__(self, index=None):
+        self.index = index or c2b_index
+
+    def match(self, shortcode, amount, reference, phone_number, pending_orders=True):
+        """
+        Match a Paybill payment.
+
+        Returns a dict with provider_id, payment_id or ticket_type_id and the
+        match reason; reason is one of the unmatched_* values when nothing fits.
+        Pending orders come from a snapshot and are only matched when
+        pending_orders is set.
+        """
+        catalog, pending = self.index.get()
+        provider_id = catalog['shortcodes'].get(str(shortcode or '').strip())
+        if not provider_id:
+            return {'reason': 'unmatched_shortcode'}
+
+        result = {'provider_id': provider_id}
+        if amount is None:
+            return {**result, 'reason': 'unmatched_amount'}
+
+        if pending_orders:
+            order = pending['by_reference'].get((provider_id, normalize_reference(reference)))
+            if order and order[1] == amount:
+                return {**result, 'payment_id': order[0], 'reason': 'pending_order'}
+            phone = unmasked_phone(phone_number)
+            payment_id = pending['by_phone'].get((provider_id, amount, phone)) if phone else None
+            if payment_id:
+                return {**result, 'payment_id': payment_id, 'reason': 'pending_order'}
+
+        entry = catalog['by_reference'].get((provider_id, normalize_reference(reference)))
+        if entry:
+            ticket_type_id, price = entry
+            if price != amount:
+                return {**result, 'ticket_type_id': ticket_type_id, 'reason': 'unmatched_amount'}
+            return {**result, 'ticket_type_id': ticket_type_id, 'reason': 'account_reference'}
+
+        candidates = catalog['by_amount'].get((provider_id, amount), [])
+        if len(candidates) == 1:
+            return {**result, 'ticket_type_id': candidates[0], 'reason': 'amount'}
+        if candidates:
+            return {**result, 'reason': 'unmatched_ambiguous_amount'}
+        return {**result, 'reason': 'unmatched_amount'}
+
+    def validate(self, payload):
+        """Get the (ResultCode, ResultDesc) to answer a C2B validation request with"""
+        amount = parse_amount(payload.get('TransAmount'))
+        match = self.match(payload.get('BusinessShortCode'), amount, payload.get('BillRefNumber'), payload.get('MSISDN'))
+        reason = match['reason']
+
+        if reason == 'unmatched_shortcode':
+            return INVALID_SHORTCODE, 'Rejected'
+        if reason.startswith('unmatched') and getattr(settings, 'C2B_REJECT_UNMATCHED', False):
+            return (INVALID_AMOUNT if reason == 'unmatched_amount' else INVALID_ACCOUNT), 'Rejected'
+        return ACCEPTED, 'Accepted'
+
+    def confirm(self, payload):
+        """Record a C2B confirmation and issue the ticket if it matches"""
+        trans_id = str(payload.get('TransID') or '').strip()
+        if not trans_id:
+            raise ValueError('C2B confirmation has no TransID')
+
+        amount = parse_amount(payload.get('TransAmount'))
+        try:
+            with transaction.atomic():
+                c2b_txn = C2BTransaction.objects.create(
+                    trans_id=trans_id,
+                    transaction_type=payload.get('TransactionType') or '',
+                    business_shortcode=str(payload.get('BusinessShortCode') or ''),
+                    amount=amount or Decimal('0'),
+                    bill_ref_number=payload.get('BillRefNumber') or '',
+                    msisdn=str(payload.get('MSISDN') or ''),
+                    first_name=payload.get('FirstName') or '',
+                    trans_time=str(payload.get('TransTime') or ''),
+                    payload=payload
+                )
+        except IntegrityError:
+            # Daraja retried a confirmation we already have
+            return C2BTransaction.objects.get(trans_id=trans_id)
+
+        match = self.match(c2b_txn.business_shortcode, amount, c2b_txn.bill_ref_number, c2b_txn.msisdn)
+        with transaction.atomic():
+            payment_id = match.get('payment_id')
+            # The pending snapshot may be stale; re-check the order under a row lock held until commit
+            if payment_id and not Payment.objects.select_for_update().filter(id=payment_id, status='pending').exists():
+                logger.info(f"C2B payment {trans_id}: order {payment_id} is no longer pending, matching on its own")
+                match = self.match(
+                    c2b_txn.business_shortcode, amount, c2b_txn.bill_ref_number, c2b_txn.msisdn, pending_orders=False
+                )
+            c2b_txn.provider_id = match.get('provider_id')
+            c2b_txn.match_reason = match['reason']
+
+            if match['reason'].startswith('unmatched'):
+                c2b_txn.ticket_type_id = match.get('ticket_type_id')
+                c2b_txn.save(update_fields=['provider', 'ticket_type', 'match_reason', 'updated_at'])
+                logger.warning(f"C2B payment {trans_id} unmatched ({match['reason']}), queued for review")
+                return c2b_txn
+
+            self.fulfil(c2b_txn, payment_id=match.get('payment_id'), ticket_type_id=match.get('ticket_type_id'))
+        return c2b_txn
+
+    def fulfil(self, c2b_txn, payment_id=None, ticket_type_id=None, status='matched'):
+        """Complete the matched order (or create one for the ticket type) and issue its ticket"""
+        with transaction.atomic():
+            if not payment_id:
+                from tickets.models import TicketType
+                ticket_type = TicketType.objects.get(id=ticket_type_id)
+                payment = Payment.objects.create(
+                    provider_id=c2b_txn.provider_id or ticket_type.provider_id,
+                    ticket_type=ticket_type,
+                    phone_number=c2b_txn.msisdn[:15] if unmasked_phone(c2b_txn.msisdn) else None,
+                    amount=c2b_txn.amount,
+                    currency=ticket_type.currency,
+                    payment_method='mpesa',
+                    description=f"Paybill - {ticket_type.name}",
+                    mpesa_receipt_number=c2b_txn.trans_id
+                )
+                payment_id = payment.id
+
+            record_stage(payment_id, 'callback_received', c2b_txn.created_at)
+            payment, ticket = complete_payment(payment_id, receipt_number=c2b_txn.trans_id)
+
+            c2b_txn.payment = payment
+            c2b_txn.ticket_type_id = payment.ticket_type_id
+            c2b_txn.status = status
+            c2b_txn.save(update_fields=['provider', 'ticket_type', 'payment', 'status', 'match_reason', 'updated_at'])
+
+        logger.info(f"C2B payment {c2b_txn.trans_id} matched ({c2b_txn.match_reason}), ticket {ticket.code if ticket else None}")
+        return ticket
+
+    def resolve(self, c2b_txn, ticket_type, reviewed_by=None):
+        """Issue a ticket for an unmatched payment after review"""
+        with transaction.atomic():
+            c2b_txn = C2BTransaction.objects.select_for_update().get(pk=c2b_txn.pk)
+            if c2b_txn.status != 'unmatched':
+                return None
+            return self._resolve(c2b_txn, ticket_type, reviewed_by)
+
+    def _resolve(self, c2b_txn, ticket_type, reviewed_by):
+        c2b_txn.provider_id = c2b_txn.provider_id or ticket_type.provider_id
+        c2b_txn.match_reason = 'manual'
+        ticket = self.fulfil(c2b_txn, ticket_type_id=ticket_type.id, status='resolved')
+        C2BTransaction.objects.filter(pk=c2b_txn.pk).update(reviewed_by=reviewed_by, reviewed_at=timezone.now())
+        return ticket
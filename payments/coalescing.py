@@ -0,0 +1,202 @@
+"""
+Request coalescing for upstream status queries
+
+Several callers often ask about the same STK push at once (the captive portal
+polling from multiple tabs, retries, the reconciliation sweeper). Instead of
+each one querying Daraja:
+
+  - results are cached briefly, and terminal results (paid, cancelled,
+    failed) are cached for good since they can no longer change
+  - within a process, concurrent callers for the same key wait on a single
+    in-flight query and share its result or error
+  - across processes, the first caller takes a short cache lock and the others
+    poll the cache for its result, falling back to their own query if it
+    does not arrive in time
+
+Async callers use aget(), which does the same with asyncio futures within
+their event loop and awaits instead of sleeping while another process fetches.
+
+Cross-process coalescing needs a shared cache backend (CACHE_REDIS_URL).
+"""
+import asyncio
+import threading
+import time
+import logging
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    """An upstream query in progress that other callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer:
+    """Share one upstream call between concurrent callers asking for the same key"""
+
+    def __init__(self, namespace, ttl=5, terminal_ttl=None, wait_seconds=10, poll_interval=0.1):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.terminal_ttl = terminal_ttl
+        self.wait_seconds = wait_seconds
+        self.poll_interval = poll_interval
+        self._flights = {}
+        # (event loop, key) -> asyncio.Future
+        self._async_flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'cache_hits': 0, 'coalesced': 0, 'upstream_calls': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _cache_key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def get(self, key, fetch, is_terminal=None):
+        """
+        Get the result for key, calling fetch() only if no fresh result is cached
+        and no other caller is already fetching it.
+
+        is_terminal(result) decides whether the result is cached for
+        terminal_ttl or only briefly (ttl). Errors are shared with callers
+        waiting on the same flight but never cached.
+        """
+        cache_key = self._cache_key(key)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            self._count('cache_hits')
+            return cached
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            self._count('coalesced')
+            if not flight.done.wait(self.wait_seconds):
+                logger.warning(f"Timed out waiting for in-flight {self.namespace} query {key}")
+                return self._fetch(cache_key, fetch, is_terminal)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._fetch_shared(cache_key, fetch, is_terminal)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _fetch_shared(self, cache_key, fetch, is_terminal):
+        """Fetch under a cross-process lock, or wait for the process holding it"""
+        lock_key = f"{cache_key}:lock"
+        if cache.add(lock_key, 1, self.wait_seconds):
+            try:
+                return self._fetch(cache_key, fetch, is_terminal)
+            finally:
+                cache.delete(lock_key)
+
+        deadline = time.monotonic() + self.wait_seconds
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                self._count('coalesced')
+                return cached
+            if cache.get(lock_key) is None:
+                # The other process failed without storing a result
+                break
+        return self._fetch(cache_key, fetch, is_terminal)
+
+    def _fetch(self, cache_key, fetch, is_terminal):
+        self._count('upstream_calls')
+        result = fetch()
+        if result is not None:
+            terminal = is_terminal(result) if is_terminal else False
+            cache.set(cache_key, result, self.terminal_ttl if terminal else self.ttl)
+        return result
+
+    async def aget(self, key, fetch, is_terminal=None):
+        """Async version of get(); fetch is a coroutine function"""
+        cache_key = self._cache_key(key)
+        cached = await cache.aget(cache_key)
+        if cached is not None:
+            self._count('cache_hits')
+            return cached
+
+        flight_key = (asyncio.get_running_loop(), key)
+        with self._lock:
+            flight = self._async_flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._async_flights[flight_key] = asyncio.get_running_loop().create_future()
+
+        if not leader:
+            self._count('coalesced')
+            try:
+                return await asyncio.wait_for(asyncio.shield(flight), self.wait_seconds)
+            except asyncio.TimeoutError:
+                logger.warning(f"Timed out waiting for in-flight {self.namespace} query {key}")
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+                # The leading request was cancelled (client went away) before it got a result
+            return await self._afetch(cache_key, fetch, is_terminal)
+
+        try:
+            result = await self._afetch_shared(cache_key, fetch, is_terminal)
+            flight.set_result(result)
+            return result
+        except Exception as e:
+            flight.set_exception(e)
+            # Mark the exception retrieved so an unawaited flight does not log a warning
+            flight.exception()
+            raise
+        finally:
+            with self._lock:
+                self._async_flights.pop(flight_key, None)
+            if not flight.done():
+                flight.cancel()
+
+    async def _afetch_shared(self, cache_key, fetch, is_terminal):
+        lock_key = f"{cache_key}:lock"
+        if await cache.aadd(lock_key, 1, self.wait_seconds):
+            try:
+                return await self._afetch(cache_key, fetch, is_terminal)
+            finally:
+                await cache.adelete(lock_key)
+
+        deadline = time.monotonic() + self.wait_seconds
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            cached = await cache.aget(cache_key)
+            if cached is not None:
+                self._count('coalesced')
+                return cached
+            if await cache.aget(lock_key) is None:
+                break
+        return await self._afetch(cache_key, fetch, is_terminal)
+
+    async def _afetch(self, cache_key, fetch, is_terminal):
+        self._count('upstream_calls')
+        result = await fetch()
+        if result is not None:
+            terminal = is_terminal(result) if is_terminal else False
+            await cache.aset(cache_key, result, self.terminal_ttl if terminal else self.ttl)
+        return result
+
+    def invalidate(self, key):
+        cache.delete(self._cache_key(key))
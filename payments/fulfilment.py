@@ -0,0 +1,164 @@
+"""
+Idempotent fulfilment of completed payments (WiFi tickets and subscriptions)
+"""
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def get_ticket_expiry(ticket_type, now=None):
+    """Get the expiry time for a ticket of the given type"""
+    now = now or timezone.now()
+    if ticket_type.type == 'time' and ticket_type.duration_hours:
+        return now + timedelta(hours=ticket_type.duration_hours)
+    # Data-based tickets get a 30 day validity window
+    return now + timedelta(days=30)
+
+
+def issue_ticket_for_payment(payment):
+    """
+    Issue the WiFi ticket for a completed M-PESA payment.
+
+    Returns the existing ticket if the payment was already fulfilled, so callers
+    holding a lock on the payment row can call this any number of times.
+    """
+    from tickets.models import Ticket, TicketSale
+    from .latency import record_stage
+
+    existing_ticket = payment.tickets.first()
+    if existing_ticket:
+        return existing_ticket
+
+    if not payment.provider_id or not payment.ticket_type_id:
+        logger.warning(f"Payment {payment.id} has no provider or ticket type, cannot issue ticket")
+        return None
+
+    ticket_type = payment.ticket_type
+    ticket = Ticket.objects.create(
+        provider_id=payment.provider_id,
+        ticket_type=ticket_type,
+        payment=payment,
+        expires_at=get_ticket_expiry(ticket_type),
+    )
+
+    TicketSale.objects.create(
+        provider_id=payment.provider_id,
+        ticket_type=ticket_type,
+        ticket=ticket,
+        unit_price=ticket_type.price,
+        total_amount=payment.amount,
+        currency=payment.currency,
+        payment_method='mpesa',
+        payment_reference=payment.mpesa_receipt_number or payment.mpesa_checkout_request_id or '',
+        status='completed'
+    )
+
+    record_stage(payment.id, 'ticket_issued', ticket.created_at)
+
+    logger.info(f"Ticket {ticket.code} issued for payment {payment.id}")
+    return ticket
+
+
+def activate_subscription_for_payment(payment):
+    """
+    Activate the provider subscription paid for by a completed Pesapal payment.
+
+    A subscription already activated with this payment's reference is returned
+    unchanged, so repeated calls do not extend the subscription twice.
+    """
+    from accounts.models import Provider
+    from subscriptions.models import ProviderSubscription
+
+    provider = Provider.objects.filter(user_id=payment.user_id).first() if payment.user_id else None
+    if not provider:
+        logger.warning(f"Payment {payment.id} has no provider profile, cannot activate subscription")
+        return None
+
+    reference = payment.pesapal_order_tracking_id or str(payment.id)
+
+    active_subscription = ProviderSubscription.objects.filter(
+        provider=provider,
+        payment_reference=reference,
+        status='active'
+    ).first()
+    if active_subscription:
+        return active_subscription
+
+    subscription = ProviderSubscription.objects.select_for_update().filter(
+        Q(payment_reference=reference) | Q(payment_reference__isnull=True) | Q(payment_reference=''),
+        provider=provider,
+        status='pending'
+    ).order_by('-created_at').first()
+
+    if not subscription:
+        logger.warning(f"No pending subscription found for payment {payment.id}")
+        return None
+
+    now = timezone.now()
+    subscription.status = 'active'
+    subscription.payment_reference = reference
+    subscription.amount_paid = payment.amount
+    subscription.end_date = now + timedelta(days=subscription.plan.duration_days)
+    subscription.save(update_fields=['status', 'payment_reference', 'amount_paid', 'end_date', 'updated_at'])
+
+    Provider.objects.filter(pk=provider.pk).update(
+        subscription_status='active',
+        subscription_start_date=now,
+        subscription_end_date=subscription.end_date
+    )
+
+    logger.info(f"Subscription activated for provider {provider.business_name} from payment {payment.id}")
+    return subscription
+
+
+def fulfil_payment(payment):
+    """Issue whatever a completed payment paid for"""
+    if payment.payment_method == 'mpesa':
+        return issue_ticket_for_payment(payment)
+    if payment.payment_method == 'pesapal':
+        return activate_subscription_for_payment(payment)
+    return None
+
+
+def mark_payment_completed(payment, receipt_number=None, payment_reference=None):
+    """Set completion fields on a locked payment row and return the changed field names"""
+    payment.status = 'completed'
+    payment.completed_at = payment.completed_at or timezone.now()
+    fields = ['status', 'completed_at', 'updated_at']
+
+    if receipt_number and not payment.mpesa_receipt_number:
+        payment.mpesa_receipt_number = receipt_number
+        fields.append('mpesa_receipt_number')
+    if payment_reference and not payment.pesapal_payment_reference:
+        payment.pesapal_payment_reference = payment_reference
+        fields.append('pesapal_payment_reference')
+
+    return fields
+
+
+def complete_payment(payment_id, receipt_number=None, payment_reference=None):
+    """
+    Mark a payment completed and fulfil it exactly once.
+
+    Used by callbacks, status polls and the reconciliation sweeper; whichever
+    arrives first does the work and the others get the same ticket/subscription.
+    """
+    from .models import Payment
+
+    with transaction.atomic():
+        payment = Payment.objects.select_for_update().get(id=payment_id)
+        if payment.status in ('failed', 'cancelled'):
+            logger.warning(f"Completing payment {payment.id} previously marked {payment.status}")
+        newly_completed = payment.status != 'completed'
+        if newly_completed:
+            fields = mark_payment_completed(payment, receipt_number, payment_reference)
+            payment.save(update_fields=fields)
+        result = fulfil_payment(payment)
+        if newly_completed:
+            from .ledger import post_payment
+            post_payment(payment)
+        return payment, result
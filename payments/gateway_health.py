@@ -0,0 +1,264 @@
+"""
+Per-provider gateway health tracking and circuit breaking for M-PESA calls
+
+Each (provider, endpoint) pair keeps a rolling window of recent call outcomes
+and latencies. When a provider's credentials or Daraja keep failing, its
+circuit opens and further calls fail fast with CircuitOpenError instead of
+waiting on 30 second timeouts. After a cool-down a single trial call is let
+through; its outcome closes or re-opens the circuit. A trial that never
+reports back (cancelled, or its worker killed) is given up on after
+GATEWAY_BREAKER_TRIAL_TIMEOUT_SECONDS and another one is let through.
+
+State is kept in process memory. The provider's mpesa_last_test and
+mpesa_test_status columns are written by a periodic flush (at most once per
+GATEWAY_HEALTH_FLUSH_SECONDS per process) rather than on every request.
+Each process flushes its own buffer, either on the first call recorded after
+the interval or from a timer thread if no further calls arrive.
+"""
+from collections import deque
+import threading
+import time
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Circuit states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the provider's circuit is open"""
+
+    def __init__(self, provider_id, endpoint, retry_after):
+        self.provider_id = provider_id
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super().__init__(
+            f"M-PESA {endpoint} circuit open for provider {provider_id}, retry in {int(retry_after)}s"
+        )
+
+
+class EndpointHealth:
+    """Rolling window and circuit state for one provider endpoint"""
+
+    def __init__(self, window_size):
+        self.samples = deque(maxlen=window_size)
+        self.state = CLOSED
+        self.opened_at = None
+        # monotonic time the half-open trial call was let through, if one is in flight
+        self.trial_started_at = None
+        self.consecutive_failures = 0
+        self.total_calls = 0
+        self.total_failures = 0
+
+    def prune(self, now, window_seconds):
+        while self.samples and now - self.samples[0][0] > window_seconds:
+            self.samples.popleft()
+
+    def error_rate(self):
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ok, _ in self.samples if not ok) / len(self.samples)
+
+    def latency_stats(self):
+        latencies = sorted(latency for _, _, latency in self.samples)
+        if not latencies:
+            return {'avg_ms': None, 'p95_ms': None}
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return {
+            'avg_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+            'p95_ms': round(p95 * 1000, 1),
+        }
+
+
+class GatewayHealthTracker:
+    """Thread-safe health tracker and circuit breaker keyed by (provider_id, endpoint)"""
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        # provider_id -> (checked_at, test_status) waiting to be written to the DB
+        self._dirty = {}
+        self._last_flush = time.monotonic()
+        self._timer = None
+
+    @property
+    def window_seconds(self):
+        return getattr(settings, 'GATEWAY_HEALTH_WINDOW_SECONDS', 300)
+
+    @property
+    def min_calls(self):
+        return getattr(settings, 'GATEWAY_BREAKER_MIN_CALLS', 5)
+
+    @property
+    def error_threshold(self):
+        return getattr(settings, 'GATEWAY_BREAKER_ERROR_RATE', 0.5)
+
+    @property
+    def consecutive_failure_limit(self):
+        return getattr(settings, 'GATEWAY_BREAKER_CONSECUTIVE_FAILURES', 5)
+
+    @property
+    def cooldown_seconds(self):
+        return getattr(settings, 'GATEWAY_BREAKER_COOLDOWN_SECONDS', 60)
+
+    @property
+    def trial_timeout_seconds(self):
+        return getattr(settings, 'GATEWAY_BREAKER_TRIAL_TIMEOUT_SECONDS', 90)
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, 'GATEWAY_HEALTH_FLUSH_SECONDS', 30)
+
+    def _get(self, provider_id, endpoint):
+        key = (provider_id, endpoint)
+        health = self._endpoints.get(key)
+        if health is None:
+            health = EndpointHealth(getattr(settings, 'GATEWAY_HEALTH_WINDOW_SIZE', 100))
+            self._endpoints[key] = health
+        return health
+
+    def before_call(self, provider_id, endpoint):
+        """Raise CircuitOpenError if calls to this provider endpoint should fail fast"""
+        now = time.monotonic()
+        with self._lock:
+            health = self._get(provider_id, endpoint)
+            if health.state == CLOSED:
+                return
+            if health.state == OPEN:
+                remaining = self.cooldown_seconds - (now - health.opened_at)
+                if remaining > 0:
+                    raise CircuitOpenError(provider_id, endpoint, remaining)
+                health.state = HALF_OPEN
+                health.trial_started_at = None
+            # Half open: let exactly one trial call through, or another if it never reported back
+            if health.trial_started_at is not None:
+                remaining = self.trial_timeout_seconds - (now - health.trial_started_at)
+                if remaining > 0:
+                    raise CircuitOpenError(provider_id, endpoint, remaining)
+                logger.warning(f"M-PESA {endpoint} trial call for provider {provider_id} never finished, retrying")
+            health.trial_started_at = now
+
+    def record(self, provider_id, endpoint, ok, latency):
+        """Record the outcome of a call and flush to the DB if the interval has passed"""
+        if self._record(provider_id, endpoint, ok, latency):
+            self.flush()
+
+    async def arecord(self, provider_id, endpoint, ok, latency):
+        """record() for async callers; the DB flush runs in a worker thread"""
+        if self._record(provider_id, endpoint, ok, latency):
+            await sync_to_async(self.flush)()
+
+    def _record(self, provider_id, endpoint, ok, latency):
+        now = time.monotonic()
+        with self._lock:
+            health = self._get(provider_id, endpoint)
+            health.samples.append((now, ok, latency))
+            health.prune(now, self.window_seconds)
+            health.total_calls += 1
+
+            if ok:
+                health.consecutive_failures = 0
+                if health.state != CLOSED:
+                    logger.info(f"M-PESA {endpoint} circuit closed for provider {provider_id}")
+                health.state = CLOSED
+            else:
+                health.total_failures += 1
+                health.consecutive_failures += 1
+                if health.state == HALF_OPEN or self._should_open(health):
+                    if health.state != OPEN:
+                        logger.warning(
+                            f"M-PESA {endpoint} circuit opened for provider {provider_id} "
+                            f"(error rate {health.error_rate():.0%}, {health.consecutive_failures} consecutive failures)"
+                        )
+                    health.state = OPEN
+                    health.opened_at = now
+            health.trial_started_at = None
+
+            self._dirty[provider_id] = (timezone.now(), 'success' if ok else 'failed')
+            if now - self._last_flush >= self.flush_interval:
+                return True
+            self._schedule_flush(self._last_flush + self.flush_interval - now)
+            return False
+
+    def _schedule_flush(self, delay):
+        """Flush from a timer thread so a quiet process does not sit on updates; call with the lock held"""
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self._timed_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _timed_flush(self):
+        from django.db import connections
+
+        with self._lock:
+            self._timer = None
+        try:
+            self.flush()
+        finally:
+            connections.close_all()
+
+    def _should_open(self, health):
+        if health.consecutive_failures >= self.consecutive_failure_limit:
+            return True
+        return len(health.samples) >= self.min_calls and health.error_rate() >= self.error_threshold
+
+    def reset(self, provider_id):
+        """Close all circuits for a provider, e.g. after its credentials are updated"""
+        with self._lock:
+            for (pid, _), health in self._endpoints.items():
+                if pid == provider_id:
+                    health.state = CLOSED
+                    health.consecutive_failures = 0
+                    health.trial_started_at = None
+                    health.samples.clear()
+
+    def flush(self):
+        """Write pending test status updates to the provider rows"""
+        from accounts.models import Provider
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._last_flush = time.monotonic()
+
+        for provider_id, (checked_at, test_status) in dirty.items():
+            try:
+                Provider.objects.filter(pk=provider_id).update(
+                    mpesa_last_test=checked_at,
+                    mpesa_test_status=test_status
+                )
+            except Exception as e:
+                logger.error(f"Failed to flush gateway health for provider {provider_id}: {e}")
+        return len(dirty)
+
+    def snapshot(self, provider_id=None):
+        """Get current health stats, optionally for a single provider"""
+        now = time.monotonic()
+        stats = []
+        with self._lock:
+            for (pid, endpoint), health in self._endpoints.items():
+                if provider_id is not None and pid != provider_id:
+                    continue
+                health.prune(now, self.window_seconds)
+                stats.append({
+                    'provider_id': pid,
+                    'endpoint': endpoint,
+                    'state': health.state,
+                    'calls': len(health.samples),
+                    'error_rate': round(health.error_rate(), 3),
+                    'consecutive_failures': health.consecutive_failures,
+                    'total_calls': health.total_calls,
+                    'total_failures': health.total_failures,
+                    **health.latency_stats(),
+                })
+        return stats
+
+
+# Global tracker instance
+gateway_health = GatewayHealthTracker()
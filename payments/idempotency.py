@@ -0,0 +1,220 @@
+"""
+Idempotency keys for payment initiation endpoints
+
+A repeated "Pay" tap must not fire a second STK push. Each initiation request
+gets a key derived from the request's identity (e.g. provider, phone and
+ticket type). A client-supplied key (Idempotency-Key header or an
+idempotency_key field) is namespaced by that identity, so a key replayed by
+someone else on the open captive portal never returns another customer's
+response. The first request claims the key with a single
+cache.add(); repeats within the TTL get the stored response back, or a 409
+while the first request is still talking to the gateway. A derived key stops
+replaying once its payment has completed, failed or been cancelled.
+
+Keys live in the default cache, so deployments with several web workers
+need a shared backend (CACHE_REDIS_URL).
+"""
+from functools import wraps
+import asyncio
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+
+from .models import Payment
+
+logger = logging.getLogger(__name__)
+
+IN_PROGRESS = '__in_progress__'
+
+
+def normalize_phone(phone_number):
+    """Reduce a Kenyan phone number to its last nine digits (07.., 2547.., +2547..)"""
+    digits = ''.join(ch for ch in str(phone_number or '') if ch.isdigit())
+    return digits[-9:]
+
+
+def get_request_data(request):
+    """Get the request payload for DRF and plain Django requests"""
+    if hasattr(request, 'data'):
+        return request.data
+    try:
+        return json.loads(request.body or b'{}')
+    except (ValueError, UnicodeDecodeError):
+        return {}
+
+
+def get_client_key(request):
+    """Get a client-supplied idempotency key, if any"""
+    key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+    if not key:
+        data = get_request_data(request)
+        key = data.get('idempotency_key') if hasattr(data, 'get') else None
+    return str(key)[:200] if key else None
+
+
+def _cache_key(scope, key):
+    digest = hashlib.sha256(f"{scope}|{key}".encode()).hexdigest()[:40]
+    return f"idempotency:{scope}:{digest}"
+
+
+def _serialize(response):
+    if hasattr(response, 'data'):
+        # DRF Response: store the data and let the view's renderer replay it
+        stored = {'status': response.status_code, 'data': response.data}
+        body = response.data
+    else:
+        stored = {
+            'status': response.status_code,
+            'content': response.content.decode('utf-8'),
+            'content_type': response.get('Content-Type', 'application/json'),
+        }
+        try:
+            body = json.loads(stored['content'])
+        except ValueError:
+            body = None
+    stored['checkout_request_id'] = body.get('checkout_request_id') if isinstance(body, dict) else None
+    return stored
+
+
+def _replay(stored):
+    if 'data' in stored:
+        from rest_framework.response import Response
+        response = Response(stored['data'], status=stored['status'])
+    else:
+        response = HttpResponse(stored['content'], status=stored['status'], content_type=stored['content_type'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _resolve_key(scope, derive_key, request, args, kwargs):
+    """
+    Get the (cache key, TTL, derived) for a request, or None if it should
+    not be deduplicated. derived is False when the client supplied the key.
+    """
+    parts = derive_key(request, *args, **kwargs) if derive_key else None
+    if not parts or not all(parts):
+        return None
+    identity = ':'.join(str(part) for part in parts)
+
+    client_key = get_client_key(request)
+    if client_key:
+        key = f"client:{identity}:{client_key}"
+        ttl = getattr(settings, 'PAYMENT_IDEMPOTENCY_TTL_SECONDS', 600)
+    else:
+        key = f"derived:{identity}"
+        ttl = getattr(settings, 'PAYMENT_IDEMPOTENCY_WINDOW_SECONDS', 90)
+    return _cache_key(scope, key), ttl, not client_key
+
+
+def _settled_payments(stored):
+    """Get the stored response's payment if it is no longer pending"""
+    checkout_request_id = stored.get('checkout_request_id') if isinstance(stored, dict) else None
+    if not checkout_request_id:
+        return Payment.objects.none()
+    return Payment.objects.filter(mpesa_checkout_request_id=checkout_request_id).exclude(status='pending')
+
+
+def _repeat_response(scope, stored, settled):
+    """Get the response for a repeated request, or None to handle it as a new one"""
+    if stored == IN_PROGRESS:
+        return JsonResponse({
+            'success': False,
+            'message': 'This payment is already being processed. Please check your phone.'
+        }, status=409)
+    if stored is not None and not settled:
+        logger.info(f"Replaying {scope} response for repeated request")
+        return _replay(stored)
+    return None
+
+
+def _response_to_store(response):
+    """Get what to store against the key for a view's response; None releases the key"""
+    return _serialize(response) if 200 <= response.status_code < 300 else None
+
+
+def _sync_wrapper(view_func, scope, derive_key):
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        resolved = _resolve_key(scope, derive_key, request, args, kwargs)
+        if resolved is None:
+            return view_func(request, *args, **kwargs)
+        cache_key, ttl, derived = resolved
+
+        if not cache.add(cache_key, IN_PROGRESS, ttl):
+            stored = cache.get(cache_key)
+            response = _repeat_response(scope, stored, derived and _settled_payments(stored).exists())
+            if response is not None:
+                return response
+            # The key expired between add() and get(), or its payment has settled; treat as a new request
+            cache.set(cache_key, IN_PROGRESS, ttl)
+
+        try:
+            response = view_func(request, *args, **kwargs)
+        except Exception:
+            cache.delete(cache_key)
+            raise
+
+        stored = _response_to_store(response)
+        if stored is None:
+            cache.delete(cache_key)
+        else:
+            cache.set(cache_key, stored, ttl)
+        return response
+    return wrapper
+
+
+def _async_wrapper(view_func, scope, derive_key):
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        resolved = _resolve_key(scope, derive_key, request, args, kwargs)
+        if resolved is None:
+            return await view_func(request, *args, **kwargs)
+        cache_key, ttl, derived = resolved
+
+        if not await cache.aadd(cache_key, IN_PROGRESS, ttl):
+            stored = await cache.aget(cache_key)
+            response = _repeat_response(scope, stored, derived and await _settled_payments(stored).aexists())
+            if response is not None:
+                return response
+            # The key expired between add() and get(), or its payment has settled; treat as a new request
+            await cache.aset(cache_key, IN_PROGRESS, ttl)
+
+        try:
+            response = await view_func(request, *args, **kwargs)
+        except BaseException:
+            await cache.adelete(cache_key)
+            raise
+
+        stored = _response_to_store(response)
+        if stored is None:
+            await cache.adelete(cache_key)
+        else:
+            await cache.aset(cache_key, stored, ttl)
+        return response
+    return wrapper
+
+
+def idempotent_payment(scope, derive_key=None):
+    """
+    Make a payment initiation view idempotent.
+
+    derive_key(request, *args, **kwargs) returns a tuple identifying the
+    purchase (or None to skip deduplication). A client-supplied key is only
+    matched within that identity.
+    Derived keys expire after PAYMENT_IDEMPOTENCY_WINDOW_SECONDS, which is the
+    window in which an identical purchase counts as a repeat, and stop
+    replaying once the stored response's payment is no longer pending, so a
+    customer whose push was cancelled or failed can pay again at once.
+    Client keys are kept for PAYMENT_IDEMPOTENCY_TTL_SECONDS. Only successful
+    responses are stored; errors release the key so the customer can try
+    again. Works on both sync and async views.
+    """
+    def decorator(view_func):
+        if asyncio.iscoroutinefunction(view_func):
+            return _async_wrapper(view_func, scope, derive_key)
+        return _sync_wrapper(view_func, scope, derive_key)
+    return decorator
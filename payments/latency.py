@@ -0,0 +1,126 @@
+"""
+Payment-to-ticket latency
+
+Each order records when it reached each stage on its Payment row:
+
+  initiated -> stk_accepted -> callback_received -> ticket_issued -> first_login
+
+Stages are written with a single conditional UPDATE (first write wins), so
+retries and duplicate callbacks do not move them. Latency histograms are
+computed in the database: one query per interval, grouped by provider or
+gateway, with a conditional count per bucket.
+"""
+from datetime import timedelta
+import logging
+
+from django.db.models import Count, DurationField, ExpressionWrapper, F, Max, Q
+from django.utils import timezone
+
+from .models import Payment
+
+logger = logging.getLogger(__name__)
+
+STAGE_FIELDS = {
+    'initiated': 'initiated_at',
+    'stk_accepted': 'stk_accepted_at',
+    'callback_received': 'callback_received_at',
+    'ticket_issued': 'ticket_issued_at',
+    'first_login': 'first_login_at',
+}
+
+# (name, from stage field, to stage field)
+INTERVALS = (
+    ('stk_accept', 'initiated_at', 'stk_accepted_at'),
+    ('customer_payment', 'stk_accepted_at', 'callback_received_at'),
+    ('fulfilment', 'callback_received_at', 'ticket_issued_at'),
+    ('pay_to_voucher', 'initiated_at', 'ticket_issued_at'),
+    ('voucher_to_login', 'ticket_issued_at', 'first_login_at'),
+    ('end_to_end', 'initiated_at', 'first_login_at'),
+)
+
+# Histogram bucket upper bounds in seconds; the last bucket is open-ended
+BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
+
+GROUP_FIELDS = {
+    'provider': ('provider_id', 'provider__business_name'),
+    'gateway': ('payment_method',),
+}
+
+
+def record_stage(payment_id, stage, at=None):
+    """Record when a payment reached a stage, unless it already has"""
+    field = STAGE_FIELDS[stage]
+    return Payment.objects.filter(pk=payment_id, **{f"{field}__isnull": True}).update(**{field: at or timezone.now()})
+
+
+def record_mpesa_callback(provider_id, checkout_request_id, at=None):
+    """Record the STK callback arriving for a checkout"""
+    if not checkout_request_id:
+        return 0
+    return Payment.objects.filter(
+        provider_id=provider_id,
+        mpesa_checkout_request_id=checkout_request_id,
+        callback_received_at__isnull=True
+    ).update(callback_received_at=at or timezone.now())
+
+
+def _percentile(counts, total, fraction):
+    """Estimate a percentile as the upper bound of the bucket it falls in"""
+    running = 0
+    for bound, count in zip(BUCKETS + (None,), counts):
+        running += count
+        if running >= total * fraction:
+            return bound
+    return None
+
+
+def latency_histograms(since, until=None, group_by='provider', provider_id=None):
+    """
+    Get latency histograms for payments initiated in [since, until).
+
+    Returns {'buckets': [...], 'intervals': {name: [row, ...]}} where each row
+    has the group's fields, the sample count, per-bucket counts (the last
+    bucket counts everything slower than BUCKETS[-1]), estimated p50/p95
+    bucket bounds and the maximum in seconds.
+    """
+    group_fields = GROUP_FIELDS[group_by]
+    payments = Payment.objects.filter(created_at__gte=since)
+    if until:
+        payments = payments.filter(created_at__lt=until)
+    if provider_id:
+        payments = payments.filter(provider_id=provider_id)
+
+    intervals = {}
+    for name, start_field, end_field in INTERVALS:
+        cumulative = {
+            f"le_{bound}": Count('id', filter=Q(duration__lte=timedelta(seconds=bound)))
+            for bound in BUCKETS
+        }
+        rows = payments.filter(**{f"{start_field}__isnull": False, f"{end_field}__isnull": False}).annotate(
+            duration=ExpressionWrapper(F(end_field) - F(start_field), output_field=DurationField())
+        ).values(*group_fields).annotate(count=Count('id'), max_duration=Max('duration'), **cumulative).order_by()
+
+        results = []
+        for row in rows:
+            previous = 0
+            counts = []
+            for bound in BUCKETS:
+                counts.append(row[f"le_{bound}"] - previous)
+                previous = row[f"le_{bound}"]
+            counts.append(row['count'] - previous)
+
+            max_duration = row['max_duration']
+            results.append({
+                **{field: row[field] for field in group_fields},
+                'count': row['count'],
+                'counts': counts,
+                'p50_seconds': _percentile(counts, row['count'], 0.5),
+                'p95_seconds': _percentile(counts, row['count'], 0.95),
+                'max_seconds': round(max_duration.total_seconds(), 1) if max_duration is not None else None,
+            })
+        intervals[name] = sorted(results, key=lambda result: -result['count'])
+
+    return {
+        'buckets': [f"<={bound}s" for bound in BUCKETS] + [f">{BUCKETS[-1]}s"],
+        'intervals': intervals,
+    }
@@ -0,0 +1,351 @@
+"""
+Append-only double-entry ledger for provider money
+
+Every provider has four accounts:
+
+  - clearing: money collected from customers (M-PESA or cash), debit-normal
+  - provider: what the provider has earned net of platform charges
+  - platform_commission / platform_fees: platform revenue from the provider
+
+Postings (each a balanced set of LedgerEntry lines sharing a reference):
+
+  - sale:       Dr clearing            Cr provider
+  - fee:        Dr provider            Cr platform_fees
+  - commission: Dr provider            Cr platform_commission
+  - payout:     Dr provider            Cr clearing
+
+Accounts carry their running balance, so balances are single row reads and
+statements are index range reads over (account, occurred_at). References are
+unique per account, which makes posting the same sale twice a no-op.
+"""
+from decimal import Decimal
+from heapq import merge
+import logging
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Sum
+from django.db.models.functions import Coalesce, TruncMonth
+from django.utils import timezone
+
+from .models import LedgerAccount, LedgerEntry
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+CENT = Decimal('0.01')
+
+ACCOUNT_KINDS = [kind for kind, _ in LedgerAccount.KIND_CHOICES]
+
+
+def _money(value):
+    return Decimal(str(value or 0)).quantize(CENT)
+
+
+def _apply(kind, balance, debit, credit):
+    """Get an account's balance after a line is applied"""
+    if kind in LedgerAccount.DEBIT_NORMAL_KINDS:
+        return balance + debit - credit
+    return balance + credit - debit
+
+
+def sale_lines(amount):
+    return [('clearing', amount, ZERO), ('provider', ZERO, amount)]
+
+
+def fee_lines(amount):
+    return [('provider', amount, ZERO), ('platform_fees', ZERO, amount)]
+
+
+def commission_lines(amount):
+    return [('provider', amount, ZERO), ('platform_commission', ZERO, amount)]
+
+
+def payout_lines(amount):
+    return [('provider', amount, ZERO), ('clearing', ZERO, amount)]
+
+
+def get_fee(amount):
+    """Get the platform transaction fee for a sale (LEDGER_FEE_PERCENT of the amount)"""
+    percent = Decimal(str(getattr(settings, 'LEDGER_FEE_PERCENT', 0) or 0))
+    return (amount * percent / 100).quantize(CENT)
+
+
+def get_accounts(provider_id, kinds=None, lock=False):
+    """Get the provider's ledger accounts keyed by kind, creating any that are missing"""
+    kinds = kinds or ACCOUNT_KINDS
+    accounts = LedgerAccount.objects.filter(provider_id=provider_id, kind__in=kinds)
+    if lock:
+        accounts = accounts.select_for_update().order_by('id')
+    found = {account.kind: account for account in accounts}
+
+    missing = [kind for kind in kinds if kind not in found]
+    if missing:
+        LedgerAccount.objects.bulk_create(
+            [LedgerAccount(provider_id=provider_id, kind=kind) for kind in missing],
+            ignore_conflicts=True
+        )
+        return get_accounts(provider_id, kinds, lock)
+    return found
+
+
+def post(provider_id, entry_type, reference, lines, occurred_at=None, payment_id=None, description=''):
+    """
+    Post a balanced set of (account kind, debit, credit) lines.
+
+    Returns the created entries, or an empty list if the reference was
+    already posted. Must be balanced and non-zero.
+    """
+    lines = [(kind, _money(debit), _money(credit)) for kind, debit, credit in lines]
+    total_debit = sum(debit for _, debit, _ in lines)
+    if total_debit != sum(credit for _, _, credit in lines):
+        raise ValueError(f"Unbalanced ledger posting {reference}")
+    if not total_debit:
+        return []
+
+    occurred_at = occurred_at or timezone.now()
+    try:
+        with transaction.atomic():
+            if LedgerEntry.objects.filter(reference=reference).exists():
+                return []
+
+            # Lock in id order so concurrent postings for a provider cannot deadlock
+            accounts = get_accounts(provider_id, sorted({kind for kind, _, _ in lines}), lock=True)
+            entries = []
+            for kind, debit, credit in lines:
+                account = accounts[kind]
+                account.balance = _apply(kind, account.balance, debit, credit)
+                account.total_debit += debit
+                account.total_credit += credit
+                account.entry_count += 1
+                entries.append(LedgerEntry(
+                    account=account,
+                    entry_type=entry_type,
+                    reference=reference,
+                    debit=debit,
+                    credit=credit,
+                    balance_after=account.balance,
+                    payment_id=payment_id,
+                    description=description[:255],
+                    occurred_at=occurred_at
+                ))
+
+            LedgerEntry.objects.bulk_create(entries)
+            for account in accounts.values():
+                account.save(update_fields=['balance', 'total_debit', 'total_credit', 'entry_count', 'updated_at'])
+    except IntegrityError:
+        # Lost a race with another worker posting the same reference
+        return []
+    return entries
+
+
+def post_payment(payment):
+    """Post the sale (and platform fee) for a completed M-PESA payment"""
+    if payment.payment_method != 'mpesa' or not payment.provider_id:
+        return []
+
+    amount = _money(payment.amount)
+    occurred_at = payment.completed_at or timezone.now()
+    entries = post(
+        payment.provider_id, 'sale', f"sale:payment:{payment.id}", sale_lines(amount),
+        occurred_at=occurred_at, payment_id=payment.id, description=payment.description or ''
+    )
+    fee = get_fee(amount)
+    if entries and fee:
+        entries += post(
+            payment.provider_id, 'fee', f"fee:payment:{payment.id}", fee_lines(fee),
+            occurred_at=occurred_at, payment_id=payment.id
+        )
+    return entries
+
+
+def post_ticket_sale(sale):
+    """Post a sale that did not go through a Payment, e.g. a cashier's cash sale"""
+    if sale.status != 'completed' or sale.ticket.payment_id:
+        return []
+    return post(
+        sale.provider_id, 'sale', f"sale:ticketsale:{sale.id}", sale_lines(_money(sale.total_amount)),
+        occurred_at=sale.created_at, description=f"{sale.payment_method} sale"
+    )
+
+
+def post_commission(provider_id, amount, reference, occurred_at=None, description=''):
+    """Charge platform commission to a provider"""
+    return post(provider_id, 'commission', reference, commission_lines(amount),
+                occurred_at=occurred_at, description=description)
+
+
+def post_payout(provider_id, amount, reference, occurred_at=None, description=''):
+    """Record money paid out to (or collected by) the provider"""
+    return post(provider_id, 'payout', reference, payout_lines(amount),
+                occurred_at=occurred_at, description=description)
+
+
+def get_balances(provider_id):
+    """Get the provider's account balances keyed by kind"""
+    balances = {kind: ZERO for kind in ACCOUNT_KINDS}
+    balances.update(LedgerAccount.objects.filter(provider_id=provider_id).values_list('kind', 'balance'))
+    return balances
+
+
+def get_sales_total(provider_id, start=None, end=None):
+    """
+    Get the provider's gross sales, all time or for [start, end).
+
+    Only sales debit the clearing account, so the all-time total is its
+    running debit total; a period is one range read of its entries.
+    """
+    if start is None and end is None:
+        account = LedgerAccount.objects.filter(provider_id=provider_id, kind='clearing').only('total_debit').first()
+        return account.total_debit if account else ZERO
+    entries = LedgerEntry.objects.filter(account__provider_id=provider_id, account__kind='clearing', entry_type='sale')
+    if start:
+        entries = entries.filter(occurred_at__gte=start)
+    if end:
+        entries = entries.filter(occurred_at__lt=end)
+    return entries.aggregate(total=Sum('debit'))['total'] or ZERO
+
+
+def get_platform_totals():
+    """Get balances and debit/credit totals per account kind across all providers"""
+    totals = {kind: {'balance': ZERO, 'total_debit': ZERO, 'total_credit': ZERO} for kind in ACCOUNT_KINDS}
+    rows = LedgerAccount.objects.values('kind').annotate(
+        balance=Sum('balance'),
+        total_debit=Sum('total_debit'),
+        total_credit=Sum('total_credit')
+    )
+    for row in rows:
+        totals[row.pop('kind')] = row
+    return totals
+
+
+def get_monthly_sales(since, provider_id=None):
+    """Get gross sales per month since the given time as [(month, amount)], from one range read"""
+    entries = LedgerEntry.objects.filter(entry_type='sale', account__kind='clearing', occurred_at__gte=since)
+    if provider_id:
+        entries = entries.filter(account__provider_id=provider_id)
+    rows = entries.annotate(month=TruncMonth('occurred_at')).values('month').annotate(
+        amount=Sum('debit')
+    ).order_by('month')
+    return [(row['month'], row['amount']) for row in rows]
+
+
+def get_statement(provider_id, kind='provider', start=None, end=None):
+    """
+    Get an account statement for [start, end).
+
+    Returns the opening balance, the entries in the range and the closing
+    balance; only the range and the last entry before it are read.
+    """
+    account = LedgerAccount.objects.filter(provider_id=provider_id, kind=kind).first()
+    if not account:
+        return {'opening_balance': ZERO, 'closing_balance': ZERO, 'entries': []}
+
+    entries = account.entries.order_by('occurred_at', 'id')
+    opening_balance = ZERO
+    if start:
+        previous = entries.filter(occurred_at__lt=start).only('balance_after').last()
+        opening_balance = previous.balance_after if previous else ZERO
+        entries = entries.filter(occurred_at__gte=start)
+    if end:
+        entries = entries.filter(occurred_at__lt=end)
+
+    entries = list(entries)
+    closing_balance = entries[-1].balance_after if entries else opening_balance
+    return {'opening_balance': opening_balance, 'closing_balance': closing_balance, 'entries': entries}
+
+
+def _history(batch_size):
+    """Stream (occurred_at, provider_id, entry_type, reference, lines, payment_id, description) in time order"""
+    from .models import Payment
+    from tickets.models import TicketSale
+
+    def payments():
+        rows = Payment.objects.filter(
+            status='completed', payment_method='mpesa', provider_id__isnull=False
+        ).order_by(Coalesce('completed_at', 'created_at'), 'id').values_list(
+            'id', 'provider_id', 'amount', 'completed_at', 'created_at', 'description'
+        ).iterator(chunk_size=batch_size)
+        for payment_id, provider_id, amount, completed_at, created_at, description in rows:
+            amount = _money(amount)
+            occurred_at = completed_at or created_at
+            yield (occurred_at, provider_id, 'sale', f"sale:payment:{payment_id}", sale_lines(amount),
+                   payment_id, description or '')
+            fee = get_fee(amount)
+            if fee:
+                yield (occurred_at, provider_id, 'fee', f"fee:payment:{payment_id}", fee_lines(fee), payment_id, '')
+
+    def cash_sales():
+        rows = TicketSale.objects.filter(
+            status='completed', ticket__payment__isnull=True
+        ).order_by('created_at').values_list(
+            'id', 'provider_id', 'total_amount', 'created_at', 'payment_method'
+        ).iterator(chunk_size=batch_size)
+        for sale_id, provider_id, amount, created_at, payment_method in rows:
+            yield (created_at, provider_id, 'sale', f"sale:ticketsale:{sale_id}", sale_lines(_money(amount)),
+                   None, f"{payment_method} sale")
+
+    return payments(), cash_sales()
+
+
+def rebuild(batch_size=2000):
+    """
+    Recreate the ledger from payment and sale history.
+
+    Commission and payout postings have no other source, so they are carried
+    over from the current ledger. Everything is replayed in time order and
+    running balances are computed in memory; returns the number of entries.
+    """
+    carried = {}
+    kept = LedgerEntry.objects.filter(entry_type__in=['commission', 'payout']).select_related('account')
+    for entry in kept.order_by('id').iterator(chunk_size=batch_size):
+        posting = carried.setdefault(entry.reference, [
+            entry.occurred_at, entry.account.provider_id, entry.entry_type, entry.reference, [],
+            entry.payment_id, entry.description
+        ])
+        posting[4].append((entry.account.kind, entry.debit, entry.credit))
+    carried = sorted((tuple(posting) for posting in carried.values()), key=lambda posting: posting[0])
+
+    with transaction.atomic():
+        LedgerEntry.objects.all().delete()
+        LedgerAccount.objects.all().delete()
+
+        accounts = {}
+        pending = []
+        count = 0
+        for occurred_at, provider_id, entry_type, reference, lines, payment_id, description in merge(
+            *_history(batch_size), carried, key=lambda posting: posting[0]
+        ):
+            for kind, debit, credit in lines:
+                account = accounts.get((provider_id, kind))
+                if account is None:
+                    account = LedgerAccount.objects.create(provider_id=provider_id, kind=kind)
+                    accounts[(provider_id, kind)] = account
+                account.balance = _apply(kind, account.balance, debit, credit)
+                account.total_debit += debit
+                account.total_credit += credit
+                account.entry_count += 1
+                pending.append(LedgerEntry(
+                    account=account,
+                    entry_type=entry_type,
+                    reference=reference,
+                    debit=debit,
+                    credit=credit,
+                    balance_after=account.balance,
+                    payment_id=payment_id,
+                    description=description[:255],
+                    occurred_at=occurred_at
+                ))
+            if len(pending) >= batch_size:
+                LedgerEntry.objects.bulk_create(pending)
+                count += len(pending)
+                pending = []
+
+        LedgerEntry.objects.bulk_create(pending)
+        count += len(pending)
+        LedgerAccount.objects.bulk_update(
+            list(accounts.values()), ['balance', 'total_debit', 'total_credit', 'entry_count'], batch_size=batch_size
+        )
+
+    logger.info(f"Ledger rebuilt: {count} entries across {len(accounts)} accounts")
+    return count
@@ -0,0 +1,72 @@
+"""
+Management command to reconcile an M-PESA statement CSV against our payments
+"""
+import csv
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from accounts.models import Provider
+from payments.statements import StatementReconciler, MATCHED, MISSING, ORPHANED
+
+
+class Command(BaseCommand):
+    help = 'Match an M-PESA statement CSV against a provider\'s payments and report matched, missing and orphaned sets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', help='Path to the statement CSV')
+        parser.add_argument('--provider', type=int, required=True, help='Provider ID the statement belongs to')
+        parser.add_argument('--output-dir', help='Write matched.csv, missing.csv and orphaned.csv here')
+        parser.add_argument('--window-minutes', type=int, help='Time window for matching rows without a known receipt')
+        parser.add_argument('--apply', action='store_true', help='Apply corrections (default is a dry run)')
+        parser.add_argument('--queue-missing', action='store_true', help='Queue missing rows for review as C2B transactions')
+
+    def handle(self, *args, **options):
+        try:
+            provider = Provider.objects.get(id=options['provider'])
+        except Provider.DoesNotExist:
+            raise CommandError(f"Provider {options['provider']} not found")
+
+        writers = {}
+        files = []
+        if options['output_dir']:
+            os.makedirs(options['output_dir'], exist_ok=True)
+
+        def write_row(set_name, record):
+            if not options['output_dir']:
+                return
+            if set_name not in writers:
+                handle = open(os.path.join(options['output_dir'], f'{set_name}.csv'), 'w', newline='')
+                files.append(handle)
+                writers[set_name] = csv.DictWriter(handle, fieldnames=list(record))
+                writers[set_name].writeheader()
+            writers[set_name].writerow(record)
+
+        reconciler = StatementReconciler(provider, window_minutes=options['window_minutes'])
+        try:
+            with open(options['statement'], 'rb') as statement:
+                summary = reconciler.reconcile_file(
+                    statement,
+                    on_row=write_row,
+                    keep_missing=options['queue_missing']
+                )
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        finally:
+            for handle in files:
+                handle.close()
+
+        self.stdout.write(
+            f"{summary['rows']} statement rows: {summary[MATCHED]} matched, {summary[MISSING]} missing, "
+            f"{summary[ORPHANED]} orphaned payments, {summary['amount_mismatches']} amount mismatches, "
+            f"{summary['corrections']} corrections"
+        )
+
+        if options['apply'] or options['queue_missing']:
+            if not options['apply']:
+                reconciler.corrections = {}
+            result = reconciler.apply_corrections(queue_missing=options['queue_missing'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Corrected {result['corrected']} payments, queued {result['queued_for_review']} rows for review"
+            ))
+        else:
+            self.stdout.write('Dry run: no corrections applied (use --apply)')
@@ -0,0 +1,40 @@
+"""
+Management command to drain the webhook inbox
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from payments.webhooks import WebhookProcessor
+
+
+class Command(BaseCommand):
+    help = 'Process stored M-PESA and Pesapal callbacks from the webhook inbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Events claimed per batch')
+        parser.add_argument('--max-attempts', type=int, help='Attempts before an event is dead-lettered')
+        parser.add_argument('--loop', action='store_true', help='Keep polling the inbox instead of exiting')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the inbox is empty')
+
+    def handle(self, *args, **options):
+        processor = WebhookProcessor(
+            batch_size=options['batch_size'],
+            max_attempts=options['max_attempts'],
+        )
+
+        if not options['loop']:
+            summary = processor.run()
+            self.stdout.write(
+                f"Processed {summary['processed']} events, {summary['retried']} scheduled for retry, "
+                f"{summary['dead']} dead-lettered"
+            )
+            return
+
+        self.stdout.write('Processing webhook inbox (Ctrl+C to stop)')
+        while True:
+            summary = processor.run()
+            if not any(summary.values()):
+                # Don't hold an idle connection between polls
+                connection.close()
+                time.sleep(options['interval'])
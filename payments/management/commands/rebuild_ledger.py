@@ -0,0 +1,21 @@
+"""
+Management command to recreate the payment ledger from history
+"""
+from django.core.management.base import BaseCommand
+from payments.ledger import rebuild
+from payments.models import LedgerEntry
+
+
+class Command(BaseCommand):
+    help = 'Rebuild ledger accounts and entries from completed payments and cash sales'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000, help='Rows read and written per batch')
+        parser.add_argument('--if-empty', action='store_true', help='Only build the ledger if it has no entries yet')
+
+    def handle(self, *args, **options):
+        if options['if_empty'] and LedgerEntry.objects.exists():
+            self.stdout.write('Ledger already has entries, not rebuilt')
+            return
+        count = rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Ledger rebuilt with {count} entries'))
@@ -0,0 +1,35 @@
+"""
+Management command to reconcile payments stuck in pending
+"""
+from django.core.management.base import BaseCommand
+from payments.reconciliation import PaymentReconciler
+
+
+class Command(BaseCommand):
+    help = 'Re-check stale pending M-PESA and Pesapal payments with their gateways'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age-minutes', type=int, help='Only check payments older than this')
+        parser.add_argument('--max-age-hours', type=int, help='Ignore payments older than this')
+        parser.add_argument('--workers', type=int, help='Size of the query thread pool')
+        parser.add_argument('--per-provider', type=int, help='Concurrent Daraja queries per provider')
+        parser.add_argument('--batch-size', type=int, help='Results applied per transaction')
+        parser.add_argument('--limit', type=int, help='Maximum payments to check in this run')
+
+    def handle(self, *args, **options):
+        reconciler = PaymentReconciler(
+            min_age_minutes=options['min_age_minutes'],
+            max_age_hours=options['max_age_hours'],
+            max_workers=options['workers'],
+            per_provider_limit=options['per_provider'],
+            batch_size=options['batch_size'],
+            limit=options['limit'],
+        )
+        summary = reconciler.run()
+
+        self.stdout.write(
+            f"Checked {summary['checked']} payments: {summary['completed']} completed, "
+            f"{summary['failed']} failed, {summary['cancelled']} cancelled, "
+            f"{summary['pending']} still pending ({summary['errors']} upstream errors)"
+        )
+        self.stdout.write(self.style.SUCCESS('Reconciliation completed successfully'))
@@ -0,0 +1,63 @@
+"""
+Management command to settle platform commissions for a period
+"""
+import csv
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from payments.models import CommissionSettlement
+from payments.settlement import CommissionSettlementEngine, month_period, previous_month_period
+
+
+class Command(BaseCommand):
+    help = 'Compute, persist and post provider commission settlements for a month or date range'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='Month to settle as YYYY-MM (defaults to last month)')
+        parser.add_argument('--start', help='Period start date (YYYY-MM-DD), used with --end')
+        parser.add_argument('--end', help='Period end date, exclusive (YYYY-MM-DD)')
+        parser.add_argument('--no-post', action='store_true', help='Persist settlements without posting them to the ledger')
+        parser.add_argument('--recompute', action='store_true', help='Replace settlements not yet posted')
+        parser.add_argument('--output', help='Write per-provider settlement statements to this CSV file')
+
+    def handle(self, *args, **options):
+        try:
+            if options['start'] or options['end']:
+                start, end = date.fromisoformat(options['start']), date.fromisoformat(options['end'])
+            elif options['month']:
+                year, month = options['month'].split('-')
+                start, end = month_period(int(year), int(month))
+            else:
+                start, end = previous_month_period()
+        except (TypeError, ValueError):
+            raise CommandError('Give --month YYYY-MM or both --start and --end as YYYY-MM-DD')
+        if start >= end:
+            raise CommandError('Period start must be before its end')
+
+        engine = CommissionSettlementEngine(start, end)
+        summary = engine.settle(post=not options['no_post'], recompute=options['recompute'])
+
+        if options['output']:
+            self.write_statements(options['output'], start, end)
+
+        self.stdout.write(
+            f"Settled {start} - {end}: {summary['providers']} providers ({summary['created']} new, "
+            f"{summary['posted']} posted), gross sales {summary['gross_sales']}, commission {summary['commission']}"
+        )
+        self.stdout.write(self.style.SUCCESS('Commission settlement completed successfully'))
+
+    def write_statements(self, path, start, end):
+        settlements = CommissionSettlement.objects.filter(period_start=start, period_end=end).select_related('provider')
+        with open(path, 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(['provider_id', 'provider', 'period_start', 'period_end', 'sales', 'gross_sales',
+                             'rate', 'min_commission', 'max_commission', 'calculated_commission', 'commission',
+                             'net_amount', 'status'])
+            for settlement in settlements.iterator():
+                writer.writerow([
+                    settlement.provider_id, settlement.provider.business_name, settlement.period_start,
+                    settlement.period_end, settlement.sale_count, settlement.gross_sales,
+                    settlement.commission_rate, settlement.min_commission, settlement.max_commission or '',
+                    settlement.calculated_commission, settlement.commission, settlement.net_amount,
+                    settlement.status
+                ])
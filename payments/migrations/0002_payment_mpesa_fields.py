@@ -0,0 +1,72 @@
+# Generated by Django 4.2.7 on 2026-10-19 09:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('accounts', '0009_postgresql_add_user_fields'),
+        ('tickets', '0004_safe_fix_ticket_models'),
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='payments', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='payment_method',
+            field=models.CharField(choices=[('pesapal', 'Pesapal'), ('mpesa', 'M-PESA'), ('manual', 'Manual')], default='pesapal', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='provider',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='payments', to='accounts.provider'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='ticket_type',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payments', to='tickets.tickettype'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='phone_number',
+            field=models.CharField(blank=True, max_length=15, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='mpesa_checkout_request_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='mpesa_merchant_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='mpesa_receipt_number',
+            field=models.CharField(blank=True, db_index=True, max_length=30, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='last_checked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='check_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'payment_method', 'created_at'], name='payments_status_method_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_payment_mpesa_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PesapalIPNRegistration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('environment', models.CharField(choices=[('sandbox', 'Sandbox'), ('live', 'Live')], max_length=10)),
+                ('ipn_url', models.URLField(max_length=500)),
+                ('ipn_id', models.CharField(max_length=100)),
+                ('notification_type', models.CharField(default='GET', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Pesapal IPN Registration',
+                'verbose_name_plural': 'Pesapal IPN Registrations',
+                'unique_together': {('environment', 'ipn_url')},
+            },
+        ),
+    ]
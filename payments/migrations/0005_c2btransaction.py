@@ -0,0 +1,48 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('accounts', '0009_postgresql_add_user_fields'),
+        ('tickets', '0004_safe_fix_ticket_models'),
+        ('payments', '0004_webhookevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='C2BTransaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trans_id', models.CharField(max_length=30, unique=True)),
+                ('transaction_type', models.CharField(blank=True, max_length=30)),
+                ('business_shortcode', models.CharField(db_index=True, max_length=20)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('bill_ref_number', models.CharField(blank=True, max_length=100)),
+                ('msisdn', models.CharField(blank=True, max_length=100)),
+                ('first_name', models.CharField(blank=True, max_length=100)),
+                ('trans_time', models.CharField(blank=True, max_length=20)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('matched', 'Matched'), ('unmatched', 'Unmatched (needs review)'), ('resolved', 'Resolved'), ('ignored', 'Ignored')], default='unmatched', max_length=20)),
+                ('match_reason', models.CharField(blank=True, max_length=50)),
+                ('reviewed_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='c2b_transactions', to='payments.payment')),
+                ('provider', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='c2b_transactions', to='accounts.provider')),
+                ('reviewed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reviewed_c2b_transactions', to=settings.AUTH_USER_MODEL)),
+                ('ticket_type', models.ForeignKey(blank=True, help_text='Set when resolving an unmatched payment', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='c2b_transactions', to='tickets.tickettype')),
+            ],
+            options={
+                'verbose_name': 'C2B Transaction',
+                'verbose_name_plural': 'C2B Transactions',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='payments_c2b_status_idx')],
+            },
+        ),
+    ]
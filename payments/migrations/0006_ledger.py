@@ -0,0 +1,72 @@
+# Generated by Django 4.2.7 on 2026-10-19 12:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_postgresql_add_user_fields'),
+        ('payments', '0005_c2btransaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerAccount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('clearing', 'Clearing (money collected)'), ('provider', 'Provider balance'), ('platform_commission', 'Platform commission'), ('platform_fees', 'Platform fees')], max_length=30)),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_debit', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_credit', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('entry_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='ledger_accounts', to='accounts.provider')),
+            ],
+            options={
+                'verbose_name': 'Ledger Account',
+                'verbose_name_plural': 'Ledger Accounts',
+                'ordering': ['provider_id', 'kind'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='ledgeraccount',
+            constraint=models.UniqueConstraint(fields=('provider', 'kind'), name='payments_ledger_account_unique'),
+        ),
+        migrations.CreateModel(
+            name='LedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_type', models.CharField(choices=[('sale', 'Sale'), ('commission', 'Commission'), ('fee', 'Fee'), ('payout', 'Payout')], max_length=20)),
+                ('reference', models.CharField(help_text='Shared by all lines of one posting, e.g. sale:payment:<id>', max_length=100)),
+                ('debit', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('credit', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('balance_after', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('occurred_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='entries', to='payments.ledgeraccount')),
+                ('payment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='ledger_entries', to='payments.payment')),
+            ],
+            options={
+                'verbose_name': 'Ledger Entry',
+                'verbose_name_plural': 'Ledger Entries',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='ledgerentry',
+            constraint=models.UniqueConstraint(fields=('reference', 'account'), name='payments_ledger_entry_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['account', 'occurred_at', 'id'], name='payments_ledger_stmt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ledgerentry',
+            index=models.Index(fields=['entry_type', 'occurred_at'], name='payments_ledger_type_idx'),
+        ),
+    ]
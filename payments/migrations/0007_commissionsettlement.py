@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_postgresql_add_user_fields'),
+        ('payments', '0006_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommissionSettlement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_start', models.DateField()),
+                ('period_end', models.DateField(help_text='Exclusive')),
+                ('sale_count', models.PositiveIntegerField(default=0)),
+                ('gross_sales', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('commission_rate', models.DecimalField(decimal_places=2, default=0, max_digits=5)),
+                ('min_commission', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('max_commission', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('calculated_commission', models.DecimalField(decimal_places=2, default=0, help_text='Rate applied to gross sales, before clamping', max_digits=14)),
+                ('commission', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('net_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('status', models.CharField(choices=[('draft', 'Draft'), ('posted', 'Posted to ledger')], default='draft', max_length=20)),
+                ('ledger_reference', models.CharField(blank=True, max_length=100)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('posted_at', models.DateTimeField(blank=True, null=True)),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='commission_settlements', to='accounts.provider')),
+            ],
+            options={
+                'verbose_name': 'Commission Settlement',
+                'verbose_name_plural': 'Commission Settlements',
+                'ordering': ['-period_start', 'provider_id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='commissionsettlement',
+            constraint=models.UniqueConstraint(fields=('provider', 'period_start', 'period_end'), name='payments_settlement_period_unique'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0007_commissionsettlement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='initiated_at',
+            field=models.DateTimeField(blank=True, help_text='When the customer tapped Pay', null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='stk_accepted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='callback_received_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='ticket_issued_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='first_login_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -17,11 +17,15 @@ class Payment(models.Model):
     
     PAYMENT_METHOD_CHOICES = [
         ('pesapal', 'Pesapal'),
+        ('mpesa', 'M-PESA'),
         ('manual', 'Manual'),
     ]
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments', blank=True, null=True)
+    provider = models.ForeignKey('accounts.Provider', on_delete=models.CASCADE, related_name='payments', blank=True, null=True)
+    ticket_type = models.ForeignKey('tickets.TicketType', on_delete=models.SET_NULL, related_name='payments', blank=True, null=True)
+    phone_number = models.CharField(max_length=15, blank=True, null=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     currency = models.CharField(max_length=3, default='KES')
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
@@ -32,6 +36,22 @@ class Payment(models.Model):
     pesapal_merchant_reference = models.CharField(max_length=100, blank=True, null=True)
     pesapal_payment_reference = models.CharField(max_length=100, blank=True, null=True)
     
+    # M-PESA specific fields
+    mpesa_checkout_request_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+    mpesa_merchant_request_id = models.CharField(max_length=100, blank=True, null=True)
+    mpesa_receipt_number = models.CharField(max_length=30, blank=True, null=True, db_index=True)
+    
+    # Payment-to-ticket stage timestamps (see payments.latency)
+    initiated_at = models.DateTimeField(blank=True, null=True, help_text="When the customer tapped Pay")
+    stk_accepted_at = models.DateTimeField(blank=True, null=True)
+    callback_received_at = models.DateTimeField(blank=True, null=True)
+    ticket_issued_at = models.DateTimeField(blank=True, null=True)
+    first_login_at = models.DateTimeField(blank=True, null=True)
+    
+    # Reconciliation tracking
+    last_checked_at = models.DateTimeField(blank=True, null=True)
+    check_attempts = models.IntegerField(default=0)
+    
     # Payment details
     description = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
@@ -39,10 +59,14 @@ class Payment(models.Model):
     completed_at = models.DateTimeField(blank=True, null=True)
     
     def __str__(self):
-        return f"{self.user.email} - {self.amount} {self.currency}"
+        payer = self.user.email if self.user else self.phone_number
+        return f"{payer} - {self.amount} {self.currency}"
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'payment_method', 'created_at'], name='payments_status_method_idx'),
+        ]
 
 
 class PaymentItem(models.Model):
@@ -60,3 +84,260 @@ class PaymentItem(models.Model):
     
     def __str__(self):
         return f"{self.name} - {self.total_price}"
+
+
+class PesapalIPNRegistration(models.Model):
+    """Registered Pesapal IPN URLs, reused until the IPN URL changes"""
+    ENVIRONMENT_CHOICES = [
+        ('sandbox', 'Sandbox'),
+        ('live', 'Live'),
+    ]
+    
+    environment = models.CharField(max_length=10, choices=ENVIRONMENT_CHOICES)
+    ipn_url = models.URLField(max_length=500)
+    ipn_id = models.CharField(max_length=100)
+    notification_type = models.CharField(max_length=10, default='GET')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ['environment', 'ipn_url']
+        verbose_name = 'Pesapal IPN Registration'
+        verbose_name_plural = 'Pesapal IPN Registrations'
+    
+    def __str__(self):
+        return f"{self.environment} - {self.ipn_url} ({self.ipn_id})"
+
+
+class WebhookEvent(models.Model):
+    """
+    Append-only inbox of raw gateway callbacks.
+    
+    Callbacks are stored and acknowledged immediately; the payload is never
+    modified afterwards and workers only advance the processing state.
+    """
+    SOURCE_CHOICES = [
+        ('mpesa_stk', 'M-PESA STK Callback'),
+        ('pesapal', 'Pesapal Notification'),
+    ]
+    
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('processed', 'Processed'),
+        ('failed', 'Failed (will retry)'),
+        ('dead', 'Dead Letter'),
+    ]
+    
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+    dedup_key = models.CharField(max_length=255, unique=True)
+    provider = models.ForeignKey(
+        'accounts.Provider',
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name='webhook_events',
+        null=True,
+        blank=True
+    )
+    payload = models.JSONField(default=dict)
+    
+    # Processing state
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    result = models.JSONField(blank=True, null=True)
+    
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='payments_webhook_due_idx'),
+        ]
+        verbose_name = 'Webhook Event'
+        verbose_name_plural = 'Webhook Events'
+    
+    def __str__(self):
+        return f"{self.source} {self.dedup_key} ({self.status})"
+
+
+class C2BTransaction(models.Model):
+    """
+    M-PESA Paybill (C2B) confirmations.
+    
+    Every confirmed Paybill payment is recorded here. Payments that could not
+    be matched to a pending order or ticket type wait in the review queue
+    (status 'unmatched') until staff resolve or ignore them.
+    """
+    STATUS_CHOICES = [
+        ('matched', 'Matched'),
+        ('unmatched', 'Unmatched (needs review)'),
+        ('resolved', 'Resolved'),
+        ('ignored', 'Ignored'),
+    ]
+    
+    trans_id = models.CharField(max_length=30, unique=True)
+    transaction_type = models.CharField(max_length=30, blank=True)
+    business_shortcode = models.CharField(max_length=20, db_index=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    bill_ref_number = models.CharField(max_length=100, blank=True)
+    msisdn = models.CharField(max_length=100, blank=True)
+    first_name = models.CharField(max_length=100, blank=True)
+    trans_time = models.CharField(max_length=20, blank=True)
+    payload = models.JSONField(default=dict)
+    
+    # Matching
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='unmatched')
+    match_reason = models.CharField(max_length=50, blank=True)
+    provider = models.ForeignKey('accounts.Provider', on_delete=models.SET_NULL, related_name='c2b_transactions', null=True, blank=True)
+    ticket_type = models.ForeignKey('tickets.TicketType', on_delete=models.SET_NULL, related_name='c2b_transactions', null=True, blank=True,
+                                    help_text="Set when resolving an unmatched payment")
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, related_name='c2b_transactions', null=True, blank=True)
+    
+    reviewed_by = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='reviewed_c2b_transactions', null=True, blank=True)
+    reviewed_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='payments_c2b_status_idx'),
+        ]
+        verbose_name = 'C2B Transaction'
+        verbose_name_plural = 'C2B Transactions'
+    
+    def __str__(self):
+        return f"{self.trans_id} - {self.amount} ({self.status})"
+
+
+class LedgerAccount(models.Model):
+    """
+    A provider's ledger account with its running balance.
+    
+    The balance and debit/credit totals are updated in the same transaction
+    as every entry posted to the account, so balance queries are a single
+    row read instead of an aggregate over the provider's history.
+    """
+    KIND_CHOICES = [
+        ('clearing', 'Clearing (money collected)'),
+        ('provider', 'Provider balance'),
+        ('platform_commission', 'Platform commission'),
+        ('platform_fees', 'Platform fees'),
+    ]
+    # Accounts whose balance grows with debits; all others grow with credits
+    DEBIT_NORMAL_KINDS = ('clearing',)
+    
+    provider = models.ForeignKey('accounts.Provider', on_delete=models.PROTECT, related_name='ledger_accounts')
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_debit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_credit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    entry_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['provider_id', 'kind']
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'kind'], name='payments_ledger_account_unique'),
+        ]
+        verbose_name = 'Ledger Account'
+        verbose_name_plural = 'Ledger Accounts'
+    
+    def __str__(self):
+        return f"{self.provider_id} {self.kind}: {self.balance}"
+
+
+class LedgerEntry(models.Model):
+    """
+    One line of a double-entry posting.
+    
+    Entries are append-only: every posting writes balanced debit and credit
+    lines sharing a reference, and corrections are new postings. balance_after
+    is the account's running balance once the line was applied.
+    """
+    ENTRY_TYPE_CHOICES = [
+        ('sale', 'Sale'),
+        ('commission', 'Commission'),
+        ('fee', 'Fee'),
+        ('payout', 'Payout'),
+    ]
+    
+    account = models.ForeignKey(LedgerAccount, on_delete=models.PROTECT, related_name='entries')
+    entry_type = models.CharField(max_length=20, choices=ENTRY_TYPE_CHOICES)
+    reference = models.CharField(max_length=100, help_text="Shared by all lines of one posting, e.g. sale:payment:<id>")
+    debit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    credit = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    balance_after = models.DecimalField(max_digits=14, decimal_places=2)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, related_name='ledger_entries', null=True, blank=True)
+    description = models.CharField(max_length=255, blank=True)
+    occurred_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['id']
+        constraints = [
+            models.UniqueConstraint(fields=['reference', 'account'], name='payments_ledger_entry_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['account', 'occurred_at', 'id'], name='payments_ledger_stmt_idx'),
+            models.Index(fields=['entry_type', 'occurred_at'], name='payments_ledger_type_idx'),
+        ]
+        verbose_name = 'Ledger Entry'
+        verbose_name_plural = 'Ledger Entries'
+    
+    def __str__(self):
+        return f"{self.reference} {self.account_id} Dr {self.debit} Cr {self.credit}"
+    
+    def save(self, *args, **kwargs):
+        if self.pk:
+            raise ValueError("Ledger entries are append-only; post a correcting entry instead")
+        super().save(*args, **kwargs)
+
+
+class CommissionSettlement(models.Model):
+    """
+    A provider's platform commission for one settlement period.
+    
+    Settlements are computed for all providers at once and are unique per
+    (provider, period); once posted to the ledger they are never recomputed.
+    """
+    STATUS_CHOICES = [
+        ('draft', 'Draft'),
+        ('posted', 'Posted to ledger'),
+    ]
+    
+    provider = models.ForeignKey('accounts.Provider', on_delete=models.PROTECT, related_name='commission_settlements')
+    period_start = models.DateField()
+    period_end = models.DateField(help_text="Exclusive")
+    
+    sale_count = models.PositiveIntegerField(default=0)
+    gross_sales = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    commission_rate = models.DecimalField(max_digits=5, decimal_places=2, default=0)
+    min_commission = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    max_commission = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    calculated_commission = models.DecimalField(max_digits=14, decimal_places=2, default=0,
+                                                help_text="Rate applied to gross sales, before clamping")
+    commission = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    net_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='draft')
+    ledger_reference = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    posted_at = models.DateTimeField(blank=True, null=True)
+    
+    class Meta:
+        ordering = ['-period_start', 'provider_id']
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'period_start', 'period_end'],
+                                    name='payments_settlement_period_unique'),
+        ]
+        verbose_name = 'Commission Settlement'
+        verbose_name_plural = 'Commission Settlements'
+    
+    def __str__(self):
+        return f"{self.provider_id} {self.period_start} - {self.period_end}: {self.commission}"
@@ -1,7 +1,6 @@
 """
 M-PESA Daraja API integration for customer payments
 """
-import requests
 import json
 import base64
 import hashlib
@@ -10,6 +9,7 @@ from datetime import datetime
 from django.conf import settings
 from django.utils import timezone
 import logging
+from .tracing import gateway_request
 
 logger = logging.getLogger(__name__)
 
@@ -41,7 +41,7 @@ class MpesaDarajaAPI:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.get(url, headers=headers)
+            response = gateway_request('get', url, 'daraja', 'oauth', headers=headers)
             response.raise_for_status()
             
             data = response.json()
@@ -95,7 +95,7 @@ class MpesaDarajaAPI:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            response = gateway_request('post', url, 'daraja', 'stk_push', json=payload, headers=headers)
             response.raise_for_status()
             
             data = response.json()
@@ -134,7 +134,7 @@ class MpesaDarajaAPI:
                 'Content-Type': 'application/json'
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            response = gateway_request('post', url, 'daraja', 'stk_query', json=payload, headers=headers)
             response.raise_for_status()
             
             data = response.json()
@@ -144,6 +144,37 @@ class MpesaDarajaAPI:
             logger.error(f"Failed to query STK Push status: {e}")
             return None, str(e)
 
+    def register_c2b_urls(self, shortcode, confirmation_url, validation_url, response_type='Completed'):
+        """Register Paybill (C2B) confirmation and validation URLs for a shortcode"""
+        try:
+            access_token = self.get_access_token()
+            if not access_token:
+                return None, "Failed to get access token"
+            
+            url = f"{self.base_url}/mpesa/c2b/v1/registerurl"
+            
+            payload = {
+                "ShortCode": shortcode,
+                "ResponseType": response_type,
+                "ConfirmationURL": confirmation_url,
+                "ValidationURL": validation_url
+            }
+            
+            headers = {
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json'
+            }
+            
+            response = gateway_request('post', url, 'daraja', 'register_c2b_urls', json=payload, headers=headers)
+            response.raise_for_status()
+            
+            data = response.json()
+            return data, None
+            
+        except Exception as e:
+            logger.error(f"Failed to register C2B URLs: {e}")
+            return None, str(e)
+
 class CustomerPaymentService:
     """Service for handling customer WiFi payments"""
     
@@ -1,46 +1,174 @@
-import requests
 import json
 import base64
+import time
 from datetime import datetime
+import httpx
+import requests
 from django.conf import settings
 from django.utils import timezone
 from accounts.models import Provider
 from accounts.encryption import decrypt_mpesa_credential
+from .gateway_health import gateway_health
+from .coalescing import RequestCoalescer
+from .tracing import gateway_request, async_gateway_request
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Shares STK status queries between concurrent callers; terminal results never
+# change, so they are kept for a day rather than a few seconds
+stk_status_coalescer = RequestCoalescer(
+    'stk_status',
+    ttl=getattr(settings, 'STK_STATUS_CACHE_SECONDS', 5),
+    terminal_ttl=getattr(settings, 'STK_STATUS_TERMINAL_CACHE_SECONDS', 86400),
+    wait_seconds=getattr(settings, 'STK_STATUS_COALESCE_WAIT_SECONDS', 35)
+)
+
+
+def is_terminal_stk_status(result):
+    from .reconciliation import interpret_mpesa_result, PENDING
+    return interpret_mpesa_result(result) != PENDING
+
+
+def daraja_error_code(response):
+    """Get the errorCode of a Daraja error response, or None"""
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    return body.get('errorCode') if isinstance(body, dict) else None
+
+
+def is_still_processing(response):
+    """
+    Check whether a Daraja STK query error response only says the payment is still being processed.
+
+    Daraja answers "500.001.1001 The transaction is being processed" with an
+    HTTP 500, commonly on the first poll right after a push; its body is a
+    pending result rather than an error.
+    """
+    from .reconciliation import MPESA_PENDING_ERROR_CODES
+
+    return response.status_code >= 400 and daraja_error_code(response) in MPESA_PENDING_ERROR_CODES
+
+
+def is_gateway_failure(error):
+    """
+    Check whether an exception from an STK push or query counts against the provider's circuit.
+
+    Everything does (missing or rejected credentials, token failures,
+    transport errors, timeouts, 5xx) except a Daraja business error: an STK
+    push or query answered with a 4xx errorCode (e.g. an invalid phone
+    number) or "500.001.1001 The transaction is being processed", which are
+    about this request rather than the provider or Daraja.
+    """
+    from .reconciliation import MPESA_PENDING_ERROR_CODES
+
+    response = getattr(error, 'response', None)
+    if not isinstance(error, (requests.HTTPError, httpx.HTTPStatusError)) or response is None:
+        return True
+    if '/mpesa/stkpush' not in str(response.request.url):
+        return True
+    error_code = daraja_error_code(response)
+    if not error_code:
+        return True
+    return response.status_code >= 500 and error_code not in MPESA_PENDING_ERROR_CODES
+
+
 class PaymentBucketService:
     """Payment Bucket service for handling M-PESA transactions across multiple providers"""
     
     def __init__(self):
         self.daraja_base_url = "https://sandbox.safaricom.co.ke" if settings.DEBUG else "https://api.safaricom.co.ke"
     
+    def _oauth_request(self, provider):
+        """Get the Daraja token URL and headers for a provider's credentials"""
+        consumer_key = decrypt_mpesa_credential(provider.mpesa_consumer_key)
+        consumer_secret = decrypt_mpesa_credential(provider.mpesa_consumer_secret)
+        
+        if not consumer_key or not consumer_secret:
+            raise ValueError("Provider M-PESA credentials not found or invalid")
+        
+        # Generate access token
+        auth_url = f"{self.daraja_base_url}/oauth/v1/generate?grant_type=client_credentials"
+        
+        # Create basic auth header
+        credentials = f"{consumer_key}:{consumer_secret}"
+        encoded_credentials = base64.b64encode(credentials.encode()).decode()
+        
+        headers = {
+            'Authorization': f'Basic {encoded_credentials}',
+            'Content-Type': 'application/json'
+        }
+        return auth_url, headers
+    
+    def _stk_password(self, provider):
+        """Get the (password, timestamp) pair Daraja expects on STK requests"""
+        shortcode = provider.mpesa_shortcode
+        passkey = decrypt_mpesa_credential(provider.mpesa_passkey)
+        
+        if not shortcode or not passkey:
+            raise ValueError("Provider M-PESA shortcode or passkey not found")
+        
+        # Generate timestamp and password
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(f"{shortcode}{passkey}{timestamp}".encode()).decode()
+        return password, timestamp
+    
+    def _stk_push_request(self, provider, access_token, phone_number, amount, account_reference, transaction_desc):
+        """Build the STK Push URL, headers and payload"""
+        password, timestamp = self._stk_password(provider)
+        shortcode = provider.mpesa_shortcode
+        
+        # STK Push URL
+        stk_url = f"{self.daraja_base_url}/mpesa/stkpush/v1/processrequest"
+        
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        
+        payload = {
+            "BusinessShortCode": shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": int(amount),
+            "PartyA": phone_number,
+            "PartyB": shortcode,
+            "PhoneNumber": phone_number,
+            "CallBackURL": provider.callback_url,
+            "AccountReference": account_reference,
+            "TransactionDesc": transaction_desc
+        }
+        return stk_url, headers, payload
+    
+    def _stk_query_request(self, provider, access_token, checkout_request_id):
+        """Build the STK Push query URL, headers and payload"""
+        password, timestamp = self._stk_password(provider)
+        
+        query_url = f"{self.daraja_base_url}/mpesa/stkpushquery/v1/query"
+        
+        headers = {
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        }
+        
+        payload = {
+            "BusinessShortCode": provider.mpesa_shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id
+        }
+        return query_url, headers, payload
+    
     def get_provider_access_token(self, provider_id):
         """Get access token for a specific provider using their credentials"""
         try:
             provider = Provider.objects.get(id=provider_id)
+            auth_url, headers = self._oauth_request(provider)
             
-            # Decrypt provider credentials
-            consumer_key = decrypt_mpesa_credential(provider.mpesa_consumer_key)
-            consumer_secret = decrypt_mpesa_credential(provider.mpesa_consumer_secret)
-            
-            if not consumer_key or not consumer_secret:
-                raise ValueError("Provider M-PESA credentials not found or invalid")
-            
-            # Generate access token
-            auth_url = f"{self.daraja_base_url}/oauth/v1/generate?grant_type=client_credentials"
-            
-            # Create basic auth header
-            credentials = f"{consumer_key}:{consumer_secret}"
-            encoded_credentials = base64.b64encode(credentials.encode()).decode()
-            
-            headers = {
-                'Authorization': f'Basic {encoded_credentials}',
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.get(auth_url, headers=headers, timeout=30)
+            response = gateway_request('get', auth_url, 'daraja', 'oauth', provider_id=provider_id, headers=headers, timeout=30)
             response.raise_for_status()
             
             token_data = response.json()
@@ -52,97 +180,125 @@ class PaymentBucketService:
     
     def initiate_stk_push(self, provider_id, phone_number, amount, account_reference, transaction_desc):
         """Initiate STK Push for a specific provider"""
+        # Fail fast while this provider's credentials or Daraja are failing
+        gateway_health.before_call(provider_id, 'stk_push')
+        started = time.monotonic()
         try:
             provider = Provider.objects.get(id=provider_id)
             access_token = self.get_provider_access_token(provider_id)
+            stk_url, headers, payload = self._stk_push_request(
+                provider, access_token, phone_number, amount, account_reference, transaction_desc
+            )
             
-            # Decrypt provider credentials
-            shortcode = provider.mpesa_shortcode
-            passkey = decrypt_mpesa_credential(provider.mpesa_passkey)
-            
-            if not shortcode or not passkey:
-                raise ValueError("Provider M-PESA shortcode or passkey not found")
-            
-            # Generate timestamp and password
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            password = base64.b64encode(f"{shortcode}{passkey}{timestamp}".encode()).decode()
-            
-            # STK Push URL
-            stk_url = f"{self.daraja_base_url}/mpesa/stkpush/v1/processrequest"
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            payload = {
-                "BusinessShortCode": shortcode,
-                "Password": password,
-                "Timestamp": timestamp,
-                "TransactionType": "CustomerPayBillOnline",
-                "Amount": int(amount),
-                "PartyA": phone_number,
-                "PartyB": shortcode,
-                "PhoneNumber": phone_number,
-                "CallBackURL": provider.callback_url,
-                "AccountReference": account_reference,
-                "TransactionDesc": transaction_desc
-            }
-            
-            response = requests.post(stk_url, headers=headers, json=payload, timeout=30)
+            response = gateway_request('post', stk_url, 'daraja', 'stk_push', provider_id=provider_id, headers=headers, json=payload, timeout=30)
             response.raise_for_status()
             
             result = response.json()
             
-            # Update provider test status
-            provider.mpesa_last_test = timezone.now()
-            provider.mpesa_test_status = 'success' if result.get('ResponseCode') == '0' else 'failed'
-            provider.save()
+            # A ResponseCode other than 0 is about the customer's request, not Daraja's health.
+            # Provider test status is flushed to the DB periodically by the tracker
+            gateway_health.record(provider_id, 'stk_push', True, time.monotonic() - started)
             
             return result
             
         except Exception as e:
             logger.error(f"STK Push failed for provider {provider_id}: {e}")
-            # Update provider test status
-            try:
-                provider = Provider.objects.get(id=provider_id)
-                provider.mpesa_last_test = timezone.now()
-                provider.mpesa_test_status = 'failed'
-                provider.save()
-            except:
-                pass
+            gateway_health.record(provider_id, 'stk_push', not is_gateway_failure(e), time.monotonic() - started)
             raise
     
     def query_stk_push_status(self, provider_id, checkout_request_id):
-        """Query STK Push status for a specific provider"""
+        """
+        Query STK Push status for a specific provider.
+        
+        Concurrent queries for the same checkout share one Daraja call and the
+        result is cached (for good once the payment reached a final state).
+        """
+        return stk_status_coalescer.get(
+            f"{provider_id}:{checkout_request_id}",
+            lambda: self._query_stk_push_status(provider_id, checkout_request_id),
+            is_terminal_stk_status
+        )
+    
+    def _query_stk_push_status(self, provider_id, checkout_request_id):
+        gateway_health.before_call(provider_id, 'stk_query')
+        started = time.monotonic()
         try:
             access_token = self.get_provider_access_token(provider_id)
             provider = Provider.objects.get(id=provider_id)
+            query_url, headers, payload = self._stk_query_request(provider, access_token, checkout_request_id)
             
-            query_url = f"{self.daraja_base_url}/mpesa/stkpushquery/v1/query"
-            
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
+            response = gateway_request('post', query_url, 'daraja', 'stk_query', provider_id=provider_id, headers=headers, json=payload, timeout=30)
+            if not is_still_processing(response):
+                response.raise_for_status()
             
-            timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-            password = base64.b64encode(f"{provider.mpesa_shortcode}{decrypt_mpesa_credential(provider.mpesa_passkey)}{timestamp}".encode()).decode()
+            result = response.json()
+            gateway_health.record(provider_id, 'stk_query', True, time.monotonic() - started)
+            return result
             
-            payload = {
-                "BusinessShortCode": provider.mpesa_shortcode,
-                "Password": password,
-                "Timestamp": timestamp,
-                "CheckoutRequestID": checkout_request_id
-            }
+        except Exception as e:
+            logger.error(f"STK Push query failed for provider {provider_id}: {e}")
+            gateway_health.record(provider_id, 'stk_query', not is_gateway_failure(e), time.monotonic() - started)
+            raise
+    
+    # Async versions for the ASGI captive portal views: same requests, health
+    # tracking and coalescing, but the event loop is free while Daraja responds
+    
+    async def _aget_access_token(self, provider):
+        auth_url, headers = self._oauth_request(provider)
+        response = await async_gateway_request('get', auth_url, 'daraja', 'oauth', provider_id=provider.id, headers=headers, timeout=30)
+        response.raise_for_status()
+        return response.json().get('access_token')
+    
+    async def ainitiate_stk_push(self, provider_id, phone_number, amount, account_reference, transaction_desc):
+        """Async version of initiate_stk_push()"""
+        gateway_health.before_call(provider_id, 'stk_push')
+        started = time.monotonic()
+        try:
+            provider = await Provider.objects.aget(id=provider_id)
+            access_token = await self._aget_access_token(provider)
+            stk_url, headers, payload = self._stk_push_request(
+                provider, access_token, phone_number, amount, account_reference, transaction_desc
+            )
             
-            response = requests.post(query_url, headers=headers, json=payload, timeout=30)
+            response = await async_gateway_request('post', stk_url, 'daraja', 'stk_push', provider_id=provider_id, headers=headers, json=payload, timeout=30)
             response.raise_for_status()
             
-            return response.json()
+            result = response.json()
+            await gateway_health.arecord(provider_id, 'stk_push', True, time.monotonic() - started)
+            return result
+            
+        except Exception as e:
+            logger.error(f"STK Push failed for provider {provider_id}: {e}")
+            await gateway_health.arecord(provider_id, 'stk_push', not is_gateway_failure(e), time.monotonic() - started)
+            raise
+    
+    async def aquery_stk_push_status(self, provider_id, checkout_request_id):
+        """Async version of query_stk_push_status()"""
+        return await stk_status_coalescer.aget(
+            f"{provider_id}:{checkout_request_id}",
+            lambda: self._aquery_stk_push_status(provider_id, checkout_request_id),
+            is_terminal_stk_status
+        )
+    
+    async def _aquery_stk_push_status(self, provider_id, checkout_request_id):
+        gateway_health.before_call(provider_id, 'stk_query')
+        started = time.monotonic()
+        try:
+            provider = await Provider.objects.aget(id=provider_id)
+            access_token = await self._aget_access_token(provider)
+            query_url, headers, payload = self._stk_query_request(provider, access_token, checkout_request_id)
+            
+            response = await async_gateway_request('post', query_url, 'daraja', 'stk_query', provider_id=provider_id, headers=headers, json=payload, timeout=30)
+            if not is_still_processing(response):
+                response.raise_for_status()
+            
+            result = response.json()
+            await gateway_health.arecord(provider_id, 'stk_query', True, time.monotonic() - started)
+            return result
             
         except Exception as e:
             logger.error(f"STK Push query failed for provider {provider_id}: {e}")
+            await gateway_health.arecord(provider_id, 'stk_query', not is_gateway_failure(e), time.monotonic() - started)
             raise
     
     def test_provider_credentials(self, provider_id):
@@ -157,7 +313,10 @@ class PaymentBucketService:
                 provider.mpesa_credentials_verified = True
                 provider.mpesa_last_test = timezone.now()
                 provider.mpesa_test_status = 'success'
-                provider.save()
+                provider.save(update_fields=['mpesa_credentials_verified', 'mpesa_last_test', 'mpesa_test_status'])
+                
+                # Working credentials close any open circuits for this provider
+                gateway_health.reset(provider_id)
                 
                 return {
                     'success': True,
@@ -176,7 +335,7 @@ class PaymentBucketService:
                 provider.mpesa_credentials_verified = False
                 provider.mpesa_last_test = timezone.now()
                 provider.mpesa_test_status = 'failed'
-                provider.save()
+                provider.save(update_fields=['mpesa_credentials_verified', 'mpesa_last_test', 'mpesa_test_status'])
             except:
                 pass
             
@@ -215,27 +374,45 @@ class PaymentBucketService:
                 if name and value:
                     payment_data[name] = value
             
+            from .models import Payment
+            from .fulfilment import complete_payment
+            
+            payment = Payment.objects.filter(
+                provider_id=provider_id,
+                mpesa_checkout_request_id=checkout_request_id
+            ).first()
+            
             # Process the callback
             if result_code == 0:  # Success
                 # Payment successful
                 logger.info(f"Payment successful for provider {provider_id}: {checkout_request_id}")
                 
-                # Here you would typically:
-                # 1. Update ticket status to 'paid'
-                # 2. Activate WiFi access
-                # 3. Send confirmation to customer
-                # 4. Update provider revenue tracking
+                ticket = None
+                if payment:
+                    payment, ticket = complete_payment(
+                        payment.id,
+                        receipt_number=payment_data.get('MpesaReceiptNumber')
+                    )
+                else:
+                    logger.warning(f"No payment record for checkout request {checkout_request_id}")
                 
                 return {
                     'success': True,
                     'message': 'Payment processed successfully',
                     'checkout_request_id': checkout_request_id,
-                    'payment_data': payment_data
+                    'payment_data': payment_data,
+                    'ticket_code': ticket.code if ticket else None
                 }
             else:
                 # Payment failed
                 logger.warning(f"Payment failed for provider {provider_id}: {result_desc}")
                 
+                if payment:
+                    Payment.objects.filter(id=payment.id, status='pending').update(
+                        status='cancelled' if str(result_code) == '1032' else 'failed',
+                        updated_at=timezone.now()
+                    )
+                
                 return {
                     'success': False,
                     'message': f'Payment failed: {result_desc}',
@@ -9,6 +9,10 @@ import hmac
 from django.conf import settings
 from django.utils import timezone
 from datetime import datetime
+from .pesapal_cache import (
+    TOKEN_ERROR, error_body, error_kind, get_cached_access_token, get_ipn_id, invalidate_access_token
+)
+from .tracing import gateway_request
 
 
 class PesapalAPI:
@@ -22,7 +26,15 @@ class PesapalAPI:
         self.ipn_url = settings.PESAPAL_IPN_URL
         
     def get_access_token(self):
-        """Get Pesapal access token"""
+        """Get Pesapal access token (cached until shortly before it expires)"""
+        return get_cached_access_token(self.base_url, self.consumer_key, self.request_access_token)
+    
+    def invalidate_access_token(self):
+        """Drop the cached token after Pesapal rejects it"""
+        invalidate_access_token(self.base_url, self.consumer_key)
+    
+    def request_access_token(self):
+        """Request a new Pesapal access token"""
         url = f"{self.base_url}Auth/RequestToken"
         
         headers = {
@@ -36,9 +48,9 @@ class PesapalAPI:
         }
         
         try:
-            response = requests.post(url, json=data, headers=headers)
+            response = gateway_request('post', url, 'pesapal', 'auth', json=data, headers=headers)
             response.raise_for_status()
-            return response.json()
+            return response.json().get('token')
         except requests.exceptions.RequestException as e:
             print(f"Error getting access token: {e}")
             return None
@@ -59,15 +71,23 @@ class PesapalAPI:
         }
         
         try:
-            response = requests.post(url, json=data, headers=headers)
+            response = gateway_request('post', url, 'pesapal', 'register_ipn', json=data, headers=headers)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             print(f"Error registering IPN: {e}")
             return None
     
+    def get_ipn_id(self, access_token, force=False):
+        """Get the stored IPN ID for our IPN URL, registering it only if needed"""
+        def register():
+            response = self.register_ipn(access_token)
+            return response.get('ipn_id') if response else None
+        
+        return get_ipn_id(self.base_url, self.ipn_url, register, force=force)
+    
     def create_order(self, order_data, access_token):
-        """Create Pesapal order"""
+        """Create Pesapal order; a failed request returns its error body"""
         url = f"{self.base_url}Transactions/SubmitOrderRequest"
         
         headers = {
@@ -77,12 +97,12 @@ class PesapalAPI:
         }
         
         try:
-            response = requests.post(url, json=order_data, headers=headers)
+            response = gateway_request('post', url, 'pesapal', 'submit_order', json=order_data, headers=headers)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             print(f"Error creating order: {e}")
-            return None
+            return error_body(e)
     
     def get_order_status(self, order_tracking_id, access_token):
         """Get order status from Pesapal"""
@@ -99,11 +119,14 @@ class PesapalAPI:
         }
         
         try:
-            response = requests.post(url, json=data, headers=headers)
+            response = gateway_request('post', url, 'pesapal', 'transaction_status', json=data, headers=headers)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
             print(f"Error getting order status: {e}")
+            if error_kind(error_body(e)) == TOKEN_ERROR:
+                # The caller's retry fetches a fresh token
+                self.invalidate_access_token()
             return None
     
     def verify_callback(self, order_tracking_id, merchant_reference, payment_reference):
@@ -0,0 +1,152 @@
+"""
+Shared caching for Pesapal access tokens and IPN registrations
+
+Pesapal tokens are valid for five minutes and an IPN URL only needs to be
+registered once per environment, yet every checkout used to request a new
+token and re-register the IPN URL. Tokens are cached in the Django cache; IPN
+IDs are persisted in PesapalIPNRegistration and reused until the URL changes.
+A stored IPN ID is not checked up front: submit_with_recovery() re-registers
+it only when Pesapal rejects an order because of it, and drops a cached token
+Pesapal no longer accepts.
+"""
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Why Pesapal rejected a request, see error_kind()
+TOKEN_ERROR = 'token'
+IPN_ERROR = 'ipn'
+
+
+def get_environment(base_url):
+    """Get the Pesapal environment name for an API base URL"""
+    return 'sandbox' if 'cybqa' in base_url or 'sandbox' in base_url else 'live'
+
+
+def _cache_key(prefix, *parts):
+    digest = hashlib.sha256('|'.join(parts).encode()).hexdigest()[:32]
+    return f"pesapal:{prefix}:{digest}"
+
+
+def get_cached_access_token(base_url, consumer_key, fetch_token):
+    """
+    Get a Pesapal access token, calling fetch_token() only on a cache miss.
+
+    Every Pesapal client shares the cached token for a base URL and consumer
+    key, so fetch_token must return the token string, not the full response.
+    """
+    key = _cache_key('token', base_url, consumer_key)
+    token = cache.get(key)
+    if isinstance(token, str) and token:
+        return token
+
+    token = fetch_token()
+    if token:
+        cache.set(key, token, getattr(settings, 'PESAPAL_TOKEN_CACHE_SECONDS', 240))
+    return token
+
+
+def invalidate_access_token(base_url, consumer_key):
+    """Drop a cached token, e.g. after Pesapal rejects it"""
+    cache.delete(_cache_key('token', base_url, consumer_key))
+
+
+def get_ipn_id(base_url, ipn_url, register, force=False):
+    """
+    Get the IPN ID for ipn_url in the environment of base_url.
+
+    register() is only called when no registration is stored for this URL or
+    when force is set; it must return the new ipn_id (or None on failure).
+    """
+    from .models import PesapalIPNRegistration
+
+    environment = get_environment(base_url)
+    key = _cache_key('ipn', environment, ipn_url)
+
+    if not force:
+        ipn_id = cache.get(key)
+        if ipn_id:
+            return ipn_id
+
+        registration = PesapalIPNRegistration.objects.filter(
+            environment=environment,
+            ipn_url=ipn_url
+        ).only('ipn_id').first()
+        if registration:
+            cache.set(key, registration.ipn_id, None)
+            return registration.ipn_id
+
+    ipn_id = register()
+    if not ipn_id:
+        return None
+
+    PesapalIPNRegistration.objects.update_or_create(
+        environment=environment,
+        ipn_url=ipn_url,
+        defaults={'ipn_id': ipn_id}
+    )
+    cache.set(key, ipn_id, None)
+    logger.info(f"Registered Pesapal IPN URL {ipn_url} ({environment}): {ipn_id}")
+    return ipn_id
+
+
+def error_body(exc):
+    """Get a Pesapal-style error body ({'error': ..., 'status': ...}) for a failed request"""
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return {'error': str(exc)}
+    try:
+        data = response.json()
+    except ValueError:
+        data = None
+    error = data.get('error') if isinstance(data, dict) else None
+    return {'error': error or str(exc), 'status': str(response.status_code)}
+
+
+def error_kind(data):
+    """
+    Tell why Pesapal rejected a request from its response body.
+
+    Returns TOKEN_ERROR for a 401 or an expired/invalid token, IPN_ERROR when
+    the notification (IPN) ID was refused, and None for anything else,
+    including successful responses.
+    """
+    if not isinstance(data, dict) or not data.get('error'):
+        return None
+    text = json.dumps(data['error']).lower()
+    if str(data.get('status')) == '401' or 'token' in text or 'unauthorized' in text:
+        return TOKEN_ERROR
+    if 'notification' in text or 'ipn' in text:
+        return IPN_ERROR
+    return None
+
+
+def submit_with_recovery(client, access_token, ipn_id, submit):
+    """
+    Call submit(access_token, ipn_id) and retry once if Pesapal rejected the
+    token or the IPN ID.
+
+    submit must return the response body, or error_body() for a failed
+    request. A rejected token is dropped from the cache and a fresh one is
+    fetched; a rejected IPN ID is re-registered. Other failures are returned
+    as they are. Returns (response body, IPN ID used).
+    """
+    data = submit(access_token, ipn_id)
+    kind = error_kind(data)
+    if kind == TOKEN_ERROR:
+        logger.warning("Pesapal rejected the cached access token; fetching a new one")
+        client.invalidate_access_token()
+        access_token = client.get_access_token()
+        if access_token:
+            data = submit(access_token, ipn_id)
+    elif kind == IPN_ERROR:
+        new_ipn_id = client.get_ipn_id(access_token, force=True)
+        if new_ipn_id:
+            ipn_id = new_ipn_id
+            data = submit(access_token, ipn_id)
+    return data, ipn_id
@@ -1,7 +1,6 @@
 """
 Pesapal integration for provider subscriptions
 """
-import requests
 import json
 import base64
 import hashlib
@@ -10,6 +9,11 @@ from datetime import datetime
 from django.conf import settings
 from django.utils import timezone
 import logging
+from .pesapal_cache import (
+    TOKEN_ERROR, error_body, error_kind, get_cached_access_token, get_ipn_id, invalidate_access_token,
+    submit_with_recovery
+)
+from .tracing import gateway_request
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +28,15 @@ class PesapalProviderAPI:
         self.ipn_url = getattr(settings, 'PESAPAL_IPN_URL', '')
         
     def get_access_token(self):
-        """Get Pesapal access token"""
+        """Get Pesapal access token (cached until shortly before it expires)"""
+        return get_cached_access_token(self.base_url, self.consumer_key, self.request_access_token)
+    
+    def invalidate_access_token(self):
+        """Drop the cached token after Pesapal rejects it"""
+        invalidate_access_token(self.base_url, self.consumer_key)
+    
+    def request_access_token(self):
+        """Request a new Pesapal access token"""
         try:
             url = f"{self.base_url}Auth/RequestToken"
             
@@ -38,7 +50,7 @@ class PesapalProviderAPI:
                 "Accept": "application/json"
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            response = gateway_request('post', url, 'pesapal', 'auth', json=payload, headers=headers)
             response.raise_for_status()
             
             data = response.json()
@@ -64,7 +76,7 @@ class PesapalProviderAPI:
                 "Accept": "application/json"
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            response = gateway_request('post', url, 'pesapal', 'register_ipn', json=payload, headers=headers)
             response.raise_for_status()
             
             data = response.json()
@@ -74,8 +86,17 @@ class PesapalProviderAPI:
             logger.error(f"Failed to register IPN URL: {e}")
             return None
     
+    def get_ipn_id(self, access_token, force=False):
+        """Get the stored IPN ID for our IPN URL, registering it only if needed"""
+        return get_ipn_id(
+            self.base_url,
+            self.ipn_url,
+            lambda: self.register_ipn_url(access_token),
+            force=force
+        )
+    
     def submit_order(self, access_token, order_data):
-        """Submit order to Pesapal"""
+        """Submit order to Pesapal; returns the response body, or the error body of a failed request"""
         try:
             url = f"{self.base_url}Transactions/SubmitOrderRequest"
             
@@ -108,15 +129,14 @@ class PesapalProviderAPI:
                 "Accept": "application/json"
             }
             
-            response = requests.post(url, json=payload, headers=headers)
+            response = gateway_request('post', url, 'pesapal', 'submit_order', json=payload, headers=headers)
             response.raise_for_status()
             
-            data = response.json()
-            return data.get('redirect_url')
+            return response.json()
             
         except Exception as e:
             logger.error(f"Failed to submit order to Pesapal: {e}")
-            return None
+            return error_body(e)
     
     def get_transaction_status(self, access_token, order_tracking_id):
         """Get transaction status from Pesapal"""
@@ -132,7 +152,7 @@ class PesapalProviderAPI:
                 "Accept": "application/json"
             }
             
-            response = requests.get(url, params=params, headers=headers)
+            response = gateway_request('get', url, 'pesapal', 'transaction_status', params=params, headers=headers)
             response.raise_for_status()
             
             data = response.json()
@@ -140,6 +160,9 @@ class PesapalProviderAPI:
             
         except Exception as e:
             logger.error(f"Failed to get transaction status: {e}")
+            if error_kind(error_body(e)) == TOKEN_ERROR:
+                # The caller's retry fetches a fresh token
+                self.invalidate_access_token()
             return None
 
 class ProviderSubscriptionService:
@@ -156,8 +179,8 @@ class ProviderSubscriptionService:
             if not access_token:
                 return None, "Failed to get access token"
             
-            # Register IPN URL
-            ipn_id = self.pesapal.register_ipn_url(access_token)
+            # Reuse the registered IPN ID (registers only on first use or URL change)
+            ipn_id = self.pesapal.get_ipn_id(access_token)
             if not ipn_id:
                 return None, "Failed to register IPN URL"
             
@@ -181,8 +204,12 @@ class ProviderSubscriptionService:
                 'state': provider.county
             }
             
-            # Submit order
-            redirect_url = self.pesapal.submit_order(access_token, order_data)
+            # Submit order, recovering once from a rejected token or IPN ID
+            def submit(token, notification_id):
+                return self.pesapal.submit_order(token, dict(order_data, ipn_id=notification_id))
+            
+            order_response, ipn_id = submit_with_recovery(self.pesapal, access_token, ipn_id, submit)
+            redirect_url = order_response.get('redirect_url')
             if not redirect_url:
                 return None, "Failed to submit order"
             
@@ -0,0 +1,262 @@
+"""
+Reconciliation sweeper for payments stuck in pending
+
+Callbacks from Daraja and Pesapal get lost (timeouts, deploys, bad callback
+URLs), leaving payments pending forever. The sweeper selects stale pending
+payments, asks the upstream gateway for their status through a bounded thread
+pool, and applies the results in batched transactions as they come in.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from collections import defaultdict
+import threading
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Payment
+from .fulfilment import fulfil_payment, mark_payment_completed
+from .ledger import post_payment
+from .tracing import trace_context
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of an upstream status query
+COMPLETED = 'completed'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+PENDING = 'pending'
+
+# Daraja STK query result codes that mean the customer cancelled or the push expired
+MPESA_CANCELLED_CODES = {'1032', '1037'}
+# Daraja STK query result codes and errorCodes that mean the transaction is still being processed
+MPESA_PENDING_CODES = {'4999'}
+MPESA_PENDING_ERROR_CODES = {'500.001.1001'}
+
+# Pesapal payment_status_description values
+PESAPAL_STATUS_MAP = {
+    'COMPLETED': COMPLETED,
+    'FAILED': FAILED,
+    'INVALID': FAILED,
+    'REVERSED': CANCELLED,
+}
+
+
+def interpret_mpesa_result(result):
+    """Map a Daraja STK query response to a reconciliation outcome"""
+    if result.get('errorCode') in MPESA_PENDING_ERROR_CODES:
+        return PENDING
+    result_code = result.get('ResultCode')
+    if result_code is None or result_code == '':
+        return PENDING
+    result_code = str(result_code)
+    if result_code in MPESA_PENDING_CODES:
+        return PENDING
+    if result_code == '0':
+        return COMPLETED
+    if result_code in MPESA_CANCELLED_CODES:
+        return CANCELLED
+    return FAILED
+
+
+def interpret_pesapal_result(result):
+    """Map a Pesapal transaction status response to a reconciliation outcome"""
+    status_text = result.get('payment_status_description') or result.get('payment_status') or ''
+    return PESAPAL_STATUS_MAP.get(status_text.upper(), PENDING)
+
+
+class PaymentReconciler:
+    """Re-check stale pending M-PESA and Pesapal payments against their gateways"""
+
+    def __init__(self, min_age_minutes=None, max_age_hours=None, max_workers=None,
+                 per_provider_limit=None, pesapal_limit=None, batch_size=None,
+                 max_attempts=None, limit=None):
+        self.min_age_minutes = min_age_minutes or getattr(settings, 'PAYMENT_RECONCILE_MIN_AGE_MINUTES', 5)
+        self.max_age_hours = max_age_hours or getattr(settings, 'PAYMENT_RECONCILE_MAX_AGE_HOURS', 48)
+        self.max_workers = max_workers or getattr(settings, 'PAYMENT_RECONCILE_MAX_WORKERS', 16)
+        self.per_provider_limit = per_provider_limit or getattr(settings, 'PAYMENT_RECONCILE_PER_PROVIDER', 2)
+        self.pesapal_limit = pesapal_limit or getattr(settings, 'PAYMENT_RECONCILE_PESAPAL_CONCURRENCY', 4)
+        self.batch_size = batch_size or getattr(settings, 'PAYMENT_RECONCILE_BATCH_SIZE', 100)
+        self.max_attempts = max_attempts or getattr(settings, 'PAYMENT_RECONCILE_MAX_ATTEMPTS', 10)
+        self.limit = limit or getattr(settings, 'PAYMENT_RECONCILE_LIMIT', 1000)
+
+        self._semaphores = {}
+        self._semaphores_lock = threading.Lock()
+        self._pesapal_token = None
+
+    def select_stale_payments(self):
+        """Get pending payments old enough to have missed their callback"""
+        now = timezone.now()
+        mpesa = Payment.objects.filter(
+            status='pending',
+            payment_method='mpesa',
+            mpesa_checkout_request_id__isnull=False,
+        )
+        pesapal = Payment.objects.filter(
+            status='pending',
+            payment_method='pesapal',
+            pesapal_order_tracking_id__isnull=False,
+        )
+        stale = (mpesa | pesapal).filter(
+            created_at__lte=now - timedelta(minutes=self.min_age_minutes),
+            created_at__gte=now - timedelta(hours=self.max_age_hours),
+        ).only(
+            'id', 'provider_id', 'payment_method', 'check_attempts',
+            'mpesa_checkout_request_id', 'pesapal_order_tracking_id',
+        ).order_by(F('last_checked_at').asc(nulls_first=True), 'created_at')
+
+        return list(stale[:self.limit])
+
+    def run(self):
+        """Run one reconciliation sweep and return a summary"""
+        payments = self.select_stale_payments()
+        summary = {'checked': len(payments), COMPLETED: 0, FAILED: 0, CANCELLED: 0, PENDING: 0, 'errors': 0}
+        if not payments:
+            return summary
+
+        if any(payment.payment_method == 'pesapal' for payment in payments):
+            self._pesapal_token = self._get_pesapal_token()
+
+        # Interleave providers so one slow provider does not hold up the queue
+        by_key = defaultdict(list)
+        for payment in payments:
+            by_key[self._concurrency_key(payment)].append(payment)
+        ordered = []
+        while by_key:
+            for key in list(by_key):
+                ordered.append(by_key[key].pop(0))
+                if not by_key[key]:
+                    del by_key[key]
+
+        # Apply results batch by batch as they come in, so a sweep cut short keeps what it found
+        batch = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for result in executor.map(self._check_payment, ordered):
+                batch.append(result)
+                if len(batch) >= self.batch_size:
+                    self._add_to_summary(summary, self._apply_batch(batch))
+                    batch = []
+        if batch:
+            self._add_to_summary(summary, self._apply_batch(batch))
+
+        logger.info(f"Payment reconciliation finished: {summary}")
+        return summary
+
+    def _add_to_summary(self, summary, batch_summary):
+        for key, value in batch_summary.items():
+            summary[key] += value
+
+    def _concurrency_key(self, payment):
+        if payment.payment_method == 'pesapal':
+            return 'pesapal'
+        return f"mpesa:{payment.provider_id}"
+
+    def _get_semaphore(self, key):
+        with self._semaphores_lock:
+            if key not in self._semaphores:
+                limit = self.pesapal_limit if key == 'pesapal' else self.per_provider_limit
+                self._semaphores[key] = threading.BoundedSemaphore(limit)
+            return self._semaphores[key]
+
+    def _get_pesapal_token(self):
+        from subscriptions.pesapal_integration import PesapalAPI
+        return PesapalAPI().get_access_token()
+
+    def _check_payment(self, payment):
+        """Query the upstream status of one payment (runs in a worker thread)"""
+        semaphore = self._get_semaphore(self._concurrency_key(payment))
+        try:
+            with semaphore, trace_context(f"reconcile:{payment.id}"):
+                if payment.payment_method == 'pesapal':
+                    return self._check_pesapal(payment)
+                return self._check_mpesa(payment)
+        except Exception as e:
+            logger.warning(f"Reconciliation query failed for payment {payment.id}: {e}")
+            return payment.id, PENDING, {}, True
+        finally:
+            # Worker threads get their own DB connection; don't leak it
+            connection.close()
+
+    def _check_mpesa(self, payment):
+        from .payment_bucket import payment_bucket_service
+
+        result = payment_bucket_service.query_stk_push_status(
+            provider_id=payment.provider_id,
+            checkout_request_id=payment.mpesa_checkout_request_id
+        )
+        return payment.id, interpret_mpesa_result(result), result, False
+
+    def _check_pesapal(self, payment):
+        from subscriptions.pesapal_integration import PesapalAPI
+
+        if not self._pesapal_token:
+            return payment.id, PENDING, {}, True
+        result = PesapalAPI().get_transaction_status(self._pesapal_token, payment.pesapal_order_tracking_id)
+        if not result:
+            return payment.id, PENDING, {}, True
+        return payment.id, interpret_pesapal_result(result), result, False
+
+    def _apply_batch(self, results):
+        """
+        Apply one batch of query results in a single transaction.
+
+        Each payment is applied in its own savepoint, so a payment that cannot
+        be fulfilled or posted is rolled back, logged and counted as an error
+        while the rest of the batch (and the sweep) carries on; it stays
+        pending for the next sweep.
+        """
+        summary = defaultdict(int)
+        outcomes = {payment_id: (outcome, result, error) for payment_id, outcome, result, error in results}
+        now = timezone.now()
+
+        with transaction.atomic():
+            locked = Payment.objects.select_for_update().filter(id__in=list(outcomes), status='pending')
+            still_pending = []
+
+            for payment in locked:
+                outcome, result, error = outcomes[payment.id]
+                if error:
+                    summary['errors'] += 1
+
+                try:
+                    with transaction.atomic():
+                        outcome = self._apply_outcome(payment, outcome, result, error, now)
+                except Exception as e:
+                    logger.exception(f"Could not apply reconciliation result for payment {payment.id}: {e}")
+                    summary['errors'] += 1
+                    outcome = PENDING
+                if outcome == PENDING:
+                    still_pending.append(payment.id)
+
+                summary[outcome] += 1
+
+            if still_pending:
+                Payment.objects.filter(id__in=still_pending).update(
+                    last_checked_at=now,
+                    check_attempts=F('check_attempts') + 1
+                )
+
+        return summary
+
+    def _apply_outcome(self, payment, outcome, result, error, now):
+        """Apply a query result to a locked pending payment and return the outcome applied"""
+        if outcome == COMPLETED:
+            # Daraja's STK query response carries no receipt number; the callback
+            # or a statement import (matched on phone, amount and time) fills it in
+            fields = mark_payment_completed(payment, payment_reference=result.get('confirmation_code'))
+            payment.last_checked_at = now
+            payment.save(update_fields=fields + ['last_checked_at'])
+            fulfil_payment(payment)
+            post_payment(payment)
+            return COMPLETED
+        if outcome in (FAILED, CANCELLED) or (not error and payment.check_attempts + 1 >= self.max_attempts):
+            # Upstream errors never fail a payment; only a gateway that keeps saying "pending" does
+            outcome = outcome if outcome != PENDING else FAILED
+            payment.status = outcome
+            payment.last_checked_at = now
+            payment.save(update_fields=['status', 'last_checked_at', 'updated_at'])
+            return outcome
+        return PENDING
@@ -17,6 +17,21 @@ class PaymentSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'created_at', 'updated_at', 'completed_at')
 
 
+class PaymentListSerializer(serializers.ModelSerializer):
+    """Payment summary without line items and gateway references, for list endpoints"""
+    
+    class Meta:
+        model = Payment
+        fields = (
+            'id', 'amount', 'currency', 'status', 'payment_method', 'phone_number',
+            'description', 'created_at', 'completed_at',
+        )
+    
+    @classmethod
+    def setup_queryset(cls, queryset):
+        return queryset.only(*cls.Meta.fields)
+
+
 class CreatePaymentSerializer(serializers.ModelSerializer):
     plan_id = serializers.IntegerField(write_only=True)
     
@@ -0,0 +1,165 @@
+"""
+Period commission settlement for all providers
+
+A period is settled in a fixed number of queries regardless of how many sales
+it holds:
+
+  1. one GROUP BY over the ledger's sale entries in the period, giving each
+     provider's gross sales and sale count
+  2. one read of the active ProviderCommission rows
+  3. one bulk insert of the settlements (existing ones are skipped)
+
+The commission rate is applied to each provider's gross sales and clamped to
+its min/max commission. Settlements are unique per (provider, period), so
+re-running a period only fills in providers that are missing; posting charges
+the commission to the provider's ledger account under a per-period reference.
+"""
+from datetime import date, datetime, time, timedelta
+import logging
+
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .models import CommissionSettlement, LedgerEntry
+from .ledger import post_commission, ZERO, CENT
+
+logger = logging.getLogger(__name__)
+
+
+def month_period(year, month):
+    """Get the (start, end) dates of a calendar month; end is exclusive"""
+    start = date(year, month, 1)
+    end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+    return start, end
+
+
+def previous_month_period(today=None):
+    today = today or timezone.localdate()
+    return month_period(today.year - 1, 12) if today.month == 1 else month_period(today.year, today.month - 1)
+
+
+def clamp_commission(gross_sales, rate, min_commission=ZERO, max_commission=None):
+    """Apply a percentage rate to gross sales and clamp the result to [min, max]"""
+    calculated = (gross_sales * rate / 100).quantize(CENT)
+    commission = max(calculated, min_commission or ZERO)
+    if max_commission is not None:
+        commission = min(commission, max_commission)
+    return calculated, commission
+
+
+class CommissionSettlementEngine:
+    """Compute, persist and post commission settlements for one period"""
+
+    def __init__(self, period_start, period_end):
+        self.period_start = period_start
+        self.period_end = period_end
+
+    def _bounds(self):
+        return (
+            timezone.make_aware(datetime.combine(self.period_start, time.min)),
+            timezone.make_aware(datetime.combine(self.period_end, time.min)),
+        )
+
+    def gross_sales(self):
+        """Get {provider_id: (gross_sales, sale_count)} for the period in one aggregate query"""
+        start, end = self._bounds()
+        rows = LedgerEntry.objects.filter(
+            entry_type='sale',
+            account__kind='clearing',
+            occurred_at__gte=start,
+            occurred_at__lt=end
+        ).values('account__provider_id').annotate(gross=Sum('debit'), sales=Count('id')).order_by()
+        return {row['account__provider_id']: (row['gross'] or ZERO, row['sales']) for row in rows}
+
+    def commission_terms(self, provider_ids):
+        """Get {provider_id: (rate, min, max)} from each provider's latest active ProviderCommission"""
+        from super_admin.models import ProviderCommission
+
+        terms = {}
+        rows = ProviderCommission.objects.filter(is_active=True, provider_id__in=provider_ids).order_by(
+            'provider_id', '-created_at', '-id'
+        ).values_list('provider_id', 'commission_rate', 'min_commission', 'max_commission')
+        for provider_id, rate, min_commission, max_commission in rows:
+            terms.setdefault(provider_id, (rate, min_commission, max_commission))
+        return terms
+
+    def compute(self):
+        """Build unsaved settlements for every provider with sales in the period"""
+        sales = self.gross_sales()
+        terms = self.commission_terms(list(sales))
+
+        settlements = []
+        for provider_id, (gross_sales, sale_count) in sales.items():
+            rate, min_commission, max_commission = terms.get(provider_id, (ZERO, ZERO, None))
+            calculated, commission = clamp_commission(gross_sales, rate, min_commission, max_commission)
+            settlements.append(CommissionSettlement(
+                provider_id=provider_id,
+                period_start=self.period_start,
+                period_end=self.period_end,
+                sale_count=sale_count,
+                gross_sales=gross_sales,
+                commission_rate=rate,
+                min_commission=min_commission or ZERO,
+                max_commission=max_commission,
+                calculated_commission=calculated,
+                commission=commission,
+                net_amount=gross_sales - commission,
+                ledger_reference=self.reference(provider_id)
+            ))
+        return settlements
+
+    def reference(self, provider_id):
+        return f"commission:{provider_id}:{self.period_start:%Y%m%d}-{self.period_end:%Y%m%d}"
+
+    def settle(self, post=True, recompute=False):
+        """
+        Persist the period's settlements and optionally post them to the ledger.
+
+        Existing settlements are kept as they are; recompute replaces those
+        still in draft. Returns a summary of the period.
+        """
+        settlements = self.compute()
+        period = CommissionSettlement.objects.filter(period_start=self.period_start, period_end=self.period_end)
+
+        with transaction.atomic():
+            if recompute:
+                period.filter(status='draft').delete()
+            existing = period.count()
+            CommissionSettlement.objects.bulk_create(settlements, batch_size=1000, ignore_conflicts=True)
+            created = period.count() - existing
+
+        posted = 0
+        if post:
+            for settlement in period.filter(status='draft', commission__gt=0):
+                posted += self.post(settlement)
+
+        totals = period.aggregate(gross=Sum('gross_sales'), commission=Sum('commission'), providers=Count('id'))
+        summary = {
+            'providers': totals['providers'],
+            'created': created,
+            'posted': posted,
+            'gross_sales': totals['gross'] or ZERO,
+            'commission': totals['commission'] or ZERO,
+        }
+        logger.info(f"Commission settlement {self.period_start} - {self.period_end}: {summary}")
+        return summary
+
+    def post(self, settlement):
+        """Charge a draft settlement's commission to the provider's ledger account"""
+        _, end = self._bounds()
+        with transaction.atomic():
+            updated = CommissionSettlement.objects.filter(pk=settlement.pk, status='draft').update(
+                status='posted',
+                posted_at=timezone.now()
+            )
+            if not updated:
+                return 0
+            post_commission(
+                settlement.provider_id,
+                settlement.commission,
+                settlement.ledger_reference,
+                occurred_at=end - timedelta(microseconds=1),
+                description=f"Commission {self.period_start} - {self.period_end} at {settlement.commission_rate}%"
+            )
+        return 1
@@ -0,0 +1,335 @@
+"""
+Bulk reconciliation of M-PESA statement exports against our payment records
+
+Statements from the M-PESA org portal can run to hundreds of thousands of
+rows, so the CSV is parsed as a stream and joined against an in-memory hash
+index of the provider's payments (build side) instead of querying per row:
+
+  - receipt number -> payment
+  - (amount, phone) -> payments ordered by time, claimed within a time window
+
+Each statement row ends up matched or missing (paid in on the statement but
+unknown to us). Our completed payments inside the statement's time span that no
+row claimed are orphaned. Corrections (receipt numbers, completion status,
+ticket sale references) are applied with bulk updates.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta
+import csv
+import io
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Payment, C2BTransaction
+from .c2b import parse_amount
+from .fulfilment import fulfil_payment
+from .idempotency import normalize_phone
+from .ledger import post_payment
+
+logger = logging.getLogger(__name__)
+
+# Header aliases seen in M-PESA org portal and Daraja statement exports
+COLUMN_ALIASES = {
+    'receipt': ('receipt no.', 'receipt no', 'receipt', 'transaction id', 'trans id'),
+    'completed_at': ('completion time', 'transaction time', 'date', 'initiation time'),
+    'amount': ('paid in', 'amount', 'credit'),
+    'status': ('transaction status', 'status'),
+    'party': ('other party info', 'msisdn', 'phone number', 'phone', 'details'),
+    'account': ('a/c no.', 'a/c no', 'account', 'account no.', 'bill ref number'),
+}
+
+DATE_FORMATS = (
+    '%Y-%m-%d %H:%M:%S',
+    '%d-%m-%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y %H:%M',
+    '%Y%m%d%H%M%S',
+)
+
+# Output sets
+MATCHED = 'matched'
+MISSING = 'missing'
+ORPHANED = 'orphaned'
+
+
+def parse_statement_time(value):
+    value = (value or '').strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return timezone.make_aware(datetime.strptime(value, date_format))
+        except ValueError:
+            continue
+    return None
+
+
+def _resolve_columns(header):
+    normalized = [column.strip().lower() for column in header]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in normalized:
+                columns[field] = normalized.index(alias)
+                break
+    missing = {'receipt', 'completed_at', 'amount'} - set(columns)
+    if missing:
+        raise ValueError(f"Statement is missing required columns: {', '.join(sorted(missing))}")
+    return columns
+
+
+def iter_statement_rows(stream):
+    """
+    Stream paid-in rows from a statement CSV.
+
+    Yields (receipt, completed_at, amount, phone, account) tuples; withdrawals,
+    failed transactions and unparseable rows are skipped. stream may be a
+    text or binary file object.
+    """
+    if isinstance(stream.read(0), bytes):
+        wrapper = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+        try:
+            yield from _iter_rows(wrapper)
+        finally:
+            # Leave the caller's file open (and seekable for a second pass)
+            wrapper.detach()
+    else:
+        yield from _iter_rows(stream)
+
+
+def _iter_rows(stream):
+    reader = csv.reader(stream)
+    columns = None
+    for row in reader:
+        if columns is None:
+            # Portal exports start with a few lines of account details before the header
+            lowered = [cell.strip().lower() for cell in row]
+            if any(alias in lowered for alias in COLUMN_ALIASES['receipt']):
+                columns = _resolve_columns(row)
+            continue
+
+        try:
+            receipt = row[columns['receipt']].strip().upper()
+            amount = parse_amount((row[columns['amount']] or '').replace(',', ''))
+            completed_at = parse_statement_time(row[columns['completed_at']])
+        except IndexError:
+            continue
+        if not receipt or not amount or amount <= 0 or not completed_at:
+            continue
+        if 'status' in columns and row[columns['status']].strip().lower() not in ('completed', 'success', ''):
+            continue
+
+        party = row[columns['party']] if 'party' in columns and len(row) > columns['party'] else ''
+        account = row[columns['account']].strip() if 'account' in columns and len(row) > columns['account'] else ''
+        yield receipt, completed_at, amount, normalize_phone(party.split(' - ')[0]), account
+
+    if columns is None:
+        raise ValueError("No statement header row found")
+
+
+def statement_span(rows):
+    """Get the earliest and latest completion time of statement rows, or (None, None) if there are none"""
+    start = end = None
+    for _, completed_at, _, _, _ in rows:
+        start = completed_at if start is None or completed_at < start else start
+        end = completed_at if end is None or completed_at > end else end
+    return start, end
+
+
+class StatementReconciler:
+    """Hash-join a provider's M-PESA statement against its payments"""
+
+    def __init__(self, provider, window_minutes=None, since=None, until=None):
+        self.provider = provider
+        self.window = timedelta(minutes=window_minutes or getattr(settings, 'STATEMENT_MATCH_WINDOW_MINUTES', 10))
+        self.since = since
+        self.until = until
+
+    def build_index(self):
+        """Load the provider's M-PESA payments into the hash join's build side"""
+        payments = Payment.objects.filter(provider=self.provider, payment_method='mpesa')
+        if self.since:
+            payments = payments.filter(created_at__gte=self.since - self.window)
+        if self.until:
+            payments = payments.filter(created_at__lte=self.until + self.window)
+
+        self.payments = {}
+        self.by_receipt = {}
+        by_amount_phone = defaultdict(list)
+        rows = payments.values_list(
+            'id', 'status', 'amount', 'phone_number', 'mpesa_receipt_number', 'created_at', 'completed_at'
+        ).iterator(chunk_size=5000)
+
+        for payment_id, status, amount, phone_number, receipt, created_at, completed_at in rows:
+            paid_at = completed_at or created_at
+            self.payments[payment_id] = (status, parse_amount(amount), receipt, paid_at)
+            if receipt:
+                self.by_receipt[receipt.upper()] = payment_id
+            by_amount_phone[(parse_amount(amount), normalize_phone(phone_number))].append((paid_at, payment_id))
+
+        for candidates in by_amount_phone.values():
+            candidates.sort()
+        self.by_amount_phone = by_amount_phone
+        return len(self.payments)
+
+    def reconcile_file(self, stream, on_row=None, keep_missing=False):
+        """
+        Reconcile a seekable statement file.
+
+        Unless since/until were given, the statement's time span is read in a
+        first streaming pass, so the build side only holds the payments of
+        that span (plus the match window) rather than the provider's history.
+        """
+        if self.since is None and self.until is None:
+            self.since, self.until = statement_span(iter_statement_rows(stream))
+            stream.seek(0)
+            if self.since is None:
+                # No paid-in rows, so there is nothing to match against
+                self.since = self.until = timezone.now() + self.window * 2
+        return self.reconcile(iter_statement_rows(stream), on_row=on_row, keep_missing=keep_missing)
+
+    def _claim_by_window(self, amount, phone, completed_at, claimed):
+        """Claim the unclaimed payment closest in time to a statement row"""
+        candidates = self.by_amount_phone.get((amount, phone))
+        if not candidates or not phone:
+            return None
+        position = bisect_left(candidates, (completed_at - self.window,))
+        best = None
+        while position < len(candidates) and candidates[position][0] <= completed_at + self.window:
+            paid_at, payment_id = candidates[position]
+            if payment_id not in claimed and not self.payments[payment_id][2]:
+                distance = abs((paid_at - completed_at).total_seconds())
+                if best is None or distance < best[0]:
+                    best = (distance, payment_id)
+            position += 1
+        return best[1] if best else None
+
+    def reconcile(self, rows, on_row=None, keep_missing=False):
+        """
+        Probe the index with statement rows.
+
+        on_row(set_name, record) is called for every matched and missing row
+        and, at the end, every orphaned payment, so callers can write the sets
+        out without holding them in memory; missing rows are only kept when
+        keep_missing is set (needed to queue them for review). Returns a
+        summary including the number of corrections to apply.
+        """
+        self.build_index()
+        claimed = set()
+        corrections = {}
+        summary = {MATCHED: 0, MISSING: 0, ORPHANED: 0, 'rows': 0, 'amount_mismatches': 0}
+        span_start = span_end = None
+        self.missing_rows = []
+
+        for receipt, completed_at, amount, phone, account in rows:
+            summary['rows'] += 1
+            span_start = completed_at if span_start is None or completed_at < span_start else span_start
+            span_end = completed_at if span_end is None or completed_at > span_end else span_end
+
+            payment_id = self.by_receipt.get(receipt)
+            how = 'receipt'
+            if payment_id is None:
+                payment_id = self._claim_by_window(amount, phone, completed_at, claimed)
+                how = 'amount_phone_time'
+
+            if payment_id is None or payment_id in claimed:
+                summary[MISSING] += 1
+                record = {'receipt': receipt, 'completed_at': completed_at.isoformat(), 'amount': str(amount),
+                          'phone': phone, 'account': account}
+                if keep_missing:
+                    self.missing_rows.append((receipt, completed_at, amount, phone, account))
+                if on_row:
+                    on_row(MISSING, record)
+                continue
+
+            claimed.add(payment_id)
+            status, our_amount, our_receipt, paid_at = self.payments[payment_id]
+            if our_amount != amount:
+                summary['amount_mismatches'] += 1
+            elif status != 'completed' or not our_receipt:
+                corrections[payment_id] = (receipt, completed_at)
+
+            summary[MATCHED] += 1
+            if on_row:
+                on_row(MATCHED, {'receipt': receipt, 'payment_id': str(payment_id), 'matched_by': how,
+                                 'amount': str(amount), 'our_amount': str(our_amount), 'our_status': status})
+
+        if span_start is not None:
+            for payment_id, (status, amount, receipt, paid_at) in self.payments.items():
+                if payment_id in claimed or status != 'completed':
+                    continue
+                if span_start - self.window <= paid_at <= span_end + self.window:
+                    summary[ORPHANED] += 1
+                    if on_row:
+                        on_row(ORPHANED, {'payment_id': str(payment_id), 'receipt': receipt or '',
+                                          'amount': str(amount), 'paid_at': paid_at.isoformat()})
+
+        summary['corrections'] = len(corrections)
+        self.corrections = corrections
+        return summary
+
+    def apply_corrections(self, batch_size=1000, queue_missing=False):
+        """Bulk-apply receipt/status corrections and optionally queue missing rows for review"""
+        from tickets.models import TicketSale
+
+        corrected = 0
+        payment_ids = list(self.corrections)
+        for start in range(0, len(payment_ids), batch_size):
+            batch_ids = payment_ids[start:start + batch_size]
+            with transaction.atomic():
+                payments = list(Payment.objects.select_for_update().filter(id__in=batch_ids))
+                newly_completed = []
+                for payment in payments:
+                    receipt, completed_at = self.corrections[payment.id]
+                    payment.mpesa_receipt_number = payment.mpesa_receipt_number or receipt
+                    if payment.status != 'completed':
+                        payment.status = 'completed'
+                        payment.completed_at = completed_at
+                        newly_completed.append(payment)
+                    payment.updated_at = timezone.now()
+                Payment.objects.bulk_update(payments, ['status', 'completed_at', 'mpesa_receipt_number', 'updated_at'])
+
+                # Issue what recovered payments paid for, as the sweeper and callbacks do
+                for payment in newly_completed:
+                    fulfil_payment(payment)
+
+                sales = []
+                for sale in TicketSale.objects.filter(ticket__payment_id__in=batch_ids).select_related('ticket'):
+                    sale.payment_reference = self.corrections[sale.ticket.payment_id][0]
+                    sale.status = 'completed'
+                    sales.append(sale)
+                TicketSale.objects.bulk_update(sales, ['payment_reference', 'status'])
+
+                for payment in newly_completed:
+                    post_payment(payment)
+            corrected += len(payments)
+
+        queued = 0
+        if queue_missing and self.missing_rows:
+            shortcode = self.provider.mpesa_shortcode or ''
+            for start in range(0, len(self.missing_rows), batch_size):
+                batch = self.missing_rows[start:start + batch_size]
+                # Rows already queued (by a callback or an earlier import) are skipped by
+                # ignore_conflicts, so count what the insert actually added
+                stored = C2BTransaction.objects.filter(trans_id__in=[row[0] for row in batch])
+                before = stored.count()
+                C2BTransaction.objects.bulk_create([
+                    C2BTransaction(
+                        trans_id=receipt,
+                        transaction_type='Statement Import',
+                        business_shortcode=shortcode,
+                        amount=amount,
+                        bill_ref_number=account[:100],
+                        msisdn=phone,
+                        trans_time=completed_at.strftime('%Y%m%d%H%M%S'),
+                        provider=self.provider,
+                        match_reason='statement_missing'
+                    )
+                    for receipt, completed_at, amount, phone, account in batch
+                ], ignore_conflicts=True)
+                queued += stored.count() - before
+
+        logger.info(f"Statement import for provider {self.provider.id}: {corrected} payments corrected, {queued} rows queued")
+        return {'corrected': corrected, 'queued_for_review': queued}
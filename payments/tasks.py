@@ -0,0 +1,30 @@
+"""
+Celery tasks for payments app
+"""
+from celery import shared_task
+
+from .reconciliation import PaymentReconciler
+from .webhooks import WebhookProcessor
+
+
+@shared_task
+def reconcile_pending_payments():
+    """Re-check stale pending payments with their gateways"""
+    summary = PaymentReconciler().run()
+    return f"Reconciled {summary['checked']} payments: {summary['completed']} completed, {summary['failed']} failed"
+
+
+@shared_task
+def process_webhook_inbox():
+    """Drain due events from the webhook inbox"""
+    summary = WebhookProcessor().run()
+    return f"Processed {summary['processed']} webhooks, {summary['retried']} retried, {summary['dead']} dead-lettered"
+
+
+@shared_task
+def settle_previous_month_commissions():
+    """Settle and post platform commissions for last month"""
+    from .settlement import CommissionSettlementEngine, previous_month_period
+
+    summary = CommissionSettlementEngine(*previous_month_period()).settle()
+    return f"Settled commissions for {summary['providers']} providers: {summary['commission']} total"
@@ -0,0 +1,1247 @@
+"""
+Tests for payments app
+"""
+from datetime import datetime, timedelta
+import io
+import json
+from unittest import mock
+import threading
+import time
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from accounts.models import Provider
+from tickets.models import TicketType, Ticket, TicketSale
+from payments.models import Payment, PesapalIPNRegistration, WebhookEvent
+from payments.webhooks import WebhookProcessor, pesapal_dedup_key
+from payments.models import C2BTransaction
+from payments.c2b import c2b_index, callback_token
+from payments.statements import StatementReconciler, iter_statement_rows
+from payments.gateway_health import GatewayHealthTracker, CircuitOpenError, OPEN, CLOSED
+from payments.pesapal_cache import get_cached_access_token, get_ipn_id, submit_with_recovery
+from payments.reconciliation import PaymentReconciler, interpret_mpesa_result
+from payments.coalescing import RequestCoalescer
+from payments.latency import latency_histograms, record_stage
+from payments.fulfilment import complete_payment
+from payments.models import LedgerAccount, LedgerEntry
+from payments import ledger
+from payments.models import CommissionSettlement
+from payments.settlement import CommissionSettlementEngine, month_period
+from payments.tracing import GatewayTracer, gateway_request, gateway_tracer, trace_context
+from accounts.encryption import encrypt_mpesa_credential
+from django.test import override_settings
+from hotspot_config.admission import admission_controller, classify_request
+import httpx
+import requests
+from super_admin.models import ProviderCommission
+
+User = get_user_model()
+
+
+def create_provider(email='provider@example.com'):
+    user = User.objects.create_user(
+        email=email,
+        username=email.split('@')[0],
+        password='testpass123'
+    )
+    return Provider.objects.create(
+        user=user,
+        status='active',
+        license_number=f'LIC-{email}',
+        business_name='Test Hotspot',
+        business_type='cafe',
+        contact_person='Jane Doe',
+        contact_phone='254700000000',
+        contact_email=email,
+        address='Moi Avenue',
+        city='Nairobi',
+        county='Nairobi',
+        service_areas='CBD',
+        is_approved=True
+    )
+
+
+class PaymentReconcilerTest(TestCase):
+    """Test the pending payment reconciliation sweeper"""
+
+    def setUp(self):
+        self.provider = create_provider()
+        self.ticket_type = TicketType.objects.create(
+            provider=self.provider,
+            name='1 Hour WiFi',
+            type='time',
+            duration_hours=1,
+            price=20
+        )
+        self.payment = Payment.objects.create(
+            provider=self.provider,
+            ticket_type=self.ticket_type,
+            phone_number='254712345678',
+            amount=20,
+            payment_method='mpesa',
+            description='WiFi Access - 1 Hour WiFi',
+            mpesa_checkout_request_id='ws_CO_123'
+        )
+        Payment.objects.filter(id=self.payment.id).update(created_at=timezone.now() - timedelta(minutes=30))
+
+    def test_interpret_mpesa_result(self):
+        """Test mapping of Daraja result codes"""
+        self.assertEqual(interpret_mpesa_result({'ResultCode': '0'}), 'completed')
+        self.assertEqual(interpret_mpesa_result({'ResultCode': 0}), 'completed')
+        self.assertEqual(interpret_mpesa_result({'ResultCode': '1032'}), 'cancelled')
+        self.assertEqual(interpret_mpesa_result({'ResultCode': '2001'}), 'failed')
+        self.assertEqual(interpret_mpesa_result({}), 'pending')
+        self.assertEqual(interpret_mpesa_result({'ResultCode': '4999'}), 'pending')
+        self.assertEqual(interpret_mpesa_result({'ResultCode': 4999}), 'pending')
+        self.assertEqual(interpret_mpesa_result({
+            'ResultCode': '1', 'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'
+        }), 'pending')
+
+    def test_processing_results_are_not_cached_for_good(self):
+        """Test still-processing STK results are not treated as terminal"""
+        from payments.payment_bucket import is_terminal_stk_status
+
+        self.assertFalse(is_terminal_stk_status({'ResultCode': '4999', 'ResultDesc': 'The transaction is still under processing'}))
+        self.assertFalse(is_terminal_stk_status({'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}))
+        self.assertTrue(is_terminal_stk_status({'ResultCode': '1032'}))
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.query_stk_push_status')
+    def test_completed_payment_issues_ticket_once(self, mock_query):
+        """Test a completed upstream status issues exactly one ticket across runs"""
+        mock_query.return_value = {'ResultCode': '0', 'ResultDesc': 'Success'}
+
+        summary = PaymentReconciler().run()
+        self.assertEqual(summary['completed'], 1)
+
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertIsNotNone(self.payment.completed_at)
+        self.assertEqual(Ticket.objects.filter(payment=self.payment).count(), 1)
+        self.assertEqual(TicketSale.objects.filter(ticket__payment=self.payment).count(), 1)
+        self.assertEqual(LedgerEntry.objects.filter(reference=f"sale:payment:{self.payment.id}").count(), 2)
+
+        # The sold ticket stays usable until the customer activates it
+        ticket = Ticket.objects.get(payment=self.payment)
+        self.assertEqual(ticket.status, 'active')
+        response = self.client.get(reverse('captive_portal:ticket_activation', args=[ticket.code]))
+        self.assertEqual(response.status_code, 200)
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.status, 'used')
+
+        # A second sweep finds nothing pending and issues nothing
+        summary = PaymentReconciler().run()
+        self.assertEqual(summary['checked'], 0)
+        self.assertEqual(Ticket.objects.filter(payment=self.payment).count(), 1)
+        self.assertEqual(LedgerEntry.objects.filter(reference=f"sale:payment:{self.payment.id}").count(), 2)
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.query_stk_push_status')
+    def test_upstream_error_keeps_payment_pending(self, mock_query):
+        """Test an upstream error never fails a payment"""
+        mock_query.side_effect = Exception('The transaction is being processed')
+
+        summary = PaymentReconciler(max_attempts=1).run()
+        self.assertEqual(summary['errors'], 1)
+
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'pending')
+        self.assertEqual(self.payment.check_attempts, 1)
+        self.assertIsNotNone(self.payment.last_checked_at)
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.query_stk_push_status')
+    def test_failed_fulfilment_does_not_stop_the_batch(self, mock_query):
+        """Test a payment that cannot be fulfilled is rolled back alone and the sweep carries on"""
+        from payments.fulfilment import fulfil_payment
+
+        mock_query.return_value = {'ResultCode': '0', 'ResultDesc': 'Success'}
+        broken = Payment.objects.create(
+            provider=self.provider, ticket_type=self.ticket_type, phone_number='254712345679', amount=20,
+            payment_method='mpesa', mpesa_checkout_request_id='ws_CO_456'
+        )
+        Payment.objects.filter(id=broken.id).update(created_at=timezone.now() - timedelta(minutes=30))
+
+        def fulfil(payment):
+            if payment.id == broken.id:
+                raise ValueError('Ticket type is gone')
+            return fulfil_payment(payment)
+
+        with mock.patch('payments.reconciliation.fulfil_payment', side_effect=fulfil):
+            summary = PaymentReconciler().run()
+        self.assertEqual((summary['completed'], summary['pending'], summary['errors']), (1, 1, 1))
+
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        broken.refresh_from_db()
+        self.assertEqual(broken.status, 'pending')
+        self.assertEqual(broken.check_attempts, 1)
+        self.assertFalse(LedgerEntry.objects.filter(payment_id=broken.id).exists())
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.query_stk_push_status')
+    def test_recent_payments_are_skipped(self, mock_query):
+        """Test payments younger than the minimum age are left for their callback"""
+        Payment.objects.filter(id=self.payment.id).update(created_at=timezone.now())
+
+        summary = PaymentReconciler().run()
+        self.assertEqual(summary['checked'], 0)
+        mock_query.assert_not_called()
+
+    def test_never_checked_payments_come_first(self):
+        """Test payments no sweep has reached yet are picked before rechecks on every backend"""
+        unchecked = Payment.objects.create(
+            provider=self.provider, ticket_type=self.ticket_type, phone_number='254712345679', amount=20,
+            payment_method='mpesa', mpesa_checkout_request_id='ws_CO_789'
+        )
+        Payment.objects.filter(id=unchecked.id).update(created_at=timezone.now() - timedelta(minutes=10))
+        Payment.objects.filter(id=self.payment.id).update(last_checked_at=timezone.now() - timedelta(minutes=1))
+
+        self.assertEqual([payment.id for payment in PaymentReconciler(limit=1).select_stale_payments()], [unchecked.id])
+
+
+class PesapalCacheTest(TestCase):
+    """Test Pesapal token caching and IPN registration reuse"""
+
+    base_url = 'https://cybqa.pesapal.com/pesapalv3/api/'
+    ipn_url = 'https://example.com/payments/pesapal/ipn/'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_access_token_is_fetched_once(self):
+        """Test the token endpoint is only hit on a cache miss"""
+        fetch = mock.Mock(return_value='token-1')
+        self.assertEqual(get_cached_access_token(self.base_url, 'key', fetch), 'token-1')
+        self.assertEqual(get_cached_access_token(self.base_url, 'key', fetch), 'token-1')
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_clients_share_the_token_string(self):
+        """Test every Pesapal client caches and reads the same token string"""
+        from payments.pesapal import PesapalAPI as PaymentsPesapalAPI
+        from subscriptions.pesapal_integration import PesapalAPI as SubscriptionsPesapalAPI
+
+        response = mock.Mock()
+        response.json.return_value = {'token': 'token-1', 'expiryDate': '2026-10-19T10:05:00Z'}
+        with mock.patch('payments.pesapal.gateway_request', return_value=response) as payments_request, \
+                mock.patch('subscriptions.pesapal_integration.gateway_request', return_value=response):
+            self.assertEqual(PaymentsPesapalAPI().get_access_token(), 'token-1')
+            self.assertEqual(SubscriptionsPesapalAPI().get_access_token(), 'token-1')
+        self.assertEqual(payments_request.call_count, 1)
+
+    def test_ipn_registered_once_and_persisted(self):
+        """Test the IPN URL is registered once and reused from the database"""
+        register = mock.Mock(return_value='ipn-1')
+        self.assertEqual(get_ipn_id(self.base_url, self.ipn_url, register), 'ipn-1')
+
+        cache.clear()
+        self.assertEqual(get_ipn_id(self.base_url, self.ipn_url, register), 'ipn-1')
+        self.assertEqual(register.call_count, 1)
+
+        registration = PesapalIPNRegistration.objects.get()
+        self.assertEqual(registration.environment, 'sandbox')
+
+    def test_force_re_registers(self):
+        """Test force replaces a stale IPN ID"""
+        get_ipn_id(self.base_url, self.ipn_url, mock.Mock(return_value='ipn-1'))
+        self.assertEqual(get_ipn_id(self.base_url, self.ipn_url, mock.Mock(return_value='ipn-2'), force=True), 'ipn-2')
+        self.assertEqual(PesapalIPNRegistration.objects.get().ipn_id, 'ipn-2')
+
+    def test_rejected_token_is_replaced(self):
+        """Test a 401 drops the cached token and retries with a fresh one without re-registering the IPN"""
+        from payments.pesapal import PesapalAPI
+
+        api = PesapalAPI()
+        get_cached_access_token(api.base_url, api.consumer_key, lambda: 'stale')
+        submit = mock.Mock(side_effect=[{'error': '401 Client Error', 'status': '401'}, {'redirect_url': 'https://pay'}])
+        with mock.patch.object(api, 'request_access_token', return_value='fresh'), \
+                mock.patch.object(api, 'get_ipn_id') as get_ipn:
+            data, ipn_id = submit_with_recovery(api, api.get_access_token(), 'ipn-1', submit)
+
+        self.assertEqual(data, {'redirect_url': 'https://pay'})
+        self.assertEqual(submit.call_args_list, [mock.call('stale', 'ipn-1'), mock.call('fresh', 'ipn-1')])
+        get_ipn.assert_not_called()
+
+    def test_only_ipn_errors_re_register(self):
+        """Test the IPN URL is re-registered for a rejected notification ID but not for other order errors"""
+        client = mock.Mock()
+        client.get_ipn_id.return_value = 'ipn-2'
+        invalid_ipn = {'error': {'code': 'invalid_notification_id', 'message': 'Invalid IPN id'}, 'status': '500'}
+        submit = mock.Mock(side_effect=[invalid_ipn, {'redirect_url': 'https://pay'}])
+
+        self.assertEqual(submit_with_recovery(client, 'token', 'ipn-1', submit), ({'redirect_url': 'https://pay'}, 'ipn-2'))
+        client.get_ipn_id.assert_called_once_with('token', force=True)
+
+        client.reset_mock()
+        amount_error = {'error': {'code': 'invalid_amount', 'message': 'Amount is invalid'}, 'status': '500'}
+        self.assertEqual(submit_with_recovery(client, 'token', 'ipn-1', mock.Mock(return_value=amount_error)),
+                         (amount_error, 'ipn-1'))
+        client.get_ipn_id.assert_not_called()
+        client.invalidate_access_token.assert_not_called()
+
+
+class GatewayHealthTrackerTest(TestCase):
+    """Test the per-provider circuit breaker and periodic health flush"""
+
+    def setUp(self):
+        self.provider = create_provider()
+        self.tracker = GatewayHealthTracker()
+
+    def test_circuit_opens_after_failures_and_recovers(self):
+        """Test repeated failures open the circuit and a successful trial closes it"""
+        with self.settings(GATEWAY_BREAKER_CONSECUTIVE_FAILURES=3, GATEWAY_BREAKER_COOLDOWN_SECONDS=0):
+            for _ in range(3):
+                self.tracker.before_call(self.provider.id, 'stk_push')
+                self.tracker.record(self.provider.id, 'stk_push', False, 0.1)
+            self.assertEqual(self.tracker.snapshot()[0]['state'], OPEN)
+
+            # Cool-down elapsed: one trial call is let through, a second is rejected
+            self.tracker.before_call(self.provider.id, 'stk_push')
+            with self.assertRaises(CircuitOpenError):
+                self.tracker.before_call(self.provider.id, 'stk_push')
+
+            self.tracker.record(self.provider.id, 'stk_push', True, 0.1)
+            self.assertEqual(self.tracker.snapshot()[0]['state'], CLOSED)
+
+    def test_abandoned_trial_is_replaced_after_timeout(self):
+        """Test a trial call that never records its outcome does not hold the circuit open for good"""
+        with self.settings(GATEWAY_BREAKER_CONSECUTIVE_FAILURES=1, GATEWAY_BREAKER_COOLDOWN_SECONDS=0,
+                           GATEWAY_BREAKER_TRIAL_TIMEOUT_SECONDS=60):
+            self.tracker.record(self.provider.id, 'stk_push', False, 0.1)
+            # The trial is let through, then cancelled before it records anything
+            self.tracker.before_call(self.provider.id, 'stk_push')
+            with self.assertRaises(CircuitOpenError):
+                self.tracker.before_call(self.provider.id, 'stk_push')
+
+            with mock.patch('payments.gateway_health.time.monotonic', return_value=time.monotonic() + 61):
+                self.tracker.before_call(self.provider.id, 'stk_push')
+                with self.assertRaises(CircuitOpenError):
+                    self.tracker.before_call(self.provider.id, 'stk_push')
+
+    def test_open_circuit_fails_fast(self):
+        """Test calls are rejected during the cool-down"""
+        with self.settings(GATEWAY_BREAKER_CONSECUTIVE_FAILURES=1):
+            self.tracker.record(self.provider.id, 'stk_push', False, 0.1)
+            with self.assertRaises(CircuitOpenError):
+                self.tracker.before_call(self.provider.id, 'stk_push')
+            # Other providers are unaffected
+            self.tracker.before_call(self.provider.id + 1, 'stk_push')
+
+    def test_only_daraja_business_errors_are_not_failures(self):
+        """Test credential, token and outage errors count against the circuit, business errors do not"""
+        from payments.payment_bucket import is_gateway_failure
+
+        def status_error(status_code, body, path='/mpesa/stkpushquery/v1/query'):
+            request = httpx.Request('POST', f'https://api.safaricom.co.ke{path}')
+            response = httpx.Response(status_code, json=body, request=request)
+            try:
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                return e
+
+        processing = {'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'}
+        self.assertFalse(is_gateway_failure(status_error(500, processing)))
+        self.assertFalse(is_gateway_failure(status_error(400, {'errorCode': '400.002.02'}, '/mpesa/stkpush/v1/processrequest')))
+        self.assertTrue(is_gateway_failure(status_error(500, {'errorCode': '500.003.02', 'errorMessage': 'System is busy'})))
+        self.assertTrue(is_gateway_failure(status_error(401, {})))
+        self.assertTrue(is_gateway_failure(status_error(400, {'errorCode': '400.008.01'}, '/oauth/v1/generate')))
+        self.assertTrue(is_gateway_failure(ValueError('Provider M-PESA credentials not found or invalid')))
+        self.assertTrue(is_gateway_failure(status_error(503, {})))
+        self.assertTrue(is_gateway_failure(httpx.ReadTimeout('timed out')))
+        self.assertTrue(is_gateway_failure(requests.ConnectionError('connection reset')))
+
+    def test_status_is_flushed_periodically(self):
+        """Test provider test status is only written on flush"""
+        with self.settings(GATEWAY_HEALTH_FLUSH_SECONDS=3600):
+            self.tracker.record(self.provider.id, 'stk_push', True, 0.1)
+            self.provider.refresh_from_db()
+            self.assertIsNone(self.provider.mpesa_test_status)
+
+            self.assertEqual(self.tracker.flush(), 1)
+            self.provider.refresh_from_db()
+            self.assertEqual(self.provider.mpesa_test_status, 'success')
+            self.assertIsNotNone(self.provider.mpesa_last_test)
+
+    def test_quiet_process_flushes_on_timer(self):
+        """Test a buffered status is written by the timer when no further calls arrive"""
+        with self.settings(GATEWAY_HEALTH_FLUSH_SECONDS=3600):
+            self.tracker.record(self.provider.id, 'stk_push', False, 0.1)
+        timer = self.tracker._timer
+        self.assertIsNotNone(timer)
+        timer.cancel()
+
+        with mock.patch('django.db.connections.close_all'):
+            timer.function()
+        self.provider.refresh_from_db()
+        self.assertEqual(self.provider.mpesa_test_status, 'failed')
+        self.assertIsNone(self.tracker._timer)
+
+
+class WebhookInboxTest(TestCase):
+    """Test the durable webhook inbox and its batch processor"""
+
+    def setUp(self):
+        self.provider = create_provider()
+        self.ticket_type = TicketType.objects.create(
+            provider=self.provider,
+            name='1 Hour WiFi',
+            type='time',
+            duration_hours=1,
+            price=20
+        )
+        self.payment = Payment.objects.create(
+            provider=self.provider,
+            ticket_type=self.ticket_type,
+            phone_number='254712345678',
+            amount=20,
+            payment_method='mpesa',
+            mpesa_checkout_request_id='ws_CO_456'
+        )
+        self.callback = {
+            'Body': {
+                'stkCallback': {
+                    'MerchantRequestID': '29115-34620561-1',
+                    'CheckoutRequestID': 'ws_CO_456',
+                    'ResultCode': 0,
+                    'ResultDesc': 'The service request is processed successfully.',
+                    'CallbackMetadata': {'Item': [
+                        {'Name': 'Amount', 'Value': 20},
+                        {'Name': 'MpesaReceiptNumber', 'Value': 'NLJ7RT61SV'},
+                    ]}
+                }
+            }
+        }
+
+    def post_callback(self):
+        return self.client.post(
+            reverse('mpesa_callback', args=[self.provider.id]),
+            data=json.dumps(self.callback),
+            content_type='application/json'
+        )
+
+    def test_duplicate_callbacks_are_stored_once(self):
+        """Test callbacks are acknowledged and deduplicated without processing"""
+        for _ in range(3):
+            response = self.post_callback()
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['ResultCode'], 0)
+
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'pending')
+
+    def test_pesapal_status_changes_are_not_deduplicated(self):
+        """Test a Pesapal notification with a new status gets its own key"""
+        pending = {'order_tracking_id': 'abc-123', 'payment_status': 'PENDING'}
+        completed = {'order_tracking_id': 'abc-123', 'payment_status': 'COMPLETED'}
+        self.assertEqual(pesapal_dedup_key(pending), pesapal_dedup_key(dict(pending)))
+        self.assertNotEqual(pesapal_dedup_key(pending), pesapal_dedup_key(completed))
+
+    @mock.patch('payments.pesapal.PesapalAPI.get_order_status')
+    @mock.patch('payments.pesapal.PesapalAPI.get_access_token', return_value='token-1')
+    def test_pesapal_ipn_after_dead_letter_is_processed(self, mock_token, mock_status):
+        """Test a repeated IPN re-queues its dead-lettered event while the order is still pending"""
+        payment = Payment.objects.create(provider=self.provider, amount=500, payment_method='pesapal',
+                                         pesapal_order_tracking_id='abc-123')
+        ipn = {'OrderTrackingId': 'abc-123', 'OrderNotificationType': 'IPNCHANGE', 'OrderMerchantReference': 'p-1'}
+
+        mock_status.return_value = {'payment_status_description': 'Pending'}
+        self.client.get(reverse('pesapal_ipn'), ipn)
+        self.assertEqual(WebhookProcessor(max_attempts=1).run()['dead'], 1)
+
+        mock_status.return_value = {'payment_status_description': 'Completed', 'confirmation_code': 'PSP1'}
+        self.client.get(reverse('pesapal_ipn'), ipn)
+        self.assertEqual(WebhookEvent.objects.get().status, 'pending')
+        self.assertEqual(WebhookProcessor().run()['processed'], 1)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'completed')
+
+        # Once the order is final, redeliveries stay deduplicated
+        self.client.get(reverse('pesapal_ipn'), ipn)
+        self.assertEqual(WebhookEvent.objects.get().status, 'processed')
+
+    def test_processor_completes_payment(self):
+        """Test the worker applies the stored callback and issues the ticket"""
+        self.post_callback()
+
+        summary = WebhookProcessor().run()
+        self.assertEqual(summary['processed'], 1)
+
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.status, 'processed')
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.payment.mpesa_receipt_number, 'NLJ7RT61SV')
+        self.assertEqual(Ticket.objects.filter(payment=self.payment).count(), 1)
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.handle_mpesa_callback')
+    def test_failures_retry_then_dead_letter(self, mock_handle):
+        """Test failing events back off and end up dead-lettered"""
+        mock_handle.return_value = {'success': False, 'error': 'database unavailable'}
+        self.post_callback()
+
+        processor = WebhookProcessor(max_attempts=2)
+        self.assertEqual(processor.run()['retried'], 1)
+        event = WebhookEvent.objects.get()
+        self.assertEqual(event.status, 'failed')
+        self.assertGreater(event.next_attempt_at, timezone.now())
+
+        WebhookEvent.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(processor.run()['dead'], 1)
+        event.refresh_from_db()
+        self.assertEqual(event.status, 'dead')
+        self.assertEqual(event.last_error, 'database unavailable')
+
+
+class PaymentIdempotencyTest(TestCase):
+    """Test repeated payment initiation requests fire a single STK push"""
+
+    def setUp(self):
+        cache.clear()
+        self.provider = create_provider()
+        self.ticket_type = TicketType.objects.create(
+            provider=self.provider,
+            name='1 Hour WiFi',
+            type='time',
+            duration_hours=1,
+            price=20
+        )
+
+    def initiate(self, phone_number='0712345678', **headers):
+        return self.client.post(
+            reverse('captive_portal:initiate_payment'),
+            data=json.dumps({
+                'provider_id': self.provider.id,
+                'ticket_type_id': self.ticket_type.id,
+                'phone_number': phone_number
+            }),
+            content_type='application/json',
+            **headers
+        )
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.ainitiate_stk_push')
+    def test_double_tap_replays_first_response(self, mock_push):
+        """Test a repeat with an equivalent phone number reuses the first STK push"""
+        mock_push.return_value = {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_789', 'CustomerMessage': 'OK'}
+
+        first = self.initiate('0712345678')
+        second = self.initiate('+254712345678')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.json()['checkout_request_id'], 'ws_CO_789')
+        self.assertEqual(mock_push.call_count, 1)
+        self.assertEqual(Payment.objects.filter(mpesa_checkout_request_id='ws_CO_789').count(), 1)
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.ainitiate_stk_push')
+    def test_settled_payment_is_not_replayed(self, mock_push):
+        """Test a customer whose push was cancelled can pay again inside the repeat window"""
+        mock_push.side_effect = [
+            {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_793'},
+            {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_794'},
+        ]
+
+        self.initiate('0712345678')
+        Payment.objects.filter(mpesa_checkout_request_id='ws_CO_793').update(status='cancelled')
+        second = self.initiate('0712345678')
+
+        self.assertFalse(second.has_header('Idempotent-Replayed'))
+        self.assertEqual(second.json()['checkout_request_id'], 'ws_CO_794')
+        self.assertEqual(mock_push.call_count, 2)
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.ainitiate_stk_push')
+    def test_failed_attempt_can_be_retried(self, mock_push):
+        """Test errors are not stored against the key"""
+        mock_push.side_effect = [
+            {'ResponseCode': '1', 'CustomerMessage': 'Failed'},
+            {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_790'},
+        ]
+
+        self.assertEqual(self.initiate(HTTP_IDEMPOTENCY_KEY='abc').status_code, 400)
+        self.assertEqual(self.initiate(HTTP_IDEMPOTENCY_KEY='abc').status_code, 200)
+        self.assertEqual(mock_push.call_count, 2)
+
+    @mock.patch('payments.payment_bucket.payment_bucket_service.ainitiate_stk_push')
+    def test_client_key_is_scoped_to_purchase(self, mock_push):
+        """Test another customer's reused Idempotency-Key does not replay the first response"""
+        mock_push.side_effect = [
+            {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_791'},
+            {'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_792'},
+        ]
+
+        first = self.initiate('0712345678', HTTP_IDEMPOTENCY_KEY='shared')
+        second = self.initiate('0798765432', HTTP_IDEMPOTENCY_KEY='shared')
+
+        self.assertEqual(first.json()['checkout_request_id'], 'ws_CO_791')
+        self.assertEqual(second.json()['checkout_request_id'], 'ws_CO_792')
+        self.assertFalse(second.has_header('Idempotent-Replayed'))
+        self.assertEqual(mock_push.call_count, 2)
+
+
+class C2BConfirmationTest(TestCase):
+    """Test Paybill confirmations are matched to ticket types or queued for review"""
+
+    def setUp(self):
+        c2b_index.invalidate()
+        self.provider = create_provider()
+        self.provider.mpesa_shortcode = '600123'
+        self.provider.save(update_fields=['mpesa_shortcode'])
+        self.hour = TicketType.objects.create(provider=self.provider, name='1 Hour WiFi', type='time', duration_hours=1, price=20)
+        self.day = TicketType.objects.create(provider=self.provider, name='24 Hours WiFi', type='time', duration_hours=24, price=50)
+
+    def confirm(self, trans_id, amount, reference, msisdn='254712345678', token=None):
+        return self.client.post(
+            reverse('c2b_confirmation', args=[token or callback_token('600123')]),
+            data=json.dumps({
+                'TransactionType': 'Pay Bill',
+                'TransID': trans_id,
+                'TransTime': '20261019120000',
+                'TransAmount': amount,
+                'BusinessShortCode': '600123',
+                'BillRefNumber': reference,
+                'MSISDN': msisdn,
+                'FirstName': 'Jane'
+            }),
+            content_type='application/json'
+        )
+
+    def test_account_reference_issues_ticket(self):
+        """Test a reference naming a ticket type issues that ticket once"""
+        self.assertEqual(self.confirm('RKT1', '50.00', '24 hours wifi').json()['ResultCode'], 0)
+        self.confirm('RKT1', '50.00', '24 hours wifi')
+
+        c2b_txn = C2BTransaction.objects.get(trans_id='RKT1')
+        self.assertEqual(c2b_txn.status, 'matched')
+        self.assertEqual(c2b_txn.ticket_type, self.day)
+        self.assertEqual(c2b_txn.payment.status, 'completed')
+        self.assertEqual(Ticket.objects.filter(ticket_type=self.day).count(), 1)
+
+    def test_confirmation_without_token_is_rejected(self):
+        """Test a confirmation posted without the shortcode's callback token is not recorded"""
+        response = self.confirm('RKT9', '50.00', '24 hours wifi', token='forged')
+        other_shortcode = self.confirm('RKT9', '50.00', '24 hours wifi', token=callback_token('600999'))
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(other_shortcode.status_code, 403)
+        self.assertFalse(C2BTransaction.objects.filter(trans_id='RKT9').exists())
+        self.assertFalse(Ticket.objects.filter(ticket_type=self.day).exists())
+
+    def test_pending_order_is_completed(self):
+        """Test a manual Paybill payment completes the customer's pending STK order"""
+        payment = Payment.objects.create(provider=self.provider, ticket_type=self.hour, phone_number='254712345678',
+                                         amount=20, payment_method='mpesa', mpesa_checkout_request_id='ws_CO_1')
+        self.confirm('RKT2', '20', 'anything', msisdn='0712345678')
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'completed')
+        self.assertEqual(payment.mpesa_receipt_number, 'RKT2')
+        self.assertEqual(Ticket.objects.filter(payment=payment).count(), 1)
+
+    def test_pending_order_is_matched_by_order_code_with_masked_msisdn(self):
+        """Test a Paybill payment with the order code as account number completes the order whatever the MSISDN"""
+        from payments.c2b import order_code
+
+        payment = Payment.objects.create(provider=self.provider, ticket_type=self.hour, phone_number='254712345678',
+                                         amount=20, payment_method='mpesa', mpesa_checkout_request_id='ws_CO_3')
+        self.confirm('RKT5', '20', order_code(payment.id).lower(), msisdn='2547 ***** 678')
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'completed')
+        self.assertEqual(C2BTransaction.objects.get(trans_id='RKT5').match_reason, 'pending_order')
+
+    def test_masked_msisdn_does_not_match_pending_orders_by_phone(self):
+        """Test a masked or hashed MSISDN is never used to pick a pending order"""
+        payment = Payment.objects.create(provider=self.provider, ticket_type=self.hour, phone_number='254712345678',
+                                         amount=20, payment_method='mpesa', mpesa_checkout_request_id='ws_CO_4')
+        hashed = 'a3f1c2e4b5d6978812345678' * 2 + '12345678'
+        for trans_id, msisdn in (('RKT6', '2547 ***** 678'), ('RKT7', hashed)):
+            self.confirm(trans_id, '20', 'anything', msisdn=msisdn)
+            c2b_txn = C2BTransaction.objects.get(trans_id=trans_id)
+            self.assertEqual(c2b_txn.match_reason, 'amount')
+            self.assertIsNone(c2b_txn.payment.phone_number)
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'pending')
+
+    def test_settled_order_in_stale_snapshot_is_not_reused(self):
+        """Test an order completed after the pending snapshot was taken does not absorb a new payment"""
+        payment = Payment.objects.create(provider=self.provider, ticket_type=self.hour, phone_number='254712345678',
+                                         amount=20, payment_method='mpesa', mpesa_checkout_request_id='ws_CO_2')
+        c2b_index.get()
+        complete_payment(payment.id, receipt_number='RKS1')
+
+        self.confirm('RKT4', '20', 'anything', msisdn='0712345678')
+
+        c2b_txn = C2BTransaction.objects.get(trans_id='RKT4')
+        self.assertEqual(c2b_txn.match_reason, 'amount')
+        self.assertNotEqual(c2b_txn.payment_id, payment.id)
+        self.assertEqual(c2b_txn.payment.status, 'completed')
+        payment.refresh_from_db()
+        self.assertEqual(payment.mpesa_receipt_number, 'RKS1')
+        self.assertEqual(Ticket.objects.filter(ticket_type=self.hour).count(), 2)
+
+    def test_unmatched_payment_goes_to_review(self):
+        """Test an amount matching no ticket type is queued for review"""
+        self.confirm('RKT3', '35', 'unknown')
+
+        c2b_txn = C2BTransaction.objects.get(trans_id='RKT3')
+        self.assertEqual(c2b_txn.status, 'unmatched')
+        self.assertEqual(c2b_txn.match_reason, 'unmatched_amount')
+        self.assertFalse(Ticket.objects.exists())
+
+
+class StatementReconcilerTest(TestCase):
+    """Test M-PESA statement rows are hash-joined against payments"""
+
+    statement = (
+        'Account Name:,Test Hotspot\n'
+        'Receipt No.,Completion Time,Initiation Time,Details,Transaction Status,Paid In,Withdrawn,Balance,Other Party Info\n'
+        'RKA1,2026-10-19 10:00:00,2026-10-19 10:00:00,Pay Bill,Completed,20.00,,100.00,254712345678 - JANE DOE\n'
+        'RKA2,2026-10-19 10:05:00,2026-10-19 10:05:00,Pay Bill,Completed,"1,000.00",,1100.00,254700000001 - JOHN DOE\n'
+        'RKA3,2026-10-19 10:06:00,2026-10-19 10:06:00,Pay Bill,Completed,50.00,,1150.00,254799999999 - NEW CUSTOMER\n'
+        'RKA4,2026-10-19 10:07:00,2026-10-19 10:07:00,Withdrawal,Completed,,500.00,650.00,\n'
+    )
+
+    def setUp(self):
+        self.provider = create_provider()
+        at = timezone.make_aware(datetime(2026, 10, 19, 10, 0))
+        self.by_receipt = Payment.objects.create(provider=self.provider, phone_number='254712345678', amount=20,
+                                                 payment_method='mpesa', status='completed', mpesa_receipt_number='RKA1')
+        ticket_type = TicketType.objects.create(provider=self.provider, name='Week', type='time', duration_hours=168,
+                                                price=1000)
+        self.by_window = Payment.objects.create(provider=self.provider, ticket_type=ticket_type,
+                                                phone_number='0700000001', amount=1000, payment_method='mpesa')
+        self.orphan = Payment.objects.create(provider=self.provider, phone_number='254711111111', amount=30,
+                                             payment_method='mpesa', status='completed', mpesa_receipt_number='RKX9')
+        Payment.objects.filter(id=self.by_receipt.id).update(created_at=at, completed_at=at)
+        Payment.objects.filter(id=self.by_window.id).update(created_at=at + timedelta(minutes=4))
+        Payment.objects.filter(id=self.orphan.id).update(created_at=at, completed_at=at + timedelta(minutes=2))
+
+    def test_matched_missing_and_orphaned_sets(self):
+        """Test rows are matched by receipt or by amount, phone and time window"""
+        sets = {'matched': [], 'missing': [], 'orphaned': []}
+        reconciler = StatementReconciler(self.provider)
+        summary = reconciler.reconcile(
+            iter_statement_rows(io.BytesIO(self.statement.encode())),
+            on_row=lambda name, record: sets[name].append(record)
+        )
+
+        self.assertEqual(summary['rows'], 3)
+        self.assertEqual({r['receipt'] for r in sets['matched']}, {'RKA1', 'RKA2'})
+        self.assertEqual([r['receipt'] for r in sets['missing']], ['RKA3'])
+        self.assertEqual([r['payment_id'] for r in sets['orphaned']], [str(self.orphan.id)])
+        self.assertEqual(summary['corrections'], 1)
+
+        reconciler.apply_corrections()
+        self.by_window.refresh_from_db()
+        self.assertEqual(self.by_window.status, 'completed')
+        self.assertEqual(self.by_window.mpesa_receipt_number, 'RKA2')
+        # The recovered payment gets its ticket, with the statement receipt on the sale
+        sale = TicketSale.objects.get(ticket__payment=self.by_window)
+        self.assertEqual((sale.ticket.status, sale.payment_reference), ('active', 'RKA2'))
+
+    def test_file_import_only_loads_the_statement_span(self):
+        """Test the build side only holds payments from the statement's time span plus the window"""
+        old = Payment.objects.create(provider=self.provider, phone_number='254712345678', amount=20,
+                                     payment_method='mpesa', status='completed', mpesa_receipt_number='RJA1')
+        Payment.objects.filter(id=old.id).update(created_at=timezone.make_aware(datetime(2025, 10, 19, 10, 0)))
+
+        statement = io.BytesIO(self.statement.encode())
+        reconciler = StatementReconciler(self.provider)
+        summary = reconciler.reconcile_file(statement)
+
+        self.assertEqual((reconciler.since, reconciler.until), (
+            timezone.make_aware(datetime(2026, 10, 19, 10, 0)), timezone.make_aware(datetime(2026, 10, 19, 10, 6))
+        ))
+        self.assertEqual(set(reconciler.payments), {self.by_receipt.id, self.by_window.id, self.orphan.id})
+        self.assertEqual((summary['rows'], summary['matched']), (3, 2))
+        self.assertFalse(statement.closed)
+
+    def test_queued_count_excludes_rows_already_queued(self):
+        """Test re-importing a statement does not count missing rows queued by the first import"""
+        for expected in (1, 0):
+            reconciler = StatementReconciler(self.provider)
+            reconciler.reconcile(iter_statement_rows(io.BytesIO(self.statement.encode())), keep_missing=True)
+            self.assertEqual(reconciler.apply_corrections(queue_missing=True)['queued_for_review'], expected)
+        self.assertEqual(C2BTransaction.objects.filter(trans_id='RKA3').count(), 1)
+
+
+class LedgerTest(TestCase):
+    """Test ledger postings, running balances and rebuilds"""
+
+    def setUp(self):
+        self.provider = create_provider()
+        self.ticket_type = TicketType.objects.create(
+            provider=self.provider,
+            name='1 Hour WiFi',
+            type='time',
+            duration_hours=1,
+            price=50
+        )
+
+    def create_payment(self):
+        return Payment.objects.create(
+            provider=self.provider,
+            ticket_type=self.ticket_type,
+            phone_number='254712345678',
+            amount=50,
+            payment_method='mpesa'
+        )
+
+    def test_completed_payment_is_posted_once(self):
+        payment = self.create_payment()
+        complete_payment(payment.id, receipt_number='QAB1')
+        complete_payment(payment.id, receipt_number='QAB1')
+
+        self.assertEqual(LedgerEntry.objects.filter(reference=f"sale:payment:{payment.id}").count(), 2)
+        balances = ledger.get_balances(self.provider.id)
+        self.assertEqual(balances['clearing'], 50)
+        self.assertEqual(balances['provider'], 50)
+
+    def test_running_balances_and_statement(self):
+        complete_payment(self.create_payment().id)
+        ledger.post_commission(self.provider.id, 5, 'commission:test')
+        ledger.post_payout(self.provider.id, 45, 'payout:test')
+
+        balances = ledger.get_balances(self.provider.id)
+        self.assertEqual(balances['provider'], 0)
+        self.assertEqual(balances['clearing'], 5)
+        self.assertEqual(balances['platform_commission'], 5)
+
+        statement = ledger.get_statement(self.provider.id, 'provider')
+        self.assertEqual([entry.balance_after for entry in statement['entries']], [50, 45, 0])
+        with self.assertRaises(ValueError):
+            ledger.post(self.provider.id, 'fee', 'fee:bad', [('provider', 1, 0)])
+
+    def test_rebuild_matches_live_postings(self):
+        complete_payment(self.create_payment().id)
+        complete_payment(self.create_payment().id)
+        ledger.post_payout(self.provider.id, 30, 'payout:test')
+        live = dict(LedgerAccount.objects.values_list('kind', 'balance'))
+
+        self.assertEqual(ledger.rebuild(), 6)
+        self.assertEqual(dict(LedgerAccount.objects.values_list('kind', 'balance')), live)
+
+    def test_provider_revenue_and_statement_come_from_the_ledger(self):
+        complete_payment(self.create_payment().id)
+        ledger.post_payout(self.provider.id, 20, 'payout:test')
+        self.assertEqual(ledger.get_sales_total(self.provider.id), 50)
+        self.assertEqual(ledger.get_sales_total(self.provider.id, start=timezone.now() + timedelta(minutes=1)), 0)
+
+        self.client.force_login(self.provider.user)
+        stats = self.client.get(reverse('provider:api_provider_stats')).json()
+        self.assertEqual(float(stats['total_revenue']), 50)
+        self.assertEqual(float(stats['balances']['provider']), 30)
+
+        statement = self.client.get(reverse('provider:api_provider_statement')).json()
+        self.assertEqual([float(entry['balance_after']) for entry in statement['entries']], [50, 30])
+        self.assertEqual(float(statement['closing_balance']), 30)
+
+    def test_release_backfill_only_fills_an_empty_ledger(self):
+        from django.core.management import call_command
+
+        complete_payment(self.create_payment().id)
+        LedgerEntry.objects.all().delete()
+        LedgerAccount.objects.all().delete()
+        call_command('rebuild_ledger', if_empty=True, stdout=io.StringIO())
+        self.assertEqual(ledger.get_balances(self.provider.id)['provider'], 50)
+
+        ledger.post_payout(self.provider.id, 50, 'payout:test')
+        with mock.patch('payments.management.commands.rebuild_ledger.rebuild') as rebuild:
+            call_command('rebuild_ledger', if_empty=True, stdout=io.StringIO())
+        rebuild.assert_not_called()
+
+
+class CommissionSettlementTest(TestCase):
+    """Test period commission settlement"""
+
+    def setUp(self):
+        self.providers = [create_provider('a@example.com'), create_provider('b@example.com')]
+        self.start, self.end = month_period(2026, 9)
+        occurred_at = timezone.make_aware(datetime(2026, 9, 15, 12, 0))
+        for provider in self.providers:
+            for sale in range(4):
+                ledger.post(provider.id, 'sale', f"sale:test:{provider.id}:{sale}", ledger.sale_lines(1000),
+                            occurred_at=occurred_at)
+        ledger.post(self.providers[0].id, 'sale', 'sale:test:october', ledger.sale_lines(1000),
+                    occurred_at=timezone.make_aware(datetime(2026, 10, 1, 0, 0)))
+        ProviderCommission.objects.create(provider=self.providers[0], commission_rate=10, max_commission=300)
+        ProviderCommission.objects.create(provider=self.providers[1], commission_rate=1, min_commission=100)
+
+    def test_settlement_clamps_and_is_idempotent(self):
+        engine = CommissionSettlementEngine(self.start, self.end)
+        summary = engine.settle()
+        self.assertEqual(summary['providers'], 2)
+        self.assertEqual(summary['posted'], 2)
+
+        capped = CommissionSettlement.objects.get(provider=self.providers[0])
+        self.assertEqual((capped.gross_sales, capped.calculated_commission, capped.commission), (4000, 400, 300))
+        floored = CommissionSettlement.objects.get(provider=self.providers[1])
+        self.assertEqual((floored.calculated_commission, floored.commission), (40, 100))
+        self.assertEqual(ledger.get_balances(self.providers[0].id)['platform_commission'], 300)
+
+        summary = engine.settle(recompute=True)
+        self.assertEqual((summary['created'], summary['posted']), (0, 0))
+        self.assertEqual(LedgerEntry.objects.filter(entry_type='commission').count(), 4)
+
+
+class CeleryRoutingTest(TestCase):
+    """Test that every project task is routed to a prioritised queue"""
+
+    def test_every_task_has_an_explicit_route(self):
+        from django.conf import settings
+        from hotspot_config.celery import app
+
+        app.loader.import_default_modules()
+        project_tasks = {name for name in app.tasks if not name.startswith('celery.')}
+        self.assertTrue(project_tasks)
+        self.assertEqual(project_tasks - set(settings.CELERY_TASK_ROUTES), set())
+        for route in settings.CELERY_TASK_ROUTES.values():
+            self.assertIn(route['queue'], settings.CELERY_QUEUE_TIME_LIMITS)
+        for entry in settings.CELERY_BEAT_SCHEDULE.values():
+            self.assertIn(entry['task'], project_tasks)
+        self.assertEqual(app.amqp.router.route({}, 'tickets.tasks.generate_daily_reports')['queue'].name, 'reports')
+
+
+class RequestCoalescerTest(TestCase):
+    """Test sharing of concurrent STK status queries"""
+
+    def setUp(self):
+        cache.clear()
+        self.coalescer = RequestCoalescer('test_status', ttl=60, terminal_ttl=None, wait_seconds=5)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = []
+
+    def fetch(self):
+        self.calls.append(1)
+        self.started.set()
+        self.release.wait(5)
+        return {'ResultCode': '0'}
+
+    def test_concurrent_callers_share_one_query(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.coalescer.get('ws_CO_1', self.fetch)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(self.started.wait(5))
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(results, [{'ResultCode': '0'}] * 5)
+        self.assertEqual(self.coalescer.get('ws_CO_1', self.fetch), {'ResultCode': '0'})
+        self.assertEqual(len(self.calls), 1)
+
+    def test_errors_are_not_cached(self):
+        with self.assertRaises(ValueError):
+            self.coalescer.get('ws_CO_2', mock.Mock(side_effect=ValueError('still processing')))
+        self.release.set()
+        self.assertEqual(self.coalescer.get('ws_CO_2', self.fetch), {'ResultCode': '0'})
+
+
+class PaymentLatencyTest(TestCase):
+    """Test payment-to-ticket stage timestamps and histograms"""
+
+    def setUp(self):
+        self.provider = create_provider()
+        self.ticket_type = TicketType.objects.create(
+            provider=self.provider,
+            name='1 Hour WiFi',
+            type='time',
+            duration_hours=1,
+            price=20
+        )
+        self.now = timezone.now()
+
+    def create_payment(self, accepted_after, callback_after):
+        payment = Payment.objects.create(
+            provider=self.provider,
+            ticket_type=self.ticket_type,
+            phone_number='254712345678',
+            amount=20,
+            payment_method='mpesa',
+            initiated_at=self.now,
+            stk_accepted_at=self.now + timedelta(seconds=accepted_after)
+        )
+        record_stage(payment.id, 'callback_received', self.now + timedelta(seconds=callback_after))
+        return payment
+
+    def test_stages_recorded_once_and_histogrammed(self):
+        fast = self.create_payment(1, 15)
+        self.create_payment(3, 400)
+        complete_payment(fast.id)
+        issued_at = Payment.objects.get(id=fast.id).ticket_issued_at
+        self.assertIsNotNone(issued_at)
+        record_stage(fast.id, 'callback_received', self.now + timedelta(hours=1))
+        self.assertEqual(Payment.objects.get(id=fast.id).callback_received_at, self.now + timedelta(seconds=15))
+
+        latency = latency_histograms(self.now - timedelta(hours=1))
+        [row] = latency['intervals']['customer_payment']
+        self.assertEqual(row['count'], 2)
+        self.assertEqual(sum(row['counts']), 2)
+        self.assertEqual(row['counts'][latency['buckets'].index('<=20s')], 1)
+        self.assertEqual(row['counts'][latency['buckets'].index('<=600s')], 1)
+        self.assertEqual(row['max_seconds'], 397.0)
+        self.assertEqual(len(latency['intervals']['fulfilment']), 1)
+
+    def test_latency_api_and_monitoring_page(self):
+        self.create_payment(1, 15)
+        admin = User.objects.create_superuser(email='admin@example.com', username='admin', password='testpass123')
+        self.client.force_login(admin)
+
+        response = self.client.get(reverse('payment_latency'), {'group_by': 'gateway'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['intervals']['stk_accept'][0]['payment_method'], 'mpesa')
+
+        response = self.client.get(reverse('super_admin:payment_monitoring'))
+        self.assertContains(response, 'Test Hotspot')
+
+        # Super admins without a provider profile see every provider too
+        super_admin = User.objects.create_user(
+            email='ops@example.com', username='ops', password='testpass123', is_super_admin=True
+        )
+        self.client.force_login(super_admin)
+        response = self.client.get(reverse('payment_latency'), {'group_by': 'gateway'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['intervals']['stk_accept'][0]['count'], 1)
+
+
+class GatewayTracingTest(TestCase):
+    def setUp(self):
+        gateway_tracer.reset()
+
+    def test_calls_after_a_failure_are_counted_as_retries(self):
+        failed = mock.Mock(status_code=503, ok=False)
+        succeeded = mock.Mock(status_code=200, ok=True)
+        responses = [failed, failed, succeeded, succeeded]
+        with mock.patch('payments.tracing.requests.request', side_effect=responses) as request:
+            with trace_context('req-1'):
+                for _ in responses:
+                    gateway_request('GET', 'https://example.com/query', 'daraja', 'stk_query', provider_id=7, timeout=5)
+        request.assert_called_with('GET', 'https://example.com/query', timeout=5)
+
+        calls = gateway_tracer.recent(gateway='daraja')
+        # Newest first: a repeat poll after a success is not a retry
+        self.assertEqual([call['retry'] for call in calls], [0, 2, 1, 0])
+        self.assertEqual({call['correlation_id'] for call in calls}, {'req-1'})
+
+        aggregate, = gateway_tracer.aggregates()
+        self.assertEqual((aggregate['calls'], aggregate['errors'], aggregate['retries']), (4, 2, 2))
+        self.assertEqual(aggregate['statuses'], {503: 2, 200: 2})
+
+    def test_exceptions_are_recorded_and_reraised(self):
+        with mock.patch('payments.tracing.requests.request', side_effect=ConnectionError('down')):
+            with self.assertRaises(ConnectionError):
+                gateway_request('POST', 'https://example.com/token', 'pesapal', 'auth')
+        call, = gateway_tracer.recent()
+        self.assertEqual((call['status'], call['ok'], call['correlation_id']), ('ConnectionError', False, None))
+
+    def test_buffer_keeps_most_recent_calls(self):
+        tracer = GatewayTracer(buffer_size=3)
+        for provider_id in range(5):
+            tracer.record('daraja', 'stk_push', provider_id, 0.1, 200, True, 0)
+        self.assertEqual([call['provider_id'] for call in tracer.recent()], [4, 3, 2])
+        self.assertEqual(tracer.aggregates()[0]['calls'], 5)
+
+    def test_request_id_header_is_echoed(self):
+        response = self.client.get('/', HTTP_X_REQUEST_ID='abc-123')
+        self.assertEqual(response['X-Request-ID'], 'abc-123')
+
+
+class AsyncCaptivePortalPaymentTest(TestCase):
+    """Test the async payment views end to end against a fake Daraja"""
+
+    def setUp(self):
+        cache.clear()
+        gateway_tracer.reset()
+        self.provider = create_provider()
+        Provider.objects.filter(pk=self.provider.pk).update(
+            mpesa_consumer_key=encrypt_mpesa_credential('key'),
+            mpesa_consumer_secret=encrypt_mpesa_credential('secret'),
+            mpesa_passkey=encrypt_mpesa_credential('passkey'),
+            mpesa_shortcode='174379'
+        )
+        self.ticket_type = TicketType.objects.create(
+            provider=self.provider, name='1 Hour WiFi', type='time', duration_hours=1, price=20
+        )
+        self.daraja_calls = []
+        self.query_response = httpx.Response(200, json={'ResultCode': '1032', 'ResultDesc': 'Request cancelled by user'})
+
+        def daraja(request):
+            self.daraja_calls.append(request.url.path)
+            if request.url.path.startswith('/oauth'):
+                return httpx.Response(200, json={'access_token': 'token'})
+            if request.url.path.endswith('processrequest'):
+                return httpx.Response(200, json={
+                    'ResponseCode': '0', 'CheckoutRequestID': 'ws_CO_async', 'MerchantRequestID': 'm-1'
+                })
+            return self.query_response
+
+        client_patch = mock.patch(
+            'payments.tracing.get_async_client',
+            side_effect=lambda: httpx.AsyncClient(transport=httpx.MockTransport(daraja))
+        )
+        client_patch.start()
+        self.addCleanup(client_patch.stop)
+
+    async def test_initiate_and_poll_under_asgi(self):
+        response = await self.async_client.post(
+            reverse('captive_portal:initiate_payment'),
+            data={'provider_id': self.provider.id, 'ticket_type_id': self.ticket_type.id, 'phone_number': '0712345678'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await Payment.objects.filter(mpesa_checkout_request_id='ws_CO_async', initiated_at__isnull=False).aexists())
+
+        for _ in range(2):
+            status = await self.async_client.post(
+                reverse('captive_portal:check_payment_status'),
+                data={'checkout_request_id': 'ws_CO_async'},
+                content_type='application/json'
+            )
+            self.assertEqual(status.json()['status'], 'pending')
+        # The cancelled result is terminal, so the second poll is served from the cache
+        self.assertEqual(self.daraja_calls.count('/mpesa/stkpushquery/v1/query'), 1)
+        self.assertEqual(
+            {(call['endpoint'], call['status']) for call in gateway_tracer.recent()},
+            {('oauth', 200), ('stk_push', 200), ('stk_query', 200)}
+        )
+
+    async def test_still_processing_error_is_pending(self):
+        self.query_response = httpx.Response(500, json={
+            'requestId': 'r-1', 'errorCode': '500.001.1001', 'errorMessage': 'The transaction is being processed'
+        })
+        await self.async_client.post(
+            reverse('captive_portal:initiate_payment'),
+            data={'provider_id': self.provider.id, 'ticket_type_id': self.ticket_type.id, 'phone_number': '0712345678'},
+            content_type='application/json'
+        )
+        status = await self.async_client.post(
+            reverse('captive_portal:check_payment_status'),
+            data={'checkout_request_id': 'ws_CO_async'},
+            content_type='application/json'
+        )
+        self.assertEqual(status.status_code, 200)
+        self.assertEqual(status.json()['status'], 'pending')
+        # Cached only briefly, as a pending result
+        from payments.payment_bucket import is_terminal_stk_status
+        self.assertFalse(is_terminal_stk_status(await cache.aget(f"stk_status:{self.provider.id}:ws_CO_async")))
+
+    async def test_get_is_not_allowed(self):
+        response = await self.async_client.get(reverse('captive_portal:initiate_payment'))
+        self.assertEqual(response.status_code, 405)
+
+    @override_settings(DEBUG=False, DISABLE_CSP=False)
+    async def test_security_headers_under_asgi(self):
+        response = await self.async_client.get(reverse('captive_portal:initiate_payment'))
+        self.assertIn("frame-ancestors 'none'", response['Content-Security-Policy'])
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+    @override_settings(DEBUG=True)
+    def test_no_middleware_is_adapted_under_asgi(self):
+        import logging
+        from django.core.handlers.asgi import ASGIHandler
+
+        with self.assertLogs('django.request', logging.DEBUG) as logs:
+            logging.getLogger('django.request').debug('Loading ASGI middleware')
+            ASGIHandler()
+        self.assertEqual([line for line in logs.output if 'adapted for middleware' in line], [])
+
+    async def test_static_files_are_served_ahead_of_django(self):
+        import tempfile
+        from hotspot_config.static import StaticFilesApplication
+
+        async def django_app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def get(application, path):
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {
+                'type': 'http', 'method': 'GET', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+                'root_path': '', 'scheme': 'http', 'server': ('testserver', 80), 'headers': [],
+                'http_version': '1.1',
+            }
+            await application(scope, receive, send)
+            return messages[0]['status']
+
+        with tempfile.TemporaryDirectory() as root:
+            with open(f'{root}/portal.css', 'w') as css:
+                css.write('body {}')
+            with override_settings(STATIC_ROOT=root, STATIC_URL='/static/', DEBUG=False):
+                application = StaticFilesApplication(django_app)
+            self.assertEqual(await get(application, '/static/portal.css'), 200)
+            self.assertEqual(await get(application, '/static/missing.css'), 204)
+            self.assertEqual(await get(application, '/portal/pay/'), 204)
+
+
+class AdmissionControlTest(TestCase):
+    """Test overloaded processes shed low-priority traffic but never payment callbacks"""
+
+    def setUp(self):
+        admission_controller.reset()
+        self.addCleanup(admission_controller.reset)
+
+    def test_requests_are_classified_by_path(self):
+        self.assertEqual(classify_request('/api/v1/payments/callback/3/'), 'callback')
+        self.assertEqual(classify_request('/api/v1/payments/pesapal/ipn/'), 'callback')
+        self.assertEqual(classify_request('/api/v1/subscriptions/callback/'), 'callback')
+        self.assertEqual(classify_request('/subscriptions/callback/'), 'callback')
+        self.assertEqual(classify_request('/captive-portal/payment/'), 'purchase')
+        self.assertEqual(classify_request('/captive-portal/payment/status/'), 'status')
+        self.assertEqual(classify_request('/captive-portal/'), 'page')
+        self.assertEqual(classify_request('/super-admin/payments/'), 'dashboard')
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=10)
+    def test_overload_sheds_pages_before_callbacks(self):
+        # Eight page views already in flight: level 0.8 sheds dashboards and pages only
+        admission_controller.in_flight = admission_controller.busy = 8
+
+        dashboard = self.client.get('/super-admin/')
+        self.assertEqual(dashboard.status_code, 503)
+        self.assertGreaterEqual(int(dashboard['Retry-After']), 5)
+        self.assertEqual(self.client.get('/captive-portal/').status_code, 503)
+
+        callback = self.client.post(
+            reverse('mpesa_callback', args=[999]), data='{}', content_type='application/json'
+        )
+        self.assertNotEqual(callback.status_code, 503)
+        status = self.client.post(
+            reverse('captive_portal:check_payment_status'), data='{}', content_type='application/json'
+        )
+        self.assertEqual(status.status_code, 400)
+
+        snapshot = admission_controller.snapshot()
+        self.assertEqual(snapshot['shed'], {'callback': 0, 'purchase': 0, 'status': 0, 'page': 1, 'dashboard': 1})
+        self.assertEqual(snapshot['in_flight'], 8)
+
+    @override_settings(ADMISSION_MAX_IN_FLIGHT=10)
+    def test_requests_waiting_on_mpesa_do_not_count_as_load(self):
+        for _ in range(20):
+            self.assertTrue(admission_controller.admit('purchase')[0])
+            self.assertTrue(admission_controller.admit('status')[0])
+        admitted, level = admission_controller.admit('page')
+        self.assertTrue(admitted)
+        self.assertLess(level, 0.5)
+        self.assertEqual(admission_controller.snapshot()['in_flight'], 41)
+
+    def test_router_queue_time_counts_as_load(self):
+        queued_since = int((time.time() - 30) * 1000)
+        for _ in range(5):
+            response = self.client.get('/dashboard/', HTTP_X_REQUEST_START=str(queued_since))
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertGreater(admission_controller.snapshot()['queue_ms'], 500)
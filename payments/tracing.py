@@ -0,0 +1,242 @@
+"""
+Tracing for outbound Daraja and Pesapal calls
+
+Gateway clients send their HTTP calls through gateway_request(), which records
+for every call the gateway, endpoint, provider, latency, HTTP status (or
+exception) and whether it is a retry: how many calls to the same endpoint
+failed in a row just before it in the current request. Repeat calls after a
+success, such as status polls, are not retries. Calls are tagged with the inbound request's correlation ID
+(X-Request-ID, set by RequestCorrelationMiddleware) or the background job
+that made them.
+
+Recording is an O(1) append under a lock: recent calls go to a fixed-size
+ring buffer, and per (gateway, endpoint) aggregates are kept in one-minute
+buckets covering the last GATEWAY_TRACE_WINDOW_MINUTES.
+
+Async views use async_gateway_request(), which makes the same call through a
+pooled httpx.AsyncClient (one per event loop) and records it the same way.
+"""
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone as dt_timezone
+import asyncio
+import threading
+import time
+import uuid
+import weakref
+import logging
+
+import httpx
+import requests
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_correlation_id = ContextVar('gateway_correlation_id', default=None)
+_failure_counts = ContextVar('gateway_failure_counts', default=None)
+
+
+def get_correlation_id():
+    return _correlation_id.get()
+
+
+@contextmanager
+def trace_context(correlation_id=None):
+    """Tag gateway calls made inside the block with a correlation ID"""
+    id_token = _correlation_id.set(correlation_id or uuid.uuid4().hex)
+    counts_token = _failure_counts.set(Counter())
+    try:
+        yield _correlation_id.get()
+    finally:
+        _failure_counts.reset(counts_token)
+        _correlation_id.reset(id_token)
+
+
+class MinuteBucket:
+    """Call aggregates for one endpoint over one minute"""
+
+    def __init__(self, minute):
+        self.minute = minute
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.statuses = Counter()
+
+
+class GatewayTracer:
+    """Thread-safe ring buffer of recent gateway calls plus rolling per-endpoint aggregates"""
+
+    def __init__(self, buffer_size=None):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=buffer_size or getattr(settings, 'GATEWAY_TRACE_BUFFER_SIZE', 500))
+        # (gateway, endpoint) -> deque of MinuteBucket, oldest first
+        self._buckets = {}
+
+    @property
+    def window_minutes(self):
+        return getattr(settings, 'GATEWAY_TRACE_WINDOW_MINUTES', 15)
+
+    def record(self, gateway, endpoint, provider_id, latency, status, ok, retry):
+        now = time.time()
+        minute = int(now // 60)
+        call = {
+            'at': now,
+            'gateway': gateway,
+            'endpoint': endpoint,
+            'provider_id': provider_id,
+            'latency_ms': round(latency * 1000, 1),
+            'status': status,
+            'ok': ok,
+            'retry': retry,
+            'correlation_id': _correlation_id.get(),
+        }
+        with self._lock:
+            self._recent.append(call)
+            buckets = self._buckets.get((gateway, endpoint))
+            if buckets is None:
+                buckets = self._buckets[(gateway, endpoint)] = deque()
+            if not buckets or buckets[-1].minute != minute:
+                buckets.append(MinuteBucket(minute))
+                while buckets and buckets[0].minute <= minute - self.window_minutes:
+                    buckets.popleft()
+            bucket = buckets[-1]
+            bucket.calls += 1
+            bucket.errors += 0 if ok else 1
+            bucket.retries += 1 if retry else 0
+            bucket.total_latency += latency
+            bucket.max_latency = max(bucket.max_latency, latency)
+            bucket.statuses[status] += 1
+
+    def recent(self, limit=100, gateway=None, provider_id=None):
+        """Get the most recent calls, newest first"""
+        with self._lock:
+            calls = list(self._recent)
+        calls.reverse()
+        if gateway:
+            calls = [call for call in calls if call['gateway'] == gateway]
+        if provider_id is not None:
+            calls = [call for call in calls if call['provider_id'] == provider_id]
+        return [
+            {**call, 'at': datetime.fromtimestamp(call['at'], tz=dt_timezone.utc)}
+            for call in calls[:limit]
+        ]
+
+    def aggregates(self):
+        """Get per-endpoint totals over the rolling window"""
+        oldest_minute = int(time.time() // 60) - self.window_minutes
+        results = []
+        with self._lock:
+            for (gateway, endpoint), buckets in self._buckets.items():
+                live = [bucket for bucket in buckets if bucket.minute > oldest_minute]
+                calls = sum(bucket.calls for bucket in live)
+                if not calls:
+                    continue
+                errors = sum(bucket.errors for bucket in live)
+                statuses = Counter()
+                for bucket in live:
+                    statuses.update(bucket.statuses)
+                results.append({
+                    'gateway': gateway,
+                    'endpoint': endpoint,
+                    'calls': calls,
+                    'errors': errors,
+                    'error_rate': round(errors / calls, 3),
+                    'retries': sum(bucket.retries for bucket in live),
+                    'avg_ms': round(sum(bucket.total_latency for bucket in live) / calls * 1000, 1),
+                    'max_ms': round(max(bucket.max_latency for bucket in live) * 1000, 1),
+                    'statuses': dict(statuses),
+                })
+        return sorted(results, key=lambda result: (result['gateway'], result['endpoint']))
+
+    def reset(self):
+        with self._lock:
+            self._recent.clear()
+            self._buckets.clear()
+
+
+# Global tracer instance
+gateway_tracer = GatewayTracer()
+
+
+def _next_retry(gateway, endpoint, provider_id):
+    """Get how many calls to this endpoint failed in a row before this one in the current trace context"""
+    counts = _failure_counts.get()
+    if counts is None:
+        return 0
+    return counts[(gateway, endpoint, provider_id)]
+
+
+def _count_outcome(gateway, endpoint, provider_id, ok):
+    """Track consecutive failures; a success means the next call is not a retry"""
+    counts = _failure_counts.get()
+    if counts is None:
+        return
+    if ok:
+        counts.pop((gateway, endpoint, provider_id), None)
+    else:
+        counts[(gateway, endpoint, provider_id)] += 1
+
+
+def gateway_request(method, url, gateway, endpoint, provider_id=None, **kwargs):
+    """
+    Make a traced HTTP call to a payment gateway.
+
+    Takes the same arguments as requests.request plus the gateway
+    ('daraja' or 'pesapal'), a short endpoint name and the provider the call
+    is made for. Exceptions are recorded and re-raised unchanged.
+    """
+    retry = _next_retry(gateway, endpoint, provider_id)
+    started = time.monotonic()
+    try:
+        response = requests.request(method, url, **kwargs)
+    except Exception as e:
+        gateway_tracer.record(gateway, endpoint, provider_id, time.monotonic() - started, type(e).__name__, False, retry)
+        _count_outcome(gateway, endpoint, provider_id, False)
+        raise
+    gateway_tracer.record(
+        gateway, endpoint, provider_id, time.monotonic() - started, response.status_code, response.ok, retry
+    )
+    _count_outcome(gateway, endpoint, provider_id, response.ok)
+    return response
+
+
+# event loop -> httpx.AsyncClient; a client's connections belong to the loop that opened them
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """Get the pooled async HTTP client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _async_clients[loop] = httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=getattr(settings, 'GATEWAY_ASYNC_MAX_CONNECTIONS', 200),
+            max_keepalive_connections=getattr(settings, 'GATEWAY_ASYNC_MAX_KEEPALIVE', 50)
+        ))
+    return client
+
+
+async def async_gateway_request(method, url, gateway, endpoint, provider_id=None, **kwargs):
+    """
+    Make a traced, non-blocking HTTP call to a payment gateway.
+
+    Takes the same arguments as httpx.AsyncClient.request plus those of
+    gateway_request(), and returns an httpx.Response (which has the same
+    status_code, json() and raise_for_status() as a requests response).
+    """
+    retry = _next_retry(gateway, endpoint, provider_id)
+    started = time.monotonic()
+    try:
+        response = await get_async_client().request(method.upper(), url, **kwargs)
+    except Exception as e:
+        gateway_tracer.record(gateway, endpoint, provider_id, time.monotonic() - started, type(e).__name__, False, retry)
+        _count_outcome(gateway, endpoint, provider_id, False)
+        raise
+    gateway_tracer.record(
+        gateway, endpoint, provider_id, time.monotonic() - started, response.status_code, response.is_success, retry
+    )
+    _count_outcome(gateway, endpoint, provider_id, response.is_success)
+    return response
@@ -6,6 +6,7 @@ urlpatterns = [
     path('create/', views.PaymentCreateView.as_view(), name='create_payment'),
     path('list/', views.PaymentListView.as_view(), name='payment_list'),
     path('status/<uuid:payment_id>/', views.payment_status, name='payment_status'),
+    path('latency/', views.payment_latency, name='payment_latency'),
     path('pesapal/callback/', views.pesapal_callback, name='pesapal_callback'),
     path('pesapal/ipn/', views.pesapal_ipn, name='pesapal_ipn'),
     
@@ -15,4 +16,10 @@ urlpatterns = [
     path('bucket/test-credentials/', bucket_views.test_provider_credentials, name='bucket_test_credentials'),
     path('bucket/callback-url/<int:provider_id>/', bucket_views.get_provider_callback_url, name='bucket_callback_url'),
     path('callback/<int:provider_id>/', bucket_views.mpesa_callback, name='mpesa_callback'),
+    
+    # Paybill (C2B) endpoints
+    path('c2b/<str:token>/validation/', bucket_views.c2b_validation, name='c2b_validation'),
+    path('c2b/<str:token>/confirmation/', bucket_views.c2b_confirmation, name='c2b_confirmation'),
+    path('bucket/register-c2b/', bucket_views.register_c2b_urls, name='bucket_register_c2b'),
+    path('bucket/import-statement/', bucket_views.import_mpesa_statement, name='bucket_import_statement'),
 ]
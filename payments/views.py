@@ -3,9 +3,14 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from django.conf import settings
+from django.utils import timezone
+from datetime import timedelta
 from .models import Payment, PaymentItem
-from .serializers import PaymentSerializer, CreatePaymentSerializer
+from .serializers import PaymentSerializer, PaymentListSerializer, CreatePaymentSerializer
 from .pesapal import PesapalAPI
+from .pesapal_cache import submit_with_recovery
+from .webhooks import record_pesapal_webhook
+from .latency import latency_histograms, GROUP_FIELDS
 from subscriptions.models import ProviderSubscriptionPlan, ProviderSubscription
 import json
 
@@ -24,18 +29,16 @@ class PaymentCreateView(generics.CreateAPIView):
             pesapal = PesapalAPI()
             
             # Get access token
-            token_response = pesapal.get_access_token()
-            if not token_response or 'token' not in token_response:
+            access_token = pesapal.get_access_token()
+            if not access_token:
                 return Response(
                     {'error': 'Failed to get Pesapal access token'}, 
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
             
-            access_token = token_response['token']
-            
-            # Register IPN
-            ipn_response = pesapal.register_ipn(access_token)
-            if not ipn_response:
+            # Reuse the registered IPN ID (registers only on first use or URL change)
+            ipn_id = pesapal.get_ipn_id(access_token)
+            if not ipn_id:
                 return Response(
                     {'error': 'Failed to register IPN'}, 
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -49,7 +52,7 @@ class PaymentCreateView(generics.CreateAPIView):
                 'description': payment.description,
                 'callback_url': settings.PESAPAL_CALLBACK_URL,
                 'cancellation_url': f"{settings.PESAPAL_CALLBACK_URL}?status=cancelled",
-                'notification_id': ipn_response.get('ipn_id'),
+                'notification_id': ipn_id,
                 'billing_address': {
                     'phone_number': request.user.phone_number or '',
                     'email_address': request.user.email,
@@ -66,9 +69,13 @@ class PaymentCreateView(generics.CreateAPIView):
                 }
             }
             
-            # Create Pesapal order
-            order_response = pesapal.create_order(order_data, access_token)
-            if not order_response:
+            # Create Pesapal order, recovering once from a rejected token or IPN ID
+            order_response, ipn_id = submit_with_recovery(
+                pesapal, access_token, ipn_id,
+                lambda token, notification_id: pesapal.create_order(dict(order_data, notification_id=notification_id), token)
+            )
+            
+            if not order_response or order_response.get('error'):
                 return Response(
                     {'error': 'Failed to create Pesapal order'}, 
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
@@ -90,11 +97,11 @@ class PaymentCreateView(generics.CreateAPIView):
 
 class PaymentListView(generics.ListAPIView):
     """List user's payments"""
-    serializer_class = PaymentSerializer
+    serializer_class = PaymentListSerializer
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return Payment.objects.filter(user=self.request.user)
+        return PaymentListSerializer.setup_queryset(Payment.objects.filter(user=self.request.user))
 
 
 @api_view(['GET'])
@@ -105,88 +112,79 @@ def payment_status(request, payment_id):
     return Response(PaymentSerializer(payment).data)
 
 
-@api_view(['POST'])
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def payment_latency(request):
+    """Payment-to-ticket latency histograms; super admins see all providers, providers their own"""
+    try:
+        hours = min(max(int(request.query_params.get('hours', 24)), 1), 24 * 31)
+    except ValueError:
+        return Response({'error': 'hours must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+    group_by = request.query_params.get('group_by', 'provider')
+    if group_by not in GROUP_FIELDS:
+        return Response({'error': f"group_by must be one of {', '.join(GROUP_FIELDS)}"}, status=status.HTTP_400_BAD_REQUEST)
+    
+    if request.user.is_superuser or request.user.is_super_admin_user():
+        provider_id = request.query_params.get('provider_id')
+    else:
+        provider = getattr(request.user, 'provider_profile', None)
+        if not provider:
+            return Response({'error': 'Provider profile not found'}, status=status.HTTP_403_FORBIDDEN)
+        provider_id = provider.id
+    
+    since = timezone.now() - timedelta(hours=hours)
+    return Response({
+        'hours': hours,
+        'group_by': group_by,
+        **latency_histograms(since, group_by=group_by, provider_id=provider_id),
+    })
+
+
+@api_view(['GET', 'POST'])
 @permission_classes([permissions.AllowAny])
 def pesapal_callback(request):
-    """Handle Pesapal payment callback"""
+    """Handle Pesapal payment callback (customer redirect)"""
     order_tracking_id = request.GET.get('OrderTrackingId')
     merchant_reference = request.GET.get('OrderMerchantReference')
-    payment_reference = request.GET.get('OrderNotificationType')
     
     if not all([order_tracking_id, merchant_reference]):
         return Response({'error': 'Missing required parameters'}, status=status.HTTP_400_BAD_REQUEST)
     
-    try:
-        payment = Payment.objects.get(
-            pesapal_order_tracking_id=order_tracking_id,
-            pesapal_merchant_reference=merchant_reference
-        )
-    except Payment.DoesNotExist:
-        return Response({'error': 'Payment not found'}, status=status.HTTP_404_NOT_FOUND)
-    
-    # Initialize Pesapal API to verify payment
-    pesapal = PesapalAPI()
-    token_response = pesapal.get_access_token()
+    # Verification and fulfilment happen in the webhook workers
+    payload = request.GET.dict()
+    record_pesapal_webhook(payload)
     
-    if token_response and 'token' in token_response:
-        access_token = token_response['token']
-        status_response = pesapal.get_order_status(order_tracking_id, access_token)
-        
-        if status_response and status_response.get('payment_status') == 'COMPLETED':
-            # Update payment status
-            payment.status = 'completed'
-            payment.pesapal_payment_reference = payment_reference
-            payment.completed_at = timezone.now()
-            payment.save()
-            
-            # Create or update subscription
-            from subscriptions.views import create_subscription
-            subscription_data = {
-                'plan_id': payment.items.first().name  # This should be the plan ID
-            }
-            
-            # You might want to call the subscription creation logic here
-            # For now, we'll just return success
-            
-            return Response({'status': 'success', 'message': 'Payment completed'})
+    payment = Payment.objects.filter(
+        pesapal_order_tracking_id=order_tracking_id,
+        pesapal_merchant_reference=merchant_reference
+    ).only('id', 'status').first()
+    if not payment:
+        return Response({'error': 'Payment not found'}, status=status.HTTP_404_NOT_FOUND)
     
+    if payment.status == 'completed':
+        return Response({'status': 'success', 'message': 'Payment completed'})
     return Response({'status': 'pending', 'message': 'Payment still processing'})
 
 
-@api_view(['POST'])
+@api_view(['GET', 'POST'])
 @permission_classes([permissions.AllowAny])
 def pesapal_ipn(request):
     """Handle Pesapal IPN (Instant Payment Notification)"""
-    # This is where Pesapal sends server-to-server notifications
-    # You should verify the signature and update payment status accordingly
-    
-    data = request.data
+    # The IPN is stored and acknowledged; workers confirm the status with Pesapal
+    data = request.data.dict() if hasattr(request.data, 'dict') else dict(request.data)
+    data = data or request.query_params.dict()
     order_tracking_id = data.get('OrderTrackingId')
     merchant_reference = data.get('OrderMerchantReference')
-    payment_status = data.get('PaymentStatus')
+    notification_type = data.get('OrderNotificationType', 'IPNCHANGE')
     
-    if not all([order_tracking_id, merchant_reference, payment_status]):
+    if not all([order_tracking_id, merchant_reference]):
         return Response({'error': 'Missing required parameters'}, status=status.HTTP_400_BAD_REQUEST)
     
-    try:
-        payment = Payment.objects.get(
-            pesapal_order_tracking_id=order_tracking_id,
-            pesapal_merchant_reference=merchant_reference
-        )
-    except Payment.DoesNotExist:
-        return Response({'error': 'Payment not found'}, status=status.HTTP_404_NOT_FOUND)
-    
-    # Update payment status based on Pesapal notification
-    if payment_status == 'COMPLETED':
-        payment.status = 'completed'
-        payment.completed_at = timezone.now()
-        payment.save()
-        
-        # Create subscription
-        # You'll need to implement this logic based on your requirements
-        
-    elif payment_status == 'FAILED':
-        payment.status = 'failed'
-        payment.save()
+    record_pesapal_webhook(data)
     
-    return Response({'status': 'success'})
+    return Response({
+        'orderNotificationType': notification_type,
+        'orderTrackingId': order_tracking_id,
+        'orderMerchantReference': merchant_reference,
+        'status': 200
+    })
@@ -0,0 +1,294 @@
+"""
+Durable inbox for M-PESA and Pesapal callbacks
+
+Callback views only append the raw payload to WebhookEvent and acknowledge;
+a duplicate delivery hits the unique dedup key and is ignored. Workers drain
+the inbox in batches (process_webhooks command / process_webhook_inbox task),
+retrying failures with exponential backoff and moving events that keep
+failing, or can never succeed, to the dead-letter state.
+"""
+from datetime import timedelta
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, Q
+from django.utils import timezone
+
+from .models import Payment, WebhookEvent
+from .fulfilment import complete_payment
+from .latency import record_stage, record_mpesa_callback
+from .tracing import trace_context
+from .reconciliation import interpret_pesapal_result, COMPLETED, FAILED, CANCELLED
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookPayloadError(Exception):
+    """A webhook that can never be processed; it goes straight to dead letter"""
+
+
+class WebhookRetry(Exception):
+    """The upstream state is not final yet; try the event again later"""
+
+
+def _payload_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def mpesa_dedup_key(provider_id, payload):
+    """Get the dedup key for a Daraja STK callback"""
+    stk_callback = payload.get('Body', {}).get('stkCallback', {}) if isinstance(payload, dict) else {}
+    checkout_request_id = stk_callback.get('CheckoutRequestID')
+    if checkout_request_id:
+        return f"mpesa_stk:{provider_id}:{checkout_request_id}"
+    return f"mpesa_stk:{provider_id}:{_payload_hash(payload)}"
+
+
+def pesapal_dedup_key(payload):
+    """Get the dedup key for a Pesapal IPN, callback or webhook"""
+    tracking_id = payload.get('OrderTrackingId') or payload.get('order_tracking_id')
+    if tracking_id:
+        notification_type = payload.get('OrderNotificationType') or 'CALLBACK'
+        payment_status = str(payload.get('payment_status') or payload.get('PaymentStatus') or '').upper()
+        return f"pesapal:{tracking_id}:{notification_type}" + (f":{payment_status}" if payment_status else '')
+    return f"pesapal:{_payload_hash(payload)}"
+
+
+def record_webhook(source, payload, dedup_key, provider_id=None):
+    """
+    Append a callback to the inbox.
+
+    This is a single INSERT ... ON CONFLICT DO NOTHING, so redelivered
+    callbacks are dropped without raising and without extra queries.
+    """
+    WebhookEvent.objects.bulk_create(
+        [WebhookEvent(source=source, dedup_key=dedup_key[:255], provider_id=provider_id, payload=payload)],
+        ignore_conflicts=True
+    )
+    return dedup_key
+
+
+def record_pesapal_webhook(payload):
+    """
+    Append a Pesapal notification to the inbox.
+
+    Pesapal IPNs carry no status, so a notification about a later status
+    change has the same dedup key as the first one. If that first event was
+    dead-lettered, or processed while its payment is still pending, it is
+    queued again so the new notification is not lost.
+    """
+    dedup_key = record_webhook('pesapal', payload, pesapal_dedup_key(payload))
+    tracking_id = payload.get('OrderTrackingId') or payload.get('order_tracking_id')
+    order_pending = Exists(Payment.objects.filter(pesapal_order_tracking_id=tracking_id, status='pending'))
+    WebhookEvent.objects.filter(
+        Q(status='dead') | Q(status='processed') & order_pending,
+        dedup_key=dedup_key[:255]
+    ).update(status='pending', attempts=0, next_attempt_at=timezone.now(), last_error='')
+    return dedup_key
+
+
+def process_mpesa_event(event):
+    """Apply a Daraja STK callback"""
+    from .payment_bucket import payment_bucket_service
+
+    if not event.provider_id:
+        raise WebhookPayloadError("M-PESA callback has no provider")
+
+    stk_callback = event.payload.get('Body', {}).get('stkCallback', {}) if isinstance(event.payload, dict) else {}
+    record_mpesa_callback(event.provider_id, stk_callback.get('CheckoutRequestID'), event.received_at)
+
+    result = payment_bucket_service.handle_mpesa_callback(event.provider_id, event.payload)
+    if result.get('error'):
+        raise Exception(result['error'])
+    return {
+        'success': result.get('success'),
+        'checkout_request_id': result.get('checkout_request_id'),
+        'ticket_code': result.get('ticket_code'),
+    }
+
+
+def process_pesapal_event(event):
+    """Apply a Pesapal notification by checking the order's status with Pesapal"""
+    from .pesapal import PesapalAPI
+
+    payload = event.payload
+    tracking_id = payload.get('OrderTrackingId') or payload.get('order_tracking_id')
+    if not tracking_id:
+        raise WebhookPayloadError("Pesapal notification has no order tracking ID")
+
+    payment = Payment.objects.filter(pesapal_order_tracking_id=tracking_id).only('id', 'status').first()
+    if not payment:
+        return _process_pesapal_subscription_event(payload, tracking_id)
+    record_stage(payment.id, 'callback_received', event.received_at)
+    if payment.status == 'completed':
+        return {'payment_id': str(payment.id), 'status': 'completed'}
+
+    pesapal = PesapalAPI()
+    access_token = pesapal.get_access_token()
+    if not access_token:
+        raise Exception("Failed to get Pesapal access token")
+
+    status_response = pesapal.get_order_status(tracking_id, access_token)
+    if not status_response:
+        raise Exception(f"Failed to get Pesapal status for {tracking_id}")
+
+    outcome = interpret_pesapal_result(status_response)
+    if outcome == COMPLETED:
+        complete_payment(payment.id, payment_reference=status_response.get('confirmation_code'))
+    elif outcome in (FAILED, CANCELLED):
+        Payment.objects.filter(id=payment.id, status='pending').update(status=outcome, updated_at=timezone.now())
+    else:
+        raise WebhookRetry(f"Pesapal order {tracking_id} is still pending")
+
+    return {'payment_id': str(payment.id), 'status': outcome}
+
+
+def _process_pesapal_subscription_event(payload, tracking_id):
+    """Fall back to the provider subscription flow for orders without a Payment row"""
+    from .pesapal_provider import ProviderSubscriptionService
+
+    service = ProviderSubscriptionService()
+    payment_status = payload.get('payment_status') or payload.get('PaymentStatus') or ''
+    if not payment_status:
+        # Redirect callbacks carry no status; ask Pesapal instead of assuming success
+        access_token = service.pesapal.get_access_token()
+        status_response = service.pesapal.get_transaction_status(access_token, tracking_id) if access_token else None
+        if not status_response:
+            raise Exception(f"Failed to get Pesapal status for {tracking_id}")
+        payment_status = (status_response.get('payment_status_description') or '').upper()
+        if payment_status not in ('COMPLETED', 'FAILED'):
+            raise WebhookRetry(f"Pesapal order {tracking_id} is still pending")
+
+    success, message = service.handle_pesapal_webhook({
+        'order_tracking_id': tracking_id,
+        'payment_status': payment_status,
+        'payment_method': payload.get('payment_method') or payload.get('PaymentMethod'),
+        'payment_account': payload.get('payment_account') or payload.get('PaymentAccount'),
+    })
+    if not success and payment_status.upper() != 'FAILED':
+        raise Exception(message)
+    return {'order_tracking_id': tracking_id, 'message': message}
+
+
+WEBHOOK_HANDLERS = {
+    'mpesa_stk': process_mpesa_event,
+    'pesapal': process_pesapal_event,
+}
+
+
+class WebhookProcessor:
+    """Drain the webhook inbox in batches"""
+
+    def __init__(self, batch_size=None, max_attempts=None, retry_base_seconds=None,
+                 retry_max_seconds=None, lock_timeout_seconds=None):
+        self.batch_size = batch_size or getattr(settings, 'WEBHOOK_BATCH_SIZE', 50)
+        self.max_attempts = max_attempts or getattr(settings, 'WEBHOOK_MAX_ATTEMPTS', 8)
+        self.retry_base_seconds = retry_base_seconds or getattr(settings, 'WEBHOOK_RETRY_BASE_SECONDS', 15)
+        self.retry_max_seconds = retry_max_seconds or getattr(settings, 'WEBHOOK_RETRY_MAX_SECONDS', 3600)
+        self.lock_timeout_seconds = lock_timeout_seconds or getattr(settings, 'WEBHOOK_LOCK_TIMEOUT_SECONDS', 300)
+
+    def claim_batch(self):
+        """Lock the next batch of due events for this worker"""
+        now = timezone.now()
+        with transaction.atomic():
+            due = WebhookEvent.objects.select_for_update(skip_locked=True).filter(
+                status__in=['pending', 'failed'],
+                next_attempt_at__lte=now
+            ).order_by('id')[:self.batch_size]
+            event_ids = list(due.values_list('id', flat=True))
+
+            # Events left in processing by a crashed worker are picked up again
+            stale_ids = list(
+                WebhookEvent.objects.select_for_update(skip_locked=True).filter(
+                    status='processing',
+                    locked_at__lt=now - timedelta(seconds=self.lock_timeout_seconds)
+                ).order_by('id').values_list('id', flat=True)[:self.batch_size]
+            )
+            event_ids += stale_ids
+
+            if not event_ids:
+                return []
+            WebhookEvent.objects.filter(id__in=event_ids).update(status='processing', locked_at=now)
+
+        return list(WebhookEvent.objects.filter(id__in=event_ids).order_by('id'))
+
+    def run(self, max_batches=None):
+        """Process due events until the inbox is drained and return a summary"""
+        summary = {'processed': 0, 'retried': 0, 'dead': 0}
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            events = self.claim_batch()
+            if not events:
+                break
+            batches += 1
+            for key, value in self.process_batch(events).items():
+                summary[key] += value
+
+        if any(summary.values()):
+            logger.info(f"Webhook inbox drained: {summary}")
+        return summary
+
+    def process_batch(self, events):
+        summary = {'processed': 0, 'retried': 0, 'dead': 0}
+        processed_ids = []
+
+        for event in events:
+            handler = WEBHOOK_HANDLERS.get(event.source)
+            try:
+                if not handler:
+                    raise WebhookPayloadError(f"No handler for webhook source {event.source}")
+                with trace_context(f"webhook:{event.id}"):
+                    result = handler(event)
+            except WebhookPayloadError as e:
+                self._fail(event, e, dead=True)
+                summary['dead'] += 1
+            except Exception as e:
+                dead = self._fail(event, e)
+                summary['dead' if dead else 'retried'] += 1
+            else:
+                if result:
+                    WebhookEvent.objects.filter(id=event.id).update(result=result)
+                processed_ids.append(event.id)
+                summary['processed'] += 1
+
+        if processed_ids:
+            WebhookEvent.objects.filter(id__in=processed_ids).update(
+                status='processed',
+                processed_at=timezone.now(),
+                locked_at=None,
+                last_error=''
+            )
+        return summary
+
+    def _fail(self, event, error, dead=False):
+        """Schedule a retry for a failed event, or dead-letter it; returns True if dead"""
+        attempts = event.attempts + 1
+        dead = dead or attempts >= self.max_attempts
+        delay = min(self.retry_base_seconds * (2 ** (attempts - 1)), self.retry_max_seconds)
+
+        if dead:
+            logger.error(f"Webhook {event.dedup_key} dead-lettered after {attempts} attempts: {error}")
+        elif not isinstance(error, WebhookRetry):
+            logger.warning(f"Webhook {event.dedup_key} failed (attempt {attempts}): {error}")
+
+        WebhookEvent.objects.filter(id=event.id).update(
+            status='dead' if dead else 'failed',
+            attempts=attempts,
+            next_attempt_at=timezone.now() + timedelta(seconds=delay),
+            locked_at=None,
+            last_error=str(error)[:2000]
+        )
+        return dead
+
+
+def requeue_dead_events(queryset):
+    """Send dead-lettered events back to the inbox for another round of attempts"""
+    return queryset.filter(status='dead').update(
+        status='pending',
+        attempts=0,
+        next_attempt_at=timezone.now(),
+        last_error=''
+    )
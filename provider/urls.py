@@ -12,6 +12,7 @@ urlpatterns = [
     path('tickets/', views.ticket_management, name='ticket_management'),
     path('tickets/generate/', views.generate_tickets, name='generate_tickets'),
     path('tickets/view/', views.view_tickets, name='view_tickets'),
+    path('tickets/export/', views.export_tickets_script, name='export_tickets_script'),
     
     # Analytics
     path('analytics/', views.sales_analytics, name='analytics'),
@@ -34,4 +35,5 @@ urlpatterns = [
     
     # API Endpoints
     path('api/stats/', views.api_provider_stats, name='api_provider_stats'),
+    path('api/statement/', views.api_provider_statement, name='api_provider_statement'),
 ]
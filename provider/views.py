@@ -1,7 +1,7 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse
 from django.db.models import Count, Sum, Q
 from django.utils import timezone
 from datetime import datetime, timedelta
@@ -14,7 +14,11 @@ from accounts.models import User, Provider, EndUser
 from tickets.models import Ticket, TicketSale, TicketType
 from subscriptions.models import ProviderSubscription, ProviderSubscriptionPlan
 from payments.models import Payment
+from payments.ledger import ACCOUNT_KINDS, get_balances, get_sales_total, get_statement
 from config_generator.models import GeneratedConfig
+from config_generator.blobs import config_download_response
+from config_generator.mikrotik_generator import MikroTikConfigGenerator
+from hotspot_config.streaming import streaming_response
 
 
 def is_provider(user):
@@ -46,9 +50,8 @@ def provider_dashboard(request):
     
     # Sales statistics
     total_sales = TicketSale.objects.filter(provider=provider).count()
-    total_revenue = TicketSale.objects.filter(provider=provider).aggregate(
-        total=Sum('total_amount')
-    )['total'] or 0
+    total_revenue = get_sales_total(provider.id)
+    balance = get_balances(provider.id)['provider']
     
     # Monthly statistics
     month_start = timezone.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -60,12 +63,7 @@ def provider_dashboard(request):
         provider=provider,
         sold_at__gte=month_start
     ).count()
-    monthly_revenue = TicketSale.objects.filter(
-        provider=provider,
-        sold_at__gte=month_start
-    ).aggregate(
-        total=Sum('total_amount')
-    )['total'] or 0
+    monthly_revenue = get_sales_total(provider.id, start=month_start)
     
     # Recent activity
     recent_tickets = Ticket.objects.filter(provider=provider).order_by('-created_at')[:10]
@@ -88,6 +86,7 @@ def provider_dashboard(request):
         'expired_tickets': expired_tickets,
         'total_sales': total_sales,
         'total_revenue': total_revenue,
+        'balance': balance,
         'monthly_tickets': monthly_tickets,
         'monthly_sales': monthly_sales,
         'monthly_revenue': monthly_revenue,
@@ -101,19 +100,8 @@ def provider_dashboard(request):
     return render(request, 'provider/dashboard.html', context)
 
 
-@login_required
-@user_passes_test(is_provider)
-def ticket_management(request):
-    """Ticket management page"""
-    try:
-        provider = request.user.provider_profile
-    except Provider.DoesNotExist:
-        messages.error(request, 'Provider profile not found.')
-        return redirect('accounts:login')
-    
-    # Get tickets with filters
-    tickets = Ticket.objects.filter(provider=provider).order_by('-created_at')
-    
+def _filter_tickets(request, tickets):
+    """Apply the status, ticket type and search filters from the query string"""
     # Filter by status
     status_filter = request.GET.get('status')
     if status_filter:
@@ -132,6 +120,24 @@ def ticket_management(request):
             Q(username__icontains=search)
         )
     
+    return tickets, status_filter, type_filter, search
+
+
+@login_required
+@user_passes_test(is_provider)
+def ticket_management(request):
+    """Ticket management page"""
+    try:
+        provider = request.user.provider_profile
+    except Provider.DoesNotExist:
+        messages.error(request, 'Provider profile not found.')
+        return redirect('accounts:login')
+    
+    # Get tickets with filters
+    tickets = Ticket.objects.filter(provider=provider).order_by('-created_at')
+    
+    tickets, status_filter, type_filter, search = _filter_tickets(request, tickets)
+    
     # Get ticket types for filter
     ticket_types = TicketType.objects.filter(provider=provider, is_active=True)
     
@@ -255,22 +261,20 @@ def sales_analytics(request):
     ).order_by('-revenue')
     
     # Monthly comparison
-    current_month = TicketSale.objects.filter(
-        provider=provider,
-        sold_at__date__gte=end_date.replace(day=1)
-    ).aggregate(
-        sales_count=Count('id'),
-        revenue=Sum('total_amount')
-    )
-    
-    previous_month = TicketSale.objects.filter(
-        provider=provider,
-        sold_at__date__gte=(end_date.replace(day=1) - timedelta(days=1)).replace(day=1),
-        sold_at__date__lt=end_date.replace(day=1)
-    ).aggregate(
-        sales_count=Count('id'),
-        revenue=Sum('total_amount')
-    )
+    month_start = timezone.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    previous_month_start = (month_start - timedelta(days=1)).replace(day=1)
+    current_month = {
+        'sales_count': TicketSale.objects.filter(provider=provider, sold_at__gte=month_start).count(),
+        'revenue': get_sales_total(provider.id, start=month_start),
+    }
+    previous_month = {
+        'sales_count': TicketSale.objects.filter(
+            provider=provider,
+            sold_at__gte=previous_month_start,
+            sold_at__lt=month_start
+        ).count(),
+        'revenue': get_sales_total(provider.id, start=previous_month_start, end=month_start),
+    }
     
     context = {
         'page_title': 'Sales Analytics',
@@ -370,20 +374,58 @@ def api_provider_stats(request):
         'total_tickets': Ticket.objects.filter(provider=provider).count(),
         'active_tickets': Ticket.objects.filter(provider=provider, status='active').count(),
         'total_sales': TicketSale.objects.filter(provider=provider).count(),
-        'total_revenue': TicketSale.objects.filter(provider=provider).aggregate(
-            total=Sum('total_amount')
-        )['total'] or 0,
-        'monthly_revenue': TicketSale.objects.filter(
-            provider=provider,
-            sold_at__gte=timezone.now() - timedelta(days=30)
-        ).aggregate(
-            total=Sum('total_amount')
-        )['total'] or 0,
+        'total_revenue': get_sales_total(provider.id),
+        'monthly_revenue': get_sales_total(provider.id, start=timezone.now() - timedelta(days=30)),
+        'balances': get_balances(provider.id),
     }
     
     return Response(stats)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def api_provider_statement(request):
+    """API endpoint for the provider's ledger statement over ?start=&end= (ISO dates)"""
+    if not is_provider(request.user):
+        return Response({'error': 'Unauthorized'}, status=status.HTTP_403_FORBIDDEN)
+    
+    try:
+        provider = request.user.provider_profile
+    except Provider.DoesNotExist:
+        return Response({'error': 'Provider profile not found'}, status=status.HTTP_404_NOT_FOUND)
+    
+    kind = request.GET.get('account', 'provider')
+    if kind not in ACCOUNT_KINDS:
+        return Response({'error': f'Unknown account {kind}'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    try:
+        start, end = (
+            timezone.make_aware(datetime.strptime(request.GET[key], '%Y-%m-%d')) if request.GET.get(key) else None
+            for key in ('start', 'end')
+        )
+    except ValueError:
+        return Response({'error': 'Dates must be YYYY-MM-DD'}, status=status.HTTP_400_BAD_REQUEST)
+    
+    statement = get_statement(provider.id, kind, start=start, end=end)
+    return Response({
+        'account': kind,
+        'opening_balance': statement['opening_balance'],
+        'closing_balance': statement['closing_balance'],
+        'entries': [
+            {
+                'occurred_at': entry.occurred_at,
+                'entry_type': entry.entry_type,
+                'reference': entry.reference,
+                'description': entry.description,
+                'debit': entry.debit,
+                'credit': entry.credit,
+                'balance_after': entry.balance_after,
+            }
+            for entry in statement['entries']
+        ],
+    })
+
+
 @login_required
 @user_passes_test(is_provider)
 def view_tickets(request):
@@ -397,23 +439,7 @@ def view_tickets(request):
     # Get tickets with filters
     tickets = Ticket.objects.filter(provider=provider).order_by('-created_at')
     
-    # Filter by status
-    status_filter = request.GET.get('status')
-    if status_filter:
-        tickets = tickets.filter(status=status_filter)
-    
-    # Filter by ticket type
-    type_filter = request.GET.get('type')
-    if type_filter:
-        tickets = tickets.filter(ticket_type_id=type_filter)
-    
-    # Search
-    search = request.GET.get('search')
-    if search:
-        tickets = tickets.filter(
-            Q(code__icontains=search) |
-            Q(username__icontains=search)
-        )
+    tickets, status_filter, type_filter, search = _filter_tickets(request, tickets)
     
     # Get ticket types for filter
     ticket_types = TicketType.objects.filter(provider=provider, is_active=True)
@@ -430,6 +456,31 @@ def view_tickets(request):
     return render(request, 'provider/view_tickets.html', context)
 
 
+@login_required
+@user_passes_test(is_provider)
+def export_tickets_script(request):
+    """Stream one RouterOS import script adding (or removing) the filtered tickets"""
+    try:
+        provider = request.user.provider_profile
+    except Provider.DoesNotExist:
+        messages.error(request, 'Provider profile not found.')
+        return redirect('accounts:login')
+    
+    tickets, _, _, _ = _filter_tickets(request, Ticket.objects.filter(provider=provider))
+    remove = request.GET.get('action') == 'remove'
+    # Only the columns the script needs, fetched in chunks as the response is sent
+    rows = tickets.order_by('created_at').values_list(
+        'code', 'username', 'password', 'ticket_type_id', named=True
+    ).iterator(chunk_size=2000)
+    
+    script = MikroTikConfigGenerator(provider).generate_bulk_user_script(rows, total=tickets.count(), remove=remove)
+    response = streaming_response(request, script, content_type='text/plain; charset=utf-8')
+    response['Content-Disposition'] = (
+        f'attachment; filename="hotspot_users_{"remove" if remove else "add"}_{timezone.now().strftime("%Y%m%d_%H%M%S")}.rsc"'
+    )
+    return response
+
+
 @login_required
 @user_passes_test(is_provider)
 def download_config(request):
@@ -447,8 +498,7 @@ def download_config(request):
         messages.error(request, 'No configuration found. Please generate a configuration first.')
         return redirect('provider:dashboard')
     
-    # Create HTTP response with the config file
-    response = HttpResponse(config.config_content, content_type='text/plain')
-    response['Content-Disposition'] = f'attachment; filename="mikrotik_config_{provider.business_name}_{timezone.now().strftime("%Y%m%d")}.rsc"'
-    
-    return response
+    # Stream the config file (gzip-encoded as stored if the client accepts it)
+    return config_download_response(
+        request, config, f'mikrotik_config_{provider.business_name}_{timezone.now().strftime("%Y%m%d")}.rsc'
+    )
@@ -0,0 +1,20 @@
+from django.contrib import admin
+from .models import Router, TicketRouterSync
+
+
+@admin.register(Router)
+class RouterAdmin(admin.ModelAdmin):
+    list_display = ('name', 'provider', 'host', 'api_port', 'is_active', 'last_sync_at')
+    list_filter = ('is_active',)
+    search_fields = ('name', 'host', 'provider__business_name')
+    readonly_fields = ('last_sync_at', 'last_error', 'created_at', 'updated_at')
+    exclude = ('password',)
+
+
+@admin.register(TicketRouterSync)
+class TicketRouterSyncAdmin(admin.ModelAdmin):
+    list_display = ('ticket', 'router', 'state', 'attempts', 'synced_at', 'updated_at')
+    list_filter = ('state', 'router')
+    search_fields = ('ticket__code', 'ticket__username', 'router__name')
+    raw_id_fields = ('ticket',)
+    readonly_fields = ('router_item_id', 'last_error', 'synced_at', 'updated_at')
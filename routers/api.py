@@ -0,0 +1,256 @@
+"""
+RouterOS API client (the binary protocol on port 8728)
+
+A sentence is a sequence of length-prefixed words ending with an empty word.
+Commands are sent as "/ip/hotspot/user/add" followed by "=key=value"
+attribute words; replies are "!re" (one per result row), "!trap" (an
+error) and "!done" (end of the reply, possibly with "=ret=" holding the new
+item's .id). A ".tag=" word is echoed back in every reply sentence, so many
+commands can be written before reading any reply, and the replies are
+matched up by tag (pipelining).
+
+Connections are authenticated once and kept in a per-router pool, so a
+sync run does not pay for a TCP handshake and login per ticket.
+"""
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import socket
+import threading
+import time
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RouterOSError(Exception):
+    """The router could not be reached or broke the protocol"""
+
+
+class RouterOSTrap(RouterOSError):
+    """The router rejected a command"""
+
+    def __init__(self, message, category=None):
+        super().__init__(message)
+        self.category = category
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes((length,))
+    if length < 0x4000:
+        return (length | 0x8000).to_bytes(2, 'big')
+    if length < 0x200000:
+        return (length | 0xC00000).to_bytes(3, 'big')
+    if length < 0x10000000:
+        return (length | 0xE0000000).to_bytes(4, 'big')
+    return b'\xf0' + length.to_bytes(4, 'big')
+
+
+def encode_sentence(words):
+    data = bytearray()
+    for word in words:
+        encoded = word.encode('utf-8')
+        data += encode_length(len(encoded))
+        data += encoded
+    data += b'\x00'
+    return bytes(data)
+
+
+def command_words(command, attributes=None, queries=None, tag=None):
+    """Build the words of a command sentence"""
+    words = [command]
+    words.extend(f"={key}={value}" for key, value in (attributes or {}).items())
+    words.extend(f"?{key}={value}" for key, value in (queries or {}).items())
+    if tag is not None:
+        words.append(f".tag={tag}")
+    return words
+
+
+def parse_reply(words):
+    """Split a reply sentence into (type, attributes, tag)"""
+    attributes = {}
+    tag = None
+    for word in words[1:]:
+        if word.startswith('.tag='):
+            tag = word[5:]
+        elif word.startswith('='):
+            key, _, value = word[1:].partition('=')
+            attributes[key] = value
+    return words[0], attributes, tag
+
+
+class SentenceReader:
+    """Read sentences from a socket through a buffer"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def _read(self, size):
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(max(65536, size - len(self.buffer)))
+            if not chunk:
+                raise RouterOSError('Connection closed by router')
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _read_length(self):
+        first = self._read(1)[0]
+        if first < 0x80:
+            return first
+        if first < 0xC0:
+            return ((first & 0x3F) << 8) | self._read(1)[0]
+        if first < 0xE0:
+            return ((first & 0x1F) << 16) | int.from_bytes(self._read(2), 'big')
+        if first < 0xF0:
+            return ((first & 0x0F) << 24) | int.from_bytes(self._read(3), 'big')
+        return int.from_bytes(self._read(4), 'big')
+
+    def read_sentence(self):
+        words = []
+        while True:
+            length = self._read_length()
+            if length == 0:
+                return words
+            words.append(self._read(length).decode('utf-8', errors='replace'))
+
+
+class RouterOSConnection:
+    """An authenticated API session with one router"""
+
+    def __init__(self, host, port, username, password, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout or getattr(settings, 'ROUTEROS_API_TIMEOUT', 10)
+        try:
+            self.sock = socket.create_connection((host, port), timeout=self.timeout)
+        except OSError as e:
+            raise RouterOSError(f"Cannot connect to {host}:{port}: {e}")
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = SentenceReader(self.sock)
+        self.last_used = time.monotonic()
+        self._next_tag = 0
+        try:
+            self.talk('/login', {'name': username, 'password': password})
+        except RouterOSError:
+            self.close()
+            raise
+
+    def _send(self, words):
+        try:
+            self.sock.sendall(encode_sentence(words))
+        except OSError as e:
+            raise RouterOSError(f"Send to {self.host} failed: {e}")
+
+    def _read_reply(self):
+        try:
+            return parse_reply(self.reader.read_sentence())
+        except OSError as e:
+            raise RouterOSError(f"Read from {self.host} failed: {e}")
+
+    def talk(self, command, attributes=None, queries=None):
+        """Run one command; returns (rows, done attributes) or raises RouterOSTrap"""
+        results = self.pipeline([(command, attributes, queries)])
+        result = results[0]
+        if isinstance(result, RouterOSTrap):
+            raise result
+        return result
+
+    def pipeline(self, commands):
+        """
+        Run many commands with one round trip's worth of waiting.
+
+        Takes (command, attributes, queries) tuples and returns, in the same
+        order, (rows, done attributes) for each command that succeeded or the
+        RouterOSTrap for each one the router rejected.
+        """
+        tags = []
+        for command, attributes, queries in commands:
+            tag = str(self._next_tag)
+            self._next_tag += 1
+            tags.append(tag)
+            self._send(command_words(command, attributes, queries, tag))
+
+        rows = defaultdict(list)
+        traps = {}
+        results = {}
+        while len(results) < len(tags):
+            reply, attributes, tag = self._read_reply()
+            if reply == '!re':
+                rows[tag].append(attributes)
+            elif reply == '!trap':
+                traps[tag] = RouterOSTrap(attributes.get('message', 'Command failed'), attributes.get('category'))
+            elif reply == '!done':
+                results[tag] = traps.pop(tag, None) or (rows.pop(tag, []), attributes)
+            elif reply == '!fatal':
+                raise RouterOSError(f"Router closed the session: {attributes or reply}")
+        self.last_used = time.monotonic()
+        return [results[tag] for tag in tags]
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class RouterConnectionPool:
+    """Idle authenticated connections, per router"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (host, port, username) -> deque of idle connections
+        self._idle = defaultdict(deque)
+
+    @contextmanager
+    def connection(self, router):
+        """Borrow a connection to a Router; broken connections are not returned to the pool"""
+        key = (router.host, router.api_port, router.username)
+        conn = self._take(key)
+        if conn is None:
+            conn = RouterOSConnection(router.host, router.api_port, router.username, router.get_password())
+        try:
+            yield conn
+        except RouterOSTrap:
+            self._put(key, conn)
+            raise
+        except BaseException:
+            conn.close()
+            raise
+        else:
+            self._put(key, conn)
+
+    def _take(self, key):
+        max_idle = getattr(settings, 'ROUTEROS_POOL_IDLE_SECONDS', 300)
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                conn = idle.pop()
+                if now - conn.last_used < max_idle:
+                    return conn
+                conn.close()
+        return None
+
+    def _put(self, key, conn):
+        with self._lock:
+            idle = self._idle[key]
+            if len(idle) < getattr(settings, 'ROUTEROS_POOL_SIZE', 2):
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            for idle in self._idle.values():
+                while idle:
+                    idle.pop().close()
+            self._idle.clear()
+
+
+# Global connection pool
+router_pool = RouterConnectionPool()
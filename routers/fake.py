@@ -0,0 +1,134 @@
+"""
+In-process fake RouterOS API server for tests and local benchmarks
+
+Speaks enough of the API protocol for the sync engine: /login and the
+/ip/hotspot/user add, remove and print commands, with tags echoed back so
+pipelined commands work. Hotspot users are kept in memory; adding a
+duplicate name or removing an unknown .id traps the way RouterOS does.
+
+latency simulates the network round trip to a remote router: replies to
+everything the client has sent so far are held back that long, then sent
+together.
+"""
+import socket
+import socketserver
+import threading
+import time
+import logging
+
+from .api import SentenceReader, encode_sentence, parse_reply
+
+logger = logging.getLogger(__name__)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server.fake
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = SentenceReader(self.request)
+        logged_in = False
+        pending = []
+        while True:
+            try:
+                words = reader.read_sentence()
+            except Exception:
+                return
+            if not words:
+                continue
+            command = words[0]
+            _, attributes, tag = parse_reply(words)
+            queries = dict(word[1:].split('=', 1) for word in words[1:] if word.startswith('?') and '=' in word)
+            replies = []
+            if command == '/login':
+                if attributes.get('name') == server.username and attributes.get('password') == server.password:
+                    logged_in = True
+                    with server._lock:
+                        server.logins += 1
+                    replies.append(['!done'])
+                else:
+                    replies.append(['!trap', '=message=invalid user name or password (6)'])
+                    replies.append(['!done'])
+            elif not logged_in:
+                replies.append(['!fatal', 'not logged in'])
+            else:
+                replies.extend(server.run(command, attributes, queries))
+            pending.extend(encode_sentence(reply + ([f'.tag={tag}'] if tag is not None else [])) for reply in replies)
+            fatal = replies and replies[0][0] == '!fatal'
+            if not reader.buffer or fatal:
+                # Everything received so far is answered in one round trip
+                if server.latency:
+                    time.sleep(server.latency)
+                self.request.sendall(b''.join(pending))
+                pending = []
+            if fatal:
+                return
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeRouterOSServer:
+    """A RouterOS API server on localhost with in-memory hotspot users"""
+
+    def __init__(self, username='admin', password='secret', port=0, latency=0):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.users = {}  # .id -> attributes
+        self._names = {}  # name -> .id
+        self.commands = 0
+        self.logins = 0
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def run(self, command, attributes, queries):
+        with self._lock:
+            self.commands += 1
+            if command == '/ip/hotspot/user/add':
+                name = attributes.get('name')
+                if name in self._names:
+                    return [['!trap', '=message=failure: already have user with this name'], ['!done']]
+                item_id = f'*{self._next_id:X}'
+                self._next_id += 1
+                self.users[item_id] = {**attributes, '.id': item_id}
+                self._names[name] = item_id
+                return [['!done', f'=ret={item_id}']]
+            if command == '/ip/hotspot/user/remove':
+                item_ids = attributes.get('numbers', attributes.get('.id', '')).split(',')
+                if not all(item_id in self.users for item_id in item_ids):
+                    return [['!trap', '=message=no such item'], ['!done']]
+                for item_id in item_ids:
+                    del self._names[self.users.pop(item_id)['name']]
+                return [['!done']]
+            if command == '/ip/hotspot/user/print':
+                return [
+                    ['!re'] + [f'={key}={value}' for key, value in user.items()]
+                    for user in self.users.values()
+                    if all(user.get(key) == value for key, value in queries.items())
+                ] + [['!done']]
+            return [['!trap', f'=message=no such command ({command})', '=category=0'], ['!done']]
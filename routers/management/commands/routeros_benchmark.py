@@ -0,0 +1,50 @@
+"""
+Management command to measure hotspot user push throughput against the fake RouterOS API server
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from routers.api import RouterOSConnection
+from routers.fake import FakeRouterOSServer
+from routers.sync import add_users, remove_users
+
+
+class Command(BaseCommand):
+    help = (
+        'Add and remove hotspot users on an in-process fake RouterOS API server, one command per '
+        'round trip and in pipelined batches, and report users per second.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5000)
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--latency-ms', type=float, default=20, help='Simulated round trip to the router')
+
+    def _push(self, conn, users, batch_size):
+        started = time.perf_counter()
+        item_ids = []
+        for start in range(0, len(users), batch_size):
+            item_ids.extend(result[1]['ret'] for result in add_users(conn, users[start:start + batch_size]))
+        added = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for start in range(0, len(item_ids), batch_size):
+            remove_users(conn, item_ids[start:start + batch_size])
+        return added, time.perf_counter() - started
+
+    def handle(self, *args, **options):
+        users = [
+            {'name': f'bench{i}', 'password': f'pw{i}', 'profile': 'profile_1', 'comment': f'BENCH{i}'}
+            for i in range(options['users'])
+        ]
+        with FakeRouterOSServer(latency=options['latency_ms'] / 1000) as server:
+            conn = RouterOSConnection('127.0.0.1', server.port, server.username, server.password)
+            try:
+                for label, batch_size in (('one at a time', 1), (f"batches of {options['batch_size']}", options['batch_size'])):
+                    added, removed = self._push(conn, users, batch_size)
+                    self.stdout.write(
+                        f"{label:>20}: add {len(users) / added:,.0f} users/s, remove {len(users) / removed:,.0f} users/s"
+                    )
+            finally:
+                conn.close()
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.7 on 2026-10-19 15:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('accounts', '0009_postgresql_add_user_fields'),
+        ('tickets', '0004_safe_fix_ticket_models'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Router',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('host', models.CharField(help_text="Address of the router's API service", max_length=255)),
+                ('api_port', models.PositiveIntegerField(default=8728)),
+                ('username', models.CharField(max_length=100)),
+                ('password', models.TextField(blank=True, help_text='API password (encrypted)')),
+                ('is_active', models.BooleanField(default=True)),
+                ('last_sync_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='routers', to='accounts.provider')),
+            ],
+            options={
+                'ordering': ['provider', 'name'],
+                'unique_together': {('provider', 'name')},
+            },
+        ),
+        migrations.CreateModel(
+            name='TicketRouterSync',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('synced', 'Synced'), ('removed', 'Removed'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('router_item_id', models.CharField(blank=True, max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('router', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ticket_syncs', to='routers.router')),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='router_syncs', to='tickets.ticket')),
+            ],
+            options={
+                'unique_together': {('ticket', 'router')},
+                'indexes': [models.Index(fields=['router', 'state'], name='routers_tic_router__af8a61_idx')],
+            },
+        ),
+    ]
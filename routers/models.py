@@ -0,0 +1,65 @@
+from django.db import models
+from django.utils import timezone
+
+from accounts.encryption import encryption_service
+
+
+class Router(models.Model):
+    """A provider's MikroTik router, reached over the RouterOS API"""
+    provider = models.ForeignKey('accounts.Provider', on_delete=models.CASCADE, related_name='routers')
+    name = models.CharField(max_length=100)
+    host = models.CharField(max_length=255, help_text="Address of the router's API service")
+    api_port = models.PositiveIntegerField(default=8728)
+    username = models.CharField(max_length=100)
+    password = models.TextField(blank=True, help_text="API password (encrypted)")
+    is_active = models.BooleanField(default=True)
+
+    # Sync status
+    last_sync_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.provider.business_name} - {self.name}"
+
+    def set_password(self, password):
+        self.password = encryption_service.encrypt(password) or ''
+
+    def get_password(self):
+        return encryption_service.decrypt(self.password) or ''
+
+    class Meta:
+        ordering = ['provider', 'name']
+        unique_together = ['provider', 'name']
+
+
+class TicketRouterSync(models.Model):
+    """Whether a ticket's hotspot user is present on a router"""
+    STATE_CHOICES = [
+        ('pending', 'Pending'),
+        ('synced', 'Synced'),
+        ('removed', 'Removed'),
+        ('failed', 'Failed'),
+    ]
+
+    ticket = models.ForeignKey('tickets.Ticket', on_delete=models.CASCADE, related_name='router_syncs')
+    router = models.ForeignKey(Router, on_delete=models.CASCADE, related_name='ticket_syncs')
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default='pending')
+
+    # The router's .id for the hotspot user, used to remove it
+    router_item_id = models.CharField(max_length=20, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    synced_at = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.ticket_id} on {self.router_id}: {self.state}"
+
+    class Meta:
+        unique_together = ['ticket', 'router']
+        indexes = [
+            models.Index(fields=['router', 'state']),
+        ]
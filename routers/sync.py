@@ -0,0 +1,183 @@
+"""
+Ticket sync engine: keeps each router's hotspot users in line with tickets
+
+Every ticket of a provider gets a TicketRouterSync row per router. Active
+and used tickets must exist as hotspot users on the router, expired and
+cancelled ones must not. A sync run:
+
+  1. queues a pending row for every present ticket the router has not seen,
+  2. pushes pending (and retryable failed) rows with /ip/hotspot/user/add,
+  3. removes the users of synced rows whose tickets have gone, by the .id
+     the router returned when adding them (looked up by name if unknown).
+
+Commands go out in pipelined batches of ROUTEROS_SYNC_BATCH_SIZE over a
+pooled connection, and each batch's rows are saved with one bulk update.
+"""
+from itertools import islice
+import time
+import logging
+
+from django.conf import settings
+from django.utils import timezone
+
+from tickets.models import Ticket
+from .api import RouterOSError, RouterOSTrap, router_pool
+from .models import Router, TicketRouterSync
+
+logger = logging.getLogger(__name__)
+
+PRESENT_STATUSES = ('active', 'used')
+ABSENT_STATUSES = ('expired', 'cancelled')
+
+USER_MENU = '/ip/hotspot/user'
+SYNC_FIELDS = ['state', 'router_item_id', 'attempts', 'last_error', 'synced_at', 'updated_at']
+
+
+def hotspot_user(ticket):
+    """Get the hotspot user attributes for a ticket"""
+    return {
+        'name': ticket.username,
+        'password': ticket.password,
+        'profile': f"profile_{ticket.ticket_type_id}",
+        'comment': ticket.code,
+    }
+
+
+def add_users(conn, users):
+    """Add hotspot users in one pipelined batch; returns a result or RouterOSTrap per user"""
+    return conn.pipeline([(f'{USER_MENU}/add', user, None) for user in users])
+
+
+def remove_users(conn, item_ids):
+    """Remove hotspot users by .id in one pipelined batch"""
+    return conn.pipeline([(f'{USER_MENU}/remove', {'numbers': item_id}, None) for item_id in item_ids])
+
+
+def find_users(conn, names):
+    """Get the .id of each named hotspot user ('' if the router has none)"""
+    results = conn.pipeline([
+        (f'{USER_MENU}/print', {'.proplist': '.id'}, {'name': name}) for name in names
+    ])
+    return [
+        result[0][0].get('.id', '') if not isinstance(result, RouterOSTrap) and result[0] else ''
+        for result in results
+    ]
+
+
+def _batches(queryset, size):
+    rows = queryset.iterator(chunk_size=size)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class RouterSyncEngine:
+    """Push ticket changes to routers over their pooled API connections"""
+
+    def __init__(self, pool=None):
+        self.pool = pool or router_pool
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'ROUTEROS_SYNC_BATCH_SIZE', 200)
+
+    @property
+    def max_attempts(self):
+        return getattr(settings, 'ROUTEROS_SYNC_MAX_ATTEMPTS', 5)
+
+    def queue_tickets(self, router):
+        """Create pending rows for present tickets the router has no row for"""
+        ticket_ids = Ticket.objects.filter(
+            provider_id=router.provider_id, status__in=PRESENT_STATUSES
+        ).exclude(router_syncs__router=router).values_list('id', flat=True)
+        rows = [TicketRouterSync(ticket_id=ticket_id, router=router) for ticket_id in ticket_ids]
+        TicketRouterSync.objects.bulk_create(rows, batch_size=1000, ignore_conflicts=True)
+        return len(rows)
+
+    def sync_router(self, router):
+        """Bring a router's hotspot users in line with its provider's tickets; returns counts"""
+        started = time.monotonic()
+        stats = {'queued': self.queue_tickets(router), 'added': 0, 'removed': 0, 'failed': 0}
+
+        # Rows never pushed whose tickets are already gone need no command
+        TicketRouterSync.objects.filter(
+            router=router, state='pending', ticket__status__in=ABSENT_STATUSES
+        ).update(state='removed', updated_at=timezone.now())
+
+        to_add = TicketRouterSync.objects.filter(
+            router=router, state__in=('pending', 'failed'), attempts__lt=self.max_attempts,
+            ticket__status__in=PRESENT_STATUSES
+        ).select_related('ticket').order_by('id')
+        to_remove = TicketRouterSync.objects.filter(
+            router=router, state__in=('synced', 'failed'), attempts__lt=self.max_attempts,
+            ticket__status__in=ABSENT_STATUSES
+        ).select_related('ticket').order_by('id')
+
+        try:
+            with self.pool.connection(router) as conn:
+                for batch in _batches(to_add, self.batch_size):
+                    self._add_batch(conn, batch, stats)
+                for batch in _batches(to_remove, self.batch_size):
+                    self._remove_batch(conn, batch, stats)
+        except RouterOSError as e:
+            logger.warning(f"Sync with router {router.id} ({router.host}) failed: {e}")
+            Router.objects.filter(pk=router.pk).update(last_error=str(e))
+            raise
+
+        Router.objects.filter(pk=router.pk).update(last_sync_at=timezone.now(), last_error='')
+        logger.info(
+            f"Synced router {router.id}: {stats['added']} added, {stats['removed']} removed, "
+            f"{stats['failed']} failed in {time.monotonic() - started:.2f}s"
+        )
+        return stats
+
+    def _add_batch(self, conn, rows, stats):
+        now = timezone.now()
+        results = add_users(conn, [hotspot_user(row.ticket) for row in rows])
+        for row, result in zip(rows, results):
+            row.updated_at = now
+            if isinstance(result, RouterOSTrap) and 'already have' not in str(result):
+                self._failed(row, result, stats)
+                continue
+            # A user already on the router (e.g. added by hand) counts as synced;
+            # its .id is looked up if it ever has to be removed
+            row.router_item_id = '' if isinstance(result, RouterOSTrap) else result[1].get('ret', '')
+            row.state = 'synced'
+            row.synced_at = now
+            row.last_error = ''
+            stats['added'] += 1
+        TicketRouterSync.objects.bulk_update(rows, SYNC_FIELDS)
+
+    def _remove_batch(self, conn, rows, stats):
+        now = timezone.now()
+        unknown = [row for row in rows if not row.router_item_id]
+        if unknown:
+            for row, item_id in zip(unknown, find_users(conn, [row.ticket.username for row in unknown])):
+                row.router_item_id = item_id
+
+        present = [row for row in rows if row.router_item_id]
+        results = remove_users(conn, [row.router_item_id for row in present])
+        outcomes = dict(zip((row.pk for row in present), results))
+        for row in rows:
+            row.updated_at = now
+            result = outcomes.get(row.pk)
+            if isinstance(result, RouterOSTrap) and 'no such item' not in str(result):
+                self._failed(row, result, stats)
+                continue
+            row.state = 'removed'
+            row.router_item_id = ''
+            row.last_error = ''
+            stats['removed'] += 1
+        TicketRouterSync.objects.bulk_update(rows, SYNC_FIELDS)
+
+    def _failed(self, row, error, stats):
+        row.state = 'failed'
+        row.attempts += 1
+        row.last_error = str(error)
+        stats['failed'] += 1
+
+
+# Global sync engine
+sync_engine = RouterSyncEngine()
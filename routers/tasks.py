@@ -0,0 +1,23 @@
+"""
+Celery tasks for routers app
+"""
+from celery import shared_task
+
+from .api import RouterOSError
+from .models import Router
+from .sync import sync_engine
+
+
+@shared_task
+def sync_router(router_id):
+    """Sync ticket hotspot users to one router"""
+    try:
+        router = Router.objects.select_related('provider').get(id=router_id, is_active=True)
+    except Router.DoesNotExist:
+        return f"Router {router_id} not found"
+
+    try:
+        stats = sync_engine.sync_router(router)
+    except RouterOSError as e:
+        return f"Router {router_id} unreachable: {e}"
+    return f"Router {router_id}: {stats['added']} added, {stats['removed']} removed, {stats['failed']} failed"
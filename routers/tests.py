@@ -0,0 +1,105 @@
+"""
+Tests for routers app
+"""
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from payments.tests import create_provider
+from routers.api import RouterConnectionPool, RouterOSConnection, RouterOSTrap, encode_length
+from routers.fake import FakeRouterOSServer
+from routers.models import Router, TicketRouterSync
+from routers.sync import RouterSyncEngine
+from tickets.models import Ticket, TicketType
+
+
+class RouterOSProtocolTest(TestCase):
+    """Test the API client against the fake RouterOS server"""
+
+    def setUp(self):
+        self.server = FakeRouterOSServer().start()
+        self.addCleanup(self.server.stop)
+
+    def test_length_encoding(self):
+        self.assertEqual(encode_length(0x7F), b'\x7f')
+        self.assertEqual(encode_length(0x80), b'\x80\x80')
+        self.assertEqual(encode_length(0x4000), b'\xc0\x40\x00')
+
+    def test_pipelined_commands_get_their_own_replies(self):
+        conn = RouterOSConnection('127.0.0.1', self.server.port, 'admin', 'secret')
+        self.addCleanup(conn.close)
+
+        results = conn.pipeline([
+            ('/ip/hotspot/user/add', {'name': 'a', 'password': 'x'}, None),
+            ('/ip/hotspot/user/add', {'name': 'a', 'password': 'y'}, None),
+            ('/ip/hotspot/user/add', {'name': 'b', 'password': 'z'}, None),
+            ('/ip/hotspot/user/print', None, {'name': 'b'}),
+        ])
+        self.assertEqual(results[0][1]['ret'], '*1')
+        self.assertIsInstance(results[1], RouterOSTrap)
+        self.assertEqual(results[2][1]['ret'], '*2')
+        self.assertEqual(results[3][0][0]['password'], 'z')
+
+    def test_wrong_password_is_rejected(self):
+        with self.assertRaises(RouterOSTrap):
+            RouterOSConnection('127.0.0.1', self.server.port, 'admin', 'wrong')
+
+
+@override_settings(ROUTEROS_SYNC_BATCH_SIZE=3)
+class RouterSyncEngineTest(TestCase):
+    """Test tickets are pushed to and removed from routers in pipelined batches"""
+
+    def setUp(self):
+        self.server = FakeRouterOSServer().start()
+        self.addCleanup(self.server.stop)
+        self.provider = create_provider()
+        self.ticket_type = TicketType.objects.create(
+            provider=self.provider, name='1 Hour WiFi', type='time', duration_hours=1, price=20
+        )
+        self.router = Router(provider=self.provider, name='Main', host='127.0.0.1', api_port=self.server.port,
+                             username='admin')
+        self.router.set_password('secret')
+        self.router.save()
+        self.pool = RouterConnectionPool()
+        self.addCleanup(self.pool.close_all)
+        self.engine = RouterSyncEngine(pool=self.pool)
+
+    def create_tickets(self, count, status='active'):
+        return [
+            Ticket.objects.create(
+                provider=self.provider, ticket_type=self.ticket_type, status=status,
+                expires_at=timezone.now() + timedelta(hours=1)
+            )
+            for _ in range(count)
+        ]
+
+    def test_sync_adds_then_removes_users(self):
+        tickets = self.create_tickets(7)
+        self.create_tickets(2, status='cancelled')
+
+        stats = self.engine.sync_router(self.router)
+        self.assertEqual((stats['queued'], stats['added'], stats['failed']), (7, 7, 0))
+        self.assertEqual(
+            sorted(user['name'] for user in self.server.users.values()),
+            sorted(ticket.username for ticket in tickets)
+        )
+        self.assertEqual(TicketRouterSync.objects.filter(state='synced').exclude(router_item_id='').count(), 7)
+
+        Ticket.objects.filter(pk__in=[ticket.pk for ticket in tickets[:4]]).update(status='expired')
+        stats = self.engine.sync_router(self.router)
+        self.assertEqual((stats['queued'], stats['added'], stats['removed']), (0, 0, 4))
+        self.assertEqual(len(self.server.users), 3)
+        # Both runs reused one pooled login
+        self.assertEqual(self.server.logins, 1)
+
+    def test_users_already_on_router_count_as_synced(self):
+        ticket, = self.create_tickets(1)
+        with self.pool.connection(self.router) as conn:
+            conn.talk('/ip/hotspot/user/add', {'name': ticket.username, 'password': 'manual'})
+
+        self.assertEqual(self.engine.sync_router(self.router)['added'], 1)
+        Ticket.objects.filter(pk=ticket.pk).update(status='expired')
+        # The .id is unknown, so it is looked up by name before removing
+        self.assertEqual(self.engine.sync_router(self.router)['removed'], 1)
+        self.assertEqual(self.server.users, {})
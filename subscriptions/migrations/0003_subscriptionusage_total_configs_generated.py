@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-19 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0002_providersubscription_providersubscriptionplan_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionusage',
+            name='total_configs_generated',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -160,6 +160,7 @@ class SubscriptionUsage(models.Model):
     total_tickets_sold = models.IntegerField(default=0)
     total_revenue = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     total_end_users = models.IntegerField(default=0)
+    total_configs_generated = models.IntegerField(default=0)
     
     # Last reset
     last_reset_date = models.DateTimeField(auto_now_add=True, null=True, blank=True)
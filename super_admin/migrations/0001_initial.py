@@ -0,0 +1,88 @@
+# Generated by Django 4.2.7 on 2026-10-19 13:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('accounts', '0009_postgresql_add_user_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlatformAnalytics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('total_providers', models.IntegerField(default=0)),
+                ('active_providers', models.IntegerField(default=0)),
+                ('new_providers', models.IntegerField(default=0)),
+                ('total_tickets_generated', models.IntegerField(default=0)),
+                ('total_tickets_sold', models.IntegerField(default=0)),
+                ('total_tickets_active', models.IntegerField(default=0)),
+                ('total_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('platform_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('provider_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('total_end_users', models.IntegerField(default=0)),
+                ('active_end_users', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Platform Analytics',
+                'verbose_name_plural': 'Platform Analytics',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='SystemSettings',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('value', models.TextField()),
+                ('description', models.TextField(blank=True, null=True)),
+                ('data_type', models.CharField(choices=[('string', 'String'), ('integer', 'Integer'), ('boolean', 'Boolean'), ('json', 'JSON')], default='string', max_length=20)),
+                ('is_public', models.BooleanField(default=False, help_text='Can be accessed by providers')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'System Setting',
+                'verbose_name_plural': 'System Settings',
+            },
+        ),
+        migrations.CreateModel(
+            name='SystemNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=200)),
+                ('message', models.TextField()),
+                ('notification_type', models.CharField(choices=[('info', 'Information'), ('warning', 'Warning'), ('error', 'Error'), ('success', 'Success')], default='info', max_length=20)),
+                ('is_active', models.BooleanField(default=True)),
+                ('is_global', models.BooleanField(default=False, help_text='Show to all users')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('target_providers', models.ManyToManyField(blank=True, related_name='notifications', to='accounts.provider')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ProviderCommission',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('commission_rate', models.DecimalField(decimal_places=2, help_text='Commission rate as percentage', max_digits=5)),
+                ('min_commission', models.DecimalField(decimal_places=2, default=0, max_digits=10)),
+                ('max_commission', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('provider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='commissions', to='accounts.provider')),
+            ],
+        ),
+    ]
@@ -25,6 +25,7 @@ urlpatterns = [
     # System Management
     path('settings/', views.system_settings, name='system_settings'),
     path('payments/', views.payment_monitoring, name='payment_monitoring'),
+    path('payments/gateways/', views.gateway_calls, name='gateway_calls'),
     path('logs/', views.platform_logs, name='platform_logs'),
     path('health/', views.system_health, name='system_health'),
     
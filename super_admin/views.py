@@ -11,6 +11,10 @@ from accounts.models import User, Provider
 from tickets.models import Ticket, TicketSale, TicketType
 from subscriptions.models import ProviderSubscription, ProviderSubscriptionPlan
 from payments.models import Payment
+from payments.ledger import get_balances, get_platform_totals, get_sales_total
+from payments.latency import latency_histograms, GROUP_FIELDS as LATENCY_GROUP_FIELDS
+from payments.tracing import gateway_tracer
+from payments.gateway_health import gateway_health
 
 def is_super_admin(user):
     return user.is_authenticated and user.is_superuser
@@ -25,7 +29,9 @@ def super_admin_dashboard(request):
     pending_providers = Provider.objects.filter(status='pending').count()
     
     total_tickets_sold = TicketSale.objects.aggregate(total=Sum('quantity'))['total'] or 0
-    total_revenue = TicketSale.objects.aggregate(total=Sum('total_amount'))['total'] or 0
+    ledger_totals = get_platform_totals()
+    total_revenue = ledger_totals['clearing']['total_debit']
+    platform_revenue = ledger_totals['platform_commission']['balance'] + ledger_totals['platform_fees']['balance']
     total_end_users = User.objects.filter(user_type='end_user').count()
     
     # Recent providers
@@ -41,6 +47,7 @@ def super_admin_dashboard(request):
         'pending_providers': pending_providers,
         'total_tickets_sold': total_tickets_sold,
         'total_revenue': total_revenue,
+        'platform_revenue': platform_revenue,
         'total_end_users': total_end_users,
         'recent_providers': recent_providers,
         'recent_sales': recent_sales,
@@ -86,7 +93,7 @@ def provider_detail(request, provider_id):
     provider_sales = TicketSale.objects.filter(ticket__provider=provider)
     
     total_tickets = provider_tickets.count()
-    total_sales = provider_sales.aggregate(total=Sum('total_amount'))['total'] or 0
+    total_sales = get_sales_total(provider.id)
     total_quantity = provider_sales.aggregate(total=Sum('quantity'))['total'] or 0
     
     context = {
@@ -94,6 +101,7 @@ def provider_detail(request, provider_id):
         'provider': provider,
         'total_tickets': total_tickets,
         'total_sales': total_sales,
+        'balances': get_balances(provider.id),
         'total_quantity': total_quantity,
     }
     return render(request, 'super_admin/provider_detail.html', context)
@@ -203,10 +211,13 @@ def create_provider(request):
 @user_passes_test(is_super_admin)
 def revenue_reports(request):
     """Revenue reports"""
-    total_revenue = TicketSale.objects.aggregate(total=Sum('total_amount'))['total'] or 0
+    ledger_totals = get_platform_totals()
+    total_revenue = ledger_totals['clearing']['total_debit']
+    platform_revenue = ledger_totals['platform_commission']['balance'] + ledger_totals['platform_fees']['balance']
     context = {
         'page_title': 'Revenue Reports',
         'total_revenue': total_revenue,
+        'platform_revenue': platform_revenue,
     }
     return render(request, 'super_admin/revenue_reports.html', context)
 
@@ -235,12 +246,48 @@ def provider_analytics(request):
 @login_required
 @user_passes_test(is_super_admin)
 def payment_monitoring(request):
-    """Payment monitoring"""
+    """Payment monitoring: payment-to-ticket latency per provider or gateway"""
+    try:
+        hours = min(max(int(request.GET.get('hours', 24)), 1), 24 * 31)
+    except ValueError:
+        hours = 24
+    group_by = request.GET.get('group_by', 'provider')
+    if group_by not in LATENCY_GROUP_FIELDS:
+        group_by = 'provider'
+    
+    since = timezone.now() - timedelta(hours=hours)
+    latency = latency_histograms(since, group_by=group_by)
+    status_counts = dict(
+        Payment.objects.filter(created_at__gte=since).values_list('status').annotate(count=Count('id')).order_by()
+    )
+    
     context = {
         'page_title': 'Payment Monitoring',
+        'hours': hours,
+        'group_by': group_by,
+        'buckets': latency['buckets'],
+        'intervals': [(name.replace('_', ' ').capitalize(), rows) for name, rows in latency['intervals'].items()],
+        'status_counts': status_counts,
     }
     return render(request, 'super_admin/payment_monitoring.html', context)
 
+@login_required
+@user_passes_test(is_super_admin)
+def gateway_calls(request):
+    """Recent Daraja/Pesapal calls and rolling per-endpoint aggregates for this process"""
+    gateway = request.GET.get('gateway') or None
+    context = {
+        'page_title': 'Gateway Calls',
+        'gateway': gateway,
+        'aggregates': [row for row in gateway_tracer.aggregates() if not gateway or row['gateway'] == gateway],
+        'recent_calls': gateway_tracer.recent(limit=200, gateway=gateway),
+        'circuits': gateway_health.snapshot(),
+        'window_minutes': gateway_tracer.window_minutes,
+    }
+    if request.GET.get('format') == 'json':
+        return JsonResponse({key: value for key, value in context.items() if key != 'page_title'}, safe=False)
+    return render(request, 'super_admin/gateway_calls.html', context)
+
 @login_required
 @user_passes_test(is_super_admin)
 def platform_logs(request):
@@ -4,7 +4,7 @@ Signals for tickets app
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
-from .models import Ticket, TicketSale
+from .models import Ticket
 
 
 @receiver(post_save, sender=Ticket)
@@ -12,7 +12,7 @@ def ticket_post_save(sender, instance, created, **kwargs):
     """Handle ticket post-save events"""
     if created:
         # Set expiry date for time-based tickets
-        if (instance.ticket_type.ticket_type == 'time' and 
+        if (instance.ticket_type.type == 'time' and 
             instance.ticket_type.duration_hours and 
             not instance.expires_at):
             instance.expires_at = timezone.now() + timezone.timedelta(
@@ -21,17 +21,6 @@ def ticket_post_save(sender, instance, created, **kwargs):
             instance.save(update_fields=['expires_at'])
 
 
-@receiver(post_save, sender=TicketSale)
-def ticket_sale_post_save(sender, instance, created, **kwargs):
-    """Handle ticket sale post-save events"""
-    if created:
-        # Update ticket status when sold
-        if instance.ticket.status == 'active':
-            instance.ticket.status = 'used'
-            instance.ticket.activated_at = timezone.now()
-            instance.ticket.save(update_fields=['status', 'activated_at'])
-
-
 @receiver(pre_save, sender=Ticket)
 def ticket_pre_save(sender, instance, **kwargs):
     """Handle ticket pre-save events"""
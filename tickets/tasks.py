@@ -56,23 +56,15 @@ def generate_ticket_batch(batch_id):
 
 @shared_task
 def sync_tickets_to_router():
-    """Sync active tickets to MikroTik router"""
-    # This would integrate with MikroTik API
-    # For now, just mark tickets as synced
-    active_tickets = Ticket.objects.filter(
-        status='active',
-        is_synced_to_router=False
-    )
+    """Queue a ticket sync for every active MikroTik router"""
+    from routers.models import Router
+    from routers.tasks import sync_router
     
-    count = 0
-    for ticket in active_tickets:
-        # Here you would implement actual MikroTik API integration
-        # For now, just mark as synced
-        ticket.is_synced_to_router = True
-        ticket.save(update_fields=['is_synced_to_router'])
-        count += 1
+    router_ids = list(Router.objects.filter(is_active=True).values_list('id', flat=True))
+    for router_id in router_ids:
+        sync_router.delay(router_id)
     
-    return f"Synced {count} tickets to router"
+    return f"Queued ticket sync for {len(router_ids)} routers"
 
 
 @shared_task